@@ -0,0 +1,188 @@
+"""
+Admission control of workspace uploads and job submissions
+
+Bursts of uploads fill the disk, bursts of jobs overcommit the memory. The admission controller
+refuses such requests while the server is saturated, before their body is received:
+    - uploads and imports (ingests) with 503 while the free space under the BASE_DIR, minus the
+      announced size of the ingests in flight, would drop below the minimum, and with 429 while a
+      worker receives the maximum amount of ingests
+    - job submissions with 503 while the available memory is below the minimum, and with 429 while
+      the maximum amount of jobs is running or the maximum amount of jobs is queued. Queued jobs
+      take no memory until the dispatcher starts them, they are bounded separately
+Refusals carry `Retry-After`. The measurements are refreshed at most once per `refresh_interval`,
+a burst of requests costs one measurement.
+"""
+from asyncio import Lock
+from contextlib import asynccontextmanager
+from shutil import disk_usage
+from time import monotonic
+from typing import AsyncIterator, Awaitable, Callable, Optional
+import logging
+
+from psutil import virtual_memory
+
+from ocrd_webapi import database as db
+from ocrd_webapi.constants import (
+    ADMISSION_MAX_INGESTS,
+    ADMISSION_MAX_JOBS,
+    ADMISSION_MAX_QUEUED,
+    ADMISSION_MIN_FREE_DISK,
+    ADMISSION_MIN_FREE_MEMORY,
+    ADMISSION_RETRY_AFTER,
+    BASE_DIR,
+    PROCESSORS_ROUTER,
+    WORKFLOWS_ROUTER,
+    WORKSPACES_ROUTER,
+)
+from ocrd_webapi.exceptions import AdmissionRefusedError
+from ocrd_webapi.models.discovery import AdmissionState
+
+__all__ = [
+    "AdmissionController",
+    "classify_request",
+]
+
+
+def classify_request(method: str, path: str) -> Optional[str]:
+    """
+    Returns `ingest` for requests storing workspaces, `job` for job submissions, otherwise None
+    """
+    if method in ["POST", "PUT", "PATCH"] and path.startswith(f"/{WORKSPACES_ROUTER}"):
+        return "ingest"
+    # Runs and resumes of workflows (not the upload of a workflow script) and processing jobs
+    if method == "POST" and path.startswith((f"/{WORKFLOWS_ROUTER}/", f"/{PROCESSORS_ROUTER}/")):
+        return "job"
+    return None
+
+
+class AdmissionController:
+    def __init__(self, base_dir: str = BASE_DIR, min_free_disk: int = ADMISSION_MIN_FREE_DISK,
+                 max_ingests: int = ADMISSION_MAX_INGESTS,
+                 min_free_memory: int = ADMISSION_MIN_FREE_MEMORY,
+                 max_jobs: int = ADMISSION_MAX_JOBS, max_queued: int = ADMISSION_MAX_QUEUED,
+                 retry_after: int = ADMISSION_RETRY_AFTER, refresh_interval: float = 1.0,
+                 get_disk_usage: Callable = disk_usage, get_memory: Callable = virtual_memory,
+                 count_jobs: Callable[[], Awaitable[int]] = None,
+                 count_queued: Callable[[], Awaitable[int]] = None, log_level: str = "INFO"):
+        self.log = logging.getLogger(__name__)
+        self.log.setLevel(logging.getLevelName(log_level))
+        self.base_dir = base_dir
+        self.min_free_disk = min_free_disk
+        self.max_ingests = max_ingests
+        self.min_free_memory = min_free_memory
+        self.max_jobs = max_jobs
+        self.max_queued = max_queued
+        self.retry_after = retry_after
+        self.refresh_interval = refresh_interval
+        self._get_disk_usage = get_disk_usage
+        self._get_memory = get_memory
+        self._count_jobs = count_jobs or db.count_running_jobs
+        self._count_queued = count_queued or db.count_queued_jobs
+        # Ingests received by this worker and the bytes they announced
+        self.ingests_in_flight = 0
+        self._reserved_bytes = 0
+        # The latest measurements
+        self._disk_free = 0
+        self._memory_available = 0
+        self._jobs = 0
+        self._queued = 0
+        self._measured = None
+        self._refresh_lock = Lock()
+
+    async def refresh(self, force: bool = False) -> None:
+        """
+        Measure the free disk space, the available memory and the running and queued jobs, unless
+        they were measured within the `refresh_interval`
+        """
+        async with self._refresh_lock:
+            if not force and self._measured is not None \
+                    and monotonic() - self._measured < self.refresh_interval:
+                return
+            self._disk_free = self._get_disk_usage(self.base_dir).free
+            self._memory_available = self._get_memory().available
+            if self.max_jobs:
+                try:
+                    self._jobs = await self._count_jobs()
+                except Exception as error:
+                    # Keeps the previous count, the database is not a reason to refuse requests
+                    self.log.error(f"Failed to count the running jobs: {error}")
+            if self.max_queued:
+                try:
+                    self._queued = await self._count_queued()
+                except Exception as error:
+                    self.log.error(f"Failed to count the queued jobs: {error}")
+            self._measured = monotonic()
+
+    def _disk_left(self) -> int:
+        return self._disk_free - self._reserved_bytes
+
+    async def admit_ingest(self, content_length: int = 0) -> None:
+        """
+        Raises:
+            AdmissionRefusedError: if the ingest of `content_length` bytes can not be received now
+        """
+        await self.refresh()
+        if self.max_ingests and self.ingests_in_flight >= self.max_ingests:
+            raise AdmissionRefusedError(429, f"{self.ingests_in_flight} uploads in flight",
+                                        self.retry_after)
+        if self.min_free_disk and self._disk_left() - content_length < self.min_free_disk:
+            raise AdmissionRefusedError(
+                503,
+                f"{self._disk_left()} bytes of disk space left, {content_length} bytes announced",
+                self.retry_after
+            )
+
+    @asynccontextmanager
+    async def ingest(self, content_length: int = 0) -> AsyncIterator[None]:
+        """
+        Admit an ingest and count it as in flight (with its announced bytes) until it was received
+
+        Raises:
+            AdmissionRefusedError: if the ingest can not be received now
+        """
+        await self.admit_ingest(content_length)
+        self.ingests_in_flight += 1
+        self._reserved_bytes += content_length
+        try:
+            yield
+        finally:
+            self.ingests_in_flight -= 1
+            self._reserved_bytes -= content_length
+
+    async def admit_job(self) -> None:
+        """
+        Raises:
+            AdmissionRefusedError: if a job can not be submitted now
+        """
+        await self.refresh()
+        if self.max_jobs and self._jobs >= self.max_jobs:
+            raise AdmissionRefusedError(429, f"{self._jobs} jobs running", self.retry_after)
+        if self.max_queued and self._queued >= self.max_queued:
+            raise AdmissionRefusedError(429, f"{self._queued} jobs queued", self.retry_after)
+        if self.min_free_memory and self._memory_available < self.min_free_memory:
+            raise AdmissionRefusedError(
+                503, f"{self._memory_available} bytes of memory available", self.retry_after
+            )
+        # New jobs are queued first, counted until the next measurement so a burst does not pass
+        # within one refresh interval
+        self._queued += 1
+
+    async def get_state(self) -> AdmissionState:
+        await self.refresh()
+        return AdmissionState(
+            accepting_ingests=(not self.max_ingests or self.ingests_in_flight < self.max_ingests)
+            and (not self.min_free_disk or self._disk_left() >= self.min_free_disk),
+            accepting_jobs=(not self.max_jobs or self._jobs < self.max_jobs)
+            and (not self.max_queued or self._queued < self.max_queued)
+            and (not self.min_free_memory or self._memory_available >= self.min_free_memory),
+            disk_free=self._disk_left(),
+            min_free_disk=self.min_free_disk,
+            ingests_in_flight=self.ingests_in_flight,
+            max_ingests=self.max_ingests,
+            memory_available=self._memory_available,
+            min_free_memory=self.min_free_memory,
+            jobs_running=self._jobs,
+            max_jobs=self.max_jobs,
+            jobs_queued=self._queued,
+            max_queued=self.max_queued,
+        )
@@ -1,9 +1,12 @@
+from base64 import b64decode
+from binascii import Error as DecodeError
 from hashlib import sha512
 from random import random
-from typing import Tuple
+from typing import Tuple, Union
 
+from .constants import USER_QUOTA_BYTES, USER_QUOTA_FILES
 from .database import create_user, get_user
-from .exceptions import AuthenticationError, RegistrationError
+from .exceptions import AuthenticationError, QuotaExceededError, RegistrationError
 
 
 async def authenticate_user(email: str, password: str):
@@ -35,6 +38,52 @@ async def register_user(email: str, password: str, approved_user=False):
         raise RegistrationError(f"Failed to register user: {email}")
 
 
+async def check_storage_quota(email: str, incoming_bytes: int = 0, incoming_files: int = 0) -> None:
+    """
+    Raise a QuotaExceededError if storing `incoming_bytes` (and `incoming_files`) more would exceed
+    the storage quota of the user or if the user already reached the file quota
+    """
+    db_user = await get_user(email=email)
+    if not db_user:
+        raise AuthenticationError(f"User not found: {email}")
+    quota_bytes, quota_files = get_storage_quota(db_user)
+    if quota_bytes and db_user.used_bytes + incoming_bytes > quota_bytes:
+        raise QuotaExceededError(
+            f"{incoming_bytes} bytes exceed the storage quota of {email}: "
+            f"{db_user.used_bytes} of {quota_bytes} bytes used"
+        )
+    if quota_files and db_user.used_files + max(incoming_files, 1) > quota_files:
+        raise QuotaExceededError(
+            f"{max(incoming_files, 1)} files exceed the file quota of {email}: "
+            f"{db_user.used_files} of {quota_files} files used"
+        )
+
+
+def get_storage_quota(db_user) -> Tuple[int, int]:
+    """
+    Returns the byte and file quota of the user, 0 means unlimited
+    """
+    quota_bytes = db_user.quota_bytes if db_user.quota_bytes is not None else USER_QUOTA_BYTES
+    quota_files = db_user.quota_files if db_user.quota_files is not None else USER_QUOTA_FILES
+    return quota_bytes, quota_files
+
+
+def parse_basic_credentials(authorization: str) -> Union[Tuple[str, str], None]:
+    """
+    Returns e-mail and password of a HTTP basic `Authorization` header, None if there are none
+    """
+    scheme, _, encoded = (authorization or "").partition(" ")
+    if scheme.lower() != "basic":
+        return None
+    try:
+        email, separator, password = b64decode(encoded).decode("utf-8").partition(":")
+    except (DecodeError, UnicodeDecodeError):
+        return None
+    if not separator:
+        return None
+    return email, password
+
+
 def encrypt_password(plain_password: str) -> Tuple[str, str]:
     salt = get_random_salt()
     hashed_password = get_hex_digest(salt, plain_password)
@@ -1,12 +1,71 @@
-from os import getenv
+from os import cpu_count, getenv
 from dotenv import load_dotenv
 
 __all__ = [
+    'ADMISSION_MAX_INGESTS',
+    'ADMISSION_MAX_JOBS',
+    'ADMISSION_MAX_QUEUED',
+    'ADMISSION_MIN_FREE_DISK',
+    'ADMISSION_MIN_FREE_MEMORY',
+    'ADMISSION_RETRY_AFTER',
+    'BAG_COMPRESSION_LEVEL',
+    'BROKER_URL',
     'DB_NAME',
     'DB_URL',
+    'DEFAULT_ADMIN_USER',
+    'IMPORT_CONNECTIONS',
+    'IMPORT_RETRIES',
+    'IMPORT_RETRY_BACKOFF',
+    'JANITOR_DELETED_WORKSPACE_RETENTION',
+    'JANITOR_HIGH_WATER_MARK',
+    'JANITOR_INGEST_MIN_AGE',
+    'JANITOR_INGEST_STAGING_RETENTION',
+    'JANITOR_INTERVAL',
+    'JANITOR_JOB_DIR_RETENTION',
+    'JANITOR_JOB_WORK_DIR_RETENTION',
+    'JANITOR_LOW_WATER_MARK',
+    'JANITOR_TEMP_ARCHIVE_RETENTION',
+    'JSON_STREAM_THRESHOLD',
+    'LEASE_TTL',
+    'PROCESSING_SHARD_TIMEOUT',
+    'PROCESSING_WORKERS',
+    'PROCESSOR_WORKER_MAX_JOBS',
+    'PROCESSOR_WORKER_MAX_MEMORY_GROWTH',
+    'PROFILE_DIR',
+    'PROFILE_INTERVAL',
+    'PROFILE_MAX_PROFILES',
+    'REAPER_FILES_PER_SECOND',
+    'REAPER_INTERVAL',
+    'RESOURCE_INDEX_TTL',
+    'RESULT_BATCH_SIZE',
+    'RESULT_FLUSH_INTERVAL',
+    'RESULT_QUEUE',
+    'S3_ENDPOINT_URL',
+    'SCHEDULER_INTERVAL',
+    'SCHEDULER_MAX_RUNNING',
+    'SCHEDULER_MAX_RUNNING_PER_USER',
     'SERVER_URL',
+    'STORAGE_PART_SIZE',
+    'STORAGE_TRANSFERS',
+    'STORAGE_URL',
+    'TRACE_FILE',
+    'TRACE_MAX_SPANS',
+    'TRACE_OTLP_ENDPOINT',
+    'TRACE_SAMPLE_RATE',
+    'TRACE_SLOW_THRESHOLD',
+    'UPLOAD_EXPIRY',
+    'USER_QUOTA_BYTES',
+    'USER_QUOTA_FILES',
+    'VALIDATION_CACHE_SIZE',
+    'VALIDATION_PROCESSES',
+    'VALIDATION_PROCESSES_BUDGET',
+    'WORKFLOW_CANCEL_TIMEOUT',
+    'WORKFLOW_SUPERVISE_INTERVAL',
     'BASE_DIR',
     'JOBS_ROUTER',
+    'PROCESSORS_ROUTER',
+    'TRASH_ROUTER',
+    'UPLOADS_ROUTER',
     'WORKFLOWS_ROUTER',
     'WORKSPACES_ROUTER',
 ]
@@ -21,6 +80,9 @@ load_dotenv()
 DB_URL: str = getenv("OCRD_WEBAPI_DB_URL", "mongodb://localhost:27018")
 DB_NAME: str = getenv("OCRD_WEBAPI_DB_NAME", "ocrd-webapi-db")
 
+# The account created on startup, it is also the only one allowed to use the admin endpoints
+DEFAULT_ADMIN_USER: str = getenv("OCRD_WEBAPI_USERNAME", "test")
+
 # The SERVER_URL, BASE_DIR and *_ROUTERS are used by the ResourceManagers
 SERVER_URL: str = getenv("OCRD_WEBAPI_SERVER_PATH", "http://localhost:8000")
 BASE_DIR: str = getenv("OCRD_WEBAPI_BASE_DIR", "/tmp/ocrd-webapi-data")
@@ -28,6 +90,160 @@ BASE_DIR: str = getenv("OCRD_WEBAPI_BASE_DIR", "/tmp/ocrd-webapi-data")
 # Routers are basically the folder names placed under the BASE_DIR
 # TODO: Use `JOBS_ROUTER`. Jobs must not be related to a specific workflow folder (for better consistency)
 JOBS_ROUTER: str = getenv("OCRD_WEBAPI_JOBS_ROUTER", "jobs")
+PROCESSORS_ROUTER: str = getenv("OCRD_WEBAPI_PROCESSORS_ROUTER", "processor")
 WORKFLOWS_ROUTER: str = getenv("OCRD_WEBAPI_WORKFLOWS_ROUTER", "workflow")
 WORKSPACES_ROUTER: str = getenv("OCRD_WEBAPI_WORKSPACES_ROUTER", "workspace")
+
+# Seconds a cancelled workflow job gets to exit after SIGTERM, before it is killed with SIGKILL
+WORKFLOW_CANCEL_TIMEOUT: float = float(getenv("OCRD_WEBAPI_WORKFLOW_CANCEL_TIMEOUT", 10))
+# Seconds between the checks whether the Nextflow runs of the unfinished workflow jobs are alive,
+# jobs whose runs died (e.g. with the server) are set to FAILED
+WORKFLOW_SUPERVISE_INTERVAL: float = float(getenv("OCRD_WEBAPI_WORKFLOW_SUPERVISE_INTERVAL", 10))
+# Staging files of resumable workspace uploads, kept apart from the workspaces
+UPLOADS_ROUTER: str = getenv("OCRD_WEBAPI_UPLOADS_ROUTER", "uploads")
+# Seconds a resource dir found on disk is known to exist without probing the file system again.
+# Deletes by the same worker take effect at once, deletes by other workers after at most this long
+RESOURCE_INDEX_TTL: float = float(getenv("OCRD_WEBAPI_RESOURCE_INDEX_TTL", 60))
+# Deleted resources are renamed into the trash, it is on the file system of the BASE_DIR
+TRASH_ROUTER: str = getenv("OCRD_WEBAPI_TRASH_ROUTER", ".trash")
 # Warning: Don't change the router defaults till everything is configured properly
+
+# Default storage quotas of the users, 0 means unlimited. Uploads which would exceed the quota of
+# the user are rejected before they are received. The quotas of single users are set in their
+# accounts
+USER_QUOTA_BYTES: int = int(getenv("OCRD_WEBAPI_USER_QUOTA_BYTES", 0))
+USER_QUOTA_FILES: int = int(getenv("OCRD_WEBAPI_USER_QUOTA_FILES", 0))
+
+# Seconds after the last received chunk before an unfinished upload session is garbage-collected
+UPLOAD_EXPIRY: int = int(getenv("OCRD_WEBAPI_UPLOAD_EXPIRY", 24 * 60 * 60))
+
+# Processes used for the checksum validation of a single OCRD-ZIP, 0 means a fair share.
+# All concurrent validations together never use more than VALIDATION_PROCESSES_BUDGET processes
+VALIDATION_PROCESSES: int = int(getenv("OCRD_WEBAPI_VALIDATION_PROCESSES", 0))
+VALIDATION_PROCESSES_BUDGET: int = int(
+    getenv("OCRD_WEBAPI_VALIDATION_PROCESSES_BUDGET", cpu_count() or 1)
+)
+# Amount of OCRD-ZIP digests whose validation result is remembered
+VALIDATION_CACHE_SIZE: int = int(getenv("OCRD_WEBAPI_VALIDATION_CACHE_SIZE", 1024))
+
+# Deflate level (1 fastest - 9 smallest) of the files in exported OCRD-ZIPs. Files of compressed
+# formats (JPEG, PNG, JPEG 2000, compressed TIFF ...) are stored as they are regardless
+BAG_COMPRESSION_LEVEL: int = int(getenv("OCRD_WEBAPI_BAG_COMPRESSION_LEVEL", 6))
+
+# Workspace imports from METS URLs: amount of pooled keep-alive connections (and parallel
+# downloads), retries per file and the backoff factor in seconds between the retries
+IMPORT_CONNECTIONS: int = int(getenv("OCRD_WEBAPI_IMPORT_CONNECTIONS", 16))
+IMPORT_RETRIES: int = int(getenv("OCRD_WEBAPI_IMPORT_RETRIES", 5))
+IMPORT_RETRY_BACKOFF: float = float(getenv("OCRD_WEBAPI_IMPORT_RETRY_BACKOFF", 0.5))
+
+# Processing messages are dispatched through this message broker. `amqp://...` urls select an AMQP
+# server (e.g. RabbitMQ), everything else the in-process broker for tests and single-node setups
+BROKER_URL: str = getenv("OCRD_WEBAPI_BROKER_URL", "memory://")
+# Queue the processing workers publish their result messages to
+RESULT_QUEUE: str = getenv("OCRD_WEBAPI_RESULT_QUEUE", "ocrd-webapi-results")
+# Result messages are buffered and written to the database in batches. A batch is flushed when it
+# is full or at most this many seconds after its first message arrived
+RESULT_FLUSH_INTERVAL: float = float(getenv("OCRD_WEBAPI_RESULT_FLUSH_INTERVAL", 0.5))
+RESULT_BATCH_SIZE: int = int(getenv("OCRD_WEBAPI_RESULT_BATCH_SIZE", 500))
+
+# Amount of processing workers available per processor, bounds the shards of a processing job
+PROCESSING_WORKERS: int = int(getenv("OCRD_WEBAPI_PROCESSING_WORKERS", cpu_count() or 1))
+# A sharded processing job fails if its shards are not finished after this many seconds, e.g.
+# because their result messages were lost
+PROCESSING_SHARD_TIMEOUT: int = int(getenv("OCRD_WEBAPI_PROCESSING_SHARD_TIMEOUT", 24 * 60 * 60))
+# Warm processor workers are recycled after this many jobs or when their memory (RSS) grew by more
+# than this many MiB since their first job, whichever comes first
+PROCESSOR_WORKER_MAX_JOBS: int = int(getenv("OCRD_WEBAPI_PROCESSOR_WORKER_MAX_JOBS", 100))
+PROCESSOR_WORKER_MAX_MEMORY_GROWTH: int = int(
+    getenv("OCRD_WEBAPI_PROCESSOR_WORKER_MAX_MEMORY_GROWTH", 2048)
+)
+
+# The storage janitor runs every JANITOR_INTERVAL seconds and removes artifacts older than the
+# retention (in seconds) of their class, a negative retention leaves a class to the eviction.
+# Job work dirs are the Nextflow `work/` dirs of finished jobs, needed to resume a job with the
+# task cache
+JANITOR_INTERVAL: int = int(getenv("OCRD_WEBAPI_JANITOR_INTERVAL", 600))
+JANITOR_TEMP_ARCHIVE_RETENTION: int = int(
+    getenv("OCRD_WEBAPI_JANITOR_TEMP_ARCHIVE_RETENTION", 60 * 60)
+)
+JANITOR_INGEST_STAGING_RETENTION: int = int(
+    getenv("OCRD_WEBAPI_JANITOR_INGEST_STAGING_RETENTION", 24 * 60 * 60)
+)
+JANITOR_JOB_WORK_DIR_RETENTION: int = int(
+    getenv("OCRD_WEBAPI_JANITOR_JOB_WORK_DIR_RETENTION", 7 * 24 * 60 * 60)
+)
+JANITOR_JOB_DIR_RETENTION: int = int(
+    getenv("OCRD_WEBAPI_JANITOR_JOB_DIR_RETENTION", 30 * 24 * 60 * 60)
+)
+JANITOR_DELETED_WORKSPACE_RETENTION: int = int(
+    getenv("OCRD_WEBAPI_JANITOR_DELETED_WORKSPACE_RETENTION", 0)
+)
+# Staging zips of ingests modified within this many seconds may still be received or extracted,
+# neither the retention nor the eviction removes them
+JANITOR_INGEST_MIN_AGE: int = int(getenv("OCRD_WEBAPI_JANITOR_INGEST_MIN_AGE", 60 * 60))
+# When the disk of the BASE_DIR is fuller than the high-water mark (in percent), the least recently
+# used artifacts of all classes are evicted before their retention until the low-water mark
+# is reached
+JANITOR_HIGH_WATER_MARK: float = float(getenv("OCRD_WEBAPI_JANITOR_HIGH_WATER_MARK", 90))
+JANITOR_LOW_WATER_MARK: float = float(getenv("OCRD_WEBAPI_JANITOR_LOW_WATER_MARK", 80))
+
+# Where the resources are stored durably. `s3://bucket/prefix` urls select an S3-compatible object
+# store (S3_ENDPOINT_URL for others than AWS, credentials as usual for boto3) with the BASE_DIR as
+# local cache, everything else keeps the resources in the BASE_DIR only
+STORAGE_URL: str = getenv("OCRD_WEBAPI_STORAGE_URL", "")
+S3_ENDPOINT_URL: str = getenv("OCRD_WEBAPI_S3_ENDPOINT_URL", "")
+# Files larger than the part size (in bytes) are transferred in parts, STORAGE_TRANSFERS files or
+# parts at a time
+STORAGE_PART_SIZE: int = int(getenv("OCRD_WEBAPI_STORAGE_PART_SIZE", 8 * 1024 * 1024))
+STORAGE_TRANSFERS: int = int(getenv("OCRD_WEBAPI_STORAGE_TRANSFERS", 16))
+
+# The trash reaper looks for deleted resources every REAPER_INTERVAL seconds and removes at most
+# REAPER_FILES_PER_SECOND files per second, so a large delete does not saturate the disk
+REAPER_INTERVAL: float = float(getenv("OCRD_WEBAPI_REAPER_INTERVAL", 5))
+REAPER_FILES_PER_SECOND: int = int(getenv("OCRD_WEBAPI_REAPER_FILES_PER_SECOND", 2000))
+
+# Responses listing more resources than this are streamed as JSON arrays instead of being encoded
+# in one piece
+JSON_STREAM_THRESHOLD: int = int(getenv("OCRD_WEBAPI_JSON_STREAM_THRESHOLD", 10000))
+
+# Seconds a worker holds the lease of a background service (e.g. the janitor) without renewing
+# it. When the leading worker dies, another one takes the service over within about this time
+LEASE_TTL: float = float(getenv("OCRD_WEBAPI_LEASE_TTL", 15))
+
+# Admission control, 0 disables a check. Requests storing workspaces are refused with 503 while
+# less than ADMISSION_MIN_FREE_DISK bytes would be left under the BASE_DIR and with 429 while a
+# worker receives ADMISSION_MAX_INGESTS of them. Job submissions are refused with 503 while less
+# than ADMISSION_MIN_FREE_MEMORY bytes of memory are available and with 429 while
+# ADMISSION_MAX_JOBS jobs are running or ADMISSION_MAX_QUEUED jobs are waiting for the dispatcher
+# (queued jobs take no memory, but bound the backlog). Refused clients may retry after
+# ADMISSION_RETRY_AFTER seconds
+ADMISSION_MIN_FREE_DISK: int = int(getenv("OCRD_WEBAPI_ADMISSION_MIN_FREE_DISK", 2 * 1024 ** 3))
+ADMISSION_MAX_INGESTS: int = int(getenv("OCRD_WEBAPI_ADMISSION_MAX_INGESTS", 16))
+ADMISSION_MIN_FREE_MEMORY: int = int(getenv("OCRD_WEBAPI_ADMISSION_MIN_FREE_MEMORY", 1024 ** 3))
+ADMISSION_MAX_JOBS: int = int(getenv("OCRD_WEBAPI_ADMISSION_MAX_JOBS", 200))
+ADMISSION_MAX_QUEUED: int = int(getenv("OCRD_WEBAPI_ADMISSION_MAX_QUEUED", 1000))
+ADMISSION_RETRY_AFTER: int = int(getenv("OCRD_WEBAPI_ADMISSION_RETRY_AFTER", 30))
+
+# Workflow jobs are queued and started by the dispatcher, at most SCHEDULER_MAX_RUNNING at a time
+# and SCHEDULER_MAX_RUNNING_PER_USER (0 for no maximum) per user unless the account overrides it.
+# The users get turns in proportion to the share of their account. The dispatcher looks for newly
+# queued and ended jobs every SCHEDULER_INTERVAL seconds
+SCHEDULER_MAX_RUNNING: int = int(getenv("OCRD_WEBAPI_SCHEDULER_MAX_RUNNING", cpu_count() or 1))
+SCHEDULER_MAX_RUNNING_PER_USER: int = int(getenv("OCRD_WEBAPI_SCHEDULER_MAX_RUNNING_PER_USER", 0))
+SCHEDULER_INTERVAL: float = float(getenv("OCRD_WEBAPI_SCHEDULER_INTERVAL", 1))
+
+# Request tracing, disabled unless the spans go somewhere: appended to the TRACE_FILE as JSON lines
+# and/or posted to the OTLP/HTTP collector at TRACE_OTLP_ENDPOINT (e.g. http://localhost:4318). The
+# TRACE_SAMPLE_RATE fraction of the requests is exported and every request taking at least
+# TRACE_SLOW_THRESHOLD seconds (0 disables). At most TRACE_MAX_SPANS spans are recorded per request
+TRACE_FILE: str = getenv("OCRD_WEBAPI_TRACE_FILE", "")
+TRACE_OTLP_ENDPOINT: str = getenv("OCRD_WEBAPI_TRACE_OTLP_ENDPOINT", "")
+TRACE_SAMPLE_RATE: float = float(getenv("OCRD_WEBAPI_TRACE_SAMPLE_RATE", 0.1))
+TRACE_SLOW_THRESHOLD: float = float(getenv("OCRD_WEBAPI_TRACE_SLOW_THRESHOLD", 5))
+TRACE_MAX_SPANS: int = int(getenv("OCRD_WEBAPI_TRACE_MAX_SPANS", 1000))
+
+# Profiles of single requests, taken on demand of the admin, are stored in the PROFILE_DIR. The
+# stacks are sampled every PROFILE_INTERVAL seconds, only the latest PROFILE_MAX_PROFILES are kept
+PROFILE_DIR: str = getenv("OCRD_WEBAPI_PROFILE_DIR", f"{BASE_DIR}/.profiles")
+PROFILE_INTERVAL: float = float(getenv("OCRD_WEBAPI_PROFILE_INTERVAL", 0.005))
+PROFILE_MAX_PROFILES: int = int(getenv("OCRD_WEBAPI_PROFILE_MAX_PROFILES", 50))
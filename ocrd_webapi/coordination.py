@@ -0,0 +1,142 @@
+"""
+Leader election for the background services of the Web API
+
+With several workers (e.g. `uvicorn --workers 8`, or several hosts) every worker starts the
+background services, but each of them must run exactly once. The workers compete for a lease per
+service in the database, the holder of the unexpired lease is the leader and runs the service:
+    - the leader renews its lease every `ttl / 3` seconds
+    - followers sleep until the lease expires and try to take it over, a single query per lease
+      period and follower
+    - when the leader dies its lease is not renewed anymore, a follower takes over at most
+      `ttl` (plus a little jitter) seconds later
+
+The expiry is set with the clock of the workers, their clocks must be synchronized well below
+the `ttl`.
+"""
+from asyncio import Task, create_task, sleep, wait
+from datetime import datetime
+from os import getpid
+from random import uniform
+from socket import gethostname
+from time import monotonic
+from typing import Awaitable, Callable, Optional
+import logging
+
+from ocrd_webapi import database as db
+from ocrd_webapi.constants import LEASE_TTL
+from ocrd_webapi.utils import generate_id
+
+__all__ = [
+    "LeaderElection",
+]
+
+
+class LeaderElection:
+    def __init__(self, name: str, ttl: float = LEASE_TTL, holder: str = None,
+                 log_level: str = "INFO"):
+        self.log = logging.getLogger(__name__)
+        self.log.setLevel(logging.getLevelName(log_level))
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder or f"{gethostname()}:{getpid()}:{generate_id()[:8]}"
+        # Monotonic time until which this worker surely holds the lease
+        self._leader_until = 0.0
+        self._campaign_task: Optional[Task] = None
+
+    def is_leader(self) -> bool:
+        """
+        Whether this worker holds the lease. A leader which could not renew its lease steps down
+        before the lease expires, so there are never two leaders at a time
+        """
+        return monotonic() < self._leader_until
+
+    async def try_acquire(self) -> float:
+        """
+        Try to take or renew the lease
+
+        Returns:
+            the seconds until the next attempt
+        """
+        started = monotonic()
+        try:
+            lease = await db.acquire_lease(self.name, self.holder, self.ttl)
+        except Exception as error:
+            self.log.exception(f"Failed to acquire the lease of {self.name}: {error}")
+            # Retried before the lease of this worker (if any) runs out
+            return self.ttl / 3
+        was_leader = self.is_leader()
+        if lease and lease.holder == self.holder:
+            # Counted from before the request, the lease may have been written at any time since
+            self._leader_until = started + self.ttl
+            if not was_leader:
+                self.log.info(f"Became the leader of {self.name}: {self.holder}")
+            return self.ttl / 3
+        self._leader_until = 0.0
+        if was_leader:
+            self.log.warning(f"Lost the lease of {self.name} to: {lease.holder if lease else None}")
+        # Followers try again when the lease expires, with jitter so they do not all query at once
+        expires_in = (lease.expires - datetime.utcnow()).total_seconds() if lease else 0
+        return min(max(expires_in, 0), self.ttl) + uniform(0, self.ttl / 10)
+
+    async def campaign(self) -> None:
+        """
+        Compete for the lease until cancelled, the lease is released on cancellation
+        """
+        try:
+            while True:
+                await sleep(await self.try_acquire())
+        finally:
+            await self.resign()
+
+    def start(self) -> Task:
+        if not self._campaign_task:
+            self._campaign_task = create_task(self.campaign())
+        return self._campaign_task
+
+    async def resign(self) -> None:
+        if not self.is_leader():
+            return
+        self._leader_until = 0.0
+        try:
+            await db.release_lease(self.name, self.holder)
+        except Exception as error:
+            self.log.error(f"Failed to release the lease of {self.name}: {error}")
+
+    async def run_as_leader(self, service: Callable[[], Awaitable[None]],
+                            check_interval: float = None) -> None:
+        """
+        Runs the `service` while this worker is the leader. It is started when the worker becomes
+        the leader and cancelled as soon as the worker steps down, before its lease expires
+        """
+        check_interval = check_interval or self.ttl / 10
+        self.start()
+        service_task: Optional[Task] = None
+        try:
+            while True:
+                if service_task and service_task.done():
+                    # Crashed, restarted while this worker is the leader
+                    service_task = None
+                if self.is_leader() and not service_task:
+                    service_task = create_task(service())
+                elif not self.is_leader() and service_task:
+                    await self._cancel(service_task)
+                    service_task = None
+                # Wakes up when the lease of this worker runs out, unless it is renewed meanwhile
+                if service_task:
+                    await sleep(min(check_interval, max(self._leader_until - monotonic(), 0)))
+                else:
+                    await sleep(check_interval)
+        finally:
+            if service_task:
+                await self._cancel(service_task)
+
+    @staticmethod
+    async def _cancel(task: Task) -> None:
+        """
+        Cancel the task and wait until it ended, a cancellation of the caller is not swallowed
+        """
+        task.cancel()
+        await wait([task])
+        if not task.cancelled():
+            # Ended with an error before it was cancelled, retrieved so it is not reported as lost
+            task.exception()
@@ -1,15 +1,25 @@
-from typing import List, Union
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Union
 from beanie import init_beanie, Document
+from beanie.operators import In, Inc
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
 import logging
 
 from ocrd_webapi.constants import DB_NAME
 from ocrd_webapi.models.database import (
+    LeaseDB,
+    ProcessingJobDB,
     WorkflowDB,
     WorkflowJobDB,
+    WorkflowTaskDB,
     WorkspaceDB,
+    WorkspaceImportDB,
+    WorkspaceUploadDB,
     UserAccountDB
 )
+from ocrd_webapi.tracing import traced
 from ocrd_webapi.utils import call_sync, safe_init_logging
 
 # Warning: Logging blocks completely if safe init is not called in the global scope at least once...
@@ -24,7 +34,17 @@ async def initiate_database(db_url: str, db_name: str = None, doc_models: List[D
     if db_name is None:
         db_name = DB_NAME
     if doc_models is None:
-        doc_models = [WorkflowDB, WorkspaceDB, WorkflowJobDB, UserAccountDB]
+        doc_models = [
+            ProcessingJobDB,
+            WorkflowDB,
+            WorkspaceDB,
+            WorkspaceImportDB,
+            WorkspaceUploadDB,
+            WorkflowJobDB,
+            UserAccountDB,
+            LeaseDB,
+            WorkflowTaskDB
+        ]
 
     if db_url:
         logger.info(f"MongoDB Name: {DB_NAME}")
@@ -44,6 +64,7 @@ async def sync_initiate_database(db_url: str, db_name: str = None, doc_models: L
     await initiate_database(db_url, db_name, doc_models)
 
 
+@traced
 async def get_workflow(workflow_id) -> Union[WorkflowDB, None]:
     return await WorkflowDB.find_one(WorkflowDB.workflow_id == workflow_id)
 
@@ -53,6 +74,7 @@ async def sync_get_workflow(workflow_id) -> Union[WorkflowDB, None]:
     return await get_workflow(workflow_id)
 
 
+@traced
 async def get_workflow_path(workflow_id) -> Union[str, None]:
     workflow = await get_workflow(workflow_id)
     if workflow:
@@ -66,6 +88,7 @@ async def sync_get_workflow_path(workflow_id) -> Union[str, None]:
     return await get_workflow_path(workflow_id)
 
 
+@traced
 async def get_workflow_script_path(workflow_id) -> Union[str, None]:
     workflow = await get_workflow(workflow_id)
     if workflow:
@@ -79,6 +102,7 @@ async def sync_get_workflow_script_path(workflow_id) -> Union[str, None]:
     return await get_workflow_script_path(workflow_id)
 
 
+@traced
 async def get_workflow_job(job_id) -> Union[WorkflowJobDB, None]:
     return await WorkflowJobDB.find_one(WorkflowJobDB.workflow_job_id == job_id)
 
@@ -88,6 +112,7 @@ async def sync_get_workflow_job(job_id) -> Union[WorkflowJobDB, None]:
     return await get_workflow_job(job_id)
 
 
+@traced
 async def get_workspace(workspace_id) -> Union[WorkspaceDB, None]:
     return await WorkspaceDB.find_one(WorkspaceDB.workspace_id == workspace_id)
 
@@ -97,6 +122,18 @@ async def sync_get_workspace(workspace_id) -> Union[WorkspaceDB, None]:
     return await get_workspace(workspace_id)
 
 
+@traced
+async def get_deleted_workspace_ids() -> List[str]:
+    workspaces = await WorkspaceDB.find(WorkspaceDB.deleted == True).to_list()  # noqa: E712
+    return [workspace.workspace_id for workspace in workspaces]
+
+
+@call_sync
+async def sync_get_deleted_workspace_ids() -> List[str]:
+    return await get_deleted_workspace_ids()
+
+
+@traced
 async def get_workspace_mets_path(workspace_id) -> Union[str, None]:
     workspace = await get_workspace(workspace_id)
     if workspace:
@@ -110,9 +147,12 @@ async def sync_get_workspace_mets_path(workspace_id) -> Union[str, None]:
     return await get_workspace_mets_path(workspace_id)
 
 
+@traced
 async def mark_deleted_workflow(workflow_id) -> bool:
     wf = await get_workflow(workflow_id)
     if wf:
+        if not wf.deleted:
+            await add_user_usage(wf.owner, -wf.size, -wf.files)
         wf.deleted = True
         await wf.save()
         return True
@@ -125,6 +165,7 @@ async def sync_mark_deleted_workflow(workflow_id) -> bool:
     return await mark_deleted_workflow(workflow_id)
 
 
+@traced
 async def mark_deleted_workspace(workspace_id) -> bool:
     """
     set 'WorkspaceDb.deleted' to True
@@ -134,6 +175,8 @@ async def mark_deleted_workspace(workspace_id) -> bool:
     """
     ws = await get_workspace(workspace_id)
     if ws:
+        if not ws.deleted:
+            await add_user_usage(ws.owner, -ws.size, -ws.files)
         ws.deleted = True
         await ws.save()
         return True
@@ -146,28 +189,64 @@ async def sync_mark_deleted_workspace(workspace_id) -> bool:
     return await mark_deleted_workspace(workspace_id)
 
 
-async def save_workflow(workflow_id: str, workflow_path: str, workflow_script_path: str) -> Union[WorkflowDB, None]:
+@traced
+async def save_workflow(workflow_id: str, workflow_path: str, workflow_script_path: str,
+                        workflow_parameters: Dict[str, Optional[str]] = None,
+                        workflow_processes: List[str] = None, owner: str = None, size: int = None,
+                        files: int = None) -> Union[WorkflowDB, None]:
+    """
+    save a workflow to the database. Can also be used to update a workflow
+
+    Arguments:
+        workflow_id: id of the workflow
+        workflow_path: the path of the workflow space
+        workflow_script_path: the path of the Nextflow script
+        workflow_parameters: the `params.*` of the script mapped to their default values
+        workflow_processes: names of the processes of the script
+        owner: (optional) e-mail of the uploading user, kept on updates if not set
+        size: (optional) bytes of the workflow space, kept on updates if not set
+        files: (optional) files of the workflow space, kept on updates if not set
+    """
     workflow_db = await get_workflow(workflow_id)
     if not workflow_db:
         workflow_db = WorkflowDB(
             workflow_id=workflow_id,
             workflow_path=workflow_path,
-            workflow_script_path=workflow_script_path
+            workflow_script_path=workflow_script_path,
+            workflow_parameters=workflow_parameters,
+            workflow_processes=workflow_processes,
+            owner=owner
         )
     else:
+        if size is not None and not workflow_db.deleted:
+            # The content of the workflow space is replaced
+            await add_user_usage(workflow_db.owner, -workflow_db.size, -workflow_db.files)
         workflow_db.workflow_id = workflow_id
         workflow_db.workflow_path = workflow_path
         workflow_db.workflow_script_path = workflow_script_path
+        workflow_db.workflow_parameters = workflow_parameters
+        workflow_db.workflow_processes = workflow_processes
+        if owner is not None:
+            workflow_db.owner = owner
+    if size is not None:
+        workflow_db.size, workflow_db.files, workflow_db.deleted = size, files or 0, False
+        await add_user_usage(workflow_db.owner, workflow_db.size, workflow_db.files)
     await workflow_db.save()
     return workflow_db
 
 
 @call_sync
-async def sync_save_workflow(workflow_id: str, workflow_path: str, workflow_script_path: str) -> Union[WorkflowDB, None]:
-    return await sync_save_workflow(workflow_id, workflow_path, workflow_script_path)
+async def sync_save_workflow(workflow_id: str, workflow_path: str, workflow_script_path: str,
+                             workflow_parameters: Dict[str, Optional[str]] = None,
+                             workflow_processes: List[str] = None, owner: str = None,
+                             size: int = None, files: int = None) -> Union[WorkflowDB, None]:
+    return await save_workflow(workflow_id, workflow_path, workflow_script_path,
+                               workflow_parameters, workflow_processes, owner, size, files)
 
 
-async def save_workspace(workspace_id: str, workspace_path: str, bag_info: dict) -> Union[WorkspaceDB, None]:
+@traced
+async def save_workspace(workspace_id: str, workspace_path: str, bag_info: dict, owner: str = None,
+                         size: int = None, files: int = None) -> Union[WorkspaceDB, None]:
     """
     save a workspace to the database. Can also be used to update a workspace
 
@@ -175,6 +254,9 @@ async def save_workspace(workspace_id: str, workspace_path: str, bag_info: dict)
          workspace_id: uid of the workspace which must be available on disk
          workspace_path: the path of the workspace directory on the local disk
          bag_info: dict with key-value-pairs from bag-info.txt
+         owner: (optional) e-mail of the creating user, kept on updates if not set
+         size: (optional) bytes of the payload, the usage of a replaced payload is released
+         files: (optional) files of the payload
     """
 
     workspace_mets_path = f"{workspace_path}/mets.xml"
@@ -201,9 +283,13 @@ async def save_workspace(workspace_id: str, workspace_path: str, bag_info: dict)
             ocrd_identifier=ocrd_identifier,
             bagit_profile_identifier=bagit_profile_identifier,
             ocrd_base_version_checksum=ocrd_base_version_checksum,
-            bag_info_adds=bag_info
+            bag_info_adds=bag_info,
+            owner=owner
         )
     else:
+        if size is not None and not workspace_db.deleted:
+            # The payload of the workspace is replaced
+            await add_user_usage(workspace_db.owner, -workspace_db.size, -workspace_db.files)
         workspace_db.workspace_path = workspace_path
         workspace_db.workspace_mets_path = workspace_mets_path
         workspace_db.ocrd_mets = ocrd_mets
@@ -211,16 +297,27 @@ async def save_workspace(workspace_id: str, workspace_path: str, bag_info: dict)
         workspace_db.bagit_profile_identifier = bagit_profile_identifier
         workspace_db.ocrd_base_version_checksum = ocrd_base_version_checksum
         workspace_db.bag_info_adds = bag_info
+        if owner is not None:
+            workspace_db.owner = owner
+    if size is not None:
+        workspace_db.size, workspace_db.files, workspace_db.deleted = size, files or 0, False
+        await add_user_usage(workspace_db.owner, workspace_db.size, workspace_db.files)
     await workspace_db.save()
     return workspace_db
 
 
 @call_sync
-async def sync_save_workspace(workspace_id: str, workspace_path: str, bag_info: dict) -> Union[WorkspaceDB, None]:
-    return await save_workspace(workspace_id, workspace_path, bag_info)
+async def sync_save_workspace(workspace_id: str, workspace_path: str, bag_info: dict,
+                              owner: str = None, size: int = None,
+                              files: int = None) -> Union[WorkspaceDB, None]:
+    return await save_workspace(workspace_id, workspace_path, bag_info, owner, size, files)
 
 
-async def save_workflow_job(job_id: str, workflow_id: str, workspace_id: str, job_path: str, job_state: str
+@traced
+async def save_workflow_job(job_id: str, workflow_id: str, workspace_id: str, job_path: str,
+                            job_state: str, workflow_parameters: Dict[str, Any] = None,
+                            process_group_id: int = None,
+                            owner: str = None, host: str = None, started: datetime = None
                             ) -> Union[WorkflowJobDB, None]:
     """
     save a workflow_job to the database. Can also be used to update a workflow_job
@@ -231,6 +328,11 @@ async def save_workflow_job(job_id: str, workflow_id: str, workspace_id: str, jo
         workspace_id: id of the workspace the job runs on
         job_path: the path of the workflow job
         job_state: current state of the job
+        workflow_parameters: the parameters passed to the workflow
+        process_group_id: id of the process group of the Nextflow run
+        owner: (optional) e-mail of the user who started the job
+        host: the host the Nextflow run was started on
+        started: when the Nextflow run was started
     """
     workflow_job_db = await get_workflow_job(job_id)
     if not workflow_job_db:
@@ -239,7 +341,12 @@ async def save_workflow_job(job_id: str, workflow_id: str, workspace_id: str, jo
             workflow_id=workflow_id,
             workspace_id=workspace_id,
             job_path=job_path,
-            job_state=job_state
+            job_state=job_state,
+            workflow_parameters=workflow_parameters,
+            process_group_id=process_group_id,
+            owner=owner,
+            host=host,
+            started=started
         )
     else:
         workflow_job_db.workflow_job_id = job_id
@@ -247,16 +354,27 @@ async def save_workflow_job(job_id: str, workflow_id: str, workspace_id: str, jo
         workflow_job_db.workspace_id = workspace_id
         workflow_job_db.job_path = job_path
         workflow_job_db.job_state = job_state
+        workflow_job_db.workflow_parameters = workflow_parameters
+        workflow_job_db.process_group_id = process_group_id
+        workflow_job_db.host = host
+        workflow_job_db.started = started
+        if owner is not None:
+            workflow_job_db.owner = owner
     await workflow_job_db.save()
     return workflow_job_db
 
 
 @call_sync
-async def sync_save_workflow_job(job_id: str, workflow_id: str, workspace_id: str, job_path: str, job_state: str
+async def sync_save_workflow_job(job_id: str, workflow_id: str, workspace_id: str, job_path: str,
+                                 job_state: str, workflow_parameters: Dict[str, Any] = None,
+                                 process_group_id: int = None,
+                                 owner: str = None, host: str = None, started: datetime = None
                                  ) -> Union[WorkflowJobDB, None]:
-    return await save_workflow_job(job_id, workflow_id, workspace_id, job_path, job_state)
+    return await save_workflow_job(job_id, workflow_id, workspace_id, job_path, job_state,
+                                   workflow_parameters, process_group_id, owner, host, started)
 
 
+@traced
 async def set_workflow_job_state(job_id, job_state: str) -> bool:
     """
     set state of job to 'state'
@@ -275,6 +393,7 @@ async def sync_set_workflow_job_state(job_id, job_state: str) -> bool:
     return await set_workflow_job_state(job_id, job_state)
 
 
+@traced
 async def get_workflow_job_state(job_id) -> Union[str, None]:
     """
     get state of job
@@ -291,6 +410,653 @@ async def sync_get_workflow_job_state(job_id) -> Union[str, None]:
     return await get_workflow_job_state(job_id)
 
 
+@traced
+async def get_workflow_job_states(job_ids: List[str]) -> Dict[str, str]:
+    """
+    Returns the states of the workflow jobs with one query, unknown jobs are left out
+    """
+    jobs = await WorkflowJobDB.find(In(WorkflowJobDB.workflow_job_id, job_ids)).to_list()
+    return {job.workflow_job_id: job.job_state for job in jobs}
+
+
+@call_sync
+async def sync_get_workflow_job_states(job_ids: List[str]) -> Dict[str, str]:
+    return await get_workflow_job_states(job_ids)
+
+
+@traced
+async def add_workflow_job_attempt(job_id, attempts: int, started: datetime) -> bool:
+    """
+    record a new attempt (e.g. a resume) of a finished workflow job and set it to RUNNING, unless
+    the job was resumed meanwhile by someone else. The Nextflow run of the attempt is set with
+    `start_workflow_job_attempt` once it is launched
+
+    Returns:
+        True if the attempt was added by this call
+    """
+    result = await WorkflowJobDB.get_motor_collection().update_one(
+        {"workflow_job_id": job_id, "attempts": attempts,
+         "job_state": {"$nin": ["QUEUED", "RUNNING"]}},
+        {"$set": {"job_state": "RUNNING", "cached_tasks": None, "process_group_id": None,
+                  "host": None, "started": started, "failure_reason": None, "trace_offset": 0},
+         "$inc": {"attempts": 1}}
+    )
+    return result.modified_count > 0
+
+
+@call_sync
+async def sync_add_workflow_job_attempt(job_id, attempts: int, started: datetime) -> bool:
+    return await add_workflow_job_attempt(job_id, attempts, started)
+
+
+@traced
+async def start_workflow_job_attempt(job_id, attempts: int, process_group_id: int,
+                                     host: str) -> bool:
+    """
+    set the Nextflow run of the latest attempt of a workflow job, unless the attempt was finished
+    meanwhile (e.g. cancelled by the user)
+
+    Returns:
+        True if the run was set
+    """
+    result = await WorkflowJobDB.get_motor_collection().update_one(
+        {"workflow_job_id": job_id, "attempts": attempts, "job_state": "RUNNING"},
+        {"$set": {"process_group_id": process_group_id, "host": host}}
+    )
+    return result.modified_count > 0
+
+
+@call_sync
+async def sync_start_workflow_job_attempt(job_id, attempts: int, process_group_id: int,
+                                          host: str) -> bool:
+    return await start_workflow_job_attempt(job_id, attempts, process_group_id, host)
+
+
+@traced
+async def get_unfinished_workflow_jobs(host: str = None) -> List[WorkflowJobDB]:
+    """
+    Returns the QUEUED and RUNNING workflow jobs, with a `host` only the ones started on that host.
+    Jobs of unknown hosts are not claimed by the supervisors of all hosts
+    """
+    query = In(WorkflowJobDB.job_state, ["QUEUED", "RUNNING"])
+    if host:
+        return await WorkflowJobDB.find(query, WorkflowJobDB.host == host).to_list()
+    return await WorkflowJobDB.find(query).to_list()
+
+
+@call_sync
+async def sync_get_unfinished_workflow_jobs(host: str = None) -> List[WorkflowJobDB]:
+    return await get_unfinished_workflow_jobs(host)
+
+
+@traced
+async def finish_workflow_job(job_id, attempts: int, job_state: str,
+                              failure_reason: str = None) -> bool:
+    """
+    set the state of an unfinished workflow job to the final 'job_state', unless the job was
+    finished or resumed meanwhile (e.g. cancelled by the user or finished by another worker)
+
+    Returns:
+        True if this call finished the job
+    """
+    result = await WorkflowJobDB.get_motor_collection().update_one(
+        {"workflow_job_id": job_id, "attempts": attempts,
+         "job_state": {"$in": ["QUEUED", "RUNNING"]}},
+        {"$set": {"job_state": job_state, "failure_reason": failure_reason}}
+    )
+    return result.modified_count > 0
+
+
+@call_sync
+async def sync_finish_workflow_job(job_id, attempts: int, job_state: str,
+                                   failure_reason: str = None) -> bool:
+    return await finish_workflow_job(job_id, attempts, job_state, failure_reason)
+
+
+@traced
+async def queue_workflow_job(job_id: str, workflow_id: str, workspace_id: str, job_path: str,
+                             workflow_parameters: Dict[str, Any] = None, owner: str = None,
+                             priority: int = 0) -> WorkflowJobDB:
+    """
+    save a new workflow job in state QUEUED, it is started by the dispatcher
+    """
+    workflow_job_db = WorkflowJobDB(
+        workflow_job_id=job_id,
+        workflow_id=workflow_id,
+        workspace_id=workspace_id,
+        job_path=job_path,
+        job_state="QUEUED",
+        workflow_parameters=workflow_parameters,
+        owner=owner,
+        priority=priority,
+        submitted=datetime.utcnow()
+    )
+    await workflow_job_db.save()
+    return workflow_job_db
+
+
+@call_sync
+async def sync_queue_workflow_job(job_id: str, workflow_id: str, workspace_id: str, job_path: str,
+                                  workflow_parameters: Dict[str, Any] = None, owner: str = None,
+                                  priority: int = 0) -> WorkflowJobDB:
+    return await queue_workflow_job(job_id, workflow_id, workspace_id, job_path,
+                                    workflow_parameters, owner, priority)
+
+
+@traced
+async def get_queued_workflow_jobs(submitted_since: datetime = None) -> List[WorkflowJobDB]:
+    """
+    Returns the QUEUED workflow jobs in the order of their submission, with `submitted_since` only
+    the ones submitted since then
+    """
+    query = [WorkflowJobDB.job_state == "QUEUED"]
+    if submitted_since:
+        query.append(WorkflowJobDB.submitted >= submitted_since)
+    return await WorkflowJobDB.find(*query).sort(+WorkflowJobDB.submitted).to_list()
+
+
+@call_sync
+async def sync_get_queued_workflow_jobs(submitted_since: datetime = None) -> List[WorkflowJobDB]:
+    return await get_queued_workflow_jobs(submitted_since)
+
+
+@traced
+async def get_workflow_jobs(job_ids: List[str]) -> List[WorkflowJobDB]:
+    """
+    Returns the workflow jobs with one query, unknown jobs are left out
+    """
+    return await WorkflowJobDB.find(In(WorkflowJobDB.workflow_job_id, job_ids)).to_list()
+
+
+@call_sync
+async def sync_get_workflow_jobs(job_ids: List[str]) -> List[WorkflowJobDB]:
+    return await get_workflow_jobs(job_ids)
+
+
+@traced
+async def get_running_workflow_job_owners() -> Dict[str, Optional[str]]:
+    """
+    Returns the owners of the RUNNING workflow jobs by job id
+    """
+    jobs = await WorkflowJobDB.get_motor_collection().find(
+        {"job_state": "RUNNING"}, {"workflow_job_id": 1, "owner": 1}
+    ).to_list(length=None)
+    return {job["workflow_job_id"]: job.get("owner") for job in jobs}
+
+
+@call_sync
+async def sync_get_running_workflow_job_owners() -> Dict[str, Optional[str]]:
+    return await get_running_workflow_job_owners()
+
+
+@traced
+async def start_queued_workflow_job(job_id, process_group_id: int, host: str,
+                                    started: datetime) -> bool:
+    """
+    set a QUEUED workflow job to RUNNING with its Nextflow run, unless it was cancelled meanwhile
+
+    Returns:
+        True if the job was started
+    """
+    result = await WorkflowJobDB.get_motor_collection().update_one(
+        {"workflow_job_id": job_id, "job_state": "QUEUED"},
+        {"$set": {"job_state": "RUNNING", "process_group_id": process_group_id, "host": host,
+                  "started": started}}
+    )
+    return result.modified_count > 0
+
+
+@call_sync
+async def sync_start_queued_workflow_job(job_id, process_group_id: int, host: str,
+                                         started: datetime) -> bool:
+    return await start_queued_workflow_job(job_id, process_group_id, host, started)
+
+
+@traced
+async def count_running_jobs() -> int:
+    """
+    Returns the amount of RUNNING workflow and processing jobs
+    """
+    workflow_jobs = await WorkflowJobDB.find(WorkflowJobDB.job_state == "RUNNING").count()
+    processing_jobs = await ProcessingJobDB.find(ProcessingJobDB.job_state == "RUNNING").count()
+    return workflow_jobs + processing_jobs
+
+
+@call_sync
+async def sync_count_running_jobs() -> int:
+    return await count_running_jobs()
+
+
+@traced
+async def count_queued_jobs() -> int:
+    """
+    Returns the amount of QUEUED workflow and processing jobs
+    """
+    workflow_jobs = await WorkflowJobDB.find(WorkflowJobDB.job_state == "QUEUED").count()
+    processing_jobs = await ProcessingJobDB.find(ProcessingJobDB.job_state == "QUEUED").count()
+    return workflow_jobs + processing_jobs
+
+
+@call_sync
+async def sync_count_queued_jobs() -> int:
+    return await count_queued_jobs()
+
+
+@traced
+async def add_workflow_tasks(job_id, attempts: int, trace_offset: int, new_trace_offset: int,
+                             tasks: List[Dict[str, Any]]) -> bool:
+    """
+    Store the tasks read from the trace file of a workflow job between 'trace_offset' and
+    'new_trace_offset'. The offset is moved first, tasks read concurrently by another caller
+    from the same offset are not stored twice
+
+    Arguments:
+        tasks: the fields of WorkflowTaskDB by task
+
+    Returns:
+        True if the tasks were stored
+    """
+    # Jobs stored before the traces were read have no offset yet
+    offset_query = {"$in": [0, None]} if trace_offset == 0 else trace_offset
+    result = await WorkflowJobDB.get_motor_collection().update_one(
+        {"workflow_job_id": job_id, "attempts": attempts, "trace_offset": offset_query},
+        {"$set": {"trace_offset": new_trace_offset}}
+    )
+    if not result.modified_count:
+        return False
+    if tasks:
+        await WorkflowTaskDB.insert_many([WorkflowTaskDB(**task) for task in tasks])
+    return True
+
+
+@call_sync
+async def sync_add_workflow_tasks(job_id, attempts: int, trace_offset: int, new_trace_offset: int,
+                                  tasks: List[Dict[str, Any]]) -> bool:
+    return await add_workflow_tasks(job_id, attempts, trace_offset, new_trace_offset, tasks)
+
+
+@traced
+async def get_workflow_task_values(workflow_id: str,
+                                   since: datetime = None) -> List[Dict[str, Any]]:
+    """
+    Collect the measurements of the tasks of a workflow by process, with one aggregation
+
+    Returns:
+        per process: the amount of tasks and failed tasks, and the durations, realtimes, CPU
+        usages and peak RSS of the completed tasks
+    """
+    match: Dict[str, Any] = {"series.workflow_id": workflow_id, "status": {"$ne": "CACHED"}}
+    if since:
+        match["completed"] = {"$gte": since}
+
+    def completed(field: str) -> Dict[str, Any]:
+        return {"$push": {"$cond": [{"$eq": ["$status", "COMPLETED"]}, f"${field}", "$$REMOVE"]}}
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": "$series.process",
+            "tasks": {"$sum": 1},
+            "failed": {"$sum": {"$cond": [{"$eq": ["$status", "FAILED"]}, 1, 0]}},
+            "duration": completed("duration"),
+            "realtime": completed("realtime"),
+            "cpu": completed("cpu"),
+            "peak_rss": completed("peak_rss"),
+        }},
+        {"$sort": {"_id": 1}},
+    ]
+    return await WorkflowTaskDB.get_motor_collection().aggregate(pipeline).to_list(length=None)
+
+
+@call_sync
+async def sync_get_workflow_task_values(workflow_id: str,
+                                        since: datetime = None) -> List[Dict[str, Any]]:
+    return await get_workflow_task_values(workflow_id, since)
+
+
+@traced
+async def set_workflow_job_cached_tasks(job_id, cached_tasks: int) -> bool:
+    """
+    set the amount of tasks the latest attempt of a workflow job reused from the task cache
+    """
+    job = await get_workflow_job(job_id)
+    if job:
+        job.cached_tasks = cached_tasks
+        await job.save()
+        return True
+    logger.warning(f"Trying to set cached tasks of a non-existing workflow job: {job_id}")
+    return False
+
+
+@call_sync
+async def sync_set_workflow_job_cached_tasks(job_id, cached_tasks: int) -> bool:
+    return await set_workflow_job_cached_tasks(job_id, cached_tasks)
+
+
+@traced
+async def set_workflow_job_usage(job_id, size: int, files: int) -> bool:
+    """
+    Set the measured size of a workflow job dir, the difference to the previous measurement
+    is added to the usage of the job's owner
+    """
+    job = await get_workflow_job(job_id)
+    if job:
+        await add_user_usage(job.owner, size - job.size, files - job.files)
+        job.size, job.files = size, files
+        await job.save()
+        return True
+    logger.warning(f"Trying to set the usage of a non-existing workflow job: {job_id}")
+    return False
+
+
+@call_sync
+async def sync_set_workflow_job_usage(job_id, size: int, files: int) -> bool:
+    return await set_workflow_job_usage(job_id, size, files)
+
+
+@traced
+async def release_workflow_jobs_usage(workflow_id) -> int:
+    """
+    Release the usage of all jobs of a workflow, e.g. when their job dirs are removed with the
+    workflow space. Returns the amount of released jobs
+    """
+    jobs = await WorkflowJobDB.find(WorkflowJobDB.workflow_id == workflow_id,
+                                    WorkflowJobDB.size > 0).to_list()
+    for job in jobs:
+        await set_workflow_job_usage(job.workflow_job_id, 0, 0)
+    return len(jobs)
+
+
+@call_sync
+async def sync_release_workflow_jobs_usage(workflow_id) -> int:
+    return await release_workflow_jobs_usage(workflow_id)
+
+
+@traced
+async def get_workspace_upload(upload_id) -> Union[WorkspaceUploadDB, None]:
+    return await WorkspaceUploadDB.find_one(WorkspaceUploadDB.upload_id == upload_id)
+
+
+@call_sync
+async def sync_get_workspace_upload(upload_id) -> Union[WorkspaceUploadDB, None]:
+    return await get_workspace_upload(upload_id)
+
+
+@traced
+async def save_workspace_upload(upload_id: str, upload_path: str, expires: datetime,
+                                upload_length: int = None, workspace_id: str = None,
+                                owner: str = None) -> Union[WorkspaceUploadDB, None]:
+    """
+    save a resumable upload session to the database
+
+    Arguments:
+        upload_id: id of the upload session
+        upload_path: path of the staging file the chunks are appended to
+        expires: point in time after which the session is garbage-collected
+        upload_length: (optional) total size of the upload announced by the client
+        workspace_id: (optional) id of the workspace to create or replace on finalization
+        owner: (optional) e-mail of the user who created the session
+    """
+    upload_db = WorkspaceUploadDB(
+        upload_id=upload_id,
+        upload_path=upload_path,
+        upload_length=upload_length,
+        workspace_id=workspace_id,
+        owner=owner,
+        expires=expires
+    )
+    await upload_db.save()
+    return upload_db
+
+
+@call_sync
+async def sync_save_workspace_upload(upload_id: str, upload_path: str, expires: datetime,
+                                     upload_length: int = None, workspace_id: str = None,
+                                     owner: str = None) -> Union[WorkspaceUploadDB, None]:
+    return await save_workspace_upload(upload_id, upload_path, expires, upload_length, workspace_id,
+                                       owner)
+
+
+@traced
+async def set_workspace_upload_expiry(upload_id, expires: datetime) -> bool:
+    upload = await get_workspace_upload(upload_id)
+    if upload:
+        upload.expires = expires
+        await upload.save()
+        return True
+    logger.warning(f"Trying to set the expiry of a non-existing upload session: {upload_id}")
+    return False
+
+
+@call_sync
+async def sync_set_workspace_upload_expiry(upload_id, expires: datetime) -> bool:
+    return await set_workspace_upload_expiry(upload_id, expires)
+
+
+@traced
+async def delete_workspace_upload(upload_id) -> bool:
+    upload = await get_workspace_upload(upload_id)
+    if upload:
+        await upload.delete()
+        return True
+    logger.warning(f"Trying to delete a non-existing upload session: {upload_id}")
+    return False
+
+
+@call_sync
+async def sync_delete_workspace_upload(upload_id) -> bool:
+    return await delete_workspace_upload(upload_id)
+
+
+@traced
+async def get_expired_workspace_uploads(now: datetime = None) -> List[WorkspaceUploadDB]:
+    if now is None:
+        now = datetime.utcnow()
+    return await WorkspaceUploadDB.find(WorkspaceUploadDB.expires < now).to_list()
+
+
+@call_sync
+async def sync_get_expired_workspace_uploads(now: datetime = None) -> List[WorkspaceUploadDB]:
+    return await get_expired_workspace_uploads(now)
+
+
+@traced
+async def get_workspace_import(import_id) -> Union[WorkspaceImportDB, None]:
+    return await WorkspaceImportDB.find_one(WorkspaceImportDB.import_id == import_id)
+
+
+@call_sync
+async def sync_get_workspace_import(import_id) -> Union[WorkspaceImportDB, None]:
+    return await get_workspace_import(import_id)
+
+
+@traced
+async def save_workspace_import(import_id: str, mets_url: str, job_state: str,
+                                file_grp: List[str] = None, mets_basename: str = "mets.xml",
+                                owner: str = None) -> Union[WorkspaceImportDB, None]:
+    """
+    save a workspace import job to the database
+
+    Arguments:
+        import_id: id of the import job
+        mets_url: the URL of the METS file to import
+        job_state: current state of the import job
+        file_grp: (optional) file groups to import
+        mets_basename: the name of the METS file inside the workspace
+        owner: (optional) e-mail of the user who started the import
+    """
+    import_db = WorkspaceImportDB(
+        import_id=import_id,
+        mets_url=mets_url,
+        file_grp=file_grp,
+        mets_basename=mets_basename,
+        job_state=job_state,
+        owner=owner
+    )
+    await import_db.save()
+    return import_db
+
+
+@call_sync
+async def sync_save_workspace_import(import_id: str, mets_url: str, job_state: str,
+                                     file_grp: List[str] = None, mets_basename: str = "mets.xml",
+                                     owner: str = None) -> Union[WorkspaceImportDB, None]:
+    return await save_workspace_import(import_id, mets_url, job_state, file_grp, mets_basename,
+                                       owner)
+
+
+@traced
+async def set_workspace_import_state(import_id, job_state: str, workspace_id: str = None,
+                                     failure_reason: str = None) -> bool:
+    """
+    set state of a workspace import job to 'job_state'
+    """
+    import_db = await get_workspace_import(import_id)
+    if import_db:
+        import_db.job_state = job_state
+        if workspace_id:
+            import_db.workspace_id = workspace_id
+        if failure_reason:
+            import_db.failure_reason = failure_reason
+        await import_db.save()
+        return True
+    logger.warning(f"Trying to set a state to a non-existing workspace import: {import_id}")
+    return False
+
+
+@call_sync
+async def sync_set_workspace_import_state(import_id, job_state: str, workspace_id: str = None,
+                                          failure_reason: str = None) -> bool:
+    return await set_workspace_import_state(import_id, job_state, workspace_id, failure_reason)
+
+
+@traced
+async def get_processing_job(job_id) -> Union[ProcessingJobDB, None]:
+    return await ProcessingJobDB.find_one(ProcessingJobDB.job_id == job_id)
+
+
+@call_sync
+async def sync_get_processing_job(job_id) -> Union[ProcessingJobDB, None]:
+    return await get_processing_job(job_id)
+
+
+@traced
+async def get_processing_jobs(job_ids: List[str]) -> List[ProcessingJobDB]:
+    """
+    Returns the processing jobs with one query, unknown jobs are left out
+    """
+    return await ProcessingJobDB.find(In(ProcessingJobDB.job_id, job_ids)).to_list()
+
+
+@call_sync
+async def sync_get_processing_jobs(job_ids: List[str]) -> List[ProcessingJobDB]:
+    return await get_processing_jobs(job_ids)
+
+
+@traced
+async def save_processing_job(job_id: str, processor_name: str, path_to_mets: str,
+                              input_file_grps: List[str], job_state: str, created_time: int,
+                              workspace_id: str = None, output_file_grps: List[str] = None,
+                              page_id: str = None, parameters: dict = None,
+                              parent_job_id: str = None, shard_job_ids: List[str] = None
+                              ) -> Union[ProcessingJobDB, None]:
+    """
+    save a processing job to the database
+
+    Arguments:
+        job_id: id of the processing job
+        processor_name: name of the OCR-D processor
+        path_to_mets: path of the METS file the job is running on
+        input_file_grps: list of input file groups
+        job_state: current state of the job
+        created_time: unix timestamp of the job creation
+        workspace_id: (optional) id of the workspace the job is running on
+        output_file_grps: (optional) list of output file groups
+        page_id: (optional) page ids to be processed
+        parameters: (optional) parameters passed to the OCR-D processor
+        parent_job_id: (optional) id of the sharded job this job is a shard of
+        shard_job_ids: (optional) ids of the shards of this job
+    """
+    processing_job_db = ProcessingJobDB(
+        job_id=job_id,
+        processor_name=processor_name,
+        workspace_id=workspace_id,
+        path_to_mets=path_to_mets,
+        input_file_grps=input_file_grps,
+        output_file_grps=output_file_grps,
+        page_id=page_id,
+        parameters=parameters,
+        job_state=job_state,
+        created_time=created_time,
+        parent_job_id=parent_job_id,
+        shard_job_ids=shard_job_ids
+    )
+    await processing_job_db.save()
+    return processing_job_db
+
+
+@call_sync
+async def sync_save_processing_job(job_id: str, processor_name: str, path_to_mets: str,
+                                   input_file_grps: List[str], job_state: str, created_time: int,
+                                   workspace_id: str = None, output_file_grps: List[str] = None,
+                                   page_id: str = None, parameters: dict = None,
+                                   parent_job_id: str = None, shard_job_ids: List[str] = None
+                                   ) -> Union[ProcessingJobDB, None]:
+    return await save_processing_job(job_id, processor_name, path_to_mets, input_file_grps,
+                                     job_state, created_time, workspace_id, output_file_grps,
+                                     page_id, parameters, parent_job_id, shard_job_ids)
+
+
+@traced
+async def set_processing_job_state(job_id, job_state: str) -> bool:
+    """
+    set state of a processing job to 'job_state'
+    """
+    job = await get_processing_job(job_id)
+    if job:
+        job.job_state = job_state
+        await job.save()
+        return True
+    logger.warning(f"Trying to set a state to a non-existing processing job: {job_id}")
+    return False
+
+
+@call_sync
+async def sync_set_processing_job_state(job_id, job_state: str) -> bool:
+    return await set_processing_job_state(job_id, job_state)
+
+
+@traced
+async def set_processing_job_states(job_states: Dict[str, str]) -> int:
+    """
+    set the states of many processing jobs with one bulk write. Finished jobs (SUCCESS or FAILED)
+    are not updated, a result arriving late never takes a job back to an earlier state
+
+    Arguments:
+        job_states: maps the id of a processing job to its new state
+
+    Returns:
+        the amount of unfinished processing jobs matched by the update
+    """
+    if not job_states:
+        return 0
+    updates = [
+        UpdateOne({"job_id": job_id, "job_state": {"$nin": ["SUCCESS", "FAILED"]}},
+                  {"$set": {"job_state": job_state}})
+        for job_id, job_state in job_states.items()
+    ]
+    result = await ProcessingJobDB.get_motor_collection().bulk_write(updates, ordered=False)
+    if result.matched_count < len(updates):
+        logger.info(f"Not setting the states of {len(updates) - result.matched_count} finished or "
+                    f"non-existing processing jobs")
+    return result.matched_count
+
+
+@call_sync
+async def sync_set_processing_job_states(job_states: Dict[str, str]) -> int:
+    return await set_processing_job_states(job_states)
+
+
+@traced
 async def get_user(email: str) -> Union[UserAccountDB, None]:
     return await UserAccountDB.find_one(UserAccountDB.email == email)
 
@@ -300,6 +1066,20 @@ async def sync_get_user(email: str) -> Union[UserAccountDB, None]:
     return await get_user(email)
 
 
+@traced
+async def get_users(emails: List[str]) -> List[UserAccountDB]:
+    """
+    Returns the user accounts with one query, unknown users are left out
+    """
+    return await UserAccountDB.find(In(UserAccountDB.email, emails)).to_list()
+
+
+@call_sync
+async def sync_get_users(emails: List[str]) -> List[UserAccountDB]:
+    return await get_users(emails)
+
+
+@traced
 async def create_user(email: str, encrypted_pass: str, salt: str, approved_user: bool = False
 ) -> Union[UserAccountDB, None]:
     user_account = UserAccountDB(
@@ -316,3 +1096,67 @@ async def create_user(email: str, encrypted_pass: str, salt: str, approved_user:
 async def sync_create_user(email: str, encrypted_pass: str, salt: str, approved_user: bool = False
 ) -> Union[UserAccountDB, None]:
     return await create_user(email, encrypted_pass, salt, approved_user)
+
+
+@traced
+async def add_user_usage(email: Optional[str], size: int, files: int) -> bool:
+    """
+    Add (or subtract, if negative) bytes and files to the usage of a user. Resources without an
+    owner, e.g. created before the usage was accounted, are not accounted to anybody
+    """
+    if not email or (size, files) == (0, 0):
+        return False
+    result = await UserAccountDB.find_one(UserAccountDB.email == email).update(
+        Inc({UserAccountDB.used_bytes: size, UserAccountDB.used_files: files})
+    )
+    return bool(result and result.modified_count)
+
+
+@call_sync
+async def sync_add_user_usage(email: Optional[str], size: int, files: int) -> bool:
+    return await add_user_usage(email, size, files)
+
+
+@traced
+async def acquire_lease(name: str, holder: str, ttl: float) -> Union[LeaseDB, None]:
+    """
+    Take or renew the lease `name` for `ttl` seconds, if it is expired or already held by `holder`
+
+    Returns:
+        the lease after the attempt, its holder tells whether the attempt succeeded
+    """
+    now = datetime.utcnow()
+    collection = LeaseDB.get_motor_collection()
+    try:
+        lease = await collection.find_one_and_update(
+            {"name": name, "$or": [{"holder": holder}, {"expires": {"$lt": now}}]},
+            {"$set": {"holder": holder, "expires": now + timedelta(seconds=ttl)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Held by another worker, the upsert collided with the unique name
+        lease = await collection.find_one({"name": name})
+    return LeaseDB.parse_obj(lease) if lease else None
+
+
+@call_sync
+async def sync_acquire_lease(name: str, holder: str, ttl: float) -> Union[LeaseDB, None]:
+    return await acquire_lease(name, holder, ttl)
+
+
+@traced
+async def release_lease(name: str, holder: str) -> bool:
+    """
+    Give up the lease `name` if it is held by `holder`, another worker may take it over at once
+    """
+    result = await LeaseDB.get_motor_collection().update_one(
+        {"name": name, "holder": holder},
+        {"$set": {"expires": datetime.utcfromtimestamp(0)}}
+    )
+    return bool(result.modified_count)
+
+
+@call_sync
+async def sync_release_lease(name: str, holder: str) -> bool:
+    return await release_lease(name, holder)
@@ -6,6 +6,21 @@ class RegistrationError(Exception):
     pass
 
 
+class QuotaExceededError(Exception):
+    pass
+
+
+class AdmissionRefusedError(Exception):
+    """
+    Exception to indicate that the server is saturated and refuses a request for now
+    """
+
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
 # TODO: This needs a better organization and inheritance structure
 class ResponseException(Exception):
     """
@@ -39,8 +54,43 @@ class WorkspaceGoneException(WorkspaceException):
     pass
 
 
+class WorkspaceUploadException(WorkspaceException):
+    """
+    Exception to indicate something is wrong with a resumable workspace upload
+    """
+    pass
+
+
+class WorkspaceUploadOffsetException(WorkspaceUploadException):
+    """
+    Exception to indicate that a chunk does not start at the current offset of the upload
+    """
+    pass
+
+
 class WorkflowJobException(WorkflowException):
     """
     Exception to indicate something is wrong with a workflow-job
     """
     pass
+
+
+class WorkflowParametersException(WorkflowJobException):
+    """
+    Exception to indicate that the parameters of a workflow-job are not declared by the workflow
+    """
+    pass
+
+
+class WorkflowJobStateException(WorkflowJobException):
+    """
+    Exception to indicate that the current state of a workflow-job does not allow the operation
+    """
+    pass
+
+
+class ProcessingJobException(Exception):
+    """
+    Exception to indicate something is wrong with a processing-job
+    """
+    pass
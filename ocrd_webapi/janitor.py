@@ -0,0 +1,362 @@
+"""
+Background janitor for the disk space used by the Web API.
+
+Several artifacts outlive the requests which created them. The janitor sweeps them periodically,
+each class with its own retention:
+    - temp_archive: zip archives of workflow jobs in `ocrd-wf-job-zip-*` temp dirs
+    - ingest_staging: `*.zip` files next to the workspaces, i.e. uploads whose ingest was aborted
+      and bags whose download was aborted. Recently modified ones may belong to an ingest in
+      flight and are left alone
+    - job_work_dir: the Nextflow `work/` dirs of finished workflow jobs
+    - job_dir: the dirs of finished workflow jobs
+    - deleted_workspace: dirs of workspaces which are flagged as deleted in the database
+
+When the disk is fuller than the high-water mark, the least recently used artifacts of all classes
+are evicted until the low-water mark is reached, even before their retention is over. Artifacts of
+running jobs and live workspaces are never touched.
+
+Only one janitor per host and BASE_DIR sweeps at a time: the leader elected among the Web API
+workers of the host (see the coordination module) or, without an election, the worker holding a
+file lock in the BASE_DIR. A leader which loses its lease stops in the middle of a sweep.
+
+Deleted workspaces and workflows are renamed into the trash at once. The trash reaper removes them
+in the background with a bounded rate of removed files per second.
+"""
+from asyncio import get_running_loop, sleep
+from datetime import datetime
+from os import lstat, remove, rmdir, scandir, unlink, walk
+from os.path import basename, dirname, isdir, islink, join
+from shutil import disk_usage, rmtree
+from stat import S_ISDIR
+from time import time
+from itertools import islice
+from typing import Callable, Dict, Iterator, List, Tuple
+import fcntl
+import logging
+import tempfile
+
+from ocrd_webapi import database as db
+from ocrd_webapi.constants import (
+    BASE_DIR,
+    JANITOR_DELETED_WORKSPACE_RETENTION,
+    JANITOR_HIGH_WATER_MARK,
+    JANITOR_INGEST_MIN_AGE,
+    JANITOR_INGEST_STAGING_RETENTION,
+    JANITOR_INTERVAL,
+    JANITOR_JOB_DIR_RETENTION,
+    JANITOR_JOB_WORK_DIR_RETENTION,
+    JANITOR_LOW_WATER_MARK,
+    JANITOR_TEMP_ARCHIVE_RETENTION,
+    REAPER_FILES_PER_SECOND,
+    REAPER_INTERVAL,
+    TRASH_ROUTER,
+    WORKFLOWS_ROUTER,
+    WORKSPACES_ROUTER,
+)
+from ocrd_webapi.managers.nextflow_manager import NextflowManager
+from ocrd_webapi.models.janitor import StorageArtifact, StorageReport
+from ocrd_webapi.utils import dir_usage
+
+__all__ = [
+    "StorageJanitor",
+    "TEMP_ARCHIVE_PREFIX",
+    "TrashReaper",
+]
+
+# Prefix of the temp dirs holding the zip archives of workflow jobs
+TEMP_ARCHIVE_PREFIX = "ocrd-wf-job-zip-"
+# States of workflow jobs whose Nextflow run is over
+FINISHED_JOB_STATES = ["STOPPED", "SUCCESS", "FAILED", "CANCELLED"]
+
+
+def tree_usage(path: str) -> Tuple[int, float]:
+    """
+    Returns the size in bytes of a file or directory tree and the latest access or modification
+    of anything inside it. The access times of directories are left out, listing them (e.g. by
+    this function) already updates them
+    """
+    stat = lstat(path)
+    if not S_ISDIR(stat.st_mode):
+        return stat.st_size, max(stat.st_atime, stat.st_mtime)
+    size, last_access = stat.st_size, stat.st_mtime
+    for root, dirs, files in walk(path):
+        for name in dirs + files:
+            try:
+                stat = lstat(join(root, name))
+            except FileNotFoundError:
+                continue
+            size += stat.st_size
+            last_access = max(last_access,
+                              stat.st_mtime if S_ISDIR(stat.st_mode) else stat.st_atime)
+    return size, last_access
+
+
+def remove_artifact(path: str) -> None:
+    if isdir(path):
+        rmtree(path, ignore_errors=True)
+    else:
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def iter_removal(path: str) -> Iterator[str]:
+    """
+    Removes the tree at `path` deepest first, lazily: yields each removed path after its removal
+    """
+    if islink(path) or not isdir(path):
+        remove_artifact(path)
+        yield path
+        return
+    for root, dirs, files in walk(path, topdown=False):
+        # Symlinks to dirs are listed as dirs, but are removed like files
+        for name in files + [name for name in dirs if islink(join(root, name))]:
+            unlink(join(root, name))
+            yield join(root, name)
+        rmdir(root)
+        yield root
+
+
+def advance(iterator: Iterator, steps: int) -> int:
+    return sum(1 for _ in islice(iterator, steps))
+
+
+class TrashReaper:
+    """
+    Removes the trash of deleted resources, at most `files_per_second` files per second
+    """
+    def __init__(self, base_dir: str = BASE_DIR, files_per_second: int = REAPER_FILES_PER_SECOND,
+                 interval: float = REAPER_INTERVAL, log_level: str = "INFO"):
+        self.log = logging.getLogger(__name__)
+        self.log.setLevel(logging.getLevelName(log_level))
+        self.trash_dir = join(base_dir, TRASH_ROUTER)
+        self.files_per_second = files_per_second
+        self.interval = interval
+
+    async def reap(self) -> int:
+        """
+        Removes everything in the trash, returns the amount of removed files and dirs
+        """
+        if not isdir(self.trash_dir):
+            return 0
+        loop = get_running_loop()
+        # A tenth of the rate at a time, so the IO is spread evenly
+        batch = max(1, self.files_per_second // 10)
+        reaped = 0
+        for entry in list(scandir(self.trash_dir)):
+            removals = iter_removal(entry.path)
+            removed = batch
+            while removed == batch:
+                removed = await loop.run_in_executor(None, advance, removals, batch)
+                reaped += removed
+                await sleep(removed / self.files_per_second)
+            self.log.info(f"Reaped from the trash: {entry.name}")
+        return reaped
+
+    async def reap_periodically(self, is_leader: Callable[[], bool] = lambda: True) -> None:
+        """
+        Args:
+            is_leader: whether this worker reaps, the others would only multiply the IO rate
+        """
+        while True:
+            try:
+                if is_leader():
+                    await self.reap()
+            except Exception as error:
+                self.log.exception(f"Failed to reap the trash: {error}")
+            await sleep(self.interval)
+
+
+class StorageJanitor:
+    def __init__(self, base_dir: str = BASE_DIR, temp_dir: str = None,
+                 retentions: Dict[str, int] = None,
+                 high_water_mark: float = JANITOR_HIGH_WATER_MARK,
+                 low_water_mark: float = JANITOR_LOW_WATER_MARK, interval: int = JANITOR_INTERVAL,
+                 ingest_min_age: int = JANITOR_INGEST_MIN_AGE,
+                 get_disk_usage: Callable = disk_usage, log_level: str = "INFO"):
+        self.log = logging.getLogger(__name__)
+        self.log.setLevel(logging.getLevelName(log_level))
+        self.base_dir = base_dir
+        self.temp_dir = temp_dir or tempfile.gettempdir()
+        # Retentions in seconds per artifact class, classes with a negative one are only evicted
+        self.retentions = {
+            "temp_archive": JANITOR_TEMP_ARCHIVE_RETENTION,
+            "ingest_staging": JANITOR_INGEST_STAGING_RETENTION,
+            "job_work_dir": JANITOR_JOB_WORK_DIR_RETENTION,
+            "job_dir": JANITOR_JOB_DIR_RETENTION,
+            "deleted_workspace": JANITOR_DELETED_WORKSPACE_RETENTION,
+        }
+        self.retentions.update(retentions or {})
+        # Seconds since the last modification before a staging zip may be removed
+        self.ingest_min_age = ingest_min_age
+        self.high_water_mark = high_water_mark
+        self.low_water_mark = low_water_mark
+        self.interval = interval
+        self._get_disk_usage = get_disk_usage
+        self._lock_file = None
+
+    def acquire_lock(self) -> bool:
+        """
+        Returns whether this janitor is (or became) the one sweeping. The lock is held until the
+        process exits, so another worker takes over when the current one dies
+        """
+        if self._lock_file:
+            return True
+        lock_file = open(join(self.base_dir, ".janitor.lock"), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def release_lock(self) -> None:
+        if self._lock_file:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+    async def collect_artifacts(self) -> List[StorageArtifact]:
+        """
+        Returns all artifacts the janitor may remove, whatever their age
+        """
+        loop = get_running_loop()
+        deleted_workspaces = set(await db.get_deleted_workspace_ids())
+        job_dirs = await loop.run_in_executor(None, self._list_job_dirs)
+        job_states = await db.get_workflow_job_states([job_id for job_id, _ in job_dirs])
+        finished_job_dirs = [
+            job_dir for job_id, job_dir in job_dirs
+            if job_states.get(job_id) in FINISHED_JOB_STATES
+            or NextflowManager.is_nf_report(job_dir)
+        ]
+        return await loop.run_in_executor(None, self._scan_artifacts, deleted_workspaces,
+                                          finished_job_dirs)
+
+    async def sweep(self, dry_run: bool = False) -> StorageReport:
+        """
+        Remove the artifacts whose retention is over and, above the high-water mark, the least
+        recently used ones until the low-water mark is reached
+
+        Args:
+            dry_run: only report the artifacts which would be removed
+        """
+        artifacts = await self.collect_artifacts()
+        usage = self._get_disk_usage(self.base_dir)
+        now = time()
+        selected: Dict[str, StorageArtifact] = {}
+        freed = 0
+        for artifact in artifacts:
+            retention = self.retentions.get(artifact.artifact_class, -1)
+            if 0 <= retention <= now - artifact.last_access.timestamp():
+                freed += self._select(selected, artifact, "retention")
+
+        if usage.used * 100 > self.high_water_mark * usage.total:
+            target = usage.total * self.low_water_mark / 100
+            for artifact in sorted(artifacts, key=lambda a: a.last_access):
+                if usage.used - freed <= target:
+                    break
+                freed += self._select(selected, artifact, "eviction")
+
+        report = StorageReport(
+            dry_run=dry_run,
+            disk_total=usage.total,
+            disk_used=usage.used,
+            high_water_mark=self.high_water_mark,
+            low_water_mark=self.low_water_mark,
+            freed=freed,
+            artifacts=list(selected.values())
+        )
+        if not dry_run and selected:
+            loop = get_running_loop()
+            for path, artifact in selected.items():
+                await loop.run_in_executor(None, remove_artifact, path)
+                if artifact.artifact_class in ["job_dir", "job_work_dir"]:
+                    job_dir = path if artifact.artifact_class == "job_dir" else dirname(path)
+                    await self._account_job_dir(job_dir)
+            self.log.info(f"Removed {len(selected)} storage artifacts, freed {freed} bytes")
+        return report
+
+    async def sweep_periodically(self, is_leader: Callable[[], bool] = None) -> None:
+        """
+        Args:
+            is_leader: whether this worker sweeps, by default the worker holding the file lock
+        """
+        is_leader = is_leader or self.acquire_lock
+        while True:
+            try:
+                if is_leader():
+                    await self.sweep()
+            except Exception as error:
+                self.log.exception(f"Failed to sweep the storage: {error}")
+            await sleep(self.interval)
+
+    @staticmethod
+    async def _account_job_dir(job_dir: str) -> None:
+        # The job's owner gets the removed bytes back
+        size, files = await get_running_loop().run_in_executor(None, dir_usage, job_dir)
+        await db.set_workflow_job_usage(basename(job_dir), size, files)
+
+    @staticmethod
+    def _select(selected: Dict[str, StorageArtifact], artifact: StorageArtifact,
+                reason: str) -> int:
+        """
+        Adds the artifact to the selected ones and returns the bytes this frees additionally,
+        artifacts inside already selected dirs (e.g. the work dir of a job dir) free nothing
+        """
+        if any(artifact.path == path or artifact.path.startswith(path + "/") for path in selected):
+            return 0
+        freed = artifact.size
+        for path in [path for path in selected if path.startswith(artifact.path + "/")]:
+            freed -= selected.pop(path).size
+        selected[artifact.path] = artifact.copy(update={"reason": reason})
+        return freed
+
+    def _list_job_dirs(self) -> List[Tuple[str, str]]:
+        job_dirs = []
+        workflows_dir = join(self.base_dir, WORKFLOWS_ROUTER)
+        if not isdir(workflows_dir):
+            return job_dirs
+        for workflow in scandir(workflows_dir):
+            if workflow.is_dir(follow_symlinks=False):
+                for job in scandir(workflow.path):
+                    if job.is_dir(follow_symlinks=False):
+                        job_dirs.append((job.name, job.path))
+        return job_dirs
+
+    def _scan_artifacts(self, deleted_workspaces: set,
+                        finished_job_dirs: List[str]) -> List[StorageArtifact]:
+        candidates = []
+        for entry in scandir(self.temp_dir):
+            if entry.name.startswith(TEMP_ARCHIVE_PREFIX) and entry.is_dir(follow_symlinks=False):
+                candidates.append((entry.path, "temp_archive"))
+        workspaces_dir = join(self.base_dir, WORKSPACES_ROUTER)
+        if isdir(workspaces_dir):
+            for entry in scandir(workspaces_dir):
+                if entry.is_file(follow_symlinks=False) and entry.name.endswith(".zip"):
+                    candidates.append((entry.path, "ingest_staging"))
+                elif entry.is_dir(follow_symlinks=False) and entry.name in deleted_workspaces:
+                    candidates.append((entry.path, "deleted_workspace"))
+        for job_dir in finished_job_dirs:
+            if isdir(join(job_dir, "work")):
+                candidates.append((join(job_dir, "work"), "job_work_dir"))
+            candidates.append((job_dir, "job_dir"))
+
+        artifacts = []
+        for path, artifact_class in candidates:
+            try:
+                size, last_access = tree_usage(path)
+            except FileNotFoundError:
+                # Removed in the meantime
+                continue
+            if artifact_class == "ingest_staging" and time() - last_access < self.ingest_min_age:
+                # Possibly still received or extracted by an ingest
+                continue
+            artifacts.append(StorageArtifact(
+                path=path,
+                artifact_class=artifact_class,
+                size=size,
+                last_access=datetime.fromtimestamp(last_access)
+            ))
+        return artifacts
@@ -1,22 +1,45 @@
+from asyncio import create_task, gather
 from datetime import datetime
 from os import environ
+from socket import gethostname
 
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 
+from ocrd_webapi.admission import classify_request
 from ocrd_webapi.authentication import (
     authenticate_user,
+    check_storage_quota,
+    parse_basic_credentials,
     register_user
 )
-from ocrd_webapi.constants import DB_URL, SERVER_URL
+from ocrd_webapi.constants import (
+    BASE_DIR,
+    DB_URL,
+    DEFAULT_ADMIN_USER,
+    SERVER_URL,
+    WORKFLOWS_ROUTER,
+    WORKSPACES_ROUTER
+)
+from ocrd_webapi.coordination import LeaderElection
 from ocrd_webapi.database import initiate_database
-from ocrd_webapi.exceptions import ResponseException, AuthenticationError
+from ocrd_webapi.exceptions import (
+    AdmissionRefusedError,
+    AuthenticationError,
+    QuotaExceededError,
+    ResponseException,
+)
+from ocrd_webapi.profiling import ProfilingMiddleware
+from ocrd_webapi.responses import FastJSONResponse
 from ocrd_webapi.routers import (
+    admin,
     discovery,
+    processor,
     user,
     workflow,
     workspace,
 )
+from ocrd_webapi.tracing import REQUEST_ID_HEADER, Tracer, accept_request_id, create_exporters
 
 app = FastAPI(
     title="OCR-D Web API",
@@ -33,12 +56,33 @@ app = FastAPI(
             "description": "The URL of your server offering the OCR-D API.",
         }
     ],
+    # Status and other single-resource responses are encoded with the fast encoder as well
+    default_response_class=FastJSONResponse,
 )
+app.include_router(admin.router)
 app.include_router(user.router)
 app.include_router(discovery.router)
-# app.include_router(processor.router)
+app.include_router(processor.router)
 app.include_router(workflow.router)
 app.include_router(workspace.router)
+# Added first, so it is the innermost middleware and runs in the task of the endpoint
+app.add_middleware(ProfilingMiddleware, profiler=admin.request_profiler, is_admin=admin.is_admin)
+
+# Background tasks started on startup, cancelled on shutdown
+background_tasks = []
+# Elections of the background services which must run once across all workers
+elections = {
+    # The janitor and the trash reaper clean the dirs of the host, one of each per host and
+    # BASE_DIR. They share the election, so their IO is not split across workers
+    "janitor": LeaderElection(f"janitor-{gethostname()}:{BASE_DIR}"),
+    "upload-expiry": LeaderElection("upload-expiry"),
+    # The Nextflow runs can only be checked on the host they run on, one supervisor per host
+    "workflow-supervisor": LeaderElection(f"workflow-supervisor-{gethostname()}"),
+    # A single fair-share queue of the workflow jobs of all users
+    "workflow-dispatcher": LeaderElection("workflow-dispatcher"),
+}
+# Records the stages of the requests, disabled unless TRACE_FILE or TRACE_OTLP_ENDPOINT is set
+tracer = Tracer(create_exporters())
 
 
 @app.exception_handler(ResponseException)
@@ -49,6 +93,74 @@ async def exception_handler_empty404(request: Request, exc: ResponseException):
     return JSONResponse(status_code=exc.status_code, content={} if not exc.body else exc.body)
 
 
+@app.middleware("http")
+async def enforce_storage_quota(request: Request, call_next):
+    """
+    Reject requests which store something for a user over quota before their body is received.
+    Deleting is always possible. Bodies without Content-Length are checked when they are stored,
+    the chunks of resumable uploads together with the bytes staged already
+    """
+    if request.method in ["POST", "PUT", "PATCH"] and \
+            request.url.path.startswith((f"/{WORKSPACES_ROUTER}", f"/{WORKFLOWS_ROUTER}")):
+        credentials = parse_basic_credentials(request.headers.get("Authorization"))
+        if credentials:
+            try:
+                # Only authenticated users learn about their usage
+                await authenticate_user(*credentials)
+                await check_storage_quota(credentials[0],
+                                          int(request.headers.get("Content-Length") or 0))
+            except QuotaExceededError as error:
+                return JSONResponse(status_code=413, content={"error": "storage quota exceeded",
+                                                              "reason": str(error)})
+            except (AuthenticationError, ValueError):
+                # Rejected by the endpoint
+                pass
+    return await call_next(request)
+
+
+# Added last, so it runs first: refusing is cheaper than authenticating
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    """
+    Refuse uploads and job submissions while the server is saturated, before their body is received
+    """
+    request_kind = classify_request(request.method, request.url.path)
+    try:
+        if request_kind == "ingest":
+            try:
+                content_length = int(request.headers.get("Content-Length") or 0)
+            except ValueError:
+                content_length = 0
+            async with discovery.admission_controller.ingest(content_length):
+                return await call_next(request)
+        if request_kind == "job":
+            await discovery.admission_controller.admit_job()
+    except AdmissionRefusedError as error:
+        return JSONResponse(
+            status_code=error.status_code,
+            content={"error": "server saturated", "reason": str(error)},
+            headers={"Retry-After": str(error.retry_after)}
+        )
+    return await call_next(request)
+
+
+# Added after the admission control, so refused requests are traced as well
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    """
+    Handle the request with a request ID, returned in the response header, and trace its stages
+    until the response starts
+    """
+    request_id = accept_request_id(request.headers.get(REQUEST_ID_HEADER))
+    with tracer.trace(f"{request.method} {request.url.path}", request_id,
+                      method=request.method, path=request.url.path) as root:
+        response = await call_next(request)
+        if root:
+            root.set_attribute("status_code", response.status_code)
+    response.headers[REQUEST_ID_HEADER] = request_id
+    return response
+
+
 @app.on_event("startup")
 async def startup_event():
     """
@@ -56,7 +168,7 @@ async def startup_event():
     """
     await initiate_database(DB_URL)
 
-    default_admin_user = environ.get("OCRD_WEBAPI_USERNAME", "test")
+    default_admin_user = DEFAULT_ADMIN_USER
     default_admin_pass = environ.get("OCRD_WEBAPI_PASSWORD", "test")
 
     # If the default admin user account is not available in the DB, create it
@@ -71,6 +183,54 @@ async def startup_event():
             approved_user=True
         )
 
+    # Every worker runs the background services, only the elected leader of a service does the work
+    for election in elections.values():
+        background_tasks.append(election.start())
+    background_tasks.append(create_task(
+        workspace.workspace_manager.expire_workspace_uploads_periodically(
+            is_leader=elections["upload-expiry"].is_leader
+        )
+    ))
+    # Cancelled as soon as the worker loses the lease, also in the middle of a sweep
+    background_tasks.append(create_task(elections["janitor"].run_as_leader(clean_storage)))
+    # Started as soon as this worker is elected, its first pass finishes the workflow jobs whose
+    # runs died while the server was down
+    background_tasks.append(create_task(elections["workflow-supervisor"].run_as_leader(
+        workflow.workflow_manager.supervise_workflow_jobs
+    )))
+    background_tasks.append(create_task(elections["workflow-dispatcher"].run_as_leader(
+        workflow.workflow_manager.dispatch_periodically
+    )))
+    await processor.processing_manager.start()
+
+
+async def clean_storage() -> None:
+    """
+    Sweeps the storage and reaps the trash periodically, while this worker is the janitor
+    """
+    await gather(
+        admin.storage_janitor.sweep_periodically(is_leader=lambda: True),
+        admin.trash_reaper.reap_periodically()
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Executed once on shutdown
+    """
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    # Another worker takes over at once instead of after the lease expired
+    for election in elections.values():
+        await election.resign()
+    admin.storage_janitor.release_lock()
+    await processor.processor_manager.stop()
+    await processor.processing_manager.stop()
+    # Exports the spans still buffered
+    tracer.close()
+
 
 @app.get("/")
 async def test():
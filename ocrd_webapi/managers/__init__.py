@@ -1,11 +1,15 @@
 __all__ = [
     'NextflowManager',
+    'ProcessingManager',
+    'ProcessorManager',
     'ResourceManager',
     'WorkflowManager',
     'WorkspaceManager',
 ]
 
 from .nextflow_manager import NextflowManager
+from .processing_manager import ProcessingManager
+from .processor_manager import ProcessorManager
 from .resource_manager import ResourceManager
 from .workflow_manager import WorkflowManager
 from .workspace_manager import WorkspaceManager
@@ -1,8 +1,33 @@
-from os.path import exists, join
+from datetime import datetime, timezone
+from os import getpgid, killpg, mkdir, replace
+from os.path import exists, getsize, join
+from signal import SIGKILL, SIGTERM
+from time import monotonic, sleep
 import shlex
 import subprocess
-from re import search as regex_search
-from typing import Union
+from re import compile as regex_compile, search as regex_search
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import psutil
+
+# Parameters the launcher passes itself, they cannot be set with `nf_params`
+NF_LAUNCHER_PARAMS = ["mets", "workspace_dir", "venv"]
+# `params.name = default` declarations and `process name {` definitions of a Nextflow script
+NF_PARAM_PATTERN = regex_compile(r"^\s*params\.([A-Za-z_]\w*)\s*=\s*(\"[^\"]*\"|'[^']*'|[^/]*)")
+NF_PROCESS_PATTERN = regex_compile(r"^\s*process\s+([A-Za-z_]\w*)\s*\{")
+# Human-readable values of the trace file, e.g. `1h 2m 3s`, `345ms`, `1.2 GB` or `98.5%`
+NF_DURATION_PATTERN = regex_compile(r"([\d.]+)\s*(ms|s|m|h|d)")
+NF_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400}
+NF_MEMORY_PATTERN = regex_compile(r"^([\d.]+)\s*([KMGTP]?B)$")
+NF_MEMORY_UNITS = {
+    "B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4, "PB": 1024 ** 5
+}
+# The message of an `ERROR` line of `.nextflow.log`, e.g.
+# `Jan-01 12:00:00.000 [main] ERROR nextflow.Nextflow - ...`
+NF_LOG_ERROR_PATTERN = regex_compile(r"^.*\sERROR\s+\S+\s+-\s+(.*)$")
+# Seconds the creation time of a process may be before the start of its run, the kernel derives
+# it from the boot time, which is only known to the second
+NF_PROCESS_TIME_SLACK = 2
 
 
 # Must be further refined
@@ -22,20 +47,22 @@ class NextflowManager:
             workspace_path: str = None,
             venv_path: str = None,
             input_group: str = None,
-            in_background=True
+            in_background=True,
+            resume: bool = False,
+            nf_params: Dict[str, Any] = None
     ):
-        # TODO: Parse the rest of the possible workflow params
-        # TODO: Use workflow_params to enable more flexible workflows
         nf_command = NextflowManager.build_nf_command(
             nf_script_path=nf_script_path,
             ws_mets_path=workspace_mets_path,
             ws_path=workspace_path,
             venv_path=venv_path,
             input_group=input_group,
-            in_background=in_background
+            in_background=in_background,
+            resume=resume,
+            nf_params=nf_params
         )
 
-        # Throws an exception if not successful
+        # Throws an exception if not successful, returns the id of the process group of the run
         return NextflowManager.__start_nf_process(nf_command, job_dir)
 
     @staticmethod
@@ -70,13 +97,19 @@ class NextflowManager:
             ws_path: str = None,
             venv_path: str = None,
             input_group: str = None,
-            in_background: bool = True
+            in_background: bool = True,
+            resume: bool = False,
+            nf_params: Dict[str, Any] = None
     ) -> str:
         nf_command = "nextflow"
         # If set, executes the nf process in the background
         if in_background:
             nf_command += " -bg"
         nf_command += f" run {nf_script_path}"
+        # Reuses the completed tasks of the last run in the same launch (job) dir from the task
+        # cache
+        if resume:
+            nf_command += " -resume"
         nf_command += f" --mets {ws_mets_path}"
         if ws_path:
             nf_command += f" --workspace_dir {ws_path}"
@@ -86,11 +119,27 @@ class NextflowManager:
         # If None, the input_group set inside the Nextflow script will be used
         if input_group:
             nf_command += f" --input_group {input_group}"
+        # Further `params.*` of the script, validated against the parameters of the workflow
+        for param_name, param_value in (nf_params or {}).items():
+            if param_name in NF_LAUNCHER_PARAMS or (param_name == "input_group" and input_group):
+                raise ValueError(f"Parameter passed by the launcher: {param_name}")
+            nf_command += f" --{param_name} {NextflowManager.to_nf_value(param_value)}"
         nf_command += " -with-report report.html"
+        # The completed tasks with their duration and resources, read while the run progresses
+        nf_command += " -with-trace trace.txt"
         return nf_command
 
     @staticmethod
-    def __start_nf_process(nf_command: str, job_dir: str):
+    def to_nf_value(value: Any) -> str:
+        """
+        Returns the command line value of a parameter, booleans as Nextflow (Groovy) spells them
+        """
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        return shlex.quote(str(value))
+
+    @staticmethod
+    def __start_nf_process(nf_command: str, job_dir: str) -> int:
         nf_out = f'{job_dir}/nextflow_out.txt'
         nf_err = f'{job_dir}/nextflow_err.txt'
 
@@ -101,19 +150,324 @@ class NextflowManager:
                 with open(nf_err, 'w+') as nf_err_file:
                     # TODO: We will need better management of this, blocking is bad
                     # The parent process blocks till the subprocess returns.
+                    # The run gets its own session and process group, inherited by the
+                    # backgrounded Nextflow and the OCR-D processors it starts, so the
+                    # whole run can be signalled at once
+                    nf_process = subprocess.Popen(shlex.split(nf_command),
+                                                  shell=False,
+                                                  cwd=job_dir,
+                                                  stdout=nf_out_file,
+                                                  stderr=nf_err_file,
+                                                  universal_newlines=True,
+                                                  start_new_session=True)
+                    return_code = nf_process.wait()
                     # Raises an exception if the subprocess fails
-                    nf_process = subprocess.run(shlex.split(nf_command),
-                                                shell=False,
-                                                check=True,
-                                                cwd=job_dir,
-                                                stdout=nf_out_file,
-                                                stderr=nf_err_file,
-                                                universal_newlines=True)
+                    if return_code != 0:
+                        raise subprocess.CalledProcessError(return_code, nf_command)
         # More detailed exception catches needed
         # E.g., was the exception due to IOError or subprocess.CalledProcessError
         except Exception as error:
             raise error
-        return nf_process
+        # The session leader is also the leader of the process group
+        return nf_process.pid
+
+    @staticmethod
+    def get_process_group_members(process_group_id: int) -> List[int]:
+        """
+        Returns the pids of the alive (not zombie) processes in the process group
+        """
+        members = []
+        for process in psutil.process_iter(["pid", "status"]):
+            if process.info["status"] == psutil.STATUS_ZOMBIE:
+                continue
+            try:
+                if getpgid(process.info["pid"]) == process_group_id:
+                    members.append(process.info["pid"])
+            except ProcessLookupError:
+                continue
+        return members
+
+    @staticmethod
+    def get_live_process_groups() -> Dict[int, float]:
+        """
+        Returns the ids of the process groups with alive (not zombie) processes, mapped to the
+        creation time (seconds since the epoch) of their oldest process. One pass over the
+        processes of the host for any amount of runs
+        """
+        process_groups = {}
+        for process in psutil.process_iter(["pid", "status", "create_time"]):
+            if process.info["status"] == psutil.STATUS_ZOMBIE:
+                continue
+            try:
+                process_group_id = getpgid(process.info["pid"])
+            except ProcessLookupError:
+                continue
+            # Unknown if the process is not accessible, then the others of the group decide
+            created = process.info["create_time"] or float("inf")
+            oldest = process_groups.get(process_group_id, created)
+            process_groups[process_group_id] = min(created, oldest)
+        return process_groups
+
+    @staticmethod
+    def get_run_state(location_dir: str, process_group_id: Optional[int],
+                      started: Optional[datetime],
+                      live_process_groups: Dict[int, float]) -> Tuple[str, Optional[str]]:
+        """
+        Check whether the Nextflow run in `location_dir` is still alive
+
+        Arguments:
+            location_dir: the launch (job) dir of the run
+            process_group_id: id of the process group of the run, if known
+            started: when the run was started (UTC), if known
+            live_process_groups: see `get_live_process_groups`
+
+        Returns:
+            RUNNING if the run is alive, STOPPED if it ended with a report, otherwise FAILED with
+            the reason
+        """
+        # The ids of the process groups are reused after a reboot, runs from before are dead
+        booted = datetime.utcfromtimestamp(psutil.boot_time())
+        if not started or started > booted:
+            # Also reused while the host is up, then the processes are older than the run
+            if process_group_id in live_process_groups and NextflowManager.created_since(
+                    live_process_groups[process_group_id], started):
+                return "RUNNING", None
+            nf_pid = NextflowManager.read_nf_pid(location_dir)
+            if not process_group_id and nf_pid:
+                try:
+                    if NextflowManager.created_since(psutil.Process(nf_pid).create_time(), started):
+                        return "RUNNING", None
+                except psutil.Error:
+                    pass
+        if NextflowManager.is_nf_report(location_dir):
+            return "STOPPED", None
+        reason = "Nextflow run exited without a report"
+        last_error = NextflowManager.get_last_error(location_dir)
+        if last_error:
+            reason += f": {last_error}"
+        task_states = NextflowManager.count_trace_states(location_dir)
+        if task_states:
+            task_counts = ", ".join(f"{count} {state}"
+                                    for state, count in sorted(task_states.items()))
+            reason += f" (tasks: {task_counts})"
+        return "FAILED", reason
+
+    @staticmethod
+    def created_since(created: float, started: Optional[datetime]) -> bool:
+        """
+        Whether a process created at `created` (seconds since the epoch) may belong to a run
+        started at `started` (UTC), if known
+        """
+        if not started:
+            return True
+        return created >= started.replace(tzinfo=timezone.utc).timestamp() - NF_PROCESS_TIME_SLACK
+
+    @staticmethod
+    def read_nf_pid(location_dir: str) -> Optional[int]:
+        """
+        Returns the pid of the background Nextflow run, which `nextflow -bg` writes to
+        `.nextflow.pid` in the launch dir
+        """
+        try:
+            with open(join(location_dir, ".nextflow.pid")) as pid_file:
+                return int(pid_file.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def get_last_error(location_dir: str, tail_bytes: int = 64 * 1024) -> Optional[str]:
+        """
+        Returns the last ERROR message of `.nextflow.log`, otherwise the last line Nextflow wrote
+        to stderr. Only the tail of the files is read
+        """
+        for file_name, pattern in [(".nextflow.log", NF_LOG_ERROR_PATTERN),
+                                   ("nextflow_err.txt", None)]:
+            try:
+                with open(join(location_dir, file_name), "rb") as log_file:
+                    log_file.seek(max(getsize(log_file.name) - tail_bytes, 0))
+                    lines = log_file.read().decode(errors="replace").splitlines()
+            except OSError:
+                continue
+            for line in reversed(lines):
+                if not line.strip():
+                    continue
+                if not pattern:
+                    return line.strip()
+                error_match = pattern.match(line)
+                if error_match:
+                    return error_match.group(1).strip()
+        return None
+
+    @staticmethod
+    def count_trace_states(location_dir: str) -> Dict[str, int]:
+        """
+        Count the tasks of the trace file (`-with-trace`) of the run by their status, e.g.
+        COMPLETED, FAILED or CACHED
+        """
+        counts: Dict[str, int] = {}
+        try:
+            with open(join(location_dir, "trace.txt"), errors="replace") as trace_file:
+                header = trace_file.readline().rstrip("\n").split("\t")
+                if "status" not in header:
+                    return counts
+                status_column = header.index("status")
+                for line in trace_file:
+                    columns = line.rstrip("\n").split("\t")
+                    if len(columns) > status_column:
+                        counts[columns[status_column]] = counts.get(columns[status_column], 0) + 1
+        except OSError:
+            pass
+        return counts
+
+    @staticmethod
+    def read_trace(location_dir: str, offset: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Read the tasks Nextflow appended to the trace file of the run since `offset`
+
+        Arguments:
+            location_dir: the launch (job) dir of the run
+            offset: the offset returned by the previous call, 0 for the first one
+
+        Returns:
+            the tasks (see `parse_trace_line`) and the offset to continue from. A line which is
+            still being written is left for the next call
+        """
+        try:
+            with open(join(location_dir, "trace.txt"), "rb") as trace_file:
+                header_line = trace_file.readline()
+                if not header_line.endswith(b"\n"):
+                    return [], offset
+                header = header_line.decode(errors="replace").rstrip("\n").split("\t")
+                trace_file.seek(max(offset, len(header_line)))
+                data = trace_file.read()
+        except OSError:
+            return [], offset
+        end = data.rfind(b"\n") + 1
+        tasks = []
+        for line in data[:end].decode(errors="replace").splitlines():
+            if line:
+                tasks.append(NextflowManager.parse_trace_line(header, line))
+        return tasks, max(offset, len(header_line)) + end
+
+    @staticmethod
+    def parse_trace_line(header: List[str], line: str) -> Dict[str, Any]:
+        """
+        Parse a line of the trace file into the process name, the status, the exit code, the
+        submit time (UTC), the durations (`duration` from submit, `realtime` of the execution)
+        in seconds, the CPU usage in percent and the peak RSS in bytes. Missing values are None
+        """
+        values = dict(zip(header, line.split("\t")))
+        name = values.get("name", "")
+        # `ocrd_dummy (1)`, the tag in parentheses identifies the task of the process
+        process = values.get("process") or name.split(" (", 1)[0]
+        exit_code = values.get("exit", "-")
+        return {
+            "task_id": values.get("task_id"),
+            "name": name,
+            "process": process,
+            "status": values.get("status"),
+            "exit": int(exit_code) if exit_code.lstrip("-").isdigit() else None,
+            "submit": NextflowManager._parse_trace_time(values.get("submit")),
+            "duration": NextflowManager._parse_trace_duration(values.get("duration")),
+            "realtime": NextflowManager._parse_trace_duration(values.get("realtime")),
+            "cpu": NextflowManager._parse_trace_number(values.get("%cpu", "").rstrip("%")),
+            "peak_rss": NextflowManager._parse_trace_memory(values.get("peak_rss")),
+        }
+
+    @staticmethod
+    def _parse_trace_number(value: Optional[str]) -> Optional[float]:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _parse_trace_duration(value: Optional[str]) -> Optional[float]:
+        if not value or value == "-":
+            return None
+        # Raw traces (`trace.raw = true`) have milliseconds
+        raw = NextflowManager._parse_trace_number(value)
+        if raw is not None:
+            return raw / 1000
+        parts = NF_DURATION_PATTERN.findall(value)
+        if not parts:
+            return None
+        return sum(float(amount) * NF_DURATION_UNITS[unit] for amount, unit in parts)
+
+    @staticmethod
+    def _parse_trace_memory(value: Optional[str]) -> Optional[int]:
+        if not value or value == "-":
+            return None
+        # Raw traces have bytes
+        raw = NextflowManager._parse_trace_number(value)
+        if raw is not None:
+            return int(raw)
+        memory_match = NF_MEMORY_PATTERN.match(value.strip())
+        if not memory_match:
+            return None
+        return int(float(memory_match.group(1)) * NF_MEMORY_UNITS[memory_match.group(2)])
+
+    @staticmethod
+    def _parse_trace_time(value: Optional[str]) -> Optional[datetime]:
+        if not value or value == "-":
+            return None
+        # Raw traces have epoch milliseconds, the others the local time of the host
+        raw = NextflowManager._parse_trace_number(value)
+        if raw is not None:
+            return datetime.utcfromtimestamp(raw / 1000)
+        try:
+            local_time = datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
+        except ValueError:
+            return None
+        return local_time.astimezone(timezone.utc).replace(tzinfo=None)
+
+    @staticmethod
+    def terminate_process_group(process_group_id: int, timeout: float = 10) -> bool:
+        """
+        Send SIGTERM to all processes of the group, so Nextflow can stop its tasks, and SIGKILL
+        to the remaining processes if the group did not exit after `timeout` seconds
+
+        Returns:
+            True if the group had to be killed
+        """
+        for sig in [SIGTERM, SIGKILL]:
+            try:
+                killpg(process_group_id, sig)
+            except ProcessLookupError:
+                return False
+            deadline = monotonic() + timeout
+            while NextflowManager.get_process_group_members(process_group_id):
+                if monotonic() > deadline:
+                    break
+                sleep(0.1)
+            else:
+                return sig == SIGKILL
+        return True
+
+    @staticmethod
+    def parse_nf_script(nf_script_path: str) -> Tuple[Dict[str, Optional[str]], List[str]]:
+        """
+        Parse the parameters and processes of a Nextflow script
+
+        Returns:
+            the `params.*` declarations mapped to their default values (quotes stripped) and the
+            names of the processes
+        """
+        nf_params, nf_processes = {}, []
+        with open(nf_script_path, errors="replace") as nf_script:
+            for line in nf_script:
+                param_match = NF_PARAM_PATTERN.match(line)
+                if param_match:
+                    param_name, default = param_match.groups()
+                    default = default.strip()
+                    if default[:1] in ["\"", "'"]:
+                        default = default[1:-1]
+                    nf_params[param_name] = default or None
+                    continue
+                process_match = NF_PROCESS_PATTERN.match(line)
+                if process_match:
+                    nf_processes.append(process_match.group(1))
+        return nf_params, nf_processes
 
     @staticmethod
     def is_nf_report(location_dir: str) -> Union[str, None]:
@@ -122,6 +476,35 @@ class NextflowManager:
             return report_path
         return None
 
+    @staticmethod
+    def count_cached_tasks(location_dir: str) -> int:
+        """
+        Count the tasks of the latest run in `location_dir` which were reused from the task cache
+        """
+        log_path = join(location_dir, ".nextflow.log")
+        if not exists(log_path):
+            return 0
+        with open(log_path, errors="replace") as log_file:
+            return sum(1 for line in log_file if "Cached process >" in line)
+
+    @staticmethod
+    def archive_attempt(location_dir: str, attempt: int) -> str:
+        """
+        Move the outputs of a finished run out of the way of the next run, the Nextflow task cache
+        (`.nextflow` and `work`) stays in place
+
+        Returns:
+            the directory the outputs were moved to
+        """
+        attempt_dir = join(location_dir, f"attempt_{attempt}")
+        if not exists(attempt_dir):
+            mkdir(attempt_dir)
+        for file_name in ["report.html", "trace.txt", "nextflow_out.txt", "nextflow_err.txt",
+                          ".nextflow.log"]:
+            if exists(join(location_dir, file_name)):
+                replace(join(location_dir, file_name), join(attempt_dir, file_name))
+        return attempt_dir
+
     @staticmethod
     def get_logfile_path(location_dir: str) -> Union[str, None]:
         logfile_path = join(location_dir, "nextflow_out.txt")
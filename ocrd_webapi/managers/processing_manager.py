@@ -0,0 +1,373 @@
+from asyncio import (
+    Queue,
+    Task,
+    TimeoutError,
+    create_task,
+    get_running_loop,
+    sleep,
+    wait_for,
+)
+from os import remove, replace
+from os.path import basename, dirname, exists, join
+from shutil import copyfile
+from time import time
+from typing import Awaitable, Callable, Dict, List, Set, Union
+import logging
+
+from ocrd_models import OcrdMets
+from pydantic import ValidationError
+
+from ocrd_webapi import database as db
+from ocrd_webapi.constants import (
+    PROCESSING_SHARD_TIMEOUT,
+    PROCESSING_WORKERS,
+    RESULT_BATCH_SIZE,
+    RESULT_FLUSH_INTERVAL,
+    RESULT_QUEUE,
+)
+from ocrd_webapi.exceptions import ProcessingJobException
+from ocrd_webapi.message_broker import Delivery, MessageBroker
+from ocrd_webapi.models.base import ProcessorArgs
+from ocrd_webapi.models.database import ProcessingJobDB
+from ocrd_webapi.models.ocrd_messages import OcrdProcessingMessageModel, OcrdResultMessageModel
+from ocrd_webapi.utils import (
+    expand_page_ids,
+    generate_id,
+    merge_mets_file_grps,
+    split_page_ids,
+)
+
+
+class ProcessingManager:
+    """
+    Publishes processing messages to the queue of the requested processor and consumes the
+    result messages of the processing workers to update the state of the processing jobs
+    """
+    def __init__(self, broker: MessageBroker, result_queue: str = RESULT_QUEUE,
+                 max_workers: int = PROCESSING_WORKERS,
+                 flush_interval: float = RESULT_FLUSH_INTERVAL, batch_size: int = RESULT_BATCH_SIZE,
+                 shard_timeout: float = PROCESSING_SHARD_TIMEOUT, log_level: str = "INFO"):
+        self.log = logging.getLogger(__name__)
+        self.log.setLevel(logging.getLevelName(log_level))
+        self.broker = broker
+        self.result_queue = result_queue
+        # Amount of workers available per processor, bounds the shards of a job
+        self.max_workers = max_workers
+        # Maximum latency and size of a batch of result messages written to the database at once
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # Seconds after which a sharded job with unfinished shards fails, e.g. when their result
+        # messages were lost
+        self.shard_timeout = shard_timeout
+        self._consumer_task: Union[Task, None] = None
+        self._sharded_tasks: Dict[str, Task] = {}
+        # Called with the id of a workspace when a processing job on it is finished
+        self._finished_hooks: List[Callable[[str], Awaitable[None]]] = []
+
+    async def start(self) -> None:
+        await self.broker.connect()
+        await self.broker.create_queue(self.result_queue)
+        self._consumer_task = create_task(self.consume_results())
+
+    async def stop(self) -> None:
+        if self._consumer_task:
+            self._consumer_task.cancel()
+            self._consumer_task = None
+        for task in self._sharded_tasks.values():
+            task.cancel()
+        self._sharded_tasks.clear()
+        await self.broker.close()
+
+    async def submit_job(self, processor_name: str,
+                         processor_args: ProcessorArgs) -> ProcessingJobDB:
+        """
+        Store a new processing job and publish its processing message to the queue of the processor
+        """
+        path_to_mets = await self._get_mets_path(processor_args)
+        message = self._build_message(processor_name, processor_args, path_to_mets,
+                                      processor_args.page_id)
+        job_db = await self._save_job(message, job_state="QUEUED")
+        await self.publish_processing_message(message)
+        return job_db
+
+    async def submit_sharded_job(self, processor_name: str, processor_args: ProcessorArgs,
+                                 shards: int = None) -> ProcessingJobDB:
+        """
+        Split a processing job into page-range shards which are processed in parallel
+
+        Each shard works on its own copy of the METS, so the workers do not compete for the METS
+        of the workspace. When all shards are finished, their output file groups are merged into
+        the METS of the workspace in one step.
+
+        Args:
+            processor_name: name of the OCR-D processor
+            processor_args: arguments of the job, all pages are processed if `page_id` is not set
+            shards: amount of shards, bounded by the available workers and the amount of pages
+        """
+        path_to_mets = await self._get_mets_path(processor_args)
+        if not processor_args.output_file_grps:
+            raise ProcessingJobException("Output file groups are required to merge the shards")
+        if processor_args.page_id:
+            page_ids = expand_page_ids(processor_args.page_id)
+        else:
+            page_ids = OcrdMets(filename=path_to_mets).physical_pages
+        if not page_ids:
+            raise ProcessingJobException(f"No pages to process in: {path_to_mets}")
+        shards = min(shards or self.max_workers, self.max_workers)
+
+        parent_message = self._build_message(processor_name, processor_args, path_to_mets,
+                                             processor_args.page_id)
+        shard_messages = []
+        for shard_page_ids in split_page_ids(page_ids, shards):
+            shard_mets_path = join(dirname(path_to_mets),
+                                   f".{generate_id()}.{basename(path_to_mets)}")
+            shard_messages.append(
+                self._build_message(processor_name, processor_args, shard_mets_path,
+                                    ",".join(shard_page_ids))
+            )
+        job_db = await self._save_job(
+            parent_message,
+            job_state="QUEUED",
+            shard_job_ids=[message.job_id for message in shard_messages]
+        )
+        self._sharded_tasks[job_db.job_id] = create_task(
+            self._run_sharded_job(job_db.job_id, path_to_mets, shard_messages,
+                                  parent_message.output_file_grps)
+        )
+        return job_db
+
+    async def _run_sharded_job(self, job_id: str, path_to_mets: str,
+                               shard_messages: List[OcrdProcessingMessageModel],
+                               output_file_grps: List[str]) -> None:
+        loop = get_running_loop()
+        try:
+            for message in shard_messages:
+                await loop.run_in_executor(None, copyfile, path_to_mets, message.path_to_mets)
+                await self._save_job(message, job_state="QUEUED", parent_job_id=job_id)
+            await db.set_processing_job_state(job_id=job_id, job_state="RUNNING")
+            # All shards are dispatched at once, the workers process them in parallel
+            for message in shard_messages:
+                await self.publish_processing_message(message)
+            shard_states = await self._wait_for_shards(
+                [message.job_id for message in shard_messages]
+            )
+            unfinished = [shard_id for shard_id, state in shard_states.items()
+                          if state not in ["SUCCESS", "FAILED"]]
+            if unfinished:
+                self.log.error(f"Sharded job {job_id} timed out, unfinished shards: {unfinished}")
+                await db.set_processing_job_states({shard_id: "FAILED" for shard_id in unfinished})
+                await db.set_processing_job_state(job_id=job_id, job_state="FAILED")
+                return
+
+            if any(state != "SUCCESS" for state in shard_states.values()):
+                self.log.error(f"Sharded job {job_id} failed, shard states: {shard_states}")
+                await db.set_processing_job_state(job_id=job_id, job_state="FAILED")
+                return
+            await loop.run_in_executor(
+                None, self._merge_shards, path_to_mets,
+                [message.path_to_mets for message in shard_messages], output_file_grps
+            )
+            await db.set_processing_job_state(job_id=job_id, job_state="SUCCESS")
+            await self._run_finished_hooks({shard_messages[0].workspace_id})
+        except Exception as error:
+            self.log.exception(f"Failed to run sharded job {job_id}: {error}")
+            await db.set_processing_job_state(job_id=job_id, job_state="FAILED")
+        finally:
+            for message in shard_messages:
+                if exists(message.path_to_mets):
+                    remove(message.path_to_mets)
+            self._sharded_tasks.pop(job_id, None)
+
+    async def _wait_for_shards(self, shard_ids: List[str]) -> Dict[str, str]:
+        """
+        Poll the states of the shards till all are finished or the shard timeout passed. The states
+        are read from the database, the results may be consumed by any instance sharing the
+        result queue
+        """
+        loop = get_running_loop()
+        deadline = loop.time() + self.shard_timeout
+        while True:
+            shard_states = {shard_id: None for shard_id in shard_ids}
+            for shard in await db.get_processing_jobs(shard_ids):
+                shard_states[shard.job_id] = shard.job_state
+            finished = all(state in ["SUCCESS", "FAILED"] for state in shard_states.values())
+            if finished or loop.time() >= deadline:
+                return shard_states
+            await sleep(self.flush_interval)
+
+    @staticmethod
+    def _merge_shards(path_to_mets: str, shard_mets_paths: List[str],
+                      output_file_grps: List[str]) -> None:
+        mets = OcrdMets(filename=path_to_mets)
+        for shard_mets_path in shard_mets_paths:
+            merge_mets_file_grps(mets, OcrdMets(filename=shard_mets_path), output_file_grps)
+        # Written once, after all shards are merged, into a file next to the METS which replaces
+        # it, so the METS is never seen half written
+        temp_path = join(dirname(path_to_mets), f".{generate_id()}.{basename(path_to_mets)}")
+        try:
+            with open(temp_path, "wb") as fout:
+                fout.write(mets.to_xml(xmllint=True))
+            replace(temp_path, path_to_mets)
+        finally:
+            if exists(temp_path):
+                remove(temp_path)
+
+    async def publish_processing_message(self, message: OcrdProcessingMessageModel) -> None:
+        # Each processor has its own queue, named after the processor
+        await self.broker.publish(message.processor_name,
+                                  message.json(exclude_none=True).encode("utf-8"))
+
+    async def get_processing_job(self, job_id: str) -> Union[ProcessingJobDB, None]:
+        return await db.get_processing_job(job_id)
+
+    async def consume_results(self) -> None:
+        """
+        Update the processing jobs from the result messages
+
+        The messages are buffered for at most `flush_interval` seconds (or until `batch_size`
+        messages arrived), multiple results of the same job are coalesced and the job states are
+        written with one bulk write. The messages are acknowledged only after the write succeeded,
+        so a crash before the flush delivers them again
+        """
+        deliveries: Queue = Queue()
+        receiver = create_task(self._receive_results(deliveries))
+        loop = get_running_loop()
+        try:
+            while True:
+                batch = [await deliveries.get()]
+                flush_time = loop.time() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    timeout = flush_time - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await wait_for(deliveries.get(), timeout))
+                    except TimeoutError:
+                        break
+                await self.flush_results(batch)
+        finally:
+            receiver.cancel()
+
+    async def _receive_results(self, deliveries: Queue) -> None:
+        # Enough unacknowledged messages to fill the current and the next batch
+        async for delivery in self.broker.consume(self.result_queue, prefetch=2 * self.batch_size):
+            deliveries.put_nowait(delivery)
+
+    async def flush_results(self, batch: List[Delivery]) -> None:
+        job_states: Dict[str, str] = {}
+        # Job id -> workspace id of the successful jobs
+        succeeded: Dict[str, str] = {}
+        handled = []
+        for delivery in batch:
+            try:
+                result = OcrdResultMessageModel.parse_raw(delivery.body)
+            except ValidationError as error:
+                self.log.error(f"Dropping invalid result message: {error}")
+                await delivery.nack(requeue=False)
+                continue
+            job_states[result.job_id] = self._coalesce_state(job_states.get(result.job_id),
+                                                             result.status)
+            if result.status == "SUCCESS" and result.workspace_id:
+                succeeded[result.job_id] = result.workspace_id
+            handled.append(delivery)
+        try:
+            await self.handle_results(job_states)
+            finished_workspaces = await self._finished_workspaces(succeeded)
+        except Exception as error:
+            self.log.exception(f"Failed to store the states of {len(job_states)} processing jobs: "
+                               f"{error}")
+            # Back off before the messages are delivered again
+            await sleep(self.flush_interval)
+            for delivery in handled:
+                await delivery.nack(requeue=True)
+            return
+        for delivery in handled:
+            await delivery.ack()
+        await self._run_finished_hooks(finished_workspaces)
+
+    def add_finished_hook(self, hook: Callable[[str], Awaitable[None]]) -> None:
+        """
+        Register a coroutine function called with the id of a workspace when a processing job
+        finished successfully on it, e.g. to persist the workspace
+        """
+        self._finished_hooks.append(hook)
+
+    async def _run_finished_hooks(self, workspace_ids: Set[str]) -> None:
+        for workspace_id in workspace_ids:
+            for hook in self._finished_hooks:
+                try:
+                    await hook(workspace_id)
+                except Exception as error:
+                    self.log.exception(f"Failed to finish processing on workspace {workspace_id}: "
+                                       f"{error}")
+
+    async def handle_results(self, job_states: Dict[str, str]) -> None:
+        await db.set_processing_job_states(job_states)
+
+    @staticmethod
+    async def _finished_workspaces(succeeded: Dict[str, str]) -> Set[str]:
+        """
+        Workspaces of the successful jobs. Shards write into copies of the METS, their workspace
+        is only finished once the sharded job merged them, whichever instance runs it
+        """
+        if not succeeded:
+            return set()
+        shard_ids = {job.job_id for job in await db.get_processing_jobs(list(succeeded))
+                     if job.parent_job_id}
+        return {workspace_id for job_id, workspace_id in succeeded.items()
+                if job_id not in shard_ids}
+
+    @staticmethod
+    def _coalesce_state(current_state: Union[str, None], new_state: str) -> str:
+        # Results may arrive out of order, a finished job never goes back to an earlier state
+        if current_state in ["SUCCESS", "FAILED"] and new_state not in ["SUCCESS", "FAILED"]:
+            return current_state
+        return new_state
+
+    @staticmethod
+    async def _get_mets_path(processor_args: ProcessorArgs) -> str:
+        path_to_mets = await db.get_workspace_mets_path(workspace_id=processor_args.workspace_id)
+        if not path_to_mets:
+            raise ProcessingJobException(
+                f"Workspace mets file not existing: {processor_args.workspace_id}"
+            )
+        if not processor_args.input_file_grps:
+            raise ProcessingJobException("Input file groups are required")
+        return path_to_mets
+
+    def _build_message(self, processor_name: str, processor_args: ProcessorArgs, path_to_mets: str,
+                       page_id: Union[str, None]) -> OcrdProcessingMessageModel:
+        output_file_grps = None
+        if processor_args.output_file_grps:
+            output_file_grps = processor_args.output_file_grps.split(",")
+        return OcrdProcessingMessageModel(
+            job_id=generate_id(),
+            processor_name=processor_name,
+            workspace_id=processor_args.workspace_id,
+            path_to_mets=path_to_mets,
+            input_file_grps=processor_args.input_file_grps.split(","),
+            output_file_grps=output_file_grps,
+            page_id=page_id,
+            parameters=processor_args.parameters,
+            result_queue_name=self.result_queue,
+            created_time=int(time())
+        )
+
+    @staticmethod
+    async def _save_job(message: OcrdProcessingMessageModel, job_state: str,
+                        parent_job_id: str = None,
+                        shard_job_ids: List[str] = None) -> ProcessingJobDB:
+        return await db.save_processing_job(
+            job_id=message.job_id,
+            processor_name=message.processor_name,
+            path_to_mets=message.path_to_mets,
+            input_file_grps=message.input_file_grps,
+            job_state=job_state,
+            created_time=message.created_time,
+            workspace_id=message.workspace_id,
+            output_file_grps=message.output_file_grps,
+            page_id=message.page_id,
+            parameters=message.parameters,
+            parent_job_id=parent_job_id,
+            shard_job_ids=shard_job_ids
+        )
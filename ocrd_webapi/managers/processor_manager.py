@@ -0,0 +1,293 @@
+from asyncio import Lock, Queue, Task, create_task, get_running_loop
+from importlib import import_module
+from importlib.metadata import entry_points
+from inspect import getmembers, isclass
+from multiprocessing import get_context
+from os.path import dirname
+from shutil import which
+from subprocess import run
+from typing import Dict, List, Tuple, Union
+import json
+import logging
+
+from ocrd import Processor, Resolver
+from ocrd.processor.helpers import run_processor
+from ocrd_utils import initLogging
+import psutil
+from pydantic import ValidationError
+
+from ocrd_webapi.constants import (
+    PROCESSING_WORKERS,
+    PROCESSOR_WORKER_MAX_JOBS,
+    PROCESSOR_WORKER_MAX_MEMORY_GROWTH,
+)
+from ocrd_webapi.message_broker import Delivery, MessageBroker
+from ocrd_webapi.models.ocrd_messages import OcrdProcessingMessageModel, OcrdResultMessageModel
+
+
+def resolve_processor_class(executable: str):
+    """
+    Returns the Python class of the OCR-D processor `executable` if it is installed as a Python
+    package, `None` otherwise (e.g. bashlib processors)
+    """
+    scripts = [script for script in entry_points(group="console_scripts")
+               if script.name == executable]
+    if not scripts:
+        return None
+    module = import_module(scripts[0].value.split(":")[0])
+    for _, member in getmembers(module, isclass):
+        if issubclass(member, Processor) and member is not Processor \
+                and member.__module__ == module.__name__:
+            return member
+    return None
+
+
+def _processor_worker_main(executable: str, connection, log_level: str) -> None:
+    """
+    Entrypoint of a worker process. Jobs are received over `connection` until `None` is received.
+    The processor instances (and their models) are cached for the lifetime of the worker
+    """
+    initLogging()
+    processor_class = resolve_processor_class(executable)
+    resolver = Resolver()
+    while True:
+        job = connection.recv()
+        if job is None:
+            break
+        try:
+            if processor_class:
+                run_processor(
+                    processor_class,
+                    mets_url=job["path_to_mets"],
+                    resolver=resolver,
+                    working_dir=dirname(job["path_to_mets"]),
+                    page_id=job["page_id"],
+                    input_file_grp=",".join(job["input_file_grps"]),
+                    output_file_grp=",".join(job["output_file_grps"] or []),
+                    parameter=job["parameters"] or {},
+                    log_level=log_level,
+                    instance_caching=True
+                )
+            else:
+                # Not a Python processor, nothing can be kept warm
+                _run_processor_cli(executable, job)
+            connection.send(("SUCCESS", None))
+        except Exception as error:
+            connection.send(("FAILED", f"{error.__class__.__name__}: {error}"))
+
+
+def _run_processor_cli(executable: str, job: dict) -> None:
+    command = [executable, "-m", job["path_to_mets"], "-I", ",".join(job["input_file_grps"])]
+    if job["output_file_grps"]:
+        command += ["-O", ",".join(job["output_file_grps"])]
+    if job["page_id"]:
+        command += ["-g", job["page_id"]]
+    if job["parameters"]:
+        command += ["-p", json.dumps(job["parameters"])]
+    result = run(command, cwd=dirname(job["path_to_mets"]), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{executable} exited with {result.returncode}: {result.stderr[-1000:]}")
+
+
+class ProcessorWorker:
+    """
+    A long-lived process which runs the jobs of one OCR-D processor, one job at a time
+    """
+    def __init__(self, executable: str, log_level: str = "INFO"):
+        self.executable = executable
+        self.log_level = log_level
+        self.jobs_done = 0
+        self._process = None
+        self._connection = None
+        # RSS after the first job, i.e. with the processor and its models loaded
+        self._baseline_rss: Union[int, None] = None
+
+    @property
+    def pid(self) -> Union[int, None]:
+        return self._process.pid if self._process else None
+
+    def start(self) -> None:
+        # Spawned, not forked, the parent runs an event loop and database clients
+        context = get_context("spawn")
+        self._connection, child_connection = context.Pipe()
+        self._process = context.Process(
+            target=_processor_worker_main,
+            args=(self.executable, child_connection, self.log_level),
+            name=f"processor-worker-{self.executable}",
+            daemon=True
+        )
+        self._process.start()
+        child_connection.close()
+        self.jobs_done = 0
+        self._baseline_rss = None
+
+    def stop(self, timeout: float = 5) -> None:
+        if not self._process:
+            return
+        try:
+            self._connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.kill()
+            self._process.join()
+        self._connection.close()
+        self._process = None
+
+    def restart(self) -> None:
+        self.stop()
+        self.start()
+
+    def run(self, message: OcrdProcessingMessageModel) -> Tuple[str, Union[str, None]]:
+        """
+        Run a job in the worker process and block until it is finished
+
+        Returns:
+            the final job state and an error description if the job failed
+        """
+        if not self._process or not self._process.is_alive():
+            self.start()
+        try:
+            self._connection.send(message.dict(include={
+                "path_to_mets", "page_id", "input_file_grps", "output_file_grps", "parameters"
+            }))
+            job_state, error = self._connection.recv()
+        except (EOFError, OSError) as crash:
+            # The worker died (e.g. killed by the OOM killer), start a fresh one for the next job
+            self.restart()
+            return "FAILED", f"Processor worker crashed: {crash}"
+        self.jobs_done += 1
+        return job_state, error
+
+    def rss(self) -> int:
+        try:
+            return psutil.Process(self.pid).memory_info().rss
+        except (psutil.NoSuchProcess, TypeError):
+            return 0
+
+    def needs_recycling(self, max_jobs: int, max_memory_growth: int) -> bool:
+        if self.jobs_done >= max_jobs:
+            return True
+        rss = self.rss()
+        if self._baseline_rss is None:
+            self._baseline_rss = rss
+            return False
+        return rss - self._baseline_rss > max_memory_growth
+
+
+class ProcessorManager:
+    """
+    Keeps a pool of warm worker processes per OCR-D processor. The workers consume the processing
+    messages from the queue of their processor and publish the results to the result queue of the
+    message, so jobs submitted through the ProcessingManager are run by an idle warm worker
+    """
+    def __init__(self, broker: MessageBroker, pool_size: int = PROCESSING_WORKERS,
+                 max_jobs: int = PROCESSOR_WORKER_MAX_JOBS,
+                 max_memory_growth: int = PROCESSOR_WORKER_MAX_MEMORY_GROWTH,
+                 log_level: str = "INFO"):
+        self.log = logging.getLogger(__name__)
+        self.log.setLevel(logging.getLevelName(log_level))
+        self.log_level = log_level
+        self.broker = broker
+        self.pool_size = pool_size
+        self.max_jobs = max_jobs
+        # In MiB
+        self.max_memory_growth = max_memory_growth
+        self._workers: Dict[str, List[ProcessorWorker]] = {}
+        self._consumer_tasks: Dict[str, Task] = {}
+        # Serializes starting the worker pool of a processor, concurrent requests start it once
+        self._serve_locks: Dict[str, Lock] = {}
+
+    @staticmethod
+    def is_processor_available(processor_name: str) -> bool:
+        return processor_name.startswith("ocrd-") and which(processor_name) is not None
+
+    def get_workers(self, processor_name: str) -> List[ProcessorWorker]:
+        return self._workers.get(processor_name, [])
+
+    async def serve(self, processor_name: str) -> None:
+        """
+        Start the worker pool of the processor, if not running yet
+        """
+        if processor_name in self._consumer_tasks:
+            return
+        async with self._serve_locks.setdefault(processor_name, Lock()):
+            # Started by a concurrent request while waiting for the lock
+            if processor_name in self._consumer_tasks:
+                return
+            workers = [ProcessorWorker(processor_name, log_level=self.log_level)
+                       for _ in range(self.pool_size)]
+            loop = get_running_loop()
+            for worker in workers:
+                await loop.run_in_executor(None, worker.start)
+            self._workers[processor_name] = workers
+            self._consumer_tasks[processor_name] = create_task(
+                self._consume_jobs(processor_name, workers)
+            )
+        self.log.info(f"Started {len(workers)} warm workers of {processor_name}")
+
+    async def stop(self) -> None:
+        for task in self._consumer_tasks.values():
+            task.cancel()
+        self._consumer_tasks.clear()
+        loop = get_running_loop()
+        for workers in self._workers.values():
+            for worker in workers:
+                await loop.run_in_executor(None, worker.stop)
+        self._workers.clear()
+
+    async def _consume_jobs(self, processor_name: str, workers: List[ProcessorWorker]) -> None:
+        idle_workers: Queue = Queue()
+        for worker in workers:
+            idle_workers.put_nowait(worker)
+        running = set()
+        # Not more unacknowledged jobs than workers, the other jobs stay available in the queue
+        async for delivery in self.broker.consume(processor_name, prefetch=len(workers)):
+            worker = await idle_workers.get()
+            task = create_task(self._run_job(worker, delivery, idle_workers))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+    async def _run_job(self, worker: ProcessorWorker, delivery: Delivery,
+                       idle_workers: Queue) -> None:
+        loop = get_running_loop()
+        settled = False
+        try:
+            try:
+                message = OcrdProcessingMessageModel.parse_raw(delivery.body)
+            except ValidationError as error:
+                self.log.error(f"Dropping invalid processing message: {error}")
+                settled = True
+                await delivery.nack(requeue=False)
+                return
+            await self._publish_result(message, "RUNNING")
+            job_state, error = await loop.run_in_executor(None, worker.run, message)
+            if error:
+                self.log.error(f"Processing job {message.job_id} failed: {error}")
+            await self._publish_result(message, job_state)
+            settled = True
+            await delivery.ack()
+            if worker.needs_recycling(self.max_jobs, self.max_memory_growth * 1024 * 1024):
+                self.log.info(f"Recycling worker {worker.pid} of {worker.executable} "
+                              f"after {worker.jobs_done} jobs")
+                await loop.run_in_executor(None, worker.restart)
+        except Exception as error:
+            self.log.exception(f"Failed to run a processing job: {error}")
+        finally:
+            idle_workers.put_nowait(worker)
+            if not settled:
+                # E.g. the result could not be published, the job is delivered again
+                await delivery.nack(requeue=True)
+
+    async def _publish_result(self, message: OcrdProcessingMessageModel, job_state: str) -> None:
+        if not message.result_queue_name:
+            return
+        result = OcrdResultMessageModel(
+            job_id=message.job_id,
+            status=job_state,
+            path_to_mets=message.path_to_mets,
+            workspace_id=message.workspace_id
+        )
+        await self.broker.publish(message.result_queue_name,
+                                  result.json(exclude_none=True).encode("utf-8"))
@@ -1,14 +1,36 @@
-from os import listdir, scandir
+from asyncio import Task, create_task, get_running_loop, shield
+from os import listdir, rename, scandir
 from os.path import exists, isdir, join
+from time import monotonic
 from pathlib import Path
-from typing import List, Union, Tuple
+from typing import Dict, List, Optional, Set, Union, Tuple
 import aiofiles
 import shutil
 import logging
 
-from ocrd_webapi.constants import BASE_DIR, SERVER_URL
+from ocrd_webapi.constants import (
+    BASE_DIR,
+    RESOURCE_INDEX_TTL,
+    SERVER_URL,
+    STORAGE_URL,
+    TRASH_ROUTER,
+)
+from ocrd_webapi.storage import StorageBackend, create_storage
+from ocrd_webapi.tracing import in_context, traced
 from ocrd_webapi.utils import generate_id
 
+# Local resource dirs known to exist, mapped to the (monotonic) time until which they are trusted
+# without probing the file system. Shared by all managers of the process, so a delete through one
+# manager is seen by the others
+_resource_index: Dict[str, float] = {}
+# Background uploads by storage key, and the keys which changed again while uploading. Shared by
+# all managers of the process, so there is a single upload per resource at a time
+_persist_tasks: Dict[str, Task] = {}
+_persist_again: Set[str] = set()
+# Background deletes of the stored trees by storage key. A resource being deleted is not found
+# anymore, and an upload of the same key waits until the delete is done
+_delete_tasks: Dict[str, Task] = {}
+
 
 class ResourceManager:
     # Warning: Don't change the defaults
@@ -19,6 +41,7 @@ class ResourceManager:
             resource_router: str,
             resources_base: str = BASE_DIR,
             resources_url: str = SERVER_URL,
+            storage: StorageBackend = None,
             log_level: str = "INFO"
     ):
 
@@ -44,7 +67,14 @@ class ResourceManager:
         else:
             self.log.info(f"Using the existing {log_msg}")
 
-    def get_all_resources(self, local: bool) -> List[Tuple[str, str]]:
+        # Deleted resource dirs are renamed into the trash and removed by the trash reaper
+        self._trash_dir = join(self._resources_base, TRASH_ROUTER)
+        Path(self._trash_dir).mkdir(parents=True, exist_ok=True)
+
+        # Durable storage of the resources, the resource dir is its local cache unless it is local
+        self._storage = storage or create_storage(STORAGE_URL, self._resources_base)
+
+    async def get_all_resources(self, local: bool) -> List[Tuple[str, str]]:
         resources = []
         for res in scandir(self._resource_dir):
             if res.is_dir():
@@ -53,9 +83,17 @@ class ResourceManager:
                 else:
                     url = self._to_resource(res.name, local=False)
                     resources.append((str(res.name), url))
+        if not local and not self._storage.is_local:
+            cached = {resource_id for resource_id, _ in resources}
+            stored = await get_running_loop().run_in_executor(
+                None, in_context(self._storage.list_children, self._resource_router)
+            )
+            for resource_id in stored:
+                if resource_id not in cached and self._to_key(resource_id) not in _delete_tasks:
+                    resources.append((resource_id, self._to_resource(resource_id, local=False)))
         return resources
 
-    def get_resource(self, resource_id: str, local: bool) -> Union[str, None]:
+    async def get_resource(self, resource_id: str, local: bool) -> Union[str, None]:
         """
         Returns the local path of the dir or
         the URL of the `resource_id`
@@ -66,8 +104,108 @@ class ResourceManager:
                 return res_path
             url = self._to_resource(resource_id, local=False)
             return url
+        if local or self._storage.is_local or self._to_key(resource_id) in _delete_tasks:
+            return None
+        key = self._to_key(resource_id)
+        if await get_running_loop().run_in_executor(None, in_context(self._storage.has, key)):
+            return self._to_resource(resource_id, local=False)
         return None
 
+    async def stage_resource(self, resource_id: str, sub_dir: str = None,
+                             recursive: bool = True) -> Optional[str]:
+        """
+        Returns the local path of the dir of the `resource_id` (or of its `sub_dir`), downloads it
+        from the storage if it is not cached locally. Returns None if the storage does not have it.
+        Not recursive, only the files directly inside the dir are staged (e.g. the script of a
+        workflow without the dirs of its jobs)
+        """
+        resource_dir = self._to_resource(resource_id, local=True)
+        if sub_dir:
+            resource_dir = join(resource_dir, sub_dir)
+        if self._storage.is_local:
+            if not sub_dir:
+                return self._has_dir(resource_id)
+            return resource_dir if isdir(resource_dir) else None
+        if isdir(resource_dir) and \
+                (recursive or any(entry.is_file() for entry in scandir(resource_dir))):
+            return resource_dir
+        if self._to_key(resource_id) in _delete_tasks:
+            return None
+        loop = get_running_loop()
+        key = self._to_key(resource_id, sub_dir)
+        if not await loop.run_in_executor(None, in_context(self._storage.has, key)):
+            return None
+        # Downloaded next to the cache and moved, so cached files are always complete
+        staging_dir = f"{resource_dir}.staging-{generate_id()}"
+        try:
+            files = await loop.run_in_executor(
+                None, in_context(self._storage.download_dir, key, staging_dir, recursive)
+            )
+            if not isdir(resource_dir):
+                rename(staging_dir, resource_dir)
+            else:
+                # Only what is missing, e.g. the files next to a cached sub dir or staged
+                # concurrently
+                for entry in scandir(staging_dir):
+                    if not exists(join(resource_dir, entry.name)):
+                        rename(entry.path, join(resource_dir, entry.name))
+            self.log.info(f"Staged {files} files of: {key}")
+        finally:
+            if exists(staging_dir):
+                shutil.rmtree(staging_dir, ignore_errors=True)
+        return resource_dir
+
+    @traced
+    async def persist_resource(self, resource_id: str, sub_dir: str = None,
+                               recursive: bool = True) -> None:
+        """
+        Uploads the changes of the cached dir of the `resource_id` (or of its `sub_dir`) to the
+        storage. Not recursive, only the files directly inside the dir are uploaded
+        """
+        if self._storage.is_local:
+            return
+        resource_dir = self._to_resource(resource_id, local=True)
+        if sub_dir:
+            resource_dir = join(resource_dir, sub_dir)
+        if not isdir(resource_dir):
+            return
+        delete_task = _delete_tasks.get(self._to_key(resource_id))
+        if delete_task:
+            # Else the delete could remove what is uploaded now
+            await shield(delete_task)
+        key = self._to_key(resource_id, sub_dir)
+        files = await get_running_loop().run_in_executor(
+            None, in_context(self._storage.upload_dir, resource_dir, key, recursive)
+        )
+        self.log.info(f"Persisted {files} changed files of: {key}")
+
+    def persist_resource_soon(self, resource_id: str, sub_dir: str = None) -> None:
+        """
+        Persists the resource in the background. Changes during a running upload are uploaded
+        afterwards by the same task, so there is only a single upload per resource at a time
+        """
+        if self._storage.is_local:
+            return
+        key = self._to_key(resource_id, sub_dir)
+        if key in _persist_tasks:
+            _persist_again.add(key)
+            return
+        _persist_tasks[key] = create_task(self._persist_in_background(resource_id, sub_dir, key))
+
+    async def _persist_in_background(self, resource_id: str, sub_dir: Optional[str],
+                                     key: str) -> None:
+        try:
+            while True:
+                _persist_again.discard(key)
+                try:
+                    await self.persist_resource(resource_id, sub_dir)
+                except Exception as error:
+                    self.log.exception(f"Failed to persist {key}: {error}")
+                if key not in _persist_again:
+                    return
+        finally:
+            _persist_tasks.pop(key, None)
+
     def get_resource_job(self, resource_id: str, job_id: str, local: bool) -> Union[str, None]:
         # Wrapper, in case the underlying
         # implementation has to change
@@ -84,10 +222,20 @@ class ResourceManager:
         identified with `resource_id` or None
         """
         resource_dir = self._to_resource(resource_id, local=True)
-        if exists(resource_dir) and isdir(resource_dir):
+        if _resource_index.get(resource_dir, 0) > monotonic():
+            return resource_dir
+        if isdir(resource_dir):
+            _resource_index[resource_dir] = monotonic() + RESOURCE_INDEX_TTL
             return resource_dir
+        _resource_index.pop(resource_dir, None)
         return None
 
+    def _forget_resource(self, resource_id: str) -> None:
+        """
+        Drops the `resource_id` from the index, the next lookup probes the file system again
+        """
+        _resource_index.pop(self._to_resource(resource_id, local=True), None)
+
     def _has_file(self, resource_id: str, file_ext=None) -> Union[str, None]:
         """
         Returns the local path of the file identified
@@ -125,15 +273,59 @@ class ResourceManager:
             # TODO: Raise an Exception here
         return resource_id, resource_dir
 
-    def _delete_resource_dir(self, resource_id: str) -> Tuple[str, str]:
+    async def _delete_resource_dir(self, resource_id: str) -> Tuple[str, str]:
+        """
+        Moves the dir of the `resource_id` into the trash, which is a single rename whatever the
+        size of the dir. The trash reaper removes it in the background, as the stored tree is
+        deleted by a background task
+        """
         resource_dir = self._to_resource(resource_id, local=True)
+        self._forget_resource(resource_id)
         if isdir(resource_dir):
-            shutil.rmtree(resource_dir)
+            rename(resource_dir, self._to_trash(resource_id))
+        key = self._to_key(resource_id)
+        if not self._storage.is_local and key not in _delete_tasks:
+            _delete_tasks[key] = create_task(self._delete_in_background(key))
         return resource_id, resource_dir
 
+    async def _delete_in_background(self, key: str) -> None:
+        try:
+            await get_running_loop().run_in_executor(None, self._storage.delete, key)
+            self.log.info(f"Deleted the stored tree of: {key}")
+        except Exception as error:
+            self.log.exception(f"Failed to delete the stored tree of {key}: {error}")
+        finally:
+            _delete_tasks.pop(key, None)
+
+    def _replace_resource_dir(self, resource_id: str, new_dir: str) -> str:
+        """
+        Moves `new_dir` into the place of the dir of the `resource_id`, a replaced dir is moved
+        into the trash. The next persist makes the stored tree a copy of the new dir
+        """
+        resource_dir = self._to_resource(resource_id, local=True)
+        self._forget_resource(resource_id)
+        if isdir(resource_dir):
+            rename(resource_dir, self._to_trash(resource_id))
+        rename(new_dir, resource_dir)
+        return resource_dir
+
+    def _to_trash(self, resource_id: str) -> str:
+        """
+        Returns a new path in the trash for a dir of the `resource_id`
+        """
+        return join(self._trash_dir, f"{self._resource_router}-{resource_id}-{generate_id()}")
+
+    def _to_key(self, resource_id: str, sub_dir: str = None) -> str:
+        """
+        Returns the storage key of the `resource_id`, the same as its path below the BASE_DIR
+        """
+        key = f"{self._resource_router}/{resource_id}"
+        return f"{key}/{sub_dir}" if sub_dir else key
+
     # TODO: Getting rid of the duplication seems
     #  trickier than expected implementing a single method is harder
     @staticmethod
+    @traced
     async def _receive_resource(file, resource_dest):
         async with aiofiles.open(resource_dest, "wb") as fpt:
             content = await file.read(1024)
@@ -142,6 +334,7 @@ class ResourceManager:
                 content = await file.read(1024)
 
     @staticmethod
+    @traced
     async def _receive_resource2(file_path, resource_dest):
         with open(file_path, "rb") as fin:
             with open(resource_dest, "wb") as fout:
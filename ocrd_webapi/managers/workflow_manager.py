@@ -1,15 +1,42 @@
+from asyncio import gather, get_running_loop, sleep
+from functools import partial
+from datetime import datetime, timedelta
 from os import mkdir
-from os.path import join
-from typing import List, Union, Tuple
+from os.path import getsize, isdir, join
+from socket import gethostname
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union, Tuple
 
 from ocrd_webapi import database as db
-from ocrd_webapi.constants import WORKFLOWS_ROUTER
-from ocrd_webapi.exceptions import WorkflowJobException
-from ocrd_webapi.managers.nextflow_manager import NextflowManager
+from ocrd_webapi.constants import (
+    SCHEDULER_INTERVAL,
+    SCHEDULER_MAX_RUNNING,
+    SCHEDULER_MAX_RUNNING_PER_USER,
+    WORKFLOW_CANCEL_TIMEOUT,
+    WORKFLOW_SUPERVISE_INTERVAL,
+    WORKFLOWS_ROUTER,
+)
+from ocrd_webapi.exceptions import (
+    WorkflowJobException,
+    WorkflowJobStateException,
+    WorkflowParametersException,
+)
+from ocrd_webapi.managers.nextflow_manager import NF_LAUNCHER_PARAMS, NextflowManager
 from ocrd_webapi.managers.resource_manager import ResourceManager
 from ocrd_webapi.managers.workspace_manager import WorkspaceManager
-from ocrd_webapi.models.database import WorkflowJobDB
-from ocrd_webapi.utils import generate_id
+from ocrd_webapi.models.database import WorkflowDB, WorkflowJobDB
+from ocrd_webapi.models.workflow import WorkflowProcessStats
+from ocrd_webapi.scheduler import FairShareScheduler
+from ocrd_webapi.tracing import in_context
+from ocrd_webapi.utils import dir_usage, generate_id, percentile
+
+
+# Parameters of the workflow scripts which are set by the server, not by the user
+RESERVED_WORKFLOW_PARAMETERS = NF_LAUNCHER_PARAMS
+# Fields of the parsed trace lines stored with the tasks
+TASK_TRACE_FIELDS = ["name", "status", "exit", "duration", "realtime", "cpu", "peak_rss"]
+# The dispatcher looks this far back for newly queued jobs, the workers queueing them may have
+# slightly different clocks
+QUEUE_CLOCK_SKEW = timedelta(seconds=60)
 
 
 class WorkflowManager(ResourceManager):
@@ -22,14 +49,25 @@ class WorkflowManager(ResourceManager):
             self.log.info(f"Detected Nextflow version: {self.nf_version}")
         else:
             self.log.error("Detected Nextflow version: unable to detect")
+        # Paths of the Nextflow scripts by workflow id, as stored in the database
+        self._nf_script_paths: Dict[str, str] = {}
+        # Stages the workspaces of the jobs and persists them when the jobs end
+        self._workspace_manager = WorkspaceManager(log_level=log_level)
+        # Called with the job when a workflow job ends, to release what the job held
+        self._release_hooks: List[Callable[[WorkflowJobDB], Awaitable[None]]] = []
+        # Queued jobs are started by the dispatcher, which runs in one worker
+        self.max_running = SCHEDULER_MAX_RUNNING
+        self.scheduler = FairShareScheduler(max_running_per_user=SCHEDULER_MAX_RUNNING_PER_USER)
+        self._queued_since: Optional[datetime] = None
 
-    def get_workflows(self) -> List[Tuple[str, str]]:
+    async def get_workflows(self) -> List[Tuple[str, str]]:
         """
         Get a list of all available workflow urls.
         """
-        return self.get_all_resources(local=False)
+        return await self.get_all_resources(local=False)
 
-    async def create_workflow_space(self, file, uid: str = None) -> Tuple[str, str]:
+    async def create_workflow_space(self, file, uid: str = None,
+                                    owner: str = None) -> Tuple[str, str]:
         """
         Create a new workflow space. Upload a Nextflow script inside.
 
@@ -37,30 +75,45 @@ class WorkflowManager(ResourceManager):
             file: A Nextflow script
             uid (str): The uid is used as workflow_space-directory. If `None`, an uuid is created.
             If the corresponding dir is already existing, `None` is returned,
+            owner (str): e-mail of the user the workflow is accounted to
 
         """
         workflow_id, workflow_dir = self._create_resource_dir(uid)
         mkdir(workflow_dir)
         nf_script_dest = join(workflow_dir, file.filename)
         await self._receive_resource(file, nf_script_dest)
+        # Parsed once, runs are validated against the stored parameters
+        nf_params, nf_processes = NextflowManager.parse_nf_script(nf_script_dest)
         await db.save_workflow(
             workflow_id=workflow_id,
             workflow_path=workflow_dir,
-            workflow_script_path=nf_script_dest
+            workflow_script_path=nf_script_dest,
+            workflow_parameters=nf_params,
+            workflow_processes=nf_processes,
+            owner=owner,
+            size=getsize(nf_script_dest),
+            files=1
         )
+        self._nf_script_paths[workflow_id] = nf_script_dest
+        # Only the script, the job dirs are persisted when the jobs end
+        await self.persist_resource(workflow_id, recursive=False)
 
-        workflow_url = self.get_resource(workflow_id, local=False)
+        workflow_url = await self.get_resource(workflow_id, local=False)
         return workflow_id, workflow_url
 
-    async def update_workflow_space(self, file, workflow_id: str) -> Tuple[str, str]:
+    async def update_workflow_space(self, file, workflow_id: str,
+                                    owner: str = None) -> Tuple[str, str]:
         """
         Update a workflow space
 
         Delete the workflow space if existing and then delegate to
         :py:func:`ocrd_webapi.workflow_manager.WorkflowManager.create_workflow_space
         """
-        self._delete_resource_dir(workflow_id)
-        return await self.create_workflow_space(file, workflow_id)
+        self._nf_script_paths.pop(workflow_id, None)
+        await self._delete_resource_dir(workflow_id)
+        # The job dirs are removed with the workflow space
+        await db.release_workflow_jobs_usage(workflow_id)
+        return await self.create_workflow_space(file, workflow_id, owner=owner)
 
     def create_workflow_execution_space(self, workflow_id: str) -> Tuple[str, Union[str, None]]:
         job_id = generate_id()
@@ -68,35 +121,79 @@ class WorkflowManager(ResourceManager):
         mkdir(job_dir)
         return job_id, job_dir
 
-    async def start_nf_workflow(self, workflow_id: str, workspace_id: str) -> Union[list, WorkflowJobException]:
+    async def get_workflow_db(self, workflow_id: str) -> Union[WorkflowDB, None]:
+        """
+        Get the workflow from the database, with the parameters and processes of its script
+        """
+        workflow_db = await db.get_workflow(workflow_id)
+        if not workflow_db or workflow_db.workflow_parameters is not None:
+            return workflow_db
+        # Uploaded before the scripts were parsed on upload, parse it once now
+        nf_params, nf_processes = NextflowManager.parse_nf_script(workflow_db.workflow_script_path)
+        return await db.save_workflow(
+            workflow_id=workflow_id,
+            workflow_path=workflow_db.workflow_path,
+            workflow_script_path=workflow_db.workflow_script_path,
+            workflow_parameters=nf_params,
+            workflow_processes=nf_processes
+        )
+
+    async def validate_workflow_parameters(self, workflow_id: str,
+                                           workflow_parameters: Dict[str, Any]) -> None:
+        """
+        Check that all parameters are declared by the workflow script and none is reserved
+
+        Raises:
+            WorkflowParametersException: if a parameter is not accepted
+        """
+        if not workflow_parameters:
+            return
+        workflow_db = await self.get_workflow_db(workflow_id)
+        if not workflow_db:
+            raise WorkflowJobException(f"Workflow not existing: {workflow_id}")
+        reserved = [name for name in workflow_parameters if name in RESERVED_WORKFLOW_PARAMETERS]
+        if reserved:
+            raise WorkflowParametersException(
+                f"Parameters set by the server: {', '.join(reserved)}"
+            )
+        unknown = [name for name in workflow_parameters
+                   if name not in workflow_db.workflow_parameters]
+        if unknown:
+            raise WorkflowParametersException(
+                f"Parameters not declared by workflow {workflow_id}: {', '.join(unknown)}, "
+                f"declared are: {', '.join(workflow_db.workflow_parameters)}"
+            )
+
+    async def start_nf_workflow(self, workflow_id: str, workspace_id: str,
+                                workflow_parameters: Optional[Dict[str, Any]] = None,
+                                owner: str = None,
+                                priority: int = None) -> Union[list, WorkflowJobException]:
+        """
+        Queue a workflow job, it is started by the dispatcher when the fair-share scheduler gives
+        it a turn. The priority class is at most the one of the owner's account (the default)
+        """
         # The path to the Nextflow script inside workflow_id
-        nf_script_path = self.get_resource_file(workflow_id, file_ext='.nf')
+        nf_script_path = await self.stage_nf_script(workflow_id)
+        await self._workspace_manager.stage_resource(workspace_id)
         workspace_mets_path = await db.get_workspace_mets_path(workspace_id=workspace_id)
-        # workspace_dir = WorkspaceManager.static_get_resource(workspace_id, local=True)
 
         # TODO: These checks must happen inside the Resource Manager, not here
         if not nf_script_path:
             raise WorkflowJobException(f"Workflow script file not existing: {workflow_id}")
         if not workspace_mets_path:
             raise WorkflowJobException(f"Workspace mets file not existing: {workspace_id}")
+        await self.validate_workflow_parameters(workflow_id, workflow_parameters)
+
+        user_account = await db.get_user(owner) if owner else None
+        max_priority = user_account.priority if user_account else 0
+        priority = max_priority if priority is None else min(priority, max_priority)
 
         job_id, job_dir = self.create_workflow_execution_space(workflow_id)
-        try:
-            NextflowManager.execute_workflow(
-                nf_script_path=nf_script_path,
-                workspace_mets_path=workspace_mets_path,
-                job_dir=job_dir
-            )
-            workflow_job_status = 'RUNNING'
-            await db.save_workflow_job(job_id=job_id, workflow_id=workflow_id,
-                                       workspace_id=workspace_id, job_path=job_dir, job_state=workflow_job_status)
-        except Exception as error:
-            # TODO: Integrate FAILED instead of STOPPED
-            workflow_job_status = 'STOPPED'
-            await db.save_workflow_job(job_id=job_id, workflow_id=workflow_id,
-                                       workspace_id=workspace_id, job_path=job_dir, job_state=workflow_job_status)
-            self.log.exception(f"Failed to execute workflow: {error}")
-            raise WorkflowJobException(f"Failed to execute workflow: {workflow_id}, "f"with workspace: {workspace_id}")
+        await db.queue_workflow_job(job_id=job_id, workflow_id=workflow_id,
+                                    workspace_id=workspace_id, job_path=job_dir,
+                                    workflow_parameters=workflow_parameters, owner=owner,
+                                    priority=priority)
+        workflow_job_status = 'QUEUED'
 
         parameters = [
             # Workflow Job ID
@@ -105,21 +202,462 @@ class WorkflowManager(ResourceManager):
             self.get_resource_job(workflow_id, job_id, local=False),
             workflow_job_status,
             # Workflow URL
-            self.get_resource(workflow_id, local=False),
+            await self.get_resource(workflow_id, local=False),
             # Workspace URL
-            WorkspaceManager.static_get_resource(workspace_id, local=False)
+            await WorkspaceManager.static_get_resource(workspace_id, local=False)
         ]
         return parameters
 
+    async def _launch_workflow_job(self, wf_job_db: WorkflowJobDB) -> bool:
+        """
+        Start the Nextflow run of a queued workflow job
+
+        Returns:
+            True if the job is RUNNING
+        """
+        job_id = wf_job_db.workflow_job_id
+        started = datetime.utcnow()
+        try:
+            nf_script_path = await self.stage_nf_script(wf_job_db.workflow_id)
+            if not nf_script_path:
+                raise WorkflowJobException(
+                    f"Workflow script file not existing: {wf_job_db.workflow_id}"
+                )
+            await self._workspace_manager.stage_resource(wf_job_db.workspace_id)
+            workspace_mets_path = await db.get_workspace_mets_path(
+                workspace_id=wf_job_db.workspace_id
+            )
+            if not workspace_mets_path:
+                raise WorkflowJobException(
+                    f"Workspace mets file not existing: {wf_job_db.workspace_id}"
+                )
+            # Waits for the Nextflow launcher, which backgrounds the run
+            process_group_id = await get_running_loop().run_in_executor(None, partial(
+                NextflowManager.execute_workflow,
+                nf_script_path=nf_script_path,
+                workspace_mets_path=workspace_mets_path,
+                job_dir=wf_job_db.job_path,
+                nf_params=wf_job_db.workflow_parameters
+            ))
+        except Exception as error:
+            self.log.exception(f"Failed to execute workflow job {job_id}: {error}")
+            await self.finish_workflow_job(wf_job_db, 'FAILED',
+                                           f"Failed to start the Nextflow run: {error}")
+            return False
+        if not await db.start_queued_workflow_job(job_id=job_id, process_group_id=process_group_id,
+                                                  host=gethostname(), started=started):
+            # Cancelled while the run was started
+            await get_running_loop().run_in_executor(
+                None, NextflowManager.terminate_process_group, process_group_id,
+                WORKFLOW_CANCEL_TIMEOUT
+            )
+            return False
+        return True
+
+    async def dispatch_workflow_jobs(self) -> List[str]:
+        """
+        Start queued workflow jobs in the free slots, in the order of the fair-share scheduler.
+        The queued and running jobs are taken from the database, so jobs queued by other workers
+        are started as well and jobs ended anywhere free their slots
+
+        Returns:
+            the ids of the started jobs
+        """
+        queried = datetime.utcnow()
+        queued_jobs = await db.get_queued_workflow_jobs(submitted_since=self._queued_since)
+        self._queued_since = queried - QUEUE_CLOCK_SKEW
+        new_jobs = [wf_job for wf_job in queued_jobs
+                    if wf_job.workflow_job_id not in self.scheduler]
+        if new_jobs:
+            # The shares are taken from the accounts when their users queue jobs
+            owners = list({wf_job.owner for wf_job in new_jobs if wf_job.owner})
+            for user_account in await db.get_users(owners):
+                self.scheduler.set_user(user_account.email, user_account.share,
+                                        user_account.max_running_jobs)
+            for wf_job in new_jobs:
+                self.scheduler.submit(wf_job.workflow_job_id, wf_job.owner or "", wf_job.priority)
+
+        running = await db.get_running_workflow_job_owners()
+        self.scheduler.sync_running({job_id: owner or "" for job_id, owner in running.items()})
+        wf_jobs = []
+        while len(running) + len(wf_jobs) < self.max_running:
+            picked = []
+            while len(running) + len(wf_jobs) + len(picked) < self.max_running:
+                next_job = self.scheduler.next_job()
+                if not next_job:
+                    break
+                picked.append(next_job[0])
+            if not picked:
+                break
+            picked_jobs = await db.get_workflow_jobs(picked)
+            queued = [wf_job for wf_job in picked_jobs if wf_job.job_state == 'QUEUED']
+            wf_jobs += queued
+            # Cancelled (e.g. by another worker) or deleted meanwhile, the slot is picked again
+            queued_ids = {wf_job.workflow_job_id for wf_job in queued}
+            for job_id in picked:
+                if job_id not in queued_ids:
+                    self.scheduler.release(job_id)
+        if not wf_jobs:
+            return []
+        launched = await gather(*[self._launch_workflow_job(wf_job) for wf_job in wf_jobs])
+        return [wf_job.workflow_job_id for wf_job, is_running in zip(wf_jobs, launched)
+                if is_running]
+
+    async def dispatch_periodically(self, interval: float = SCHEDULER_INTERVAL) -> None:
+        """
+        Dispatch the queued workflow jobs every `interval` seconds. Run by the elected dispatcher
+        only, the queue is rebuilt from the database when a worker becomes the dispatcher
+        """
+        self.scheduler = FairShareScheduler(
+            max_running_per_user=self.scheduler.max_running_per_user
+        )
+        self._queued_since = None
+        while True:
+            try:
+                await self.dispatch_workflow_jobs()
+            except Exception as error:
+                self.log.exception(f"Failed to dispatch the workflow jobs: {error}")
+            await sleep(interval)
+
+    async def resume_nf_workflow(self, workflow_id: str, job_id: str) -> WorkflowJobDB:
+        """
+        Relaunch a finished workflow job with `-resume` in its job dir, so the tasks completed by
+        the previous attempts are taken from Nextflow's task cache instead of being run again.
+        The outputs of the previous attempt are moved to `attempt_<n>` inside the job dir
+        """
+        wf_job_db = await self.get_workflow_job(workflow_id, job_id)
+        if not wf_job_db:
+            raise WorkflowJobException(f"Workflow job not existing: {job_id}")
+        if wf_job_db.job_state in ['QUEUED', 'RUNNING']:
+            raise WorkflowJobStateException(
+                f"Workflow job is still {wf_job_db.job_state}: {job_id}"
+            )
+        nf_script_path = await self.stage_nf_script(wf_job_db.workflow_id)
+        if not nf_script_path:
+            raise WorkflowJobException(
+                f"Workflow script file not existing: {wf_job_db.workflow_id}"
+            )
+        # The task cache and the outputs of the previous attempts
+        await self.stage_resource(wf_job_db.workflow_id, sub_dir=job_id)
+        await self._workspace_manager.stage_resource(wf_job_db.workspace_id)
+        workspace_mets_path = await db.get_workspace_mets_path(workspace_id=wf_job_db.workspace_id)
+        if not workspace_mets_path:
+            raise WorkflowJobException(
+                f"Workspace mets file not existing: {wf_job_db.workspace_id}"
+            )
+
+        started = datetime.utcnow()
+        # Only one of concurrent resumes of the same attempt gets the job
+        if not await db.add_workflow_job_attempt(job_id=job_id, attempts=wf_job_db.attempts,
+                                                 started=started):
+            raise WorkflowJobStateException(f"Workflow job was resumed meanwhile: {job_id}")
+        NextflowManager.archive_attempt(wf_job_db.job_path, wf_job_db.attempts)
+        wf_job_db = await db.get_workflow_job(job_id)
+        try:
+            # Waits for the Nextflow launcher, which backgrounds the run
+            process_group_id = await get_running_loop().run_in_executor(None, partial(
+                NextflowManager.execute_workflow,
+                nf_script_path=nf_script_path,
+                workspace_mets_path=workspace_mets_path,
+                job_dir=wf_job_db.job_path,
+                resume=True,
+                # The same parameters, otherwise the cached tasks would not match
+                nf_params=wf_job_db.workflow_parameters
+            ))
+        except Exception as error:
+            self.log.exception(f"Failed to resume workflow job {job_id}: {error}")
+            await self.finish_workflow_job(wf_job_db, 'FAILED',
+                                           f"Failed to resume the Nextflow run: {error}")
+            raise WorkflowJobException(f"Failed to resume workflow job: {job_id}")
+        if not await db.start_workflow_job_attempt(job_id=job_id, attempts=wf_job_db.attempts,
+                                                   process_group_id=process_group_id,
+                                                   host=gethostname()):
+            # Cancelled while the run was started
+            await get_running_loop().run_in_executor(
+                None, NextflowManager.terminate_process_group, process_group_id,
+                WORKFLOW_CANCEL_TIMEOUT
+            )
+            return await db.get_workflow_job(job_id)
+        wf_job_db.process_group_id = process_group_id
+        wf_job_db.host = gethostname()
+        return await self._update_cached_tasks(wf_job_db)
+
+    def add_release_hook(self, hook: Callable[[WorkflowJobDB], Awaitable[None]]) -> None:
+        """
+        Register a coroutine function called with a workflow job when it ends, e.g. to free a
+        scheduler slot or a workspace lock held by the job
+        """
+        self._release_hooks.append(hook)
+
+    async def release_workflow_job(self, wf_job_db: WorkflowJobDB) -> None:
+        try:
+            # The tasks completed since the last pass of the supervisor
+            await self.ingest_trace(wf_job_db)
+        except Exception as error:
+            self.log.exception(f"Failed to read the trace of workflow job "
+                               f"{wf_job_db.workflow_job_id}: {error}")
+        # The processors wrote into the workspace, the job dir holds the outputs and the task cache
+        self._workspace_manager.persist_resource_soon(wf_job_db.workspace_id)
+        self.persist_resource_soon(wf_job_db.workflow_id, sub_dir=wf_job_db.workflow_job_id)
+        try:
+            # The job dir does not change anymore, account it to the owner of the job
+            size, files = await get_running_loop().run_in_executor(
+                None, in_context(dir_usage, wf_job_db.job_path)
+            )
+            await db.set_workflow_job_usage(job_id=wf_job_db.workflow_job_id, size=size,
+                                            files=files)
+        except Exception as error:
+            self.log.exception(f"Failed to account workflow job {wf_job_db.workflow_job_id}: "
+                               f"{error}")
+        for hook in self._release_hooks:
+            try:
+                await hook(wf_job_db)
+            except Exception as error:
+                self.log.exception(f"Failed to release workflow job {wf_job_db.workflow_job_id}: "
+                                   f"{error}")
+
+    async def stage_nf_script(self, workflow_id: str) -> Optional[str]:
+        """
+        Returns the local path of the Nextflow script of the workflow. The path is taken from the
+        database once instead of listing the workflow dir on every request
+        """
+        # Not recursive, the dirs of the other jobs are not needed
+        if not await self.stage_resource(workflow_id, recursive=False):
+            return None
+        nf_script_path = self._nf_script_paths.get(workflow_id)
+        if not nf_script_path:
+            workflow_db = await db.get_workflow(workflow_id)
+            if workflow_db:
+                nf_script_path = workflow_db.workflow_script_path
+            else:
+                nf_script_path = self.get_resource_file(workflow_id, file_ext='.nf')
+            if nf_script_path:
+                self._nf_script_paths[workflow_id] = nf_script_path
+        return nf_script_path
+
+    async def cancel_workflow_job(self, workflow_id: str, job_id: str,
+                                  timeout: float = WORKFLOW_CANCEL_TIMEOUT) -> WorkflowJobDB:
+        """
+        Stop a queued or running workflow job with all its processes (Nextflow and the OCR-D
+        processors started by it) and set its state to CANCELLED. The processes are only signalled
+        on the host which started the run and if their process group was created by the run, a
+        process group id reused by other processes is left alone
+        """
+        wf_job_db = await self.get_workflow_job(workflow_id, job_id)
+        if not wf_job_db:
+            raise WorkflowJobException(f"Workflow job not existing: {job_id}")
+        if wf_job_db.job_state not in ['QUEUED', 'RUNNING']:
+            raise WorkflowJobStateException(
+                f"Workflow job is already {wf_job_db.job_state}: {job_id}"
+            )
+        self.scheduler.remove(job_id)
+        if wf_job_db.process_group_id and await self._owns_process_group(wf_job_db):
+            killed = await get_running_loop().run_in_executor(None, in_context(
+                NextflowManager.terminate_process_group, wf_job_db.process_group_id, timeout
+            ))
+            if killed:
+                self.log.warning(f"Workflow job {job_id} did not stop within {timeout}s, killed it")
+        if not await self.finish_workflow_job(wf_job_db, 'CANCELLED'):
+            # The supervisor saw the run die first and released the job already
+            await db.set_workflow_job_state(job_id=job_id, job_state='CANCELLED')
+            wf_job_db.job_state = 'CANCELLED'
+        return wf_job_db
+
+    async def _owns_process_group(self, wf_job_db: WorkflowJobDB) -> bool:
+        """
+        Whether the process group of the job is alive on this host and belongs to its run
+        """
+        job_id = wf_job_db.workflow_job_id
+        if wf_job_db.host != gethostname():
+            self.log.warning(f"Not signalling workflow job {job_id}, it runs on {wf_job_db.host}")
+            return False
+        live_process_groups = await get_running_loop().run_in_executor(
+            None, NextflowManager.get_live_process_groups
+        )
+        created = live_process_groups.get(wf_job_db.process_group_id)
+        if created is None:
+            return False
+        if not NextflowManager.created_since(created, wf_job_db.started):
+            self.log.warning(f"Not signalling workflow job {job_id}, its process group id "
+                             f"{wf_job_db.process_group_id} was reused by other processes")
+            return False
+        return True
+
     async def get_workflow_job(self, workflow_id: str, job_id: str) -> Union[WorkflowJobDB, None]:
         wf_job_db = await db.get_workflow_job(job_id)
+        if not wf_job_db:
+            return None
+        # The job dir of a finished job is not probed anymore, its cached tasks were counted
+        # when it finished
+        if wf_job_db.job_state in ['STOPPED', 'SUCCESS', 'FAILED', 'CANCELLED']:
+            return wf_job_db
         job_dir = self.get_resource_job(workflow_id, job_id, local=True)
         # Check if a nextflow report is available in the job dir
-        if NextflowManager.is_nf_report(job_dir):
-            # If there is a report and the job state is not STOPPED/SUCCESS
-            if wf_job_db.job_state != 'STOPPED' and wf_job_db.job_state != 'SUCCESS':
-                # Set to STOPPED, since it probably failed.
-                await db.set_workflow_job_state(job_id=job_id, job_state='STOPPED')
+        if job_dir and NextflowManager.is_nf_report(job_dir):
+            # There is a report, set to STOPPED, since it probably failed.
+            if not await self.finish_workflow_job(wf_job_db, 'STOPPED'):
+                # Finished meanwhile by someone else
+                wf_job_db = await db.get_workflow_job(job_id)
+        if wf_job_db.attempts > 1:
+            wf_job_db = await self._update_cached_tasks(wf_job_db)
+        return wf_job_db
+
+    async def finish_workflow_job(self, wf_job_db: WorkflowJobDB, job_state: str,
+                                  failure_reason: str = None) -> bool:
+        """
+        Set the final state of an unfinished workflow job and release it. Only one of the callers
+        which see the job end (the supervisor, a status request, a cancel) finishes it
+
+        Returns:
+            True if the job was finished by this call
+        """
+        if not await db.finish_workflow_job(job_id=wf_job_db.workflow_job_id,
+                                            attempts=wf_job_db.attempts, job_state=job_state,
+                                            failure_reason=failure_reason):
+            return False
+        wf_job_db.job_state = job_state
+        wf_job_db.failure_reason = failure_reason
+        # The final count, on the host which ran the job
+        if wf_job_db.attempts > 1 and wf_job_db.job_path and isdir(wf_job_db.job_path):
+            wf_job_db = await self._update_cached_tasks(wf_job_db)
+        await self.release_workflow_job(wf_job_db)
+        return True
+
+    async def reconcile_workflow_jobs(self) -> Dict[str, str]:
+        """
+        Compare the unfinished workflow jobs started on this host with their Nextflow runs. Runs
+        which are not alive anymore (e.g. the server or the host restarted meanwhile) are finished:
+        STOPPED if Nextflow wrote its report, otherwise FAILED with the reason found in the logs.
+        The alive runs stay supervised by the next passes
+
+        Returns:
+            the new states of the finished jobs by job id
+        """
+        wf_jobs = await db.get_unfinished_workflow_jobs(host=gethostname())
+        # Not started yet, e.g. waiting for a scheduler slot
+        wf_jobs = [wf_job for wf_job in wf_jobs if wf_job.job_state == 'RUNNING']
+        if not wf_jobs:
+            return {}
+        loop = get_running_loop()
+        # A single pass over the processes of the host for all runs
+        live_process_groups = await loop.run_in_executor(
+            None, NextflowManager.get_live_process_groups
+        )
+        run_states = await gather(*[
+            loop.run_in_executor(None, NextflowManager.get_run_state, wf_job.job_path,
+                                 wf_job.process_group_id, wf_job.started, live_process_groups)
+            for wf_job in wf_jobs
+        ])
+        ended = [(wf_job, job_state, reason)
+                 for wf_job, (job_state, reason) in zip(wf_jobs, run_states)
+                 if job_state != 'RUNNING']
+        # The tasks the alive runs completed since the last pass
+        await gather(*[
+            self.ingest_trace(wf_job) for wf_job, (job_state, _) in zip(wf_jobs, run_states)
+            if job_state == 'RUNNING'
+        ], return_exceptions=True)
+        finished = await gather(*[
+            self.finish_workflow_job(wf_job, job_state, reason)
+            for wf_job, job_state, reason in ended
+        ])
+        new_states = {}
+        for (wf_job, job_state, reason), was_finished in zip(ended, finished):
+            if not was_finished:
+                continue
+            new_states[wf_job.workflow_job_id] = job_state
+            if reason:
+                self.log.warning(f"Workflow job {wf_job.workflow_job_id} failed: {reason}")
+        return new_states
+
+    async def ingest_trace(self, wf_job_db: WorkflowJobDB) -> int:
+        """
+        Store the tasks the latest attempt of the job appended to its trace file since the last
+        call. Tasks taken from the task cache are left out, they were stored by their attempt
+
+        Returns:
+            the amount of stored tasks
+        """
+        trace_offset = wf_job_db.trace_offset
+        trace_tasks, new_trace_offset = await get_running_loop().run_in_executor(
+            None, NextflowManager.read_trace, wf_job_db.job_path, trace_offset
+        )
+        if new_trace_offset == trace_offset:
+            return 0
+        tasks = []
+        for task in trace_tasks:
+            if task["status"] == "CACHED":
+                continue
+            completed = datetime.utcnow()
+            if task["submit"] and task["duration"] is not None:
+                completed = task["submit"] + timedelta(seconds=task["duration"])
+            tasks.append({
+                "completed": completed,
+                "series": {"workflow_id": wf_job_db.workflow_id, "process": task["process"]},
+                "workflow_job_id": wf_job_db.workflow_job_id,
+                "attempt": wf_job_db.attempts,
+                **{field: task[field] for field in TASK_TRACE_FIELDS}
+            })
+        if not await db.add_workflow_tasks(job_id=wf_job_db.workflow_job_id,
+                                           attempts=wf_job_db.attempts, trace_offset=trace_offset,
+                                           new_trace_offset=new_trace_offset, tasks=tasks):
+            # Read by another caller meanwhile
+            return 0
+        wf_job_db.trace_offset = new_trace_offset
+        return len(tasks)
+
+    async def get_workflow_task_stats(self, workflow_id: str,
+                                      since: datetime = None) -> List[WorkflowProcessStats]:
+        """
+        The durations and resources of the tasks of the workflow by process, as percentiles of the
+        completed tasks
+        """
+        process_stats = []
+        for values in await db.get_workflow_task_values(workflow_id, since=since):
+            measured = {
+                field: [value for value in values[field] if value is not None]
+                for field in ["duration", "realtime", "cpu", "peak_rss"]
+            }
+            process_stats.append(WorkflowProcessStats(
+                process=values["_id"],
+                tasks=values["tasks"],
+                failed=values["failed"],
+                duration_p50=percentile(measured["duration"], 50),
+                duration_p95=percentile(measured["duration"], 95),
+                realtime_p50=percentile(measured["realtime"], 50),
+                realtime_p95=percentile(measured["realtime"], 95),
+                cpu_p50=percentile(measured["cpu"], 50),
+                peak_rss_p50=percentile(measured["peak_rss"], 50),
+                peak_rss_p95=percentile(measured["peak_rss"], 95),
+            ))
+        return process_stats
+
+    async def supervise_workflow_jobs(self, is_leader: Callable[[], bool] = lambda: True,
+                                      interval: float = WORKFLOW_SUPERVISE_INTERVAL) -> None:
+        """
+        Reconcile the workflow jobs of this host every `interval` seconds, the first pass finishes
+        the jobs whose runs died while the server was down. The traces of the alive runs are read
+        on each pass
+
+        Args:
+            is_leader: whether this worker supervises the runs of the host, one worker suffices
+        """
+        while True:
+            try:
+                if is_leader():
+                    await self.reconcile_workflow_jobs()
+            except Exception as error:
+                self.log.exception(f"Failed to reconcile the workflow jobs: {error}")
+            await sleep(interval)
+
+    @staticmethod
+    async def _update_cached_tasks(wf_job_db: WorkflowJobDB) -> WorkflowJobDB:
+        # Nextflow looks up the cache while the run progresses, so the count grows until it is
+        # finished
+        cached_tasks = NextflowManager.count_cached_tasks(wf_job_db.job_path)
+        if cached_tasks != wf_job_db.cached_tasks:
+            await db.set_workflow_job_cached_tasks(job_id=wf_job_db.workflow_job_id,
+                                                   cached_tasks=cached_tasks)
+            wf_job_db.cached_tasks = cached_tasks
         return wf_job_db
 
     def get_logfile_path(self, workflow_id: str, job_id: str) -> str:
@@ -1,41 +1,68 @@
-from os.path import join
-from os import remove, symlink
-from typing import List, Union, Tuple
+from asyncio import Lock, get_running_loop, sleep
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from os.path import exists, getmtime, getsize, join
+from fcntl import LOCK_EX, LOCK_NB, flock
+from os import SEEK_END, remove, scandir, symlink
+from pathlib import Path
+from shutil import rmtree
+from time import time
+from typing import AsyncIterator, Callable, Dict, List, Optional, Union, Tuple
+import aiofiles
 
 from ocrd_webapi import database as db
-from ocrd_webapi.constants import WORKSPACES_ROUTER
+from ocrd_webapi.authentication import check_storage_quota
+from ocrd_webapi.constants import UPLOAD_EXPIRY, UPLOADS_ROUTER, WORKSPACES_ROUTER
 from ocrd_webapi.exceptions import (
     WorkspaceException,
     WorkspaceGoneException,
+    WorkspaceUploadException,
+    WorkspaceUploadOffsetException,
 )
 from ocrd_webapi.managers.resource_manager import ResourceManager
+from ocrd_webapi.models.database import WorkspaceImportDB, WorkspaceUploadDB
+from ocrd_webapi.tracing import in_context, traced
 from ocrd_webapi.utils import (
+    dir_usage,
+    download_workspace_from_url,
     extract_bag_dest,
     extract_bag_info,
     generate_id,
+    read_payload_oxum,
 )
 
 
 class WorkspaceManager(ResourceManager):
+    # Used by the static methods
+    _static_instance: Optional["WorkspaceManager"] = None
+
     # Warning: Don't change these defaults
     # till everything is configured properly
     def __init__(self, log_level: str = "INFO"):
         super().__init__(logger_label=__name__, log_level=log_level, resource_router=WORKSPACES_ROUTER)
+        # Staging files of resumable uploads - BASE_DIR/UPLOADS_ROUTER
+        self._uploads_dir = join(self._resources_base, UPLOADS_ROUTER)
+        Path(self._uploads_dir).mkdir(parents=True, exist_ok=True)
+        # Serializes chunk appends and finalization per upload session inside this process, the
+        # flock on the staging file serializes them across the worker processes
+        self._upload_locks: Dict[str, Lock] = {}
 
-    def get_workspaces(self) -> List[Tuple[str, str]]:
+    async def get_workspaces(self) -> List[Tuple[str, str]]:
         """
         Get a list of all available workspace urls.
         """
-        return self.get_all_resources(local=False)
+        return await self.get_all_resources(local=False)
 
     async def create_workspace_from_mets_dir(self, mets_dir: str, uid: str = None) -> Tuple[Union[str, None], str]:
         workspace_id, workspace_dir = self._create_resource_dir(uid)
         symlink(mets_dir, workspace_dir)
-        workspace_url = self.get_resource(workspace_id, local=False)
+        workspace_url = await self.get_resource(workspace_id, local=False)
         return workspace_url, workspace_id
 
-    async def create_workspace_from_zip(self, file, uid: str = None, file_stream: bool = True
-    ) -> Tuple[Union[str, None], str]:
+    @traced
+    async def create_workspace_from_zip(self, file, uid: str = None, file_stream: bool = True,
+                                        keep_file: bool = False,
+                                        owner: str = None) -> Tuple[Union[str, None], str]:
         """
         create a workspace from an ocrd-zipfile
 
@@ -43,43 +70,373 @@ class WorkspaceManager(ResourceManager):
             file: ocrd-zip of workspace
             file_stream: Whether the received file is UploadFile type
             uid (str): the uid is used as workspace-directory. If `None`, an uuid is created for
-                this. If corresponding dir already existing, None is returned
+                this. An existing workspace of the uid is replaced once the ocrd-zip is ingested
+            keep_file: Whether a file path (`file_stream=False`) is ingested in place instead of
+                copied, it is left to the caller
+            owner: e-mail of the user the workspace is accounted to
         """
         # TODO: Separate the local storage from DB cases
-        workspace_id, workspace_dir = self._create_resource_dir(uid)
+        workspace_id = uid or generate_id()
+        workspace_dir = self._to_resource(workspace_id, local=True)
+        # Ingested next to the workspace dir and moved into place when it is valid and saved, a
+        # failed ingest leaves an existing workspace untouched
+        ingest_dir = f"{workspace_dir}.ingest-{generate_id()}"
         # TODO: Get rid of this low level os.path access,
         #  should happen inside the Resource manager
-        zip_dest = join(self._resource_dir, workspace_id + ".zip")
+        zip_dest = f"{ingest_dir}.zip"
         # TODO: Must be a more optimal way to achieve this
         if file_stream:
             # Handles the UploadFile type file
             await self._receive_resource(file=file, resource_dest=zip_dest)
+        elif keep_file:
+            zip_dest = file
         else:
             # Handles the file paths
             await self._receive_resource2(file_path=file, resource_dest=zip_dest)
 
-        bag_info = extract_bag_info(zip_dest, workspace_dir)
+        # The received zip and the ingest dir are removed even if the ingest fails, otherwise
+        # they stay forever
+        try:
+            # Validation and extraction are CPU and IO heavy, keep them off the event loop
+            bag_info = await get_running_loop().run_in_executor(
+                None, in_context(extract_bag_info, zip_dest, ingest_dir)
+            )
 
-        # TODO: Provide a functionality to enable/disable writing to/reading from a DB
-        await db.save_workspace(workspace_id, workspace_dir, bag_info)
+            size, files = await self._payload_usage(bag_info, ingest_dir)
+            # The announced size of the upload may be missing or wrong, the unpacked one is not
+            await self._check_storage_quota(workspace_id, owner, size, files)
+            # TODO: Provide a functionality to enable/disable writing to/reading from a DB
+            await db.save_workspace(workspace_id, workspace_dir, bag_info, owner=owner, size=size,
+                                    files=files)
+            self._replace_resource_dir(workspace_id, ingest_dir)
+        finally:
+            if not keep_file:
+                try:
+                    remove(zip_dest)
+                except FileNotFoundError:
+                    # Removed by the storage janitor meanwhile
+                    pass
+            rmtree(ingest_dir, ignore_errors=True)
+        await self.persist_resource(workspace_id)
 
-        remove(zip_dest)
-        workspace_url = self.get_resource(workspace_id, local=False)
+        workspace_url = await self.get_resource(workspace_id, local=False)
         return workspace_url, workspace_id
 
-    async def update_workspace(self, file, workspace_id: str) -> Union[str, None]:
+    async def update_workspace(self, file, workspace_id: str,
+                               owner: str = None) -> Union[str, None]:
         """
         Update a workspace
 
-        Delete the workspace if existing and then delegate to
+        Delegate to
         :py:func:`ocrd_webapi.workspace_manager.WorkspaceManager.create_workspace_from_zip
+        which replaces the workspace if existing
         """
-        self._delete_resource_dir(workspace_id)
-        ws_url, ws_id = await self.create_workspace_from_zip(file=file, uid=workspace_id)
+        ws_url, ws_id = await self.create_workspace_from_zip(file=file, uid=workspace_id,
+                                                             owner=owner)
         return ws_url
 
+    async def create_workspace_import(self, mets_url: str, file_grp: List[str] = None,
+                                      mets_basename: str = "mets.xml",
+                                      owner: str = None) -> Tuple[str, str]:
+        """
+        Register an import of a workspace from a METS URL. The import itself is done by
+        :py:func:`ocrd_webapi.workspace_manager.WorkspaceManager.run_workspace_import`
+
+        Returns:
+            id and url of the import job
+        """
+        import_id = generate_id()
+        await db.save_workspace_import(
+            import_id=import_id,
+            mets_url=mets_url,
+            job_state="QUEUED",
+            file_grp=file_grp,
+            mets_basename=mets_basename,
+            owner=owner
+        )
+        return import_id, self.get_import_url(import_id)
+
+    @staticmethod
+    async def get_workspace_import(import_id: str) -> Union[WorkspaceImportDB, None]:
+        return await db.get_workspace_import(import_id)
+
+    def get_import_url(self, import_id: str) -> str:
+        return f"{self._resources_url}/{self._resource_router}/import/{import_id}"
+
+    async def run_workspace_import(self, import_id: str) -> None:
+        """
+        Download the METS and the referenced files of an import job into a new workspace and
+        register the workspace in the database
+        """
+        import_db = await db.get_workspace_import(import_id)
+        if not import_db:
+            self.log.error(f"Trying to run a non-existing workspace import: {import_id}")
+            return
+        await db.set_workspace_import_state(import_id, job_state="RUNNING")
+        workspace_id, workspace_dir = self._create_resource_dir(None)
+        try:
+            # The downloads block, keep them off the event loop
+            bag_info = await get_running_loop().run_in_executor(
+                None,
+                in_context(
+                    download_workspace_from_url,
+                    import_db.mets_url,
+                    workspace_dir,
+                    mets_basename=import_db.mets_basename,
+                    file_grp=import_db.file_grp
+                )
+            )
+            size, files = await self._payload_usage(bag_info, workspace_dir)
+            await self._check_storage_quota(workspace_id, import_db.owner, size, files)
+            await db.save_workspace(workspace_id, workspace_dir, bag_info, owner=import_db.owner,
+                                    size=size, files=files)
+            await self.persist_resource(workspace_id)
+        except Exception as error:
+            self.log.exception(f"Failed to import workspace from {import_db.mets_url}: {error}")
+            self._forget_resource(workspace_id)
+            rmtree(workspace_dir, ignore_errors=True)
+            await db.set_workspace_import_state(import_id, job_state="FAILED",
+                                                failure_reason=str(error))
+            return
+        await db.set_workspace_import_state(import_id, job_state="SUCCESS",
+                                            workspace_id=workspace_id)
+
+    async def create_workspace_upload(self, upload_length: int, workspace_id: str = None,
+                                      owner: str = None) -> Tuple[str, str]:
+        """
+        Create a resumable upload session with an empty staging file
+
+        Args:
+            upload_length: total size of the upload in bytes
+            workspace_id: (optional) the workspace to create or replace when the upload is finalized
+            owner: (optional) e-mail of the user the workspace is accounted to
+        Returns:
+            id and url of the upload session
+        """
+        upload_id = generate_id()
+        upload_path = join(self._uploads_dir, upload_id + ".zip")
+        open(upload_path, "wb").close()
+        await db.save_workspace_upload(
+            upload_id=upload_id,
+            upload_path=upload_path,
+            expires=self._upload_expiry(),
+            upload_length=upload_length,
+            workspace_id=workspace_id,
+            owner=owner
+        )
+        return upload_id, self.get_upload_url(upload_id)
+
+    def get_upload_url(self, upload_id: str) -> str:
+        return f"{self._resources_url}/{self._resource_router}/upload/{upload_id}"
+
+    async def get_workspace_upload_offset(
+            self, upload_id: str, owner: str = None) -> Union[Tuple[int, Union[int, None]], None]:
+        """
+        Returns the current offset and the announced length of an upload session or None if the
+        session does not exist (anymore)
+        """
+        upload = await self._get_workspace_upload(upload_id, owner)
+        if not upload:
+            return None
+        return getsize(upload.upload_path), upload.upload_length
+
+    @traced
+    async def append_workspace_upload(self, upload_id: str, offset: int,
+                                      chunks: AsyncIterator[bytes],
+                                      owner: str = None) -> Union[int, None]:
+        """
+        Append the received chunks to the staging file of an upload session
+
+        Args:
+            upload_id: id of the upload session
+            offset: offset of the first byte of `chunks`, must match the current size of the upload
+            chunks: the bytes to append
+            owner: e-mail of the user sending the chunks, must be the one who created the session
+        Returns:
+            the new offset or None if the session does not exist
+        """
+        upload = await self._get_workspace_upload(upload_id, owner)
+        if not upload:
+            return None
+        async with self._upload_lock(upload_id), self._lock_staging_file(upload.upload_path) as fpt:
+            # The session may have been finalized or expired by another worker meanwhile
+            upload = await self._get_workspace_upload(upload_id, owner)
+            if not fpt or not upload:
+                return None
+            current_offset = await fpt.seek(0, SEEK_END)
+            if offset != current_offset:
+                raise WorkspaceUploadOffsetException(
+                    f"Chunk offset {offset} does not match the upload offset {current_offset}"
+                )
+            async for chunk in chunks:
+                current_offset += len(chunk)
+                if upload.upload_length is not None and current_offset > upload.upload_length:
+                    raise WorkspaceUploadException(
+                        f"Upload exceeds the announced length of {upload.upload_length} bytes"
+                    )
+                await fpt.write(chunk)
+            await fpt.flush()
+            await db.set_workspace_upload_expiry(upload_id, self._upload_expiry())
+            return current_offset
+
+    @traced
+    async def finalize_workspace_upload(self, upload_id: str,
+                                        owner: str = None) -> Union[Tuple[str, str], None]:
+        """
+        Hand over a completely received upload to
+        :py:func:`ocrd_webapi.workspace_manager.WorkspaceManager.create_workspace_from_zip`. The
+        session is kept if the ingest fails, e.g. to finalize it again after a database outage
+
+        Args:
+            upload_id: id of the upload session
+            owner: e-mail of the finalizing user, must be the one who created the session
+        Returns:
+            url and id of the workspace or None if the session does not exist
+        """
+        upload = await self._get_workspace_upload(upload_id, owner)
+        if not upload:
+            return None
+        async with self._upload_lock(upload_id), self._lock_staging_file(upload.upload_path) as fpt:
+            upload = await self._get_workspace_upload(upload_id, owner)
+            if not fpt or not upload:
+                return None
+            received = getsize(upload.upload_path)
+            if upload.upload_length is not None and received != upload.upload_length:
+                raise WorkspaceUploadException(
+                    f"Upload is incomplete: {received} of {upload.upload_length} bytes received"
+                )
+            ws_url, ws_id = await self.create_workspace_from_zip(
+                file=upload.upload_path,
+                uid=upload.workspace_id,
+                file_stream=False,
+                keep_file=True,
+                owner=upload.owner
+            )
+            await self._remove_workspace_upload(upload_id, upload.upload_path)
+        return ws_url, ws_id
+
+    async def expire_workspace_uploads(self) -> List[str]:
+        """
+        Remove expired upload sessions together with their staging files. Staging files without
+        a session, e.g. left over from a crash, are removed once they are older than the expiry.
+
+        Returns:
+            the ids of the removed upload sessions
+        """
+        expired = []
+        for upload in await db.get_expired_workspace_uploads():
+            upload_lock = self._upload_locks.get(upload.upload_id)
+            if upload_lock and upload_lock.locked():
+                continue
+            # Sessions busy in another worker process are left to the next run
+            async with self._lock_staging_file(upload.upload_path, blocking=False) as fpt:
+                if fpt is False:
+                    continue
+                await self._remove_workspace_upload(upload.upload_id, upload.upload_path)
+            expired.append(upload.upload_id)
+        for entry in scandir(self._uploads_dir):
+            if entry.is_file() and getmtime(entry.path) < time() - UPLOAD_EXPIRY:
+                upload_id = entry.name[:-len(".zip")] if entry.name.endswith(".zip") else entry.name
+                if not await db.get_workspace_upload(upload_id):
+                    remove(entry.path)
+                    expired.append(upload_id)
+        if expired:
+            self.log.info(f"Garbage-collected expired upload sessions: {expired}")
+        return expired
+
+    async def expire_workspace_uploads_periodically(
+            self, interval: int = 600, is_leader: Callable[[], bool] = lambda: True
+    ) -> None:
+        while True:
+            try:
+                if is_leader():
+                    await self.expire_workspace_uploads()
+            except Exception as error:
+                self.log.exception(f"Failed to garbage-collect upload sessions: {error}")
+            await sleep(interval)
+
+    @staticmethod
+    async def _get_workspace_upload(upload_id: str,
+                                    owner: Optional[str]) -> Optional[WorkspaceUploadDB]:
+        """
+        Returns the upload session if it exists and was created by the `owner`, the sessions of
+        other users are not disclosed
+        """
+        upload = await db.get_workspace_upload(upload_id)
+        if not upload or upload.owner != owner or not exists(upload.upload_path):
+            return None
+        return upload
+
+    async def _remove_workspace_upload(self, upload_id: str, upload_path: str) -> None:
+        if exists(upload_path):
+            remove(upload_path)
+        await db.delete_workspace_upload(upload_id)
+        self._upload_locks.pop(upload_id, None)
+
+    @staticmethod
+    async def _check_storage_quota(workspace_id: str, owner: Optional[str], size: int,
+                                   files: int) -> None:
+        """
+        Raise a QuotaExceededError if storing the payload of a new workspace exceeds the quota of
+        the owner, the usage of the workspace it replaces is given back
+        """
+        if not owner:
+            return
+        replaced = await db.get_workspace(workspace_id)
+        if replaced and not replaced.deleted and replaced.owner == owner:
+            size, files = size - replaced.size, files - replaced.files
+        await check_storage_quota(owner, size, files)
+
+    @staticmethod
+    @traced
+    async def _payload_usage(bag_info: dict, workspace_dir: str) -> Tuple[int, int]:
+        """
+        Bytes and files of a new workspace, from the Payload-Oxum of the bag if declared
+        """
+        payload_usage = read_payload_oxum(bag_info)
+        if payload_usage:
+            return payload_usage
+        return await get_running_loop().run_in_executor(None, in_context(dir_usage, workspace_dir))
+
+    @staticmethod
+    @asynccontextmanager
+    async def _lock_staging_file(upload_path: str, blocking: bool = True):
+        """
+        Open the staging file of an upload without creating it and hold an exclusive flock on it.
+        Yields the file or None if it does not exist, without `blocking` False if it is locked
+        """
+        try:
+            fpt = await aiofiles.open(upload_path, "r+b")
+        except FileNotFoundError:
+            yield None
+            return
+        try:
+            if blocking:
+                await get_running_loop().run_in_executor(None, flock, fpt.fileno(), LOCK_EX)
+            else:
+                try:
+                    flock(fpt.fileno(), LOCK_EX | LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+            yield fpt
+        finally:
+            # Closing the file releases the lock
+            await fpt.close()
+
+    def _upload_lock(self, upload_id: str) -> Lock:
+        if upload_id not in self._upload_locks:
+            self._upload_locks[upload_id] = Lock()
+        return self._upload_locks[upload_id]
+
+    @staticmethod
+    def _upload_expiry() -> datetime:
+        return datetime.utcnow() + timedelta(seconds=UPLOAD_EXPIRY)
+
     # TODO: Refine this and get rid of the low level os.path bullshits
-    async def get_workspace_bag(self, workspace_id: str) -> Union[str, None]:
+    @traced
+    async def get_workspace_bag(self, workspace_id: str, file_grp: List[str] = None,
+                                page_id: List[str] = None) -> Union[str, None]:
         """
         Create workspace bag.
 
@@ -89,6 +446,8 @@ class WorkspaceManager(ResourceManager):
 
         Args:
              workspace_id (str): id of workspace to bag
+             file_grp (list): (optional) only bag files of these file groups
+             page_id (list): (optional) only bag files of these pages
         Returns:
             path to created bag
         """
@@ -97,14 +456,19 @@ class WorkspaceManager(ResourceManager):
         #     - ocrd_identifier is stored in mongodb. use that for bagging. Write method in
         #       database.py to read it from mongodb
         #     - write tests for this cases
-        if self._has_dir(workspace_id):
+        workspace_dir = await self.stage_resource(workspace_id)
+        if workspace_dir:
             workspace_db = await db.get_workspace(workspace_id)
-            workspace_dir = self.get_resource(workspace_id, local=True)
             # TODO: Get rid of this low level os.path access,
             #  should happen inside the Resource manager
             generated_id = generate_id(file_ext=".zip")
             bag_dest = join(self._resource_dir, generated_id)
-            extract_bag_dest(workspace_db, workspace_dir, bag_dest)
+            # Copying, checksumming and zipping the files is CPU and IO heavy, keep it off the
+            # event loop
+            await get_running_loop().run_in_executor(
+                None, in_context(extract_bag_dest, workspace_db, workspace_dir, bag_dest,
+                                 file_grp=file_grp, page_id=page_id)
+            )
             return bag_dest
         return None
 
@@ -113,15 +477,14 @@ class WorkspaceManager(ResourceManager):
         Delete a workspace
         """
         # TODO: Separate the local storage from DB cases
-        workspace_dir = self.get_resource(workspace_id, local=True)
-        if not workspace_dir:
+        deleted_workspace_url = await self.get_resource(workspace_id, local=False)
+        if not deleted_workspace_url:
             ws = await db.get_workspace(workspace_id)
             if ws and ws.deleted:
                 raise WorkspaceGoneException(f"Workspace is already deleted: {workspace_id}")
             raise WorkspaceException(f"Workspace is not existing: {workspace_id}")
 
-        deleted_workspace_url = self.get_resource(workspace_id, local=False)
-        self._delete_resource_dir(workspace_id)
+        await self._delete_resource_dir(workspace_id)
         await db.mark_deleted_workspace(workspace_id)
 
         return deleted_workspace_url
@@ -132,8 +495,11 @@ class WorkspaceManager(ResourceManager):
     # avoid giving access to the full WorkspaceManager
     # 2. Probably making the managers to be
     # static singletons is the right approach here
-    def static_get_resource(resource_id: str, local: bool) -> Union[str, None]:
-        return WorkspaceManager().get_resource(
+    async def static_get_resource(resource_id: str, local: bool) -> Union[str, None]:
+        # A single instance, setting up a manager probes and logs its base directory
+        if WorkspaceManager._static_instance is None:
+            WorkspaceManager._static_instance = WorkspaceManager()
+        return await WorkspaceManager._static_instance.get_resource(
             resource_id=resource_id,
             local=local
         )
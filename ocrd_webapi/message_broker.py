@@ -0,0 +1,265 @@
+"""
+Message brokers used to dispatch processing messages to processing workers and to receive their
+result messages.
+
+Two backends share the `MessageBroker` interface:
+    - InMemoryBroker: asyncio queues inside this process, for tests and single-node deployments
+    - AMQPBroker: queues of a RabbitMQ (or any other AMQP 0-9-1) server
+"""
+from abc import ABC, abstractmethod
+from asyncio import Queue, get_running_loop
+from functools import partial
+from threading import Event, Lock, Thread
+from typing import AsyncIterator, Awaitable, Callable, Dict
+import logging
+
+import pika
+
+from ocrd_webapi.tracing import in_context
+
+__all__ = [
+    "AMQPBroker",
+    "Delivery",
+    "InMemoryBroker",
+    "MessageBroker",
+    "create_broker",
+]
+
+
+class Delivery:
+    """
+    A consumed message. It must be acknowledged once it is handled, otherwise the broker
+    delivers it again (at-least-once delivery)
+    """
+    def __init__(self, body: bytes, ack: Callable[[], Awaitable[None]],
+                 nack: Callable[[bool], Awaitable[None]]):
+        self.body = body
+        self._ack = ack
+        self._nack = nack
+
+    async def ack(self) -> None:
+        await self._ack()
+
+    async def nack(self, requeue: bool = True) -> None:
+        await self._nack(requeue)
+
+
+class MessageBroker(ABC):
+    def __init__(self, logger_label: str):
+        self.log = logging.getLogger(logger_label)
+
+    @abstractmethod
+    async def connect(self) -> None:
+        pass
+
+    @abstractmethod
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    async def create_queue(self, queue_name: str) -> None:
+        """
+        Create the queue if it does not exist yet
+        """
+        pass
+
+    @abstractmethod
+    async def publish(self, queue_name: str, body: bytes) -> None:
+        pass
+
+    @abstractmethod
+    def consume(self, queue_name: str, prefetch: int = 100) -> AsyncIterator[Delivery]:
+        """
+        Yields the messages of the queue as `Delivery`s, at most `prefetch` of them are
+        unacknowledged
+        """
+        pass
+
+
+class InMemoryBroker(MessageBroker):
+    """
+    Broker backed by one asyncio queue per queue name. Messages are lost on restart
+    """
+    def __init__(self):
+        super().__init__(logger_label=__name__)
+        self._queues: Dict[str, Queue] = {}
+
+    async def connect(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        self._queues.clear()
+
+    async def create_queue(self, queue_name: str) -> None:
+        if queue_name not in self._queues:
+            self._queues[queue_name] = Queue()
+
+    async def publish(self, queue_name: str, body: bytes) -> None:
+        await self.create_queue(queue_name)
+        self._queues[queue_name].put_nowait(body)
+
+    async def consume(self, queue_name: str, prefetch: int = 100) -> AsyncIterator[Delivery]:
+        await self.create_queue(queue_name)
+        queue = self._queues[queue_name]
+        while True:
+            body = await queue.get()
+            yield Delivery(body, ack=self._noop_ack, nack=self._requeue(queue, body))
+
+    def queue_size(self, queue_name: str) -> int:
+        if queue_name not in self._queues:
+            return 0
+        return self._queues[queue_name].qsize()
+
+    @staticmethod
+    async def _noop_ack() -> None:
+        pass
+
+    @staticmethod
+    def _requeue(queue: Queue, body: bytes) -> Callable[[bool], Awaitable[None]]:
+        async def nack(requeue: bool = True) -> None:
+            if requeue:
+                queue.put_nowait(body)
+        return nack
+
+
+class AMQPBroker(MessageBroker):
+    """
+    Broker backed by an AMQP server, e.g. RabbitMQ
+
+    pika connections are not thread safe and block, so publishing uses one connection guarded by
+    a lock in the default executor, and each consumer runs its own connection in a thread which
+    hands the messages over to the event loop. Acknowledgements are sent back to that thread.
+    A consumer whose connection is lost reconnects with an exponential backoff, other errors of
+    the thread are raised by `consume`.
+    """
+    # Seconds between the reconnects of a consumer, doubled up to the maximum
+    reconnect_backoff: float = 1
+    reconnect_backoff_max: float = 60
+
+    def __init__(self, url: str):
+        super().__init__(logger_label=__name__)
+        self.url = url
+        self._publish_connection = None
+        self._publish_channel = None
+        self._publish_lock = Lock()
+        self._consumer_stops = []
+
+    async def connect(self) -> None:
+        await get_running_loop().run_in_executor(None, self._connect_publisher)
+
+    async def close(self) -> None:
+        for stop in self._consumer_stops:
+            stop.set()
+        self._consumer_stops.clear()
+        with self._publish_lock:
+            if self._publish_connection and self._publish_connection.is_open:
+                self._publish_connection.close()
+            self._publish_connection = None
+
+    async def create_queue(self, queue_name: str) -> None:
+        def declare():
+            with self._publish_lock:
+                self._publish_channel.queue_declare(queue=queue_name, durable=True)
+        await get_running_loop().run_in_executor(None, declare)
+
+    async def publish(self, queue_name: str, body: bytes) -> None:
+        def basic_publish():
+            with self._publish_lock:
+                if not self._publish_connection or not self._publish_connection.is_open:
+                    self._connect_publisher(locked=True)
+                self._publish_channel.basic_publish(
+                    exchange="",
+                    routing_key=queue_name,
+                    body=body,
+                    properties=pika.BasicProperties(delivery_mode=2)
+                )
+        await get_running_loop().run_in_executor(None, in_context(basic_publish))
+
+    async def consume(self, queue_name: str, prefetch: int = 100) -> AsyncIterator[Delivery]:
+        loop = get_running_loop()
+        deliveries = Queue()
+        stop = Event()
+        self._consumer_stops.append(stop)
+
+        def consume_once():
+            connection = pika.BlockingConnection(pika.URLParameters(self.url))
+            channel = connection.channel()
+            channel.queue_declare(queue=queue_name, durable=True)
+            channel.basic_qos(prefetch_count=prefetch)
+            try:
+                for method, _, body in channel.consume(queue_name, inactivity_timeout=1):
+                    if stop.is_set():
+                        break
+                    if method is None:
+                        continue
+                    delivery = Delivery(
+                        body,
+                        ack=self._threadsafe_ack(connection, channel, method.delivery_tag),
+                        nack=self._threadsafe_nack(connection, channel, method.delivery_tag)
+                    )
+                    loop.call_soon_threadsafe(deliveries.put_nowait, delivery)
+            finally:
+                if connection.is_open:
+                    connection.close()
+
+        def consume_forever():
+            backoff = self.reconnect_backoff
+            while not stop.is_set():
+                try:
+                    consume_once()
+                    backoff = self.reconnect_backoff
+                except (pika.exceptions.AMQPConnectionError,
+                        pika.exceptions.AMQPChannelError) as error:
+                    self.log.warning(f"Lost the connection consuming {queue_name}, reconnecting "
+                                     f"in {backoff}s: {error}")
+                    stop.wait(backoff)
+                    backoff = min(backoff * 2, self.reconnect_backoff_max)
+                except Exception as error:
+                    # Fail the consumer visibly instead of leaving it waiting forever
+                    loop.call_soon_threadsafe(deliveries.put_nowait, error)
+                    return
+
+        Thread(target=consume_forever, name=f"amqp-consumer-{queue_name}", daemon=True).start()
+        try:
+            while True:
+                delivery = await deliveries.get()
+                if isinstance(delivery, Exception):
+                    raise delivery
+                yield delivery
+        finally:
+            stop.set()
+
+    def _connect_publisher(self, locked: bool = False) -> None:
+        if not locked:
+            self._publish_lock.acquire()
+        try:
+            self._publish_connection = pika.BlockingConnection(pika.URLParameters(self.url))
+            self._publish_channel = self._publish_connection.channel()
+        finally:
+            if not locked:
+                self._publish_lock.release()
+
+    @staticmethod
+    def _threadsafe_ack(connection, channel, delivery_tag) -> Callable[[], Awaitable[None]]:
+        async def ack() -> None:
+            connection.add_callback_threadsafe(
+                partial(channel.basic_ack, delivery_tag=delivery_tag)
+            )
+        return ack
+
+    @staticmethod
+    def _threadsafe_nack(connection, channel, delivery_tag) -> Callable[[bool], Awaitable[None]]:
+        async def nack(requeue: bool = True) -> None:
+            connection.add_callback_threadsafe(
+                partial(channel.basic_nack, delivery_tag=delivery_tag, requeue=requeue)
+            )
+        return nack
+
+
+def create_broker(broker_url: str) -> MessageBroker:
+    """
+    Returns an AMQPBroker for `amqp://` and `amqps://` urls, an InMemoryBroker otherwise
+    """
+    if broker_url and broker_url.startswith(("amqp://", "amqps://")):
+        return AMQPBroker(broker_url)
+    return InMemoryBroker()
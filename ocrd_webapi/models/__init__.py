@@ -4,23 +4,43 @@ __all__ = [
     'JobState',
     'OcrdProcessingMessageModel',
     'OcrdResultMessageModel',
+    'ProcessingJobDB',
     'ProcessorArgs',
     'ProcessorRsrc',
     'ProcessorJobRsrc',
+    'ProfileInfo',
+    'ProfilingArgs',
+    'ProfilingState',
     'Resource',
+    'StorageArtifact',
+    'StorageReport',
     'WorkflowArgs',
     'WorkflowDB',
     'WorkflowRsrc',
     'WorkflowJobRsrc',
     'WorkflowJobDB',
     'WorkspaceDB',
-    'WorkspaceRsrc'
+    'WorkspaceImportArgs',
+    'WorkspaceImportDB',
+    'WorkspaceImportRsrc',
+    'WorkspaceRsrc',
+    'WorkspaceUploadDB',
+    'WorkspaceUploadRsrc',
 ]
 
-from .base import Resource, Job, JobState, ProcessorArgs, WorkflowArgs
-from .database import WorkflowDB, WorkflowJobDB, WorkspaceDB
+from .base import Resource, Job, JobState, ProcessorArgs, WorkflowArgs, WorkspaceImportArgs
+from .database import (
+    ProcessingJobDB,
+    WorkflowDB,
+    WorkflowJobDB,
+    WorkspaceDB,
+    WorkspaceImportDB,
+    WorkspaceUploadDB,
+)
 from .discovery import DiscoveryResponse
+from .janitor import StorageArtifact, StorageReport
 from .ocrd_messages import OcrdProcessingMessageModel, OcrdResultMessageModel
 from .processor import ProcessorRsrc, ProcessorJobRsrc
+from .profiling import ProfileInfo, ProfilingArgs, ProfilingState
 from .workflow import WorkflowRsrc, WorkflowJobRsrc
-from .workspace import WorkspaceRsrc
+from .workspace import WorkspaceImportRsrc, WorkspaceRsrc, WorkspaceUploadRsrc
@@ -1,5 +1,14 @@
-from pydantic import BaseModel, Field, constr
-from typing import Any, Dict, Optional
+from pydantic import (
+    BaseModel,
+    Field,
+    StrictBool,
+    StrictFloat,
+    StrictInt,
+    StrictStr,
+    conint,
+    constr,
+)
+from typing import Any, Dict, List, Optional, Union
 
 
 class Resource(BaseModel):
@@ -19,9 +28,21 @@ class Resource(BaseModel):
     class Config:
         allow_population_by_field_name = True
 
+    @classmethod
+    def trusted_dict(cls, **fields) -> Dict[str, Any]:
+        """
+        The JSON-ready dict of a resource built by the server, without validating it like the
+        constructor does. Unset fields get their defaults, the keys are in the order of the fields
+        """
+        defaults = cls.__dict__.get("_trusted_defaults")
+        if defaults is None:
+            defaults = {name: field.default for name, field in cls.__fields__.items()}
+            setattr(cls, "_trusted_defaults", defaults)
+        return {**defaults, **fields}
+
 
 class JobState(BaseModel):
-    __root__: constr(regex=r'^(QUEUED|RUNNING|STOPPED|SUCCESS)')
+    __root__: constr(regex=r'^(QUEUED|RUNNING|STOPPED|SUCCESS|FAILED|CANCELLED)')
 
 
 class Job(Resource):
@@ -41,7 +62,22 @@ class ProcessorArgs(BaseModel):
     output_file_grps: str = None
     page_id: str = None
     parameters: Optional[Dict[str, Any]] = {}
+    # Page-range shards processed in parallel, bounded by the available workers
+    shards: Optional[conint(ge=1)] = None
 
 
 class WorkflowArgs(BaseModel):
     workspace_id: str = None
+    # Values for the `params.*` of the workflow script, passed as `--name value` to Nextflow
+    workflow_parameters: Optional[Dict[
+        constr(regex=r'^[A-Za-z_]\w*$'),
+        Union[StrictStr, StrictInt, StrictFloat, StrictBool]
+    ]] = {}
+    # Priority class of the job, at most the one of the user's account (the default)
+    priority: Optional[int] = None
+
+
+class WorkspaceImportArgs(BaseModel):
+    mets_url: str
+    file_grp: Optional[List[str]] = None
+    mets_basename: str = 'mets.xml'
@@ -1,5 +1,8 @@
-from beanie import Document
-from typing import Optional
+from beanie import Document, Granularity, Indexed, TimeSeriesConfig
+from datetime import datetime
+from pydantic import BaseModel
+from pymongo import ASCENDING, IndexModel
+from typing import Any, Dict, List, Optional
 
 # NOTE: Database models must not reuse any
 # response models [discovery, processor, user, workflow, workspace]
@@ -15,14 +18,29 @@ class UserAccountDB(Document):
         encrypted_pass: The encrypted password of the user
         salt:           Random salt value used when encrypting the password
         approved_user:  Whether the user is approved by the admin
+        used_bytes:     Bytes of the workspaces, workflows and workflow jobs owned by the user
+        used_files:     Files of the workspaces, workflows and workflow jobs owned by the user
+        quota_bytes:    (optional) Maximum of used bytes, overrides the default quota
+        quota_files:    (optional) Maximum of used files, overrides the default quota
+        share:          Weight of the user's workflow jobs in the fair-share scheduling
+        priority:       Highest priority class the user's workflow jobs may be queued with
+        max_running_jobs: (optional) Maximum of running workflow jobs, overrides the default
 
     By default, the registered user's account is not validated.
     An admin must manually validate the account by assigning True value.
+    The usage is maintained incrementally on ingest, job completion and deletion.
     """
     email: str
     encrypted_pass: str
     salt: str
     approved_user: bool = False
+    used_bytes: int = 0
+    used_files: int = 0
+    quota_bytes: Optional[int]
+    quota_files: Optional[int]
+    share: float = 1.0
+    priority: int = 0
+    max_running_jobs: Optional[int]
 
     class Settings:
         name = "user_accounts"
@@ -41,6 +59,9 @@ class WorkspaceDB(Document):
         ocrd_mets                   Ocrd-Mets (optional)
         bag_info_adds               bag-info.txt can also (optionally) contain additional
                                     key-value-pairs which are saved here
+        owner                       (optional) e-mail of the user who created the workspace
+        size                        bytes of the payload of the workspace
+        files                       files of the payload of the workspace
     """
     workspace_id: str
     workspace_path: str
@@ -50,19 +71,89 @@ class WorkspaceDB(Document):
     ocrd_base_version_checksum: Optional[str]
     ocrd_mets: Optional[str]
     bag_info_adds: Optional[dict]
+    owner: Optional[str]
+    size: int = 0
+    files: int = 0
     deleted: bool = False
 
     class Settings:
         name = "workspace"
 
 
+class WorkspaceUploadDB(Document):
+    """
+    Model to store a resumable workspace upload session in the mongo-database.
+
+    Attributes:
+        upload_id       the id of the upload session
+        upload_path     path of the staging file the chunks are appended to
+        upload_length   (optional) total size of the upload in bytes, if announced by the client
+        workspace_id    (optional) id of the workspace to create or replace on finalization
+        owner           (optional) e-mail of the user who created the session
+        expires         point in time after which the session is garbage-collected
+    """
+    upload_id: str
+    upload_path: str
+    upload_length: Optional[int]
+    workspace_id: Optional[str]
+    owner: Optional[str]
+    expires: datetime
+
+    class Settings:
+        name = "workspace_upload"
+
+
+class WorkspaceImportDB(Document):
+    """
+    Model to store a workspace import from a METS URL in the mongo-database.
+
+    Attributes:
+        import_id       the id of the import job
+        mets_url        the URL of the METS file to import
+        file_grp        (optional) file groups to import, everything is imported if not set
+        mets_basename   the name of the METS file inside the workspace
+        workspace_id    id of the created workspace, once the import succeeded
+        job_state       current state of the import job
+        failure_reason  (optional) why the import failed
+        owner           (optional) e-mail of the user who started the import
+    """
+    import_id: str
+    mets_url: str
+    file_grp: Optional[List[str]]
+    mets_basename: str = "mets.xml"
+    workspace_id: Optional[str]
+    job_state: str
+    failure_reason: Optional[str]
+    owner: Optional[str]
+
+    class Settings:
+        name = "workspace_import"
+
+
 class WorkflowDB(Document):
     """
     Model to store a workflow in the mongo-database.
+
+    Attributes:
+        workflow_id            the workflow's id
+        workflow_path          the path of the workflow space
+        workflow_script_path   the path of the Nextflow script
+        workflow_parameters    the `params.*` declared by the script, mapped to their default
+                               values. `None` if the script was not parsed yet
+        workflow_processes     names of the processes defined by the script
+        owner                  (optional) e-mail of the user who uploaded the workflow
+        size                   bytes of the workflow space
+        files                  files of the workflow space
+        deleted                whether the workflow was deleted
     """
     workflow_id: str
     workflow_path: str
     workflow_script_path: str
+    workflow_parameters: Optional[Dict[str, Optional[str]]]
+    workflow_processes: Optional[List[str]]
+    owner: Optional[str]
+    size: int = 0
+    files: int = 0
     deleted: bool = False
 
     class Settings:
@@ -79,12 +170,147 @@ class WorkflowJobDB(Document):
         workflow_id       id of the workflow the job is executing
         job_path          the path of the workflow job
         job_state         current state of the workflow job
+        workflow_parameters  the parameters the job was started with, reused by resumes
+        process_group_id  id of the process group of the latest Nextflow run, used to cancel the job
+        attempts          amount of Nextflow runs of the job, each resume adds an attempt
+        cached_tasks      amount of tasks the latest attempt reused from Nextflow's task cache
+        owner             (optional) e-mail of the user who started the job
+        size              bytes of the job dir, measured when the job ended
+        files             files of the job dir, measured when the job ended
+        host              host the latest Nextflow run was started on, only there its process
+                          group can be checked and signalled
+        started           when the latest Nextflow run was started
+        failure_reason    why the job FAILED, e.g. its Nextflow run died with the server
+        trace_offset      bytes of the trace file of the latest attempt already read into
+                          WorkflowTaskDB
+        priority          priority class the job is queued with
+        submitted         when the job was queued
     """
     workflow_job_id: str
     workspace_id: str
     workflow_id: str
     job_path: str
     job_state: str
+    workflow_parameters: Optional[Dict[str, Any]]
+    process_group_id: Optional[int]
+    attempts: int = 1
+    cached_tasks: Optional[int]
+    owner: Optional[str]
+    size: int = 0
+    files: int = 0
+    host: Optional[str]
+    started: Optional[datetime]
+    failure_reason: Optional[str]
+    trace_offset: int = 0
+    priority: int = 0
+    submitted: Optional[datetime]
 
     class Settings:
         name = "workflow_job"
+        # The unfinished jobs of a host are looked up by the supervisor of the host, the newly
+        # queued jobs by the dispatcher
+        indexes = [
+            IndexModel([("job_state", ASCENDING), ("host", ASCENDING)]),
+            IndexModel([("job_state", ASCENDING), ("submitted", ASCENDING)]),
+        ]
+
+
+class ProcessingJobDB(Document):
+    """
+    Model to store a Processing-Job in the mongo-database.
+
+    Attributes:
+        job_id            the job's id
+        processor_name    name of the OCR-D processor
+        workspace_id      (optional) id of the workspace the job is running on
+        path_to_mets      path of the METS file the job is running on
+        input_file_grps   list of input file groups
+        output_file_grps  (optional) list of output file groups
+        page_id           (optional) page ids to be processed
+        parameters        (optional) parameters passed to the OCR-D processor
+        job_state         current state of the processing job
+        created_time      unix timestamp of the job creation
+        parent_job_id     (optional) id of the sharded job this job is a page-range shard of
+        shard_job_ids     (optional) ids of the page-range shards of a sharded job
+    """
+    job_id: str
+    processor_name: str
+    workspace_id: Optional[str]
+    path_to_mets: str
+    input_file_grps: List[str]
+    output_file_grps: Optional[List[str]]
+    page_id: Optional[str]
+    parameters: Optional[Dict[str, Any]]
+    job_state: str
+    created_time: int
+    parent_job_id: Optional[str]
+    shard_job_ids: Optional[List[str]]
+
+    class Settings:
+        name = "processing_job"
+        # The running jobs are counted by the admission control
+        indexes = [
+            IndexModel([("job_state", ASCENDING)]),
+        ]
+
+
+class LeaseDB(Document):
+    """
+    Model to store the lease of a background service in the mongo-database, the worker holding an
+    unexpired lease is the leader running the service.
+
+    Attributes:
+        name     name of the background service, unique
+        holder   id of the worker holding the lease
+        expires  point in time after which the lease may be taken over by another worker
+    """
+    name: Indexed(str, unique=True)
+    holder: str
+    expires: datetime
+
+    class Settings:
+        name = "lease"
+
+
+class WorkflowTaskSeries(BaseModel):
+    """
+    The series a workflow task belongs to: the tasks of one process of one workflow
+    """
+    workflow_id: str
+    process: str
+
+
+class WorkflowTaskDB(Document):
+    """
+    Model to store a task of a Nextflow run in a time series collection, read from the trace files
+    of the workflow jobs.
+
+    Attributes:
+        completed         when the task was completed (UTC), the time of the series
+        series            workflow and process of the task
+        workflow_job_id   id of the job which ran the task
+        attempt           the attempt of the job which ran the task
+        name              name of the task, e.g. `ocrd_dummy (1)`
+        status            status of the task, e.g. COMPLETED or FAILED
+        exit              exit code of the task
+        duration          seconds from the submission to the completion of the task
+        realtime          seconds the task was executing
+        cpu               CPU usage in percent, 100 per fully used core
+        peak_rss          peak resident memory in bytes
+    """
+    completed: datetime
+    series: WorkflowTaskSeries
+    workflow_job_id: str
+    attempt: int = 1
+    name: str
+    status: Optional[str]
+    exit: Optional[int]
+    duration: Optional[float]
+    realtime: Optional[float]
+    cpu: Optional[float]
+    peak_rss: Optional[int]
+
+    class Settings:
+        name = "workflow_task"
+        timeseries = TimeSeriesConfig(time_field="completed", meta_field="series",
+                                      granularity=Granularity.minutes)
@@ -1,4 +1,57 @@
 from pydantic import BaseModel, Field
+from typing import Optional
+
+
+class AdmissionState(BaseModel):
+    accepting_ingests: bool = Field(
+        default=True,
+        description='Whether workspace uploads and imports are accepted'
+    )
+    accepting_jobs: bool = Field(
+        default=True,
+        description='Whether workflow and processing jobs are accepted'
+    )
+    disk_free: int = Field(
+        default=0,
+        description='Free bytes under the base directory, minus the announced size of the uploads '
+                    'in flight'
+    )
+    min_free_disk: int = Field(
+        default=0,
+        description='Free bytes under the base directory below which uploads are refused'
+    )
+    ingests_in_flight: int = Field(
+        default=0,
+        description='Uploads and imports this worker is receiving'
+    )
+    max_ingests: int = Field(
+        default=0,
+        description='Uploads and imports a worker receives at a time'
+    )
+    memory_available: int = Field(
+        default=0,
+        description='Available bytes of memory'
+    )
+    min_free_memory: int = Field(
+        default=0,
+        description='Available bytes of memory below which jobs are refused'
+    )
+    jobs_running: int = Field(
+        default=0,
+        description='Running workflow and processing jobs'
+    )
+    max_jobs: int = Field(
+        default=0,
+        description='Running jobs above which jobs are refused'
+    )
+    jobs_queued: int = Field(
+        default=0,
+        description='Workflow and processing jobs waiting to be started'
+    )
+    max_queued: int = Field(
+        default=0,
+        description='Queued jobs above which jobs are refused'
+    )
 
 
 class DiscoveryResponse(BaseModel):
@@ -30,3 +83,7 @@ class DiscoveryResponse(BaseModel):
         default=False,
         description='Whether the OCR-D executables run in a Docker container'
     )
+    admission: Optional[AdmissionState] = Field(
+        default=None,
+        description='Whether the server currently accepts uploads and jobs'
+    )
@@ -0,0 +1,58 @@
+from datetime import datetime
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+
+class StorageArtifact(BaseModel):
+    path: str = Field(
+        ...,  # the field is required, no default set
+        description='Local path of the file or directory'
+    )
+    artifact_class: str = Field(
+        ...,  # the field is required, no default set
+        description='One of temp_archive, ingest_staging, job_work_dir, job_dir, deleted_workspace'
+    )
+    size: int = Field(
+        default=0,
+        description='Size in bytes, directories include their content'
+    )
+    last_access: datetime = Field(
+        ...,  # the field is required, no default set
+        description='Latest access or modification of the artifact or anything inside it'
+    )
+    reason: Optional[str] = Field(
+        default=None,
+        description='Why the artifact is removed: retention or eviction'
+    )
+
+
+class StorageReport(BaseModel):
+    dry_run: bool = Field(
+        default=True,
+        description='Whether the artifacts were only reported and not removed'
+    )
+    disk_total: int = Field(
+        default=0,
+        description='Size of the file system of the base directory in bytes'
+    )
+    disk_used: int = Field(
+        default=0,
+        description='Used bytes of the file system of the base directory before the sweep'
+    )
+    high_water_mark: float = Field(
+        default=0.0,
+        description='Disk usage in percent above which artifacts are evicted regardless of their '
+                    'retention'
+    )
+    low_water_mark: float = Field(
+        default=0.0,
+        description='Disk usage in percent the eviction goes down to'
+    )
+    freed: int = Field(
+        default=0,
+        description='Bytes freed (or to be freed on a dry run) by removing the artifacts'
+    )
+    artifacts: List[StorageArtifact] = Field(
+        default=[],
+        description='Artifacts removed (or to be removed on a dry run) by the sweep'
+    )
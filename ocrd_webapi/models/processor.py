@@ -44,16 +44,18 @@ class ProcessorJobRsrc(Job):
     def create(job_id: str,
                job_url: str,
                processor_name: str,
+               workspace_id: str,
                workspace_url: str,
                job_state: JobState,
                description: str = None):
         if not description:
             description = "Processor-Job"
         processor_rsrc = ProcessorRsrc.create(processor_name)
-        workspace_rsrc = WorkspaceRsrc.create(workspace_url)
+        workspace_rsrc = WorkspaceRsrc.create(workspace_id=workspace_id,
+                                              workspace_url=workspace_url)
         return ProcessorJobRsrc(
-            id=job_id,
-            job_url=job_url,
+            resource_id=job_id,
+            resource_url=job_url,
             description=description,
             job_state=job_state,
             processor=processor_rsrc,
@@ -0,0 +1,60 @@
+from datetime import datetime
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+
+class ProfileInfo(BaseModel):
+    profile_id: str = Field(
+        ...,  # the field is required, no default set
+        description='ID of the profile, download it from /admin/profiling/{profile_id}'
+    )
+    request: str = Field(
+        ...,  # the field is required, no default set
+        description='Method and path of the profiled request'
+    )
+    started: datetime = Field(
+        ...,  # the field is required, no default set
+        description='When the request was received'
+    )
+    duration: float = Field(
+        default=0.0,
+        description='Seconds the request took'
+    )
+    samples: int = Field(
+        default=0,
+        description='Stacks sampled of the request and the threads it offloaded work to'
+    )
+
+
+class ProfilingArgs(BaseModel):
+    requests: int = Field(
+        default=1,
+        description='Amount of the next requests to profile'
+    )
+    path: Optional[str] = Field(
+        default=None,
+        description='Only profile requests whose path starts with this'
+    )
+
+
+class ProfilingState(BaseModel):
+    armed_requests: int = Field(
+        default=0,
+        description='Amount of the next requests which are profiled'
+    )
+    path: Optional[str] = Field(
+        default=None,
+        description='Only requests whose path starts with this are profiled'
+    )
+    interval: float = Field(
+        default=0.0,
+        description='Seconds between the samples of the stacks'
+    )
+    max_profiles: int = Field(
+        default=0,
+        description='Amount of the latest profiles kept'
+    )
+    profiles: List[ProfileInfo] = Field(
+        default=[],
+        description='The stored profiles, the latest first'
+    )
@@ -1,4 +1,5 @@
 from pydantic import BaseModel, Field
+from typing import Optional
 
 
 class UserAction(BaseModel):
@@ -19,3 +20,37 @@ class UserAction(BaseModel):
         if not action:
             action = "User Action"
         return UserAction(email=email, action=action)
+
+
+class UserUsage(BaseModel):
+    email: str = Field(
+        ...,  # the field is required, no default set
+        description='Email linked to this User'
+    )
+    used_bytes: int = Field(
+        default=0,
+        description='Bytes of the workspaces, workflows and workflow jobs of the user'
+    )
+    used_files: int = Field(
+        default=0,
+        description='Files of the workspaces, workflows and workflow jobs of the user'
+    )
+    quota_bytes: Optional[int] = Field(
+        default=None,
+        description='Maximum of used bytes, unlimited if not set'
+    )
+    quota_files: Optional[int] = Field(
+        default=None,
+        description='Maximum of used files, unlimited if not set'
+    )
+
+    @staticmethod
+    def create(email: str, used_bytes: int, used_files: int, quota_bytes: int = 0,
+               quota_files: int = 0):
+        return UserUsage(
+            email=email,
+            used_bytes=used_bytes,
+            used_files=used_files,
+            quota_bytes=quota_bytes or None,
+            quota_files=quota_files or None
+        )
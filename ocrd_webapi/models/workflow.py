@@ -1,4 +1,6 @@
-from typing import Optional
+from datetime import datetime
+from pydantic import BaseModel, Field
+from typing import Any, Dict, List, Optional
 
 from ocrd_webapi.models.base import Job, JobState, Resource
 from ocrd_webapi.models.workspace import WorkspaceRsrc
@@ -9,15 +11,38 @@ class WorkflowRsrc(Resource):
     # resource_id: (str) - inherited from Resource
     # resource_url: (str) - inherited from Resource
     # description: (str) - inherited from Resource
+    workflow_parameters: Optional[Dict[str, Optional[str]]] = Field(
+        default=None,
+        description='Parameters of the workflow script with their default values'
+    )
+    workflow_processes: Optional[List[str]] = Field(
+        default=None,
+        description='Processes of the workflow script'
+    )
 
     @staticmethod
-    def create(workflow_id: str, workflow_url: str, description: str = None):
+    def create(workflow_id: str, workflow_url: str, description: str = None,
+               workflow_parameters: Dict[str, Optional[str]] = None,
+               workflow_processes: List[str] = None):
         if not description:
             description = "Workflow"
         return WorkflowRsrc(
             resource_id=workflow_id,
             resource_url=workflow_url,
-            description=description
+            description=description,
+            workflow_parameters=workflow_parameters,
+            workflow_processes=workflow_processes
+        )
+
+    @staticmethod
+    def create_dict(workflow_id: str, workflow_url: str, description: str = None) -> Dict[str, Any]:
+        """
+        Same as `create`, but returns the JSON-ready dict without validation, e.g. for long lists
+        """
+        return WorkflowRsrc.trusted_dict(
+            resource_id=workflow_id,
+            resource_url=workflow_url,
+            description=description or "Workflow"
         )
 
 
@@ -29,6 +54,19 @@ class WorkflowJobRsrc(Job):
     # job_state: (JobState)  - inherited from Job
     workflow_rsrc: Optional[WorkflowRsrc]
     workspace_rsrc: Optional[WorkspaceRsrc]
+    attempts: int = Field(
+        default=1,
+        description='Amount of Nextflow runs of the job, each resume adds an attempt'
+    )
+    cached_tasks: Optional[int] = Field(
+        default=None,
+        description='Amount of tasks the latest attempt reused from the task cache of the previous '
+                    'attempts'
+    )
+    failure_reason: Optional[str] = Field(
+        default=None,
+        description='Why the job FAILED, e.g. its Nextflow run exited without a report'
+    )
 
     @staticmethod
     def create(job_id: str,
@@ -38,7 +76,10 @@ class WorkflowJobRsrc(Job):
                workspace_id: str,
                workspace_url: str,
                job_state: JobState,
-               description: str = None):
+               description: str = None,
+               attempts: int = 1,
+               cached_tasks: int = None,
+               failure_reason: str = None):
         if not description:
             description = "Workflow-Job"
         workflow_rsrc = WorkflowRsrc.create(workflow_id=workflow_id, workflow_url=workflow_url)
@@ -51,4 +92,66 @@ class WorkflowJobRsrc(Job):
             job_state=job_state,
             workflow_rsrc=workflow_rsrc,
             workspace_rsrc=workspace_rsrc,
+            attempts=attempts,
+            cached_tasks=cached_tasks,
+            failure_reason=failure_reason,
         )
+
+
+class WorkflowProcessStats(BaseModel):
+    process: str = Field(
+        ...,
+        description='Name of the process of the workflow script'
+    )
+    tasks: int = Field(
+        default=0,
+        description='Amount of tasks of the process which were run, cached tasks are not counted'
+    )
+    failed: int = Field(
+        default=0,
+        description='Amount of tasks of the process which failed'
+    )
+    duration_p50: Optional[float] = Field(
+        default=None,
+        description='Median seconds from the submission to the completion of the completed tasks'
+    )
+    duration_p95: Optional[float] = Field(
+        default=None,
+        description='95th percentile of the seconds from the submission to the completion of the '
+                    'completed tasks'
+    )
+    realtime_p50: Optional[float] = Field(
+        default=None,
+        description='Median seconds the completed tasks were executing'
+    )
+    realtime_p95: Optional[float] = Field(
+        default=None,
+        description='95th percentile of the seconds the completed tasks were executing'
+    )
+    cpu_p50: Optional[float] = Field(
+        default=None,
+        description='Median CPU usage of the completed tasks in percent, 100 per fully used core'
+    )
+    peak_rss_p50: Optional[int] = Field(
+        default=None,
+        description='Median peak resident memory of the completed tasks in bytes'
+    )
+    peak_rss_p95: Optional[int] = Field(
+        default=None,
+        description='95th percentile of the peak resident memory of the completed tasks in bytes'
+    )
+
+
+class WorkflowTaskStats(BaseModel):
+    workflow_id: str = Field(
+        ...,
+        description='ID of the workflow'
+    )
+    since: Optional[datetime] = Field(
+        default=None,
+        description='Only tasks completed since this point in time (UTC) are included'
+    )
+    processes: List[WorkflowProcessStats] = Field(
+        default=[],
+        description='Durations and resources of the tasks by process'
+    )
@@ -1,4 +1,7 @@
-from ocrd_webapi.models.base import Resource
+from pydantic import Field
+from typing import Any, Dict, Optional
+
+from ocrd_webapi.models.base import Job, JobState, Resource
 
 
 class WorkspaceRsrc(Resource):
@@ -16,3 +19,82 @@ class WorkspaceRsrc(Resource):
             resource_url=workspace_url,
             description=description
         )
+
+    @staticmethod
+    def create_dict(workspace_id: str, workspace_url: str,
+                    description: str = None) -> Dict[str, Any]:
+        """
+        Same as `create`, but returns the JSON-ready dict without validation, e.g. for long lists
+        """
+        return WorkspaceRsrc.trusted_dict(
+            resource_id=workspace_id,
+            resource_url=workspace_url,
+            description=description or "Workspace"
+        )
+
+
+class WorkspaceUploadRsrc(Resource):
+    # Local variables:
+    # resource_id: (str) - inherited from Resource
+    # resource_url: (str) - inherited from Resource
+    # description: (str) - inherited from Resource
+    upload_offset: int = Field(
+        default=0,
+        description='Number of bytes received so far, the next chunk must start at this offset'
+    )
+    upload_length: Optional[int] = Field(
+        default=None,
+        description='Total size of the upload in bytes, if announced'
+    )
+
+    @staticmethod
+    def create(upload_id: str, upload_url: str, upload_offset: int, upload_length: int = None,
+               description: str = None):
+        if not description:
+            description = "Workspace-Upload"
+        return WorkspaceUploadRsrc(
+            resource_id=upload_id,
+            resource_url=upload_url,
+            description=description,
+            upload_offset=upload_offset,
+            upload_length=upload_length
+        )
+
+
+class WorkspaceImportRsrc(Job):
+    # Local variables:
+    # resource_id: (str) - inherited from Resource -> Job
+    # resource_url: (str) - inherited from Resource -> Job
+    # description: (str) - inherited from Resource -> Job
+    # job_state: (JobState)  - inherited from Job
+    mets_url: str = Field(
+        ...,  # the field is required, no default set
+        description='URL of the imported METS file'
+    )
+    workspace_rsrc: Optional[WorkspaceRsrc] = None
+    failure_reason: Optional[str] = None
+
+    @staticmethod
+    def create(import_id: str,
+               import_url: str,
+               mets_url: str,
+               job_state: JobState,
+               workspace_id: str = None,
+               workspace_url: str = None,
+               failure_reason: str = None,
+               description: str = None):
+        if not description:
+            description = "Workspace-Import"
+        workspace_rsrc = None
+        if workspace_id:
+            workspace_rsrc = WorkspaceRsrc.create(workspace_id=workspace_id,
+                                                  workspace_url=workspace_url)
+        return WorkspaceImportRsrc(
+            resource_id=import_id,
+            resource_url=import_url,
+            description=description,
+            job_state=job_state,
+            mets_url=mets_url,
+            workspace_rsrc=workspace_rsrc,
+            failure_reason=failure_reason
+        )
@@ -0,0 +1,316 @@
+"""
+On-demand profiling of single requests
+
+The admin picks the requests to profile: own requests with the `X-Profile-Request` header, or the
+next requests of any user (optionally below a path) after arming the profiler with
+`POST /admin/profiling`. A sampling profiler records the stacks of a profiled request every
+PROFILE_INTERVAL seconds:
+    - of its task on the event loop while the task runs and, while it is suspended, the chain of
+      coroutines it awaits, so the time spent waiting (e.g. for the database) shows as well
+    - of the threads running work the request offloaded with `tracing.in_context()`. Work of
+      process pools shows as the frames of the thread waiting for it. The request path offloads
+      its blocking calls (ingest, export, storage, broker, process control) this way, work
+      offloaded without it (e.g. by the background services) is not attributed to a request
+The profiles are stored in the PROFILE_DIR as collapsed stacks, the input of flamegraph.pl,
+speedscope or inferno. Only the latest PROFILE_MAX_PROFILES are kept. Requests which are not
+profiled cost a header lookup.
+"""
+from asyncio import AbstractEventLoop, Task, current_task, get_running_loop
+from collections import Counter
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from glob import glob
+from os import makedirs, remove
+from os.path import basename, exists, join
+from re import compile as re_compile
+from secrets import token_hex
+from threading import Lock, Thread, get_ident
+from time import perf_counter, sleep
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+import logging
+import sys
+
+from ocrd_webapi.constants import PROFILE_DIR, PROFILE_INTERVAL, PROFILE_MAX_PROFILES
+from ocrd_webapi.models.profiling import ProfileInfo, ProfilingState
+
+__all__ = [
+    "PROFILE_HEADER",
+    "PROFILE_ID_HEADER",
+    "ProfilingMiddleware",
+    "RequestProfiler",
+    "run_attributed",
+]
+
+PROFILE_HEADER = "X-Profile-Request"
+PROFILE_ID_HEADER = "X-Profile-ID"
+PROFILE_ID_PATTERN = re_compile(r"^[0-9T]+-[0-9a-f]+$")
+# As found in the ASGI scope
+_PROFILE_HEADER_KEY = PROFILE_HEADER.lower().encode()
+_PROFILE_ID_HEADER_KEY = PROFILE_ID_HEADER.lower().encode()
+
+
+class _Session:
+    """
+    A profiled request
+    """
+    def __init__(self, name: str, task: Task, loop: AbstractEventLoop):
+        self.started = datetime.utcnow()
+        # Sorts in the order the profiles were taken
+        self.profile_id = f"{self.started:%Y%m%dT%H%M%S%f}-{token_hex(4)}"
+        self.name = name
+        self.task = task
+        self.loop = loop
+        self.loop_thread = get_ident()
+        self.active = True
+        # Threads running work offloaded by the request, with the amount of calls they run
+        self.threads: Dict[int, int] = {}
+        # Collapsed stack -> samples
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.duration = 0.0
+        self._started = perf_counter()
+
+    def end(self) -> None:
+        self.active = False
+        self.duration = perf_counter() - self._started
+
+    def to_info(self) -> ProfileInfo:
+        return ProfileInfo(profile_id=self.profile_id, request=self.name, started=self.started,
+                           duration=self.duration, samples=self.samples)
+
+
+_active_session: ContextVar[Optional[_Session]] = ContextVar("ocrd_webapi_profile", default=None)
+
+
+def run_attributed(func: Callable, *args, **kwargs) -> Any:
+    """
+    Call `func`, if the current context belongs to a profiled request the calling thread is
+    sampled meanwhile. Used by `tracing.in_context()` for the work offloaded to threads
+    """
+    session = _active_session.get()
+    ident = get_ident()
+    if session is None or not session.active or ident == session.loop_thread:
+        return func(*args, **kwargs)
+    session.threads[ident] = session.threads.get(ident, 0) + 1
+    try:
+        return func(*args, **kwargs)
+    finally:
+        session.threads[ident] -= 1
+        if not session.threads[ident]:
+            del session.threads[ident]
+
+
+def _awaited_frames(coroutine) -> List[Any]:
+    """
+    Returns the frames of a suspended coroutine and the coroutines (and generators) it awaits
+    """
+    frames = []
+    while coroutine is not None:
+        frame = getattr(coroutine, "cr_frame", None) or getattr(coroutine, "gi_frame", None) \
+            or getattr(coroutine, "ag_frame", None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coroutine = getattr(coroutine, "cr_await", None) \
+            or getattr(coroutine, "gi_yieldfrom", None) or getattr(coroutine, "ag_await", None)
+    return frames
+
+
+class RequestProfiler:
+    def __init__(self, profile_dir: str = PROFILE_DIR, interval: float = PROFILE_INTERVAL,
+                 max_profiles: int = PROFILE_MAX_PROFILES, log_level: str = "INFO"):
+        self.log = logging.getLogger(__name__)
+        self.log.setLevel(logging.getLevelName(log_level))
+        self.profile_dir = profile_dir
+        self.interval = interval
+        self.max_profiles = max(max_profiles, 1)
+        # The next requests (with a path starting with `armed_path`) are profiled
+        self.armed_requests = 0
+        self.armed_path: Optional[str] = None
+        self._sessions: List[_Session] = []
+        self._lock = Lock()
+        self._thread: Optional[Thread] = None
+        # Labels of the code objects seen, shared by all samples
+        self._labels: Dict[Any, str] = {}
+
+    def arm(self, requests: int = 1, path: str = None) -> None:
+        self.armed_requests = max(requests, 0)
+        self.armed_path = path
+
+    def disarm(self) -> None:
+        self.arm(0)
+
+    def take_armed(self, path: str) -> bool:
+        """
+        Whether a request to `path` is one of the armed ones, it is not armed anymore afterwards
+        """
+        if not self.armed_requests or (self.armed_path and not path.startswith(self.armed_path)):
+            return False
+        self.armed_requests -= 1
+        return True
+
+    @asynccontextmanager
+    async def profile(self, name: str) -> AsyncIterator[str]:
+        """
+        Profile the current task (and the work it offloads) in the enclosed block, yields the ID
+        of the profile
+        """
+        session = _Session(name, current_task(), get_running_loop())
+        token = _active_session.set(session)
+        with self._lock:
+            self._sessions.append(session)
+            if self._thread is None:
+                self._thread = Thread(target=self._sample, name="ocrd-webapi-profiler", daemon=True)
+                self._thread.start()
+        try:
+            yield session.profile_id
+        finally:
+            _active_session.reset(token)
+            with self._lock:
+                session.end()
+                self._sessions.remove(session)
+            try:
+                await get_running_loop().run_in_executor(None, self._store, session)
+            except Exception as error:
+                self.log.error(f"Failed to store the profile of {name}: {error}")
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            name = getattr(code, "co_qualname", code.co_name)
+            # `;` separates the frames of collapsed stacks
+            label = f"{name} ({code.co_filename}:{code.co_firstlineno})".replace(";", ":")
+            self._labels[code] = label
+        return label
+
+    def _collapse(self, frames: List[Any]) -> str:
+        return ";".join(self._label(frame.f_code) for frame in frames)
+
+    def _sample_session(self, session: _Session, current_frames: Dict[int, Any]) -> None:
+        coroutine = session.task.get_coro()
+        if current_task(session.loop) is session.task and session.loop_thread in current_frames:
+            # Running, the frames from the leaf up to the coroutine of the task
+            root = getattr(coroutine, "cr_frame", None)
+            frames = []
+            frame = current_frames[session.loop_thread]
+            while frame is not None:
+                frames.append(frame)
+                if frame is root:
+                    break
+                frame = frame.f_back
+            frames.reverse()
+            session.stacks[f"[loop];{self._collapse(frames)}"] += 1
+        else:
+            frames = _awaited_frames(coroutine)
+            if frames:
+                session.stacks[f"[loop];{self._collapse(frames)};[await]"] += 1
+        for ident in list(session.threads):
+            frame = current_frames.get(ident)
+            frames = []
+            while frame is not None:
+                frames.append(frame)
+                frame = frame.f_back
+            if frames:
+                frames.reverse()
+                session.stacks[f"[thread];{self._collapse(frames)}"] += 1
+        session.samples += 1
+
+    def _sample(self) -> None:
+        while True:
+            # Held while sampling, an ended session is not sampled while it is stored
+            with self._lock:
+                if not self._sessions:
+                    self._thread = None
+                    return
+                current_frames = sys._current_frames()
+                for session in self._sessions:
+                    try:
+                        self._sample_session(session, current_frames)
+                    except Exception as error:
+                        # E.g. a frame which went away meanwhile, the next sample is taken anyway
+                        self.log.debug(f"Failed to sample {session.name}: {error}")
+                # Released before sleeping, the frames keep their locals alive
+                del current_frames
+            sleep(self.interval)
+
+    def _store(self, session: _Session) -> None:
+        makedirs(self.profile_dir, exist_ok=True)
+        profile_path = join(self.profile_dir, session.profile_id)
+        with open(f"{profile_path}.folded", "w") as fout:
+            fout.writelines(f"{stack} {samples}\n"
+                            for stack, samples in session.stacks.most_common())
+        with open(f"{profile_path}.json", "w") as fout:
+            fout.write(session.to_info().json())
+        for info_path in self._info_paths()[self.max_profiles:]:
+            for path in [info_path, f"{info_path[:-len('.json')]}.folded"]:
+                if exists(path):
+                    remove(path)
+
+    def _info_paths(self) -> List[str]:
+        """
+        Returns the paths of the infos of the stored profiles, the latest first. Ordered by their
+        profile ids, the modification times of profiles stored at once may be equal
+        """
+        return sorted(glob(join(self.profile_dir, "*.json")), key=basename, reverse=True)
+
+    def get_profiles(self) -> List[ProfileInfo]:
+        profiles = []
+        for info_path in self._info_paths():
+            try:
+                profiles.append(ProfileInfo.parse_file(info_path))
+            except (OSError, ValueError):
+                # Removed or written meanwhile
+                continue
+        return profiles
+
+    def get_profile_path(self, profile_id: str) -> Optional[str]:
+        """
+        Returns the path of the collapsed stacks of a profile, None if there is no such profile
+        """
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        profile_path = join(self.profile_dir, f"{profile_id}.folded")
+        return profile_path if exists(profile_path) else None
+
+    def get_state(self) -> ProfilingState:
+        return ProfilingState(armed_requests=self.armed_requests, path=self.armed_path,
+                              interval=self.interval, max_profiles=self.max_profiles,
+                              profiles=self.get_profiles())
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware profiling the requests picked by the admin. It must be the innermost middleware
+    (the first one added), so it runs in the task of the endpoint
+    """
+    def __init__(self, app, profiler: RequestProfiler,
+                 is_admin: Callable[[Optional[str]], Awaitable[bool]]):
+        """
+        Args:
+            profiler: takes the profiles
+            is_admin: whether an `Authorization` header authenticates the admin
+        """
+        self.app = app
+        self.profiler = profiler
+        self.is_admin = is_admin
+
+    async def _is_picked(self, scope) -> bool:
+        if self.profiler.take_armed(scope["path"]):
+            return True
+        if not any(key == _PROFILE_HEADER_KEY for key, _ in scope["headers"]):
+            return False
+        authorization = dict(scope["headers"]).get(b"authorization", b"").decode("latin-1")
+        return await self.is_admin(authorization)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not await self._is_picked(scope):
+            await self.app(scope, receive, send)
+            return
+        async with self.profiler.profile(f"{scope['method']} {scope['path']}") as profile_id:
+            async def send_with_profile_id(message):
+                if message["type"] == "http.response.start":
+                    message["headers"] = [*message.get("headers", []),
+                                          (_PROFILE_ID_HEADER_KEY, profile_id.encode())]
+                await send(message)
+            await self.app(scope, receive, send_with_profile_id)
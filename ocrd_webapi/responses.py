@@ -0,0 +1,68 @@
+"""
+Fast JSON responses
+
+Responses are encoded with orjson when it is installed, with the standard json module otherwise.
+Lists of resources are built by the server as plain dicts (see `Resource.trusted_dict`), they skip
+the validation and re-serialization of the response models. Long lists are streamed in chunks
+instead of being encoded as one document in memory.
+"""
+from itertools import islice
+from json import dumps
+from typing import Any, Iterable, Iterator, List
+
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from ocrd_webapi.constants import JSON_STREAM_THRESHOLD
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+__all__ = [
+    "FastJSONResponse",
+    "json_dumps",
+    "json_list_response",
+]
+
+# Items encoded at once by a streamed list
+STREAM_CHUNK_ITEMS = 1000
+
+
+def json_dumps(content: Any) -> bytes:
+    if orjson:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return dumps(content, ensure_ascii=False, allow_nan=False,
+                 separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return json_dumps(content)
+
+
+def iter_json_array(items: Iterable[Any], chunk_items: int = STREAM_CHUNK_ITEMS) -> Iterator[bytes]:
+    """
+    Yields the JSON array of the `items` in chunks of `chunk_items` items
+    """
+    iterator = iter(items)
+    separator = b"["
+    while True:
+        chunk = list(islice(iterator, chunk_items))
+        if not chunk:
+            break
+        # The encoded chunk is an array itself, its brackets are replaced by the separators
+        yield separator + json_dumps(chunk)[1:-1]
+        separator = b","
+    yield b"[]" if separator == b"[" else b"]"
+
+
+def json_list_response(items: List[Any], status_code: int = 200) -> Response:
+    """
+    Response with the JSON array of the `items`, which must be JSON-ready already. Lists longer
+    than JSON_STREAM_THRESHOLD are streamed
+    """
+    if len(items) > JSON_STREAM_THRESHOLD:
+        return StreamingResponse(iter_json_array(items), status_code=status_code,
+                                 media_type="application/json")
+    return FastJSONResponse(items, status_code=status_code)
@@ -0,0 +1,120 @@
+"""
+module for the administration of the Web API, only the default admin user may use it
+"""
+from typing import Optional
+import logging
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import FileResponse
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+
+from ocrd_webapi.authentication import authenticate_user, parse_basic_credentials
+from ocrd_webapi.constants import DEFAULT_ADMIN_USER
+from ocrd_webapi.exceptions import AuthenticationError, ResponseException
+from ocrd_webapi.janitor import StorageJanitor, TrashReaper
+from ocrd_webapi.models.janitor import StorageReport
+from ocrd_webapi.models.profiling import ProfilingArgs, ProfilingState
+from ocrd_webapi.profiling import RequestProfiler
+from ocrd_webapi.routers.user import user_login
+
+router = APIRouter(
+    tags=["Admin"],
+)
+
+logger = logging.getLogger(__name__)
+storage_janitor = StorageJanitor()
+trash_reaper = TrashReaper()
+request_profiler = RequestProfiler()
+security = HTTPBasic()
+
+
+async def admin_login(auth: HTTPBasicCredentials) -> None:
+    await user_login(auth)
+    if auth.username != DEFAULT_ADMIN_USER:
+        raise ResponseException(403, {"error": "admin privileges required"})
+
+
+async def is_admin(authorization: Optional[str]) -> bool:
+    """
+    Whether the `Authorization` header of a request authenticates the admin
+    """
+    credentials = parse_basic_credentials(authorization)
+    if not credentials or credentials[0] != DEFAULT_ADMIN_USER:
+        return False
+    try:
+        await authenticate_user(*credentials)
+    except AuthenticationError:
+        return False
+    return True
+
+
+@router.get("/admin/storage", responses={"200": {"model": StorageReport}})
+async def get_storage_report(auth: HTTPBasicCredentials = Depends(security)) -> StorageReport:
+    """
+    Dry run of the storage janitor: the artifacts the next sweep would remove, with the reason
+    (retention or eviction above the high-water mark) and the bytes this frees
+
+    curl -u user:pass http://localhost:8000/admin/storage
+    """
+    await admin_login(auth)
+    try:
+        return await storage_janitor.sweep(dry_run=True)
+    except Exception as e:
+        logger.exception(f"Unexpected error in get_storage_report: {e}")
+        # TODO: Don't provide the exception message to the outside world
+        raise ResponseException(500, {"error": f"internal server error: {e}"})
+
+
+@router.get("/admin/profiling", responses={"200": {"model": ProfilingState}})
+async def get_profiling(auth: HTTPBasicCredentials = Depends(security)) -> ProfilingState:
+    """
+    The requests armed for profiling and the stored profiles
+
+    curl -u user:pass http://localhost:8000/admin/profiling
+    """
+    await admin_login(auth)
+    return request_profiler.get_state()
+
+
+@router.post("/admin/profiling", responses={"200": {"model": ProfilingState}})
+async def arm_profiling(profiling_args: ProfilingArgs,
+                        auth: HTTPBasicCredentials = Depends(security)) -> ProfilingState:
+    """
+    Profile the next requests (of any user), optionally only the ones below a path. The admin can
+    profile single own requests with the `X-Profile-Request` header instead
+
+    curl -u user:pass -X POST http://localhost:8000/admin/profiling -H 'Content-Type: application/json'  # noqa
+    -d '{"requests": 3, "path": "/workspace"}'
+    """
+    await admin_login(auth)
+    if profiling_args.requests < 0:
+        raise ResponseException(422, {"error": "requests must not be negative"})
+    request_profiler.arm(profiling_args.requests, profiling_args.path)
+    return request_profiler.get_state()
+
+
+@router.delete("/admin/profiling", responses={"200": {"model": ProfilingState}})
+async def disarm_profiling(auth: HTTPBasicCredentials = Depends(security)) -> ProfilingState:
+    """
+    Stop profiling the next requests
+
+    curl -u user:pass -X DELETE http://localhost:8000/admin/profiling
+    """
+    await admin_login(auth)
+    request_profiler.disarm()
+    return request_profiler.get_state()
+
+
+@router.get("/admin/profiling/{profile_id}")
+async def get_profile(profile_id: str,
+                      auth: HTTPBasicCredentials = Depends(security)) -> FileResponse:
+    """
+    Download a profile as collapsed stacks, e.g. for `flamegraph.pl` or speedscope
+
+    curl -u user:pass http://localhost:8000/admin/profiling/{profile_id} | flamegraph.pl > profile.svg  # noqa
+    """
+    await admin_login(auth)
+    profile_path = request_profiler.get_profile_path(profile_id)
+    if not profile_path:
+        raise ResponseException(404, {"error": f"profile not available: {profile_id}"})
+    return FileResponse(path=profile_path, media_type="text/plain", filename=f"{profile_id}.folded")
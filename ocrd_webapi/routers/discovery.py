@@ -4,11 +4,14 @@ module for implementing the discovery section of the api
 from os import cpu_count
 from psutil import virtual_memory
 from fastapi import APIRouter
+from ocrd_webapi.admission import AdmissionController
 from ocrd_webapi.models.discovery import DiscoveryResponse
 
 router = APIRouter(
     tags=["Discovery"],
 )
+# Consulted by the admission middleware for every upload and job submission
+admission_controller = AdmissionController()
 
 
 class Discovery:
@@ -36,4 +39,6 @@ class Discovery:
 
 @router.get("/discovery", responses={"200": {"model": DiscoveryResponse}})
 async def discovery() -> DiscoveryResponse:
-    return Discovery.discovery()
+    res = Discovery.discovery()
+    res.admission = await admission_controller.get_state()
+    return res
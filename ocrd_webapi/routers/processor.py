@@ -1,2 +1,93 @@
-# We are going to use a different approach for the processing part
-# RabbitMQ will be used for better management
+import logging
+
+from fastapi import (
+    APIRouter,
+    Depends,
+)
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+
+from ocrd_webapi.constants import BROKER_URL, PROCESSORS_ROUTER, SERVER_URL
+from ocrd_webapi.exceptions import ProcessingJobException, ResponseException
+from ocrd_webapi.managers.processing_manager import ProcessingManager
+from ocrd_webapi.managers.processor_manager import ProcessorManager
+from ocrd_webapi.managers.workspace_manager import WorkspaceManager
+from ocrd_webapi.message_broker import create_broker
+from ocrd_webapi.models.base import ProcessorArgs
+from ocrd_webapi.models.database import ProcessingJobDB
+from ocrd_webapi.models.processor import ProcessorJobRsrc
+from ocrd_webapi.routers.user import user_login
+
+router = APIRouter(
+    tags=["Processor"],
+)
+
+logger = logging.getLogger(__name__)
+processing_manager = ProcessingManager(create_broker(BROKER_URL))
+processor_manager = ProcessorManager(processing_manager.broker)
+workspace_manager = WorkspaceManager()
+security = HTTPBasic()
+
+
+async def persist_workspace(workspace_id: str) -> None:
+    # The workspace changed, upload it to the storage without delaying the results
+    workspace_manager.persist_resource_soon(workspace_id)
+
+
+processing_manager.add_finished_hook(persist_workspace)
+
+
+async def to_processor_job_rsrc(job_db: ProcessingJobDB) -> ProcessorJobRsrc:
+    return ProcessorJobRsrc.create(
+        job_id=job_db.job_id,
+        job_url=f"{SERVER_URL}/{PROCESSORS_ROUTER}/{job_db.processor_name}/{job_db.job_id}",
+        processor_name=job_db.processor_name,
+        workspace_id=job_db.workspace_id,
+        workspace_url=await WorkspaceManager.static_get_resource(job_db.workspace_id, local=False),
+        job_state=job_db.job_state
+    )
+
+
+@router.post(f"/{PROCESSORS_ROUTER}/{{processor_name}}",
+             responses={"201": {"model": ProcessorJobRsrc}})
+async def run_processor(processor_name: str, processor_args: ProcessorArgs,
+                        auth: HTTPBasicCredentials = Depends(security)) -> ProcessorJobRsrc:
+    """
+    Run the processor {processor_name} on a workspace. The job is run by an idle warm worker of
+    the processor, poll the job url for its state. With `shards` the pages are split into that many
+    page ranges which are processed in parallel
+
+    curl -X POST http://localhost:8000/processor/ocrd-dummy -H 'Content-Type: application/json' \
+        -d '{"workspace_id": "{workspace_id}", "input_file_grps": "OCR-D-IMG", "output_file_grps": "OCR-D-DUMMY"}'  # noqa
+    """
+    await user_login(auth)
+    if not processor_manager.is_processor_available(processor_name):
+        raise ResponseException(404, {"error": f"Processor not available: {processor_name}"})
+    try:
+        await processor_manager.serve(processor_name)
+        # The workers process the local copy of the workspace
+        await workspace_manager.stage_resource(processor_args.workspace_id)
+        if processor_args.shards and processor_args.shards > 1:
+            job_db = await processing_manager.submit_sharded_job(processor_name, processor_args,
+                                                                 shards=processor_args.shards)
+        else:
+            job_db = await processing_manager.submit_job(processor_name, processor_args)
+    except ProcessingJobException as e:
+        raise ResponseException(422, {"error": f"{e}"})
+    except Exception as e:
+        logger.exception(f"Unexpected error in run_processor: {e}")
+        # TODO: Don't provide the exception message to the outside world
+        raise ResponseException(500, {"error": f"internal server error: {e}"})
+
+    return await to_processor_job_rsrc(job_db)
+
+
+@router.get(f"/{PROCESSORS_ROUTER}/{{processor_name}}/{{job_id}}",
+            responses={"200": {"model": ProcessorJobRsrc}})
+async def get_processor_job(processor_name: str, job_id: str) -> ProcessorJobRsrc:
+    """
+    Query a processor job from the database. Used to query if a job is finished or still running
+    """
+    job_db = await processing_manager.get_processing_job(job_id)
+    if not job_db or job_db.processor_name != processor_name:
+        raise ResponseException(404, {})
+    return await to_processor_job_rsrc(job_db)
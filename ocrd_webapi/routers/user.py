@@ -5,9 +5,10 @@ import logging
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 
-from ocrd_webapi.authentication import authenticate_user, register_user
+from ocrd_webapi.authentication import authenticate_user, get_storage_quota, register_user
+from ocrd_webapi.database import get_user
 from ocrd_webapi.exceptions import AuthenticationError, RegistrationError
-from ocrd_webapi.models.user import UserAction
+from ocrd_webapi.models.user import UserAction, UserUsage
 
 router = APIRouter(
     tags=["User"],
@@ -64,3 +65,22 @@ async def user_register(email: str, password: str):
     action = f"Successfully registered new account: {email}. " \
              f"Please contact the OCR-D team to get your account validated."
     return UserAction(email=email, action=action)
+
+
+@router.get("/user/usage", responses={"200": {"model": UserUsage}})
+async def user_usage(auth: HTTPBasicCredentials = Depends(security)) -> UserUsage:
+    """
+    Storage used by the workspaces, workflows and workflow jobs of the user, and the quotas
+
+    curl -u user:pass http://localhost:8000/user/usage
+    """
+    await user_login(auth)
+    db_user = await get_user(auth.username)
+    quota_bytes, quota_files = get_storage_quota(db_user)
+    return UserUsage.create(
+        email=db_user.email,
+        used_bytes=db_user.used_bytes,
+        used_files=db_user.used_files,
+        quota_bytes=quota_bytes,
+        quota_files=quota_files
+    )
@@ -1,6 +1,7 @@
+from datetime import datetime
 import logging
-from shutil import make_archive
-from typing import List, Union
+from shutil import make_archive, rmtree
+from typing import List, Optional, Union
 import tempfile
 
 
@@ -10,15 +11,22 @@ from fastapi import (
     Header,
     UploadFile,
 )
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
+from starlette.background import BackgroundTask
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 
+from ocrd_webapi.janitor import TEMP_ARCHIVE_PREFIX
 from ocrd_webapi.routers.user import user_login
-from ocrd_webapi.exceptions import ResponseException
+from ocrd_webapi.exceptions import (
+    ResponseException,
+    WorkflowJobStateException,
+    WorkflowParametersException,
+)
 from ocrd_webapi.managers.workflow_manager import WorkflowManager
 from ocrd_webapi.managers.workspace_manager import WorkspaceManager
 from ocrd_webapi.models.base import WorkflowArgs
-from ocrd_webapi.models.workflow import WorkflowRsrc, WorkflowJobRsrc
+from ocrd_webapi.models.workflow import WorkflowJobRsrc, WorkflowRsrc, WorkflowTaskStats
+from ocrd_webapi.responses import json_list_response
 from ocrd_webapi.constants import WORKFLOWS_ROUTER
 
 
@@ -31,21 +39,42 @@ workflow_manager = WorkflowManager()
 security = HTTPBasic()
 
 
+async def to_workflow_rsrc(workflow_id: str, workflow_url: str) -> WorkflowRsrc:
+    workflow_db = await workflow_manager.get_workflow_db(workflow_id)
+    return WorkflowRsrc.create(
+        workflow_id=workflow_id,
+        workflow_url=workflow_url,
+        workflow_parameters=workflow_db.workflow_parameters if workflow_db else None,
+        workflow_processes=workflow_db.workflow_processes if workflow_db else None
+    )
+
+
+async def check_workflow_job_owner(workflow_id: str, job_id: str, username: str) -> None:
+    """
+    Only the user who started a workflow job may change it, jobs without an owner are left open
+    """
+    wf_job_db = await workflow_manager.get_workflow_job(workflow_id, job_id)
+    if not wf_job_db:
+        raise ResponseException(404, {})
+    if wf_job_db.owner and wf_job_db.owner != username:
+        raise ResponseException(403, {"error": f"Workflow job not owned by the user: {job_id}"})
+
+
 # TODO: Refine all the exceptions...
-@router.get(f"/{WORKFLOWS_ROUTER}")
-async def list_workflows() -> List[WorkflowRsrc]:
+@router.get(f"/{WORKFLOWS_ROUTER}", responses={"200": {"model": List[WorkflowRsrc]}},
+            response_model=None)
+async def list_workflows() -> Response:
     """
     Get a list of existing workflow space urls.
     Each workflow space has a Nextflow script inside.
 
     curl http://localhost:8000/workflow/
     """
-    workflows = workflow_manager.get_workflows()
-    response = []
-    for workflow in workflows:
-        wf_id, wf_url = workflow
-        response.append(WorkflowRsrc.create(workflow_id=wf_id, workflow_url=wf_url))
-    return response
+    workflows = await workflow_manager.get_workflows()
+    return json_list_response([
+        WorkflowRsrc.create_dict(workflow_id=wf_id, workflow_url=wf_url)
+        for wf_id, wf_url in workflows
+    ])
 
 
 @router.get(f"/{WORKFLOWS_ROUTER}/{{workflow_id}}", response_model=None)
@@ -64,8 +93,8 @@ async def get_workflow_script(workflow_id: str, accept: str = Header(default="ap
     """
 
     try:
-        workflow_script_url = workflow_manager.get_resource(workflow_id, local=False)
-        workflow_script_path = workflow_manager.get_resource_file(workflow_id, file_ext=".nf")
+        workflow_script_url = await workflow_manager.get_resource(workflow_id, local=False)
+        workflow_script_path = await workflow_manager.stage_nf_script(workflow_id)
     except Exception as e:
         logger.exception(f"Unexpected error in get_workflow_script: {e}")
         # TODO: Don't provide the exception message to the outside world
@@ -78,7 +107,29 @@ async def get_workflow_script(workflow_id: str, accept: str = Header(default="ap
 
     if not workflow_script_url:
         raise ResponseException(404, {})
-    return WorkflowRsrc.create(workflow_id=workflow_id, workflow_url=workflow_script_url)
+    return await to_workflow_rsrc(workflow_id=workflow_id, workflow_url=workflow_script_url)
+
+
+# Before the route of the jobs, which would take `stats` for a job id
+@router.get(f"/{WORKFLOWS_ROUTER}/{{workflow_id}}/stats",
+            responses={"200": {"model": WorkflowTaskStats}})
+async def get_workflow_task_stats(workflow_id: str,
+                                  since: Optional[datetime] = None) -> WorkflowTaskStats:
+    """
+    Durations and resources of the tasks of a workflow by process, read from the Nextflow traces
+    of its jobs. `since` (UTC) restricts them to the recently completed tasks
+
+    curl http://localhost:8000/workflow/{workflow_id}/stats?since=2023-05-01T00:00:00
+    """
+    if not await workflow_manager.get_workflow_db(workflow_id):
+        raise ResponseException(404, {})
+    try:
+        processes = await workflow_manager.get_workflow_task_stats(workflow_id, since=since)
+    except Exception as e:
+        logger.exception(f"Unexpected error in get_workflow_task_stats: {e}")
+        # TODO: Don't provide the exception message to the outside world
+        raise ResponseException(500, {"error": f"internal server error: {e}"})
+    return WorkflowTaskStats(workflow_id=workflow_id, since=since, processes=processes)
 
 
 @router.get(f"/{WORKFLOWS_ROUTER}/{{workflow_id}}/{{job_id}}", responses={"200": {"model": WorkflowJobRsrc}}, response_model=None)
@@ -97,10 +148,13 @@ async def get_workflow_job(workflow_id: str, job_id: str, accept: str = Header(d
         raise ResponseException(404, {})
 
     try:
-        wf_job_url = workflow_manager.get_resource_job(wf_job_db.workflow_id, wf_job_db.workflow_job_id, local=False)
-        wf_job_local = workflow_manager.get_resource_job(wf_job_db.workflow_id, wf_job_db.workflow_job_id, local=True)
-        workflow_url = workflow_manager.get_resource(wf_job_db.workflow_id, local=False)
-        workspace_url = WorkspaceManager.static_get_resource(wf_job_db.workspace_id, local=False)
+        wf_job_url = workflow_manager.get_resource_job(wf_job_db.workflow_id,
+                                                       wf_job_db.workflow_job_id, local=False)
+        wf_job_local = workflow_manager.get_resource_job(wf_job_db.workflow_id,
+                                                         wf_job_db.workflow_job_id, local=True)
+        workflow_url = await workflow_manager.get_resource(wf_job_db.workflow_id, local=False)
+        workspace_url = await WorkspaceManager.static_get_resource(wf_job_db.workspace_id,
+                                                                   local=False)
         job_state = wf_job_db.job_state
     except Exception as e:
         logger.exception(f"Unexpected error in get_workflow_job: {e}")
@@ -108,13 +162,19 @@ async def get_workflow_job(workflow_id: str, job_id: str, accept: str = Header(d
         raise ResponseException(500, {"error": f"internal server error: {e}"})
 
     if accept == "application/vnd.zip":
-        tempdir = tempfile.mkdtemp(prefix="ocrd-wf-job-zip-")
+        wf_job_local = await workflow_manager.stage_resource(wf_job_db.workflow_id,
+                                                             sub_dir=wf_job_db.workflow_job_id)
+        if not wf_job_local:
+            raise ResponseException(404, {})
+        tempdir = tempfile.mkdtemp(prefix=TEMP_ARCHIVE_PREFIX)
         job_archive_path = make_archive(
             base_name=f'{tempdir}/{job_id}',
             format='zip',
             root_dir=wf_job_local,
         )
-        return FileResponse(job_archive_path)
+        # Removed after sending, archives of aborted downloads are left to the storage janitor
+        return FileResponse(job_archive_path,
+                            background=BackgroundTask(rmtree, tempdir, ignore_errors=True))
 
     return WorkflowJobRsrc.create(
         job_id=job_id,
@@ -123,7 +183,91 @@ async def get_workflow_job(workflow_id: str, job_id: str, accept: str = Header(d
         workflow_url=workflow_url,
         workspace_id=wf_job_db.workspace_id,
         workspace_url=workspace_url,
-        job_state=job_state
+        job_state=job_state,
+        attempts=wf_job_db.attempts,
+        cached_tasks=wf_job_db.cached_tasks,
+        failure_reason=wf_job_db.failure_reason
+    )
+
+
+@router.delete(f"/{WORKFLOWS_ROUTER}/{{workflow_id}}/{{job_id}}",
+               responses={"200": {"model": WorkflowJobRsrc}})
+async def cancel_workflow_job(workflow_id: str, job_id: str,
+                              auth: HTTPBasicCredentials = Depends(security)) -> WorkflowJobRsrc:
+    """
+    Cancel a queued or running workflow job. Nextflow and the OCR-D processors started by it are
+    terminated, processes which do not exit in time are killed.
+
+    curl -X DELETE http://localhost:8000/workflow/{workflow_id}/{job_id}
+    """
+    await user_login(auth)
+    await check_workflow_job_owner(workflow_id, job_id, auth.username)
+    try:
+        wf_job_db = await workflow_manager.cancel_workflow_job(workflow_id=workflow_id,
+                                                               job_id=job_id)
+        wf_job_url = workflow_manager.get_resource_job(wf_job_db.workflow_id, job_id, local=False)
+        workflow_url = await workflow_manager.get_resource(wf_job_db.workflow_id, local=False)
+        workspace_url = await WorkspaceManager.static_get_resource(wf_job_db.workspace_id,
+                                                                   local=False)
+    except WorkflowJobStateException as e:
+        raise ResponseException(409, {"error": f"{e}"})
+    except Exception as e:
+        logger.exception(f"Unexpected error in cancel_workflow_job: {e}")
+        # TODO: Don't provide the exception message to the outside world
+        raise ResponseException(500, {"error": f"internal server error: {e}"})
+
+    return WorkflowJobRsrc.create(
+        job_id=job_id,
+        job_url=wf_job_url,
+        workflow_id=wf_job_db.workflow_id,
+        workflow_url=workflow_url,
+        workspace_id=wf_job_db.workspace_id,
+        workspace_url=workspace_url,
+        job_state=wf_job_db.job_state,
+        attempts=wf_job_db.attempts,
+        cached_tasks=wf_job_db.cached_tasks,
+        failure_reason=wf_job_db.failure_reason
+    )
+
+
+@router.post(f"/{WORKFLOWS_ROUTER}/{{workflow_id}}/{{job_id}}/resume",
+             responses={"201": {"model": WorkflowJobRsrc}})
+async def resume_workflow_job(workflow_id: str, job_id: str,
+                              auth: HTTPBasicCredentials = Depends(security)) -> WorkflowJobRsrc:
+    """
+    Resume a finished (e.g. failed) workflow job. Nextflow is relaunched with `-resume` in the job
+    directory, tasks completed by the previous attempts are reused from the task cache. The
+    `cached_tasks` of the job report how many tasks were reused so far.
+
+    curl -X POST http://localhost:8000/workflow/{workflow_id}/{job_id}/resume
+    """
+    await user_login(auth)
+    await check_workflow_job_owner(workflow_id, job_id, auth.username)
+    try:
+        wf_job_db = await workflow_manager.resume_nf_workflow(workflow_id=workflow_id,
+                                                              job_id=job_id)
+        wf_job_url = workflow_manager.get_resource_job(wf_job_db.workflow_id, job_id, local=False)
+        workflow_url = await workflow_manager.get_resource(wf_job_db.workflow_id, local=False)
+        workspace_url = await WorkspaceManager.static_get_resource(wf_job_db.workspace_id,
+                                                                   local=False)
+    except WorkflowJobStateException as e:
+        raise ResponseException(409, {"error": f"{e}"})
+    except Exception as e:
+        logger.exception(f"Unexpected error in resume_workflow_job: {e}")
+        # TODO: Don't provide the exception message to the outside world
+        raise ResponseException(500, {"error": f"internal server error: {e}"})
+
+    return WorkflowJobRsrc.create(
+        job_id=job_id,
+        job_url=wf_job_url,
+        workflow_id=wf_job_db.workflow_id,
+        workflow_url=workflow_url,
+        workspace_id=wf_job_db.workspace_id,
+        workspace_url=workspace_url,
+        job_state=wf_job_db.job_state,
+        attempts=wf_job_db.attempts,
+        cached_tasks=wf_job_db.cached_tasks,
+        failure_reason=wf_job_db.failure_reason
     )
 
 
@@ -133,15 +277,25 @@ async def run_workflow(workflow_id: str, workflow_args: WorkflowArgs,
     """
     Trigger a Nextflow execution by using a Nextflow script with id {workflow_id} on a
     workspace with id {workspace_id}. The OCR-D results are stored inside the {workspace_id}.
+    The job is QUEUED and started when the fair-share scheduler gives the user a turn, an
+    optional `priority` lowers the priority class of the job below the one of the user.
+    Values for the `params.*` of the script can be passed as `workflow_parameters`, the
+    accepted parameters are listed in the workflow resource.
 
-    curl -X POST http://localhost:8000/workflow/{workflow_id}?workspace_id={workspace_id}
+    curl -X POST http://localhost:8000/workflow/{workflow_id} -H 'Content-Type: application/json' \
+        -d '{"workspace_id": "{workspace_id}", "workflow_parameters": {"input_group": "OCR-D-IMG"}}'
     """
     await user_login(auth)
     try:
         parameters = await workflow_manager.start_nf_workflow(
             workflow_id=workflow_id,
-            workspace_id=workflow_args.workspace_id
+            workspace_id=workflow_args.workspace_id,
+            workflow_parameters=workflow_args.workflow_parameters,
+            owner=auth.username,
+            priority=workflow_args.priority
         )
+    except WorkflowParametersException as e:
+        raise ResponseException(422, {"error": f"{e}"})
     except Exception as e:
         logger.exception(f"Unexpected error in run_workflow: {e}")
         # TODO: Don't provide the exception message to the outside world
@@ -176,13 +330,15 @@ async def upload_workflow_script(nextflow_script: UploadFile,
 
     await user_login(auth)
     try:
-        workflow_id, workflow_url = await workflow_manager.create_workflow_space(nextflow_script)
+        workflow_id, workflow_url = await workflow_manager.create_workflow_space(
+            nextflow_script, owner=auth.username
+        )
     except Exception as e:
         logger.exception(f"Error in upload_workflow_script: {e}")
         # TODO: Don't provide the exception message to the outside world
         raise ResponseException(500, {"error": f"internal server error: {e}"})
 
-    return WorkflowRsrc.create(workflow_id=workflow_id, workflow_url=workflow_url)
+    return await to_workflow_rsrc(workflow_id=workflow_id, workflow_url=workflow_url)
 
 
 @router.put("/workflow/{workflow_id}", responses={"201": {"model": WorkflowRsrc}})
@@ -198,14 +354,15 @@ async def update_workflow_script(nextflow_script: UploadFile, workflow_id: str,
     try:
         workflow_id, updated_workflow_url = await workflow_manager.update_workflow_space(
             file=nextflow_script,
-            workflow_id=workflow_id
+            workflow_id=workflow_id,
+            owner=auth.username
         )
     except Exception as e:
         logger.exception(f"Error in update_workflow_script: {e}")
         # TODO: Don't provide the exception message to the outside world
         raise ResponseException(500, {"error": f"internal server error: {e}"})
 
-    return WorkflowRsrc.create(workflow_id=workflow_id, workflow_url=updated_workflow_url)
+    return await to_workflow_rsrc(workflow_id=workflow_id, workflow_url=updated_workflow_url)
 
     # Not in the Web API Specification. Will be implemented if needed.
     # TODO: Implement that since we have some sort of dummy security check
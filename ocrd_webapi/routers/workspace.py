@@ -2,26 +2,35 @@ import logging
 from os import unlink
 from typing import List, Union
 from ocrd_webapi.constants import WORKSPACES_ROUTER
+from ocrd_webapi.utils import expand_page_ids
 
 from fastapi import (
     APIRouter,
     BackgroundTasks,
     Depends,
     Header,
+    Request,
+    Response,
     UploadFile,
 )
 from fastapi.responses import FileResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 
+from ocrd_webapi.authentication import check_storage_quota
 from ocrd_webapi.routers.user import user_login
 from ocrd_webapi.exceptions import (
+    QuotaExceededError,
     ResponseException,
     WorkspaceException,
     WorkspaceGoneException,
     WorkspaceNotValidException,
+    WorkspaceUploadException,
+    WorkspaceUploadOffsetException,
 )
 from ocrd_webapi.managers.workspace_manager import WorkspaceManager
-from ocrd_webapi.models.workspace import WorkspaceRsrc
+from ocrd_webapi.models.base import WorkspaceImportArgs
+from ocrd_webapi.models.workspace import WorkspaceImportRsrc, WorkspaceRsrc, WorkspaceUploadRsrc
+from ocrd_webapi.responses import json_list_response
 
 router = APIRouter(
     tags=["Workspace"],
@@ -33,26 +42,222 @@ security = HTTPBasic()
 
 
 # TODO: Refine all the exceptions...
-@router.get(f"/{WORKSPACES_ROUTER}")
-async def list_workspaces() -> List[WorkspaceRsrc]:
+@router.get(f"/{WORKSPACES_ROUTER}", responses={"200": {"model": List[WorkspaceRsrc]}},
+            response_model=None)
+async def list_workspaces() -> Response:
     """
     Get a list of existing workspace urls
 
     curl http://localhost:8000/workspace/
     """
-    workspaces = workspace_manager.get_workspaces()
-    response = []
-    for workspace in workspaces:
-        ws_id, ws_url = workspace
-        response.append(WorkspaceRsrc.create(workspace_id=ws_id, workspace_url=ws_url))
-    return response
+    workspaces = await workspace_manager.get_workspaces()
+    return json_list_response([
+        WorkspaceRsrc.create_dict(workspace_id=ws_id, workspace_url=ws_url)
+        for ws_id, ws_url in workspaces
+    ])
+
+
+@router.post(f"/{WORKSPACES_ROUTER}/import", responses={"201": {"model": WorkspaceImportRsrc}})
+async def post_workspace_import(
+        import_args: WorkspaceImportArgs, background_tasks: BackgroundTasks,
+        auth: HTTPBasicCredentials = Depends(security)
+) -> WorkspaceImportRsrc:
+    """
+    Import a workspace from a METS URL. The referenced files of the (optionally) given file groups
+    are downloaded in the background, poll the returned url for the state of the import.
+
+    curl -X POST http://localhost:8000/workspace/import -H 'Content-Type: application/json' -d '{"mets_url": "https://example.org/mets.xml", "file_grp": ["DEFAULT"]}'  # noqa
+    """
+    await user_login(auth)
+    try:
+        import_id, import_url = await workspace_manager.create_workspace_import(
+            mets_url=import_args.mets_url,
+            file_grp=import_args.file_grp,
+            mets_basename=import_args.mets_basename,
+            owner=auth.username
+        )
+    except Exception as e:
+        logger.exception(f"Unexpected error in post_workspace_import: {e}")
+        # TODO: Don't provide the exception message to the outside world
+        raise ResponseException(500, {"error": f"internal server error: {e}"})
+
+    background_tasks.add_task(workspace_manager.run_workspace_import, import_id)
+    return WorkspaceImportRsrc.create(import_id=import_id, import_url=import_url,
+                                      mets_url=import_args.mets_url, job_state="QUEUED")
+
+
+@router.get(f"/{WORKSPACES_ROUTER}/import/{{import_id}}",
+            responses={"200": {"model": WorkspaceImportRsrc}})
+async def get_workspace_import(import_id: str) -> WorkspaceImportRsrc:
+    """
+    Get the state of a workspace import
+
+    curl http://localhost:8000/workspace/import/{import_id}
+    """
+    import_db = await workspace_manager.get_workspace_import(import_id)
+    if not import_db:
+        raise ResponseException(404, {"error": f"workspace import not existing: {import_id}"})
+    workspace_url = None
+    if import_db.workspace_id:
+        workspace_url = await workspace_manager.get_resource(import_db.workspace_id, local=False)
+    return WorkspaceImportRsrc.create(
+        import_id=import_id,
+        import_url=workspace_manager.get_import_url(import_id),
+        mets_url=import_db.mets_url,
+        job_state=import_db.job_state,
+        workspace_id=import_db.workspace_id,
+        workspace_url=workspace_url,
+        failure_reason=import_db.failure_reason
+    )
+
+
+@router.post(f"/{WORKSPACES_ROUTER}/upload", responses={"201": {"model": WorkspaceUploadRsrc}})
+async def post_workspace_upload(
+        upload_length: int, workspace_id: str = None, auth: HTTPBasicCredentials = Depends(security)
+) -> WorkspaceUploadRsrc:
+    """
+    Create a resumable upload session for an ocrd-zip of `upload_length` bytes.
+
+    The chunks are sent with `PATCH` to the returned url, the current offset is queried with `GET`
+    and the upload is turned into a workspace with `POST {upload_url}/finalize`. If `workspace_id`
+    is set, that workspace is created or replaced on finalization.
+
+    curl -X POST "http://localhost:8000/workspace/upload?upload_length=12345"
+    """
+    await user_login(auth)
+    try:
+        # The announced length bounds the chunks, an upload over quota is rejected right away
+        await check_storage_quota(auth.username, upload_length)
+    except QuotaExceededError as e:
+        raise ResponseException(413, {"error": "storage quota exceeded", "reason": str(e)})
+    try:
+        upload_id, upload_url = await workspace_manager.create_workspace_upload(
+            upload_length=upload_length,
+            workspace_id=workspace_id,
+            owner=auth.username
+        )
+    except Exception as e:
+        logger.exception(f"Unexpected error in post_workspace_upload: {e}")
+        # TODO: Don't provide the exception message to the outside world
+        raise ResponseException(500, {"error": f"internal server error: {e}"})
+
+    return WorkspaceUploadRsrc.create(upload_id=upload_id, upload_url=upload_url, upload_offset=0,
+                                      upload_length=upload_length)
+
+
+@router.get(f"/{WORKSPACES_ROUTER}/upload/{{upload_id}}",
+            responses={"200": {"model": WorkspaceUploadRsrc}})
+async def get_workspace_upload(
+        upload_id: str, response: Response, auth: HTTPBasicCredentials = Depends(security)
+) -> WorkspaceUploadRsrc:
+    """
+    Get the current offset of a resumable upload session. Resume the upload from this offset.
+    Only the user who created the session can query, append to and finalize it.
+
+    curl http://localhost:8000/workspace/upload/{upload_id}
+    """
+    await user_login(auth)
+    upload_state = await workspace_manager.get_workspace_upload_offset(upload_id,
+                                                                       owner=auth.username)
+    if not upload_state:
+        raise ResponseException(404, {"error": f"upload session not existing: {upload_id}"})
+    upload_offset, upload_length = upload_state
+    response.headers["Upload-Offset"] = str(upload_offset)
+    return WorkspaceUploadRsrc.create(upload_id=upload_id,
+                                      upload_url=workspace_manager.get_upload_url(upload_id),
+                                      upload_offset=upload_offset, upload_length=upload_length)
+
+
+@router.patch(f"/{WORKSPACES_ROUTER}/upload/{{upload_id}}",
+              responses={"200": {"model": WorkspaceUploadRsrc}})
+async def patch_workspace_upload(
+        upload_id: str, request: Request, response: Response,
+        upload_offset: int = Header(..., alias="Upload-Offset"),
+        auth: HTTPBasicCredentials = Depends(security)
+) -> WorkspaceUploadRsrc:
+    """
+    Append a chunk to a resumable upload session. The chunk is the raw request body and must start
+    at the current offset of the upload.
+
+    curl -X PATCH http://localhost:8000/workspace/upload/{upload_id} -H "Upload-Offset: 0" --data-binary @chunk  # noqa
+    """
+    await user_login(auth)
+    upload_state = await workspace_manager.get_workspace_upload_offset(upload_id,
+                                                                       owner=auth.username)
+    if not upload_state:
+        raise ResponseException(404, {"error": f"upload session not existing: {upload_id}"})
+    # The bytes staged already count as well, a chunk without Content-Length may fill the upload
+    # up to its announced length
+    staged_length, upload_length = upload_state
+    chunk_length = (upload_length or 0) - staged_length
+    if request.headers.get("Content-Length"):
+        try:
+            chunk_length = int(request.headers["Content-Length"])
+        except ValueError:
+            raise ResponseException(400, {"error": "Content-Length not valid"})
+    try:
+        await check_storage_quota(auth.username, staged_length + chunk_length)
+    except QuotaExceededError as e:
+        raise ResponseException(413, {"error": "storage quota exceeded", "reason": str(e)})
+    try:
+        new_offset = await workspace_manager.append_workspace_upload(
+            upload_id, upload_offset, request.stream(), owner=auth.username
+        )
+    except WorkspaceUploadOffsetException as e:
+        raise ResponseException(409, {"error": "wrong upload offset", "reason": str(e)})
+    except WorkspaceUploadException as e:
+        raise ResponseException(400, {"error": "upload not valid", "reason": str(e)})
+    except Exception as e:
+        logger.exception(f"Unexpected error in patch_workspace_upload: {e}")
+        # TODO: Don't provide the exception message to the outside world
+        raise ResponseException(500, {"error": f"internal server error: {e}"})
+
+    if new_offset is None:
+        raise ResponseException(404, {"error": f"upload session not existing: {upload_id}"})
+    response.headers["Upload-Offset"] = str(new_offset)
+    return WorkspaceUploadRsrc.create(upload_id=upload_id,
+                                      upload_url=workspace_manager.get_upload_url(upload_id),
+                                      upload_offset=new_offset)
+
+
+@router.post(f"/{WORKSPACES_ROUTER}/upload/{{upload_id}}/finalize",
+             responses={"201": {"model": WorkspaceRsrc}})
+async def finalize_workspace_upload(
+        upload_id: str, auth: HTTPBasicCredentials = Depends(security)
+) -> WorkspaceRsrc:
+    """
+    Create a workspace from a completely received upload session
+
+    curl -X POST http://localhost:8000/workspace/upload/{upload_id}/finalize
+    """
+    await user_login(auth)
+    try:
+        finalized = await workspace_manager.finalize_workspace_upload(upload_id,
+                                                                      owner=auth.username)
+    except WorkspaceNotValidException as e:
+        raise ResponseException(422, {"error": "workspace not valid", "reason": str(e)})
+    except QuotaExceededError as e:
+        raise ResponseException(413, {"error": "storage quota exceeded", "reason": str(e)})
+    except WorkspaceUploadException as e:
+        raise ResponseException(400, {"error": "upload not valid", "reason": str(e)})
+    except Exception as e:
+        logger.exception(f"Unexpected error in finalize_workspace_upload: {e}")
+        # TODO: Don't provide the exception message to the outside world
+        raise ResponseException(500, {"error": f"internal server error: {e}"})
+
+    if not finalized:
+        raise ResponseException(404, {"error": f"upload session not existing: {upload_id}"})
+    ws_url, ws_id = finalized
+    return WorkspaceRsrc.create(workspace_id=ws_id, workspace_url=ws_url)
 
 
 @router.get(f"/{WORKSPACES_ROUTER}/{{workspace_id}}", response_model=None)
 async def get_workspace(
         background_tasks: BackgroundTasks,
         workspace_id: str,
-        accept: str = Header(default="application/json")
+        accept: str = Header(default="application/json"),
+        file_grp: str = None,
+        page_id: str = None
 ) -> Union[WorkspaceRsrc, FileResponse]:
     """
     Get an existing workspace
@@ -65,10 +270,14 @@ async def get_workspace(
     can be tested with:
     `curl http://localhost:8000/workspace/-the-id-of-ws -H "accept: application/json"` and
     `curl http://localhost:8000/workspace/{ws-id} -H "accept: application/vnd.ocrd+zip" -o foo.zip`
+
+    The bag can be restricted to some file groups and pages (comma separated, page ranges allowed):
+    `curl "http://localhost:8000/workspace/{ws-id}?file_grp=OCR-D-OCR&page_id=PHYS_0001..PHYS_0005"
+    -H "accept: application/vnd.ocrd+zip" -o foo.zip`
     """
 
     try:
-        workspace_url = workspace_manager.get_resource(workspace_id, local=False)
+        workspace_url = await workspace_manager.get_resource(workspace_id, local=False)
     except Exception as e:
         logger.exception(f"Unexpected error in get_workspace: {e}")
         # TODO: Don't provide the exception message to the outside world
@@ -78,7 +287,15 @@ async def get_workspace(
         raise ResponseException(404, {"error": "workspace_url is None"})
 
     if accept == "application/vnd.ocrd+zip":
-        bag_path = await workspace_manager.get_workspace_bag(workspace_id)
+        file_grps = None
+        if file_grp:
+            file_grps = [grp.strip() for grp in file_grp.split(",") if grp.strip()]
+        try:
+            page_ids = expand_page_ids(page_id) if page_id else None
+        except ValueError as e:
+            raise ResponseException(422, {"error": "page_id not valid", "reason": str(e)})
+        bag_path = await workspace_manager.get_workspace_bag(workspace_id, file_grp=file_grps,
+                                                             page_id=page_ids)
         if not bag_path:
             raise ResponseException(404, {"error": "bag_path is None"})
         # Remove the produced bag after sending it in the response
@@ -97,9 +314,12 @@ async def post_workspace(workspace: UploadFile, auth: HTTPBasicCredentials = Dep
     """
     await user_login(auth)
     try:
-        ws_url, ws_id = await workspace_manager.create_workspace_from_zip(workspace)
+        ws_url, ws_id = await workspace_manager.create_workspace_from_zip(workspace,
+                                                                          owner=auth.username)
     except WorkspaceNotValidException as e:
         raise ResponseException(422, {"error": "workspace not valid", "reason": str(e)})
+    except QuotaExceededError as e:
+        raise ResponseException(413, {"error": "storage quota exceeded", "reason": str(e)})
     except Exception as e:
         logger.exception(f"Unexpected error in post_workspace: {e}")
         # TODO: Don't provide the exception message to the outside world
@@ -116,9 +336,13 @@ async def put_workspace(workspace: UploadFile, workspace_id: str,
     """
     await user_login(auth)
     try:
-        updated_workspace_url = await workspace_manager.update_workspace(file=workspace, workspace_id=workspace_id)
+        updated_workspace_url = await workspace_manager.update_workspace(
+            file=workspace, workspace_id=workspace_id, owner=auth.username
+        )
     except WorkspaceNotValidException as e:
         raise ResponseException(422, {"error": "workspace not valid", "reason": str(e)})
+    except QuotaExceededError as e:
+        raise ResponseException(413, {"error": "storage quota exceeded", "reason": str(e)})
     except Exception as e:
         logger.exception(f"Unexpected error in put_workspace: {e}")
         # TODO: Don't provide the exception message to the outside world
@@ -0,0 +1,198 @@
+"""
+Fair-share scheduling of queued jobs
+
+Each user has a queue per priority class (a flow). The scheduler picks the next job with weighted
+fair queueing across the users:
+    - a higher priority class is always served first
+    - within a class the users are served in turns proportional to their share (weight): every
+      dispatched job advances the virtual time of its user by `1 / share`, the flow of the user
+      with the lowest virtual time is served next
+    - users who were idle start at the current virtual time, they get their share from now on
+      instead of a burst for the time they were idle
+    - users running their maximum of jobs are parked until one of their jobs is released
+
+The flows are kept in a heap, a decision costs O(log flows) regardless of the amount of queued
+jobs. Removed jobs are skipped when they come up. Users without queued or running jobs are
+forgotten once their virtual time has passed (or nothing is queued anymore), so the state grows
+with the active users only.
+"""
+from collections import deque
+from dataclasses import dataclass, field
+from heapq import heappop, heappush
+from itertools import count
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+__all__ = [
+    "FairShareScheduler",
+]
+
+# A flow: the queued jobs of one user in one priority class
+Flow = Tuple[int, str]
+
+
+@dataclass
+class _UserState:
+    share: float = 1.0
+    max_running: int = 0
+    # Virtual time at which the next job of the user is due
+    finish: float = 0.0
+    queued: int = 0
+    running: int = 0
+    parked: List[Flow] = field(default_factory=list)
+
+
+class FairShareScheduler:
+    def __init__(self, max_running_per_user: int = 0):
+        """
+        Args:
+            max_running_per_user: default maximum of running jobs per user, 0 for no maximum
+        """
+        self.max_running_per_user = max_running_per_user
+        self._users: Dict[str, _UserState] = {}
+        self._queues: Dict[Flow, Deque[str]] = {}
+        # (-priority, virtual start, sequence, flow) of the flows which are neither empty nor parked
+        self._heap: List[Tuple[int, float, int, Flow]] = []
+        self._sequence = count()
+        self._virtual_time = 0.0
+        self._queued: Dict[str, Flow] = {}
+        self._removed: Set[str] = set()
+        self._running: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._queued)
+
+    def __contains__(self, job_id: str) -> bool:
+        return job_id in self._queued or job_id in self._running
+
+    def _user(self, user: str) -> _UserState:
+        if user not in self._users:
+            self._users[user] = _UserState(max_running=self.max_running_per_user)
+        return self._users[user]
+
+    def set_user(self, user: str, share: float = 1.0, max_running: int = None) -> None:
+        """
+        Set the share (weight) of a user and the maximum of running jobs, None for the default
+        """
+        state = self._user(user)
+        state.share = share if share > 0 else 1.0
+        state.max_running = self.max_running_per_user if max_running is None else max_running
+        self._unpark(user)
+
+    def _is_capped(self, state: _UserState) -> bool:
+        return 0 < state.max_running <= state.running
+
+    def _push(self, flow: Flow) -> None:
+        state = self._users[flow[1]]
+        start = max(state.finish, self._virtual_time)
+        heappush(self._heap, (-flow[0], start, next(self._sequence), flow))
+
+    def _unpark(self, user: str) -> None:
+        state = self._users[user]
+        if state.parked and not self._is_capped(state):
+            for flow in state.parked:
+                self._push(flow)
+            state.parked = []
+
+    def submit(self, job_id: str, user: str, priority: int = 0) -> None:
+        """
+        Queue a job of the user, behind the user's queued jobs of the same priority class
+        """
+        if job_id in self:
+            return
+        self._user(user).queued += 1
+        flow = (priority, user)
+        self._queued[job_id] = flow
+        if flow in self._queues:
+            self._queues[flow].append(job_id)
+            return
+        self._queues[flow] = deque([job_id])
+        self._push(flow)
+
+    def remove(self, job_id: str) -> bool:
+        """
+        Remove a queued job, e.g. a cancelled one
+        """
+        flow = self._queued.pop(job_id, None)
+        if flow is None:
+            return False
+        self._removed.add(job_id)
+        self._users[flow[1]].queued -= 1
+        self._prune(flow[1])
+        return True
+
+    def next_job(self) -> Optional[Tuple[str, str]]:
+        """
+        Pick the next job to run and count it as running for its user until it is released
+
+        Returns:
+            the id of the job and its user, None if no job may run
+        """
+        while self._heap:
+            _, start, _, flow = heappop(self._heap)
+            queue = self._queues.get(flow)
+            while queue and queue[0] in self._removed:
+                self._removed.discard(queue.popleft())
+            if not queue:
+                self._queues.pop(flow, None)
+                continue
+            state = self._users[flow[1]]
+            if self._is_capped(state):
+                state.parked.append(flow)
+                continue
+            if start < state.finish:
+                # Another flow of the user was served meanwhile
+                self._push(flow)
+                continue
+            job_id = queue.popleft()
+            del self._queued[job_id]
+            # Never back, a flow pushed before the others were served may start earlier
+            self._virtual_time = max(self._virtual_time, start)
+            state.finish = start + 1 / state.share
+            state.queued -= 1
+            state.running += 1
+            self._running[job_id] = flow[1]
+            if queue:
+                self._push(flow)
+            else:
+                del self._queues[flow]
+            return job_id, flow[1]
+        return None
+
+    def release(self, job_id: str) -> None:
+        """
+        A running job ended, its user may run another job
+        """
+        user = self._running.pop(job_id, None)
+        if user is None:
+            return
+        self._users[user].running -= 1
+        self._unpark(user)
+        self._prune(user)
+
+    def _prune(self, user: str) -> None:
+        """
+        Forget an idle user, unless the user's virtual time is ahead while others wait. A
+        forgotten user starts at the current virtual time again, as the user would anyway
+        """
+        state = self._users.get(user)
+        if not state or state.queued or state.running:
+            return
+        if state.finish <= self._virtual_time or not self._queued:
+            del self._users[user]
+
+    def sync_running(self, running: Dict[str, str]) -> None:
+        """
+        Replace the running jobs, e.g. with the ones found in the database. Jobs may be started
+        and released elsewhere (resumes, other workers), the database is the source of truth
+
+        Args:
+            running: the users of the running jobs by job id
+        """
+        self._running = dict(running)
+        for state in self._users.values():
+            state.running = 0
+        for user in self._running.values():
+            self._user(user).running += 1
+        for user in list(self._users):
+            self._unpark(user)
+            self._prune(user)
@@ -0,0 +1,308 @@
+"""
+Storage backends holding the resources (workspaces, workflows and their jobs) of the Web API.
+
+The resource managers work on local directories below the BASE_DIR, e.g. the OCR-D processors and
+Nextflow need local files. The storage backend is where the resources are kept durably:
+    - LocalStorage: the BASE_DIR itself, nothing is copied
+    - S3Storage: a bucket of an S3-compatible object store. The BASE_DIR is a local cache, resources
+      are uploaded after they changed and staged (downloaded) on demand when they are not cached
+
+The backends block, the resource managers call them in the default executor.
+"""
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from os import makedirs, scandir, stat, utime, walk
+from os.path import dirname, isdir, join, relpath
+from shutil import rmtree
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse
+import logging
+
+from ocrd_webapi.constants import BASE_DIR, S3_ENDPOINT_URL, STORAGE_PART_SIZE, STORAGE_TRANSFERS
+
+__all__ = [
+    "LocalStorage",
+    "S3Storage",
+    "StorageBackend",
+    "create_storage",
+]
+
+
+class StorageBackend(ABC):
+    """
+    Stores directory trees under keys like `workspace/<workspace_id>`
+    """
+    # Whether the storage is the local BASE_DIR, i.e. there is nothing to upload or stage
+    is_local: bool = False
+
+    def __init__(self, logger_label: str):
+        self.log = logging.getLogger(logger_label)
+
+    @abstractmethod
+    def has(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def list_children(self, key: str) -> List[str]:
+        """
+        Returns the names of the directories directly below `key`
+        """
+        pass
+
+    @abstractmethod
+    def upload_dir(self, local_dir: str, key: str, recursive: bool = True) -> int:
+        """
+        Make the stored tree of `key` a copy of `local_dir`. Unchanged files are skipped. Not
+        recursive, only the files directly inside `local_dir` are copied and the sub dirs are kept
+
+        Returns:
+            the amount of uploaded files
+        """
+        pass
+
+    @abstractmethod
+    def download_dir(self, key: str, local_dir: str, recursive: bool = True) -> int:
+        """
+        Download the stored tree of `key` (or only the files directly below it) into `local_dir`
+
+        Returns:
+            the amount of downloaded files
+        """
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        pass
+
+
+class LocalStorage(StorageBackend):
+    """
+    The resources are only kept in the local BASE_DIR
+    """
+    is_local = True
+
+    def __init__(self, base_dir: str = BASE_DIR):
+        super().__init__(logger_label=__name__)
+        self.base_dir = base_dir
+
+    def has(self, key: str) -> bool:
+        return isdir(join(self.base_dir, key))
+
+    def list_children(self, key: str) -> List[str]:
+        if not self.has(key):
+            return []
+        return [entry.name for entry in scandir(join(self.base_dir, key)) if entry.is_dir()]
+
+    def upload_dir(self, local_dir: str, key: str, recursive: bool = True) -> int:
+        # The local dir is the stored tree already
+        return 0
+
+    def download_dir(self, key: str, local_dir: str, recursive: bool = True) -> int:
+        return 0
+
+    def delete(self, key: str) -> None:
+        if self.has(key):
+            rmtree(join(self.base_dir, key))
+
+
+class S3Storage(StorageBackend):
+    """
+    Storage backed by a bucket of an S3-compatible object store (AWS S3, MinIO, Ceph, ...)
+
+    Files larger than `part_size` are uploaded with multipart uploads and downloaded with ranged
+    requests. The files of a tree, and the parts of the large files, are transferred by a pool of
+    `transfers` threads.
+    """
+    def __init__(self, bucket: str, prefix: str = "", client=None,
+                 endpoint_url: str = S3_ENDPOINT_URL, part_size: int = STORAGE_PART_SIZE,
+                 transfers: int = STORAGE_TRANSFERS):
+        super().__init__(logger_label=__name__)
+        if client is None:
+            try:
+                import boto3
+            except ImportError as error:
+                raise ImportError(
+                    "The S3 storage requires boto3, install it with `pip install boto3`"
+                ) from error
+            client = boto3.client("s3", endpoint_url=endpoint_url or None)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        # S3 requires parts of at least 5 MiB, except for the last one
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.transfers = transfers
+
+    def has(self, key: str) -> bool:
+        response = self.client.list_objects_v2(Bucket=self.bucket,
+                                               Prefix=self._object_key(key) + "/", MaxKeys=1)
+        return response.get("KeyCount", 0) > 0
+
+    def list_children(self, key: str) -> List[str]:
+        prefix = self._object_key(key) + "/"
+        children = []
+        for response in self._list_pages(Prefix=prefix, Delimiter="/"):
+            for common_prefix in response.get("CommonPrefixes", []):
+                children.append(common_prefix["Prefix"][len(prefix):].rstrip("/"))
+        return children
+
+    def upload_dir(self, local_dir: str, key: str, recursive: bool = True) -> int:
+        stored = self._list_objects(key, recursive)
+        uploads = []
+        for root, dir_names, file_names in walk(local_dir):
+            if not recursive:
+                dir_names.clear()
+            for file_name in file_names:
+                path = join(root, file_name)
+                name = relpath(path, local_dir)
+                file_stat = stat(path)
+                size, last_modified = stored.pop(name, (None, None))
+                if size == file_stat.st_size and last_modified >= file_stat.st_mtime:
+                    continue
+                uploads.append((path, self._object_key(f"{key}/{name}"), file_stat.st_size))
+
+        # Multipart uploads not completed are aborted, the store keeps their parts otherwise
+        multiparts, completed = [], set()
+        try:
+            with ThreadPoolExecutor(max_workers=self.transfers) as executor:
+                futures = []
+                for path, object_key, size in uploads:
+                    if size <= self.part_size:
+                        futures.append(executor.submit(self._put_file, path, object_key))
+                        continue
+                    upload_id = self.client.create_multipart_upload(
+                        Bucket=self.bucket, Key=object_key
+                    )["UploadId"]
+                    part_futures = [
+                        executor.submit(self._upload_part, path, object_key, upload_id, number,
+                                        offset)
+                        for number, offset in enumerate(range(0, size, self.part_size),
+                                                        start=1)
+                    ]
+                    multiparts.append((object_key, upload_id, part_futures))
+                for future in futures:
+                    future.result()
+                for object_key, upload_id, part_futures in multiparts:
+                    parts = [future.result() for future in part_futures]
+                    self.client.complete_multipart_upload(
+                        Bucket=self.bucket, Key=object_key, UploadId=upload_id,
+                        MultipartUpload={"Parts": parts}
+                    )
+                    completed.add(upload_id)
+        finally:
+            for object_key, upload_id, _ in multiparts:
+                if upload_id in completed:
+                    continue
+                try:
+                    self.client.abort_multipart_upload(Bucket=self.bucket, Key=object_key,
+                                                       UploadId=upload_id)
+                except Exception as error:
+                    self.log.error(f"Failed to abort the multipart upload of {object_key}: {error}")
+        # What is left was removed locally
+        self._delete_objects([self._object_key(f"{key}/{name}") for name in stored])
+        return len(uploads)
+
+    def download_dir(self, key: str, local_dir: str, recursive: bool = True) -> int:
+        stored = self._list_objects(key, recursive)
+        with ThreadPoolExecutor(max_workers=self.transfers) as executor:
+            futures = []
+            for name, (size, _) in stored.items():
+                path = join(local_dir, name)
+                makedirs(dirname(path), exist_ok=True)
+                object_key = self._object_key(f"{key}/{name}")
+                if size <= self.part_size:
+                    futures.append(executor.submit(self._get_file, object_key, path))
+                    continue
+                with open(path, "wb") as fout:
+                    fout.truncate(size)
+                futures += [
+                    executor.submit(self._download_range, object_key, path, offset,
+                                    min(offset + self.part_size, size))
+                    for offset in range(0, size, self.part_size)
+                ]
+            for future in futures:
+                future.result()
+        for name, (_, last_modified) in stored.items():
+            # Not newer than the stored object, so an upload skips the unchanged file
+            utime(join(local_dir, name), (last_modified, last_modified))
+        return len(stored)
+
+    def delete(self, key: str) -> None:
+        self._delete_objects([self._object_key(f"{key}/{name}")
+                              for name in self._list_objects(key)])
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def _list_pages(self, **kwargs):
+        kwargs["Bucket"] = self.bucket
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+            yield response
+            if not response.get("IsTruncated"):
+                return
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+    def _list_objects(self, key: str, recursive: bool = True) -> Dict[str, Tuple[int, float]]:
+        """
+        Returns the size and the modification timestamp of the objects below `key` by their
+        path relative to `key`
+        """
+        prefix = self._object_key(key) + "/"
+        objects = {}
+        delimiter = {} if recursive else {"Delimiter": "/"}
+        for response in self._list_pages(Prefix=prefix, **delimiter):
+            for stored_object in response.get("Contents", []):
+                last_modified: datetime = stored_object["LastModified"]
+                objects[stored_object["Key"][len(prefix):]] = (stored_object["Size"],
+                                                               last_modified.timestamp())
+        return objects
+
+    def _put_file(self, path: str, object_key: str) -> None:
+        with open(path, "rb") as fin:
+            self.client.put_object(Bucket=self.bucket, Key=object_key, Body=fin.read())
+
+    def _upload_part(self, path: str, object_key: str, upload_id: str, number: int,
+                     offset: int) -> dict:
+        with open(path, "rb") as fin:
+            fin.seek(offset)
+            body = fin.read(self.part_size)
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=object_key, UploadId=upload_id, PartNumber=number, Body=body
+        )
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def _get_file(self, object_key: str, path: str) -> None:
+        body = self.client.get_object(Bucket=self.bucket, Key=object_key)["Body"]
+        with open(path, "wb") as fout:
+            for chunk in iter(lambda: body.read(1024 * 1024), b""):
+                fout.write(chunk)
+
+    def _download_range(self, object_key: str, path: str, start: int, end: int) -> None:
+        response = self.client.get_object(Bucket=self.bucket, Key=object_key,
+                                          Range=f"bytes={start}-{end - 1}")
+        with open(path, "r+b") as fout:
+            fout.seek(start)
+            fout.write(response["Body"].read())
+
+    def _delete_objects(self, object_keys: List[str]) -> None:
+        # At most 1000 keys per request
+        for start in range(0, len(object_keys), 1000):
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": object_key}
+                                    for object_key in object_keys[start:start + 1000]]}
+            )
+
+
+@lru_cache(maxsize=None)
+def create_storage(storage_url: str, base_dir: str = BASE_DIR) -> StorageBackend:
+    """
+    Returns an S3Storage for `s3://bucket/prefix` urls, the LocalStorage of `base_dir` otherwise.
+    The backends are shared, the managers of all resources use the same client
+    """
+    if storage_url and storage_url.startswith("s3://"):
+        parsed_url = urlparse(storage_url)
+        return S3Storage(bucket=parsed_url.netloc, prefix=parsed_url.path)
+    return LocalStorage(base_dir)
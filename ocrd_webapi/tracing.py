@@ -0,0 +1,395 @@
+"""
+Request tracing
+
+Every HTTP request gets a request ID, taken from its `X-Request-ID` header if that is a sane one,
+and the response returns it in the same header. While tracing is enabled (TRACE_FILE or
+TRACE_OTLP_ENDPOINT is set) the stages of the requests are recorded as spans:
+    - the request is the root span, the managers, the utils and the database functions add nested
+      spans with `span()` and `traced`
+    - the current trace and span are context variables, they follow the request through awaits
+      and into executor threads started with `in_context()`
+    - a request is exported if it was sampled (TRACE_SAMPLE_RATE) or took at least
+      TRACE_SLOW_THRESHOLD seconds, the sampling does not hide the slow requests
+    - a request only hands its spans to a bounded buffer, a background thread writes them to the
+      exporters. Spans are dropped while the buffer is full
+While tracing is disabled a span costs a context variable lookup.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from functools import partial, wraps
+from inspect import iscoroutinefunction
+from os import makedirs
+from os.path import dirname
+from random import random
+from re import compile as re_compile
+from secrets import token_hex
+from threading import Event, Lock, Thread
+from time import perf_counter, time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+import json
+import logging
+
+from requests import Session
+
+from ocrd_webapi.constants import (
+    TRACE_FILE,
+    TRACE_MAX_SPANS,
+    TRACE_OTLP_ENDPOINT,
+    TRACE_SAMPLE_RATE,
+    TRACE_SLOW_THRESHOLD,
+)
+from ocrd_webapi.profiling import run_attributed
+
+__all__ = [
+    "JsonlExporter",
+    "OtlpExporter",
+    "REQUEST_ID_HEADER",
+    "Span",
+    "Tracer",
+    "accept_request_id",
+    "create_exporters",
+    "get_request_id",
+    "in_context",
+    "set_attributes",
+    "span",
+    "traced",
+]
+
+REQUEST_ID_HEADER = "X-Request-ID"
+# Request IDs of the clients are only taken over if they are safe to log and to return
+REQUEST_ID_PATTERN = re_compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attributes", "start", "duration",
+                 "error", "_started")
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], name: str,
+                 attributes: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        # Wall clock time for the export, the duration is measured with the monotonic clock
+        self.start = time()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        self._started = perf_counter()
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def end(self) -> None:
+        self.duration = perf_counter() - self._started
+
+    def to_dict(self, request_id: str) -> Dict[str, Any]:
+        return {
+            "request_id": request_id,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _Trace:
+    def __init__(self, request_id: str, sampled: bool, max_spans: int):
+        self.trace_id = token_hex(16)
+        self.request_id = request_id
+        self.sampled = sampled
+        self.max_spans = max_spans
+        # The finished spans, the root span is the last one
+        self.spans: List[Span] = []
+        self.dropped = 0
+        # Set when the request was handled. Background tasks started by the request inherit its
+        # context, their later spans are not recorded
+        self.closed = False
+
+    def add(self, finished: Span) -> None:
+        if self.closed:
+            return
+        if finished.parent_id is not None and len(self.spans) >= self.max_spans - 1:
+            # The root span is always kept
+            self.dropped += 1
+            return
+        self.spans.append(finished)
+
+
+_current_trace: ContextVar[Optional[_Trace]] = ContextVar("ocrd_webapi_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("ocrd_webapi_span", default=None)
+_current_request_id: ContextVar[Optional[str]] = ContextVar("ocrd_webapi_request_id", default=None)
+
+
+def accept_request_id(request_id: Optional[str]) -> str:
+    """
+    Returns the request ID sent by a client if it is a sane one, a new one otherwise
+    """
+    if request_id and REQUEST_ID_PATTERN.match(request_id):
+        return request_id
+    return token_hex(16)
+
+
+def get_request_id() -> Optional[str]:
+    """
+    Returns the ID of the request currently handled, None outside of requests
+    """
+    return _current_request_id.get()
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """
+    Record the enclosed block as a span of the current request, nested in the current span.
+    Yields None if the request is not traced
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = _current_span.get()
+    current = Span(trace.trace_id, parent.span_id if parent else None, name, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as error:
+        current.error = f"{type(error).__name__}: {error}"
+        raise
+    finally:
+        current.end()
+        _current_span.reset(token)
+        trace.add(current)
+
+
+def set_attributes(**attributes) -> None:
+    """
+    Set attributes of the current span, if the request is traced
+    """
+    current = _current_span.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def traced(func: Callable = None, *, name: str = None) -> Callable:
+    """
+    Decorator recording the calls of a function or coroutine function as spans, named after the
+    module and the qualified name of the function unless a `name` is given
+    """
+    if func is None:
+        return partial(traced, name=name)
+    span_name = name or f"{func.__module__.rsplit('.', 1)[-1]}.{func.__qualname__}"
+
+    if iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if _current_trace.get() is None:
+                return await func(*args, **kwargs)
+            with span(span_name):
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if _current_trace.get() is None:
+            return func(*args, **kwargs)
+        with span(span_name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def in_context(func: Callable, *args, **kwargs) -> Callable[[], Any]:
+    """
+    Bind the call of `func` to the current context, e.g. for `run_in_executor`. The spans recorded
+    in the executor thread then belong to the current request, as do the samples if the request
+    is profiled
+    """
+    return partial(copy_context().run, run_attributed, func, *args, **kwargs)
+
+
+class JsonlExporter:
+    """
+    Appends the spans to a file, one JSON object per line
+    """
+    def __init__(self, path: str):
+        self.path = path
+        if dirname(path):
+            makedirs(dirname(path), exist_ok=True)
+
+    def export(self, spans: List[Dict[str, Any]]) -> None:
+        with open(self.path, "a") as fout:
+            fout.writelines(json.dumps(span_dict, separators=(",", ":"), default=str) + "\n"
+                            for span_dict in spans)
+
+
+class OtlpExporter:
+    """
+    Posts the spans to an OTLP/HTTP collector (e.g. the OpenTelemetry Collector, Jaeger or Tempo)
+    in the JSON encoding of OTLP, no OpenTelemetry SDK is needed
+    """
+    def __init__(self, endpoint: str, service_name: str = "ocrd-webapi", timeout: float = 5):
+        endpoint = endpoint.rstrip("/")
+        self.url = endpoint if endpoint.endswith("/v1/traces") else f"{endpoint}/v1/traces"
+        self.service_name = service_name
+        self.timeout = timeout
+        self._session = Session()
+
+    @staticmethod
+    def _to_attribute(key: str, value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+    def to_payload(self, spans: List[Dict[str, Any]]) -> Dict[str, Any]:
+        otlp_spans = []
+        for span_dict in spans:
+            start = int(span_dict["start"] * 1e9)
+            attributes = {"request_id": span_dict["request_id"], **span_dict["attributes"]}
+            otlp_span = {
+                "traceId": span_dict["trace_id"],
+                "spanId": span_dict["span_id"],
+                "name": span_dict["name"],
+                # The root spans are the requests received by the server, the others are internal
+                "kind": 1 if span_dict["parent_id"] else 2,
+                "startTimeUnixNano": str(start),
+                "endTimeUnixNano": str(start + int(span_dict["duration"] * 1e9)),
+                "attributes": [self._to_attribute(key, value) for key, value in attributes.items()],
+                # Error or unset
+                "status": {"code": 2, "message": span_dict["error"]} if span_dict["error"]
+                else {"code": 0},
+            }
+            if span_dict["parent_id"]:
+                otlp_span["parentSpanId"] = span_dict["parent_id"]
+            otlp_spans.append(otlp_span)
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [self._to_attribute("service.name", self.service_name)]},
+                "scopeSpans": [{"scope": {"name": "ocrd_webapi"}, "spans": otlp_spans}],
+            }]
+        }
+
+    def export(self, spans: List[Dict[str, Any]]) -> None:
+        response = self._session.post(self.url, json=self.to_payload(spans), timeout=self.timeout)
+        response.raise_for_status()
+
+
+def create_exporters(trace_file: str = TRACE_FILE,
+                     otlp_endpoint: str = TRACE_OTLP_ENDPOINT) -> List[Any]:
+    exporters = []
+    if trace_file:
+        exporters.append(JsonlExporter(trace_file))
+    if otlp_endpoint:
+        exporters.append(OtlpExporter(otlp_endpoint))
+    return exporters
+
+
+class Tracer:
+    def __init__(self, exporters: List[Any] = None, sample_rate: float = TRACE_SAMPLE_RATE,
+                 slow_threshold: float = TRACE_SLOW_THRESHOLD, max_spans: int = TRACE_MAX_SPANS,
+                 buffer_size: int = 10000, flush_interval: float = 1.0, log_level: str = "INFO"):
+        """
+        Args:
+            exporters: where the spans go, tracing is disabled without exporters
+            sample_rate: fraction of the requests exported
+            slow_threshold: requests taking at least this many seconds are exported even if they
+                were not sampled, 0 disables
+            max_spans: maximum of spans recorded per request
+            buffer_size: maximum of spans waiting for the export, more are dropped
+            flush_interval: seconds between the exports
+        """
+        self.log = logging.getLogger(__name__)
+        self.log.setLevel(logging.getLevelName(log_level))
+        self.exporters = exporters if exporters is not None else []
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_spans = max(max_spans, 1)
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        # Spans dropped since the start, because the buffer was full
+        self.dropped = 0
+        self._pending: List[_Trace] = []
+        self._buffered = 0
+        self._lock = Lock()
+        self._closed = Event()
+        self._thread: Optional[Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.exporters)
+
+    @contextmanager
+    def trace(self, name: str, request_id: str = None, **attributes) -> Iterator[Optional[Span]]:
+        """
+        Handle the enclosed block (a request) as a trace with the `request_id`, yields its root
+        span or None if tracing is disabled
+        """
+        request_id = request_id or token_hex(16)
+        request_id_token = _current_request_id.set(request_id)
+        if not self.enabled:
+            try:
+                yield None
+            finally:
+                _current_request_id.reset(request_id_token)
+            return
+        current = _Trace(request_id, random() < self.sample_rate, self.max_spans)
+        trace_token = _current_trace.set(current)
+        try:
+            with span(name, **attributes) as root:
+                yield root
+        finally:
+            current.closed = True
+            _current_trace.reset(trace_token)
+            _current_request_id.reset(request_id_token)
+            if current.dropped:
+                root.set_attribute("dropped_spans", current.dropped)
+            if current.sampled or 0 < self.slow_threshold <= root.duration:
+                self._submit(current)
+
+    def _submit(self, trace: _Trace) -> None:
+        with self._lock:
+            if self._buffered + len(trace.spans) > self.buffer_size:
+                self.dropped += len(trace.spans)
+                return
+            self._pending.append(trace)
+            self._buffered += len(trace.spans)
+            if self._thread is None and not self._closed.is_set():
+                self._thread = Thread(target=self._run, name="ocrd-webapi-tracer", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Export the buffered spans
+        """
+        with self._lock:
+            traces, self._pending, self._buffered = self._pending, [], 0
+        if not traces:
+            return
+        # Converted here and not by the requests, it is off their critical path
+        spans = [finished.to_dict(trace.request_id) for trace in traces for finished in trace.spans]
+        for exporter in self.exporters:
+            try:
+                exporter.export(spans)
+            except Exception as error:
+                self.log.error(f"Failed to export {len(spans)} spans with "
+                               f"{type(exporter).__name__}: {error}")
+
+    def close(self) -> None:
+        """
+        Stop the background thread and export the remaining spans
+        """
+        self._closed.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
@@ -1,30 +1,69 @@
-from os.path import join
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from hashlib import sha512
+from os import lstat, makedirs, replace, sep, walk
+from os.path import abspath, getsize, join, relpath, splitext
 from pathlib import Path
-from typing import Union
+from re import compile as re_compile
+from threading import Condition, Lock
+from time import sleep
+from math import ceil
+from typing import List, Optional, Sequence, Tuple, Union
+from urllib.parse import urljoin, urlparse
 import bagit
 import functools
 import tempfile
 import uuid
 import zipfile
+import zlib
+
+from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from ocrd import Resolver
 from ocrd.workspace import Workspace
 from ocrd.workspace_bagger import WorkspaceBagger
-from ocrd_utils import initLogging
+from ocrd_models import OcrdMets
+from ocrd_utils import MIME_TO_EXT, generate_range, initLogging
+from ocrd_validators.constants import OCRD_BAGIT_PROFILE_URL
 from ocrd_validators.ocrd_zip_validator import OcrdZipValidator
 
-from ocrd_webapi.constants import SERVER_URL
+from ocrd_webapi.constants import (
+    BAG_COMPRESSION_LEVEL,
+    IMPORT_CONNECTIONS,
+    IMPORT_RETRIES,
+    IMPORT_RETRY_BACKOFF,
+    SERVER_URL,
+    VALIDATION_CACHE_SIZE,
+    VALIDATION_PROCESSES,
+    VALIDATION_PROCESSES_BUDGET,
+)
 from ocrd_webapi.exceptions import WorkspaceNotValidException
+from ocrd_webapi.tracing import set_attributes, span, traced
 
 __all__ = [
     "bagit_from_url",
     "call_sync",
+    "choose_compression",
+    "digest_file",
+    "dir_usage",
+    "download_workspace_from_url",
     "extract_bag_dest",
     "extract_bag_info",
+    "expand_page_ids",
     "find_upwards",
     "generate_id",
+    "merge_mets_file_grps",
+    "percentile",
+    "prune_mets",
+    "read_payload_oxum",
+    "split_page_ids",
     "read_bag_info_from_zip",
-    "safe_init_logging"
+    "safe_init_logging",
+    "validate_ocrd_zip",
+    "zip_bag_dir",
 ]
 
 logging_initialized = False
@@ -51,18 +90,109 @@ def to_processor_job_url(processor_name: str, job_id: str) -> str:
     return f"{SERVER_URL}/processor/{processor_name}/{job_id}"
 
 
-def extract_bag_info(zip_dest, workspace_dir) -> dict:
+class ProcessBudget:
+    """
+    Global budget of processes shared by all concurrent validations
+
+    A validation gets as many processes as requested and available, but at least one. If none are
+    available, it waits till another validation releases its processes. Without a request it gets
+    a fair share, the budget divided among the active validations and one more to come
+    """
+    def __init__(self, total: int):
+        self.total = max(total, 1)
+        self.available = self.total
+        # Validations holding or waiting for processes
+        self.active = 0
+        self._condition = Condition()
+
+    def fair_share(self) -> int:
+        return max(1, self.total // (self.active + 1))
+
+    @contextmanager
+    def acquire(self, requested: int = 0):
+        """
+        Args:
+            requested: amount of processes, 0 means a fair share
+        """
+        with self._condition:
+            self.active += 1
+            self._condition.wait_for(lambda: self.available > 0)
+            wanted = self.fair_share() if requested <= 0 else requested
+            granted = min(wanted, self.available)
+            self.available -= granted
+        try:
+            yield granted
+        finally:
+            with self._condition:
+                self.available += granted
+                self.active -= 1
+                self._condition.notify_all()
+
+
+validation_budget = ProcessBudget(VALIDATION_PROCESSES_BUDGET)
+# OCRD-ZIP digest -> None if valid, the validation error otherwise
+validation_cache = OrderedDict()
+validation_cache_lock = Lock()
+
+
+@traced
+def digest_file(path, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Returns the sha512 hex digest of the file at `path`
+    """
+    file_hash = sha512()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+@traced
+def validate_ocrd_zip(zip_dest, processes: int = VALIDATION_PROCESSES) -> None:
+    """
+    Validate an OCRD-ZIP, raises a WorkspaceNotValidException if it is not valid
+
+    The result is memoized by the digest of the archive, so validating an identical OCRD-ZIP
+    again only costs reading it once.
+
+    Args:
+        zip_dest: path to the OCRD-ZIP
+        processes: processes used for the checksum validation, 0 means a fair share of the budget
+    """
+    zip_digest = digest_file(zip_dest)
+    with validation_cache_lock:
+        if zip_digest in validation_cache:
+            validation_cache.move_to_end(zip_digest)
+            error = validation_cache[zip_digest]
+            set_attributes(cache_hit=True)
+            if error:
+                raise WorkspaceNotValidException(error)
+            return
+
+    error = None
     try:
-        resolver = Resolver()
-        valid_report = OcrdZipValidator(resolver, zip_dest).validate(processes=1)
+        with validation_budget.acquire(processes) as granted:
+            valid_report = OcrdZipValidator(Resolver(), zip_dest).validate(processes=granted)
+        if valid_report is not None and not valid_report.is_valid:
+            error = valid_report.to_xml()
     except Exception as e:
         raise WorkspaceNotValidException(f"Error during workspace validation: {str(e)}") from e
 
-    if valid_report is not None and not valid_report.is_valid:
-        raise WorkspaceNotValidException(valid_report.to_xml())
+    with validation_cache_lock:
+        validation_cache[zip_digest] = error
+        while len(validation_cache) > VALIDATION_CACHE_SIZE:
+            validation_cache.popitem(last=False)
+    if error:
+        raise WorkspaceNotValidException(error)
+
+
+def extract_bag_info(zip_dest, workspace_dir, processes: int = VALIDATION_PROCESSES) -> dict:
+    validate_ocrd_zip(zip_dest, processes=processes)
 
+    resolver = Resolver()
     workspace_bagger = WorkspaceBagger(resolver)
-    workspace_bagger.spill(zip_dest, workspace_dir)
+    with span("utils.spill"):
+        workspace_bagger.spill(zip_dest, workspace_dir)
 
     # TODO: work is done twice here: spill already extracts the bag-info.txt but throws it away.
     # maybe workspace_bagger.spill can be changed to deliver the bag-info.txt here
@@ -71,16 +201,176 @@ def extract_bag_info(zip_dest, workspace_dir) -> dict:
     return bag_info
 
 
-def extract_bag_dest(workspace_db, workspace_dir, bag_dest) -> None:
+# Formats which are compressed already, deflating them again costs CPU and saves next to nothing
+COMPRESSED_EXTENSIONS = {
+    ".7z", ".bz2", ".gif", ".gz", ".j2k", ".jp2", ".jpeg", ".jpg", ".jpx", ".jxl", ".png", ".webp",
+    ".xz", ".zip", ".zst",
+}
+# Formats which always deflate well, e.g. METS, PAGE-XML, ALTO and the tag files of the bag
+TEXT_EXTENSIONS = {".csv", ".hocr", ".html", ".json", ".tsv", ".txt", ".xml"}
+# Other files (e.g. TIFF, which may or may not be compressed) are deflated if deflating their
+# first DEFLATE_PROBE_SIZE bytes saves more than 1 - DEFLATE_PROBE_RATIO of them
+DEFLATE_PROBE_SIZE = 64 * 1024
+DEFLATE_PROBE_RATIO = 0.9
+
+
+def choose_compression(path) -> int:
+    """
+    Returns the compression of the file at `path` in a zip: `ZIP_STORED` for compressed formats,
+    `ZIP_DEFLATED` for text and other files which deflate well
+    """
+    extension = splitext(path)[1].lower()
+    if extension in COMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    if extension in TEXT_EXTENSIONS:
+        return zipfile.ZIP_DEFLATED
+    with open(path, "rb") as fin:
+        probe = fin.read(DEFLATE_PROBE_SIZE)
+    if probe and len(zlib.compress(probe, 1)) < len(probe) * DEFLATE_PROBE_RATIO:
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
+
+
+@traced
+def zip_bag_dir(bag_dir, bag_dest, compresslevel: int = BAG_COMPRESSION_LEVEL) -> None:
+    """
+    Zip the bag in `bag_dir` to `bag_dest`, every file with the compression chosen for it by
+    :py:func:`choose_compression`
+
+    Args:
+        compresslevel: deflate level, 1 (fastest) to 9 (smallest)
+    """
+    with zipfile.ZipFile(bag_dest, "w", allowZip64=True) as zip_file:
+        for dir_path, dir_names, file_names in walk(bag_dir):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                path = join(dir_path, file_name)
+                zip_file.write(path, relpath(path, bag_dir), compress_type=choose_compression(path),
+                               compresslevel=compresslevel)
+
+
+def extract_bag_dest(workspace_db, workspace_dir, bag_dest, file_grp: List[str] = None,
+                     page_id: List[str] = None, compresslevel: int = BAG_COMPRESSION_LEVEL) -> None:
+    """
+    Bag the workspace stored in `workspace_dir` to `bag_dest`
+
+    If `file_grp` or `page_id` are set, only the matching files are bagged. The METS is pruned in
+    memory only, the stored workspace is never rewritten. Images of compressed formats are stored
+    in the OCRD-ZIP as they are, the other files are deflated with the `compresslevel`.
+    """
     mets = workspace_db.ocrd_mets or "mets.xml"
     identifier = workspace_db.ocrd_identifier
     resolver = Resolver()
-    WorkspaceBagger(resolver).bag(
-        Workspace(resolver, directory=workspace_dir, mets_basename=mets),
-        dest=bag_dest,
-        ocrd_identifier=identifier,
-        ocrd_mets=mets,
-    )
+    workspace = Workspace(resolver, directory=workspace_dir, mets_basename=mets)
+    if file_grp or page_id:
+        prune_mets(workspace.mets, file_grp=file_grp, page_id=page_id)
+    with tempfile.TemporaryDirectory(prefix="ocrd-webapi-bag-") as temp_dir:
+        bag_dir = join(temp_dir, "bag")
+        # Zipped here, the bagger deflates every file
+        with span("utils.bag"):
+            WorkspaceBagger(resolver).bag(
+                workspace,
+                dest=bag_dir,
+                ocrd_identifier=identifier,
+                ocrd_mets=mets,
+                skip_zip=True,
+            )
+        zip_bag_dir(bag_dir, bag_dest, compresslevel=compresslevel)
+
+
+# Page ids of a page_id expression at most, the length of ranges is checked before they are
+# expanded
+MAX_PAGE_IDS = 100000
+NUMBER_PATTERN = re_compile(r"\d+")
+
+
+def expand_page_ids(page_id: str, max_pages: int = MAX_PAGE_IDS) -> List[str]:
+    """
+    Expand a page_id expression to a list of page ids
+
+    The format matches `OcrdProcessingMessageModel.page_id`: comma separated page ids and ranges,
+    e.g. `PHYS_0001..PHYS_0005,PHYS_0007`. Raises a ValueError for malformed ranges and for
+    expressions of more than `max_pages` page ids, the ranges are not expanded before
+    """
+    page_ids = []
+    for part in page_id.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if ".." in part:
+            start, end = (bound.strip() for bound in part.split("..", 1))
+            start_num, end_num = NUMBER_PATTERN.findall(start), NUMBER_PATTERN.findall(end)
+            if start_num and end_num and \
+                    int(end_num[-1]) - int(start_num[-1]) + 1 > max_pages - len(page_ids):
+                raise ValueError(f"Range '{part}' exceeds the limit of {max_pages} page ids")
+            try:
+                page_ids.extend(generate_range(start, end))
+            except Exception as error:
+                raise ValueError(f"Range '{part}' not valid: {error}") from error
+        else:
+            page_ids.append(part)
+        if len(page_ids) > max_pages:
+            raise ValueError(f"More than {max_pages} page ids")
+    return page_ids
+
+
+def prune_mets(mets: OcrdMets, file_grp: List[str] = None, page_id: List[str] = None) -> None:
+    """
+    Remove all files from `mets` which are not in one of the `file_grp`s or not on one of the
+    pages in `page_id`. File groups and physical pages left empty are removed as well.
+
+    Only the in-memory METS is changed, nothing is written to disk
+    """
+    for ocrd_file in list(mets.find_files()):
+        if file_grp and ocrd_file.fileGrp not in file_grp:
+            mets.remove_one_file(ocrd_file.ID)
+        elif page_id and ocrd_file.pageId not in page_id:
+            mets.remove_one_file(ocrd_file.ID)
+    for grp in mets.file_groups:
+        if not next(mets.find_files(fileGrp=grp), None):
+            mets.remove_file_group(grp)
+    if page_id:
+        for physical_page in mets.physical_pages:
+            if physical_page not in page_id:
+                mets.remove_physical_page(physical_page)
+
+
+def split_page_ids(page_ids: List[str], shards: int) -> List[List[str]]:
+    """
+    Split `page_ids` into `shards` contiguous parts whose sizes differ by at most one page
+    """
+    shards = max(1, min(shards, len(page_ids)))
+    size, remainder = divmod(len(page_ids), shards)
+    parts, start = [], 0
+    for shard in range(shards):
+        end = start + size + (1 if shard < remainder else 0)
+        parts.append(page_ids[start:end])
+        start = end
+    return parts
+
+
+def merge_mets_file_grps(mets: OcrdMets, other_mets: OcrdMets, file_grp: List[str]) -> int:
+    """
+    Add the files of the file groups `file_grp` of `other_mets` to `mets`. Files with the same ID
+    are replaced. Only the in-memory `mets` is changed
+
+    Returns:
+        the amount of merged files
+    """
+    merged = 0
+    for grp in file_grp:
+        for ocrd_file in other_mets.find_files(fileGrp=grp):
+            mets.add_file(
+                grp,
+                ID=ocrd_file.ID,
+                mimetype=ocrd_file.mimetype,
+                pageId=ocrd_file.pageId,
+                url=ocrd_file.url,
+                local_filename=ocrd_file.local_filename,
+                force=True
+            )
+            merged += 1
+    return merged
 
 
 def generate_id(file_ext=None):
@@ -93,6 +383,7 @@ def generate_id(file_ext=None):
     return generated_id
 
 
+@traced
 def read_bag_info_from_zip(path_to_zip) -> dict:
     """
     Extracts bag-info.txt from bagit-file and turns it into a dict
@@ -111,6 +402,42 @@ def read_bag_info_from_zip(path_to_zip) -> dict:
             return bagit._load_tag_file(tmp.name)
 
 
+def read_payload_oxum(bag_info: dict) -> Union[Tuple[int, int], None]:
+    """
+    Returns the bytes and files of the payload of a bag from the `Payload-Oxum` of its
+    bag-info.txt, `None` if the bag does not declare it
+    """
+    octets, _, streams = str(bag_info.get("Payload-Oxum", "")).partition(".")
+    if not (octets.isdigit() and streams.isdigit()):
+        return None
+    return int(octets), int(streams)
+
+
+def dir_usage(path: str) -> Tuple[int, int]:
+    """
+    Returns the bytes and files inside a directory, symlinks are counted with their own size
+    """
+    size, files = 0, 0
+    for root, _, file_names in walk(path):
+        for file_name in file_names:
+            try:
+                size += lstat(join(root, file_name)).st_size
+            except FileNotFoundError:
+                continue
+            files += 1
+    return size, files
+
+
+def percentile(values: Sequence[float], percent: float) -> Optional[float]:
+    """
+    Returns the nearest-rank percentile of the values, None for no values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(ceil(percent / 100 * len(ordered)), 1) - 1]
+
+
 def find_upwards(filename, cwd: Path = None) -> Union[Path, None]:
     """
     search in current directory and all directories above for 'filename'
@@ -124,7 +451,143 @@ def find_upwards(filename, cwd: Path = None) -> Union[Path, None]:
     return fullpath if fullpath.exists() else find_upwards(filename, cwd.parent)
 
 
-# TODO: Provide separate functions for the steps below
+def pooled_http_session(connections: int = IMPORT_CONNECTIONS, retries: int = IMPORT_RETRIES,
+                        backoff: float = IMPORT_RETRY_BACKOFF) -> Session:
+    """
+    Returns a requests session with a pool of `connections` keep-alive connections per host which
+    retries failed requests with an exponential backoff
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections, max_retries=retry)
+    session = Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# File groups and ids of a METS become the paths of the downloaded files, anything else than a
+# plain name is rejected
+SAFE_NAME_PATTERN = re_compile(r"[A-Za-z0-9_][A-Za-z0-9_.-]*")
+
+
+def download_file(session: Session, url: str, dest: str, chunk_size: int = 1024 * 1024,
+                  retries: int = IMPORT_RETRIES, backoff: float = IMPORT_RETRY_BACKOFF) -> None:
+    """
+    Stream `url` to `dest`. The file is written next to `dest` first and renamed when complete.
+
+    The session only retries establishing the response, a connection broken while streaming the
+    body restarts the whole download with an exponential backoff
+    """
+    part_dest = dest + ".part"
+    for attempt in range(retries + 1):
+        try:
+            with session.get(url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                with open(part_dest, "wb") as fout:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        fout.write(chunk)
+            break
+        except RequestException as error:
+            # Error responses were already retried by the session
+            if attempt == retries or getattr(error, "response", None) is not None:
+                raise
+            sleep(backoff * 2 ** attempt)
+    replace(part_dest, dest)
+
+
+def download_workspace_from_url(mets_url: str, workspace_dir: str,
+                                mets_basename: str = "mets.xml",
+                                file_grp: Union[str, List[str]] = None,
+                                ocrd_identifier: str = None,
+                                connections: int = IMPORT_CONNECTIONS,
+                                retries: int = IMPORT_RETRIES,
+                                backoff: float = IMPORT_RETRY_BACKOFF) -> dict:
+    """
+    Create a local workspace from a mets-URL
+
+    1. Downloads the mets file from the mets_url
+    2. Downloads all files for the provided file_grp/s with a bounded pool of keep-alive
+       connections, failed downloads are retried with a backoff
+    3. Saves the mets with the local file locations
+
+    Args:
+        mets_url:                   url to a mets file
+        workspace_dir:              directory of the created workspace
+        mets_basename: (optional):  under which name is the downloaded mets saved
+        file_grp (optional):        file groups to download, downloads everything if not set
+        ocrd_identifier (optional): defaults to the unique identifier of the mets
+        connections (optional):     amount of pooled connections and parallel downloads
+        retries (optional):         retries per file
+        backoff (optional):         backoff factor in seconds between the retries
+
+    Returns:
+        bag-info like dict of the workspace, as expected by `database.save_workspace`
+    """
+    if isinstance(file_grp, str):
+        file_grp = [file_grp]
+    makedirs(workspace_dir, exist_ok=True)
+    mets_path = join(workspace_dir, mets_basename)
+    with pooled_http_session(connections, retries, backoff) as session:
+        download_file(session, mets_url, mets_path, retries=retries, backoff=backoff)
+        mets = OcrdMets(filename=mets_path)
+        if file_grp:
+            # Remove unnecessary file groups from the mets file to reduce the size
+            prune_mets(mets, file_grp=file_grp)
+
+        downloads = []
+        for ocrd_file in mets.find_files():
+            href = ocrd_file.url or ocrd_file.local_filename
+            if not href:
+                continue
+            remote_url = urljoin(mets_url, href)
+            extension = Path(urlparse(remote_url).path).suffix \
+                or MIME_TO_EXT.get(ocrd_file.mimetype, ".xml")
+            for name in (ocrd_file.fileGrp, ocrd_file.ID):
+                if not SAFE_NAME_PATTERN.fullmatch(name or ""):
+                    raise ValueError(f"Not a valid file group or file id in the mets: '{name}'")
+            local_filename = join(ocrd_file.fileGrp, f"{ocrd_file.ID}{extension}")
+            dest = abspath(join(workspace_dir, local_filename))
+            if not dest.startswith(abspath(workspace_dir) + sep):
+                raise ValueError(f"File '{local_filename}' is outside of the workspace")
+            makedirs(join(workspace_dir, ocrd_file.fileGrp), exist_ok=True)
+            downloads.append((remote_url, dest))
+            ocrd_file.local_filename = local_filename
+
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [executor.submit(download_file, session, url, dest, retries=retries,
+                                       backoff=backoff)
+                       for url, dest in downloads]
+            try:
+                for future in futures:
+                    # Raises the exception of the first failed download
+                    future.result()
+            except Exception:
+                # Don't start the remaining downloads of a failed import
+                for future in futures:
+                    future.cancel()
+                raise
+
+    with open(mets_path, "wb") as fout:
+        fout.write(mets.to_xml(xmllint=True))
+
+    # The sizes are known from the downloads, no need to walk the workspace again
+    payload_bytes = getsize(mets_path) + sum(getsize(dest) for _, dest in downloads)
+    bag_info = {
+        "BagIt-Profile-Identifier": OCRD_BAGIT_PROFILE_URL,
+        "Ocrd-Identifier": ocrd_identifier or mets.unique_identifier or f"ocrd-{generate_id()}",
+        "Payload-Oxum": f"{payload_bytes}.{len(downloads) + 1}"
+    }
+    if mets_basename != "mets.xml":
+        bag_info["Ocrd-Mets"] = mets_basename
+    return bag_info
+
+
 def bagit_from_url(mets_url, mets_basename="mets.xml", dest=None, file_grp=None, ocrd_identifier=None):
     """
     Create OCRD-ZIP from a mets-URL.
@@ -149,24 +612,13 @@ def bagit_from_url(mets_url, mets_basename="mets.xml", dest=None, file_grp=None,
         ocrd_identifier = f"ocrd-{generate_id()}"
 
     bag_dest = join(dest, f"{ocrd_identifier}.zip")
+    download_workspace_from_url(mets_url, dest, mets_basename=mets_basename, file_grp=file_grp,
+                                ocrd_identifier=ocrd_identifier)
     resolver = Resolver()
-    # Create an OCR-D Workspace from a mets URL
-    # without downloading the files referenced in the mets file
-    workspace = resolver.workspace_from_url(mets_url,
-                                            dest,
-                                            clobber_mets=False,
-                                            mets_basename=mets_basename,
-                                            download=False)
-
-    if file_grp:
-        # Remove unnecessary file groups from the mets file to reduce the size
-        remove_groups = [x for x in workspace.mets.file_groups if x not in file_grp]
-        for g in remove_groups:
-            workspace.remove_file_group(g, recursive=True, force=True)
-        workspace.save_mets()
-
-    # The ocrd workspace bagger automatically downloads the files/groups
-    WorkspaceBagger(resolver).bag(workspace, dest=bag_dest, ocrd_identifier=ocrd_identifier)
+    workspace = Workspace(resolver, directory=dest, mets_basename=mets_basename)
+    # The files are local already, the bagger only copies them
+    WorkspaceBagger(resolver).bag(workspace, dest=bag_dest, ocrd_identifier=ocrd_identifier,
+                                  ocrd_mets=mets_basename)
 
     return bag_dest
 
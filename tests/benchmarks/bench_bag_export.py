@@ -0,0 +1,142 @@
+"""
+Benchmark of the OCRD-ZIP export of a scanned book
+
+Builds a synthetic book workspace as OCR-D workflows leave it: per page a JPEG scan, a binarized
+PNG and a PAGE-XML, with `--tiff` an uncompressed grayscale TIFF master as well. Then times the
+bagging with the bagger deflating every file (the export before the compression was chosen per
+file) and with `extract_bag_dest` at several deflate levels, and prints the size of the OCRD-ZIPs.
+
+    python -m tests.benchmarks.bench_bag_export --pages 100 [--tiff]
+"""
+from argparse import ArgumentParser
+from os import cpu_count, makedirs
+from os.path import getsize, join
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+from types import SimpleNamespace
+
+from ocrd import Resolver
+from ocrd.workspace_bagger import WorkspaceBagger
+from PIL import Image, ImageDraw
+
+from ocrd_webapi.utils import dir_usage, extract_bag_dest
+
+PAGE_XML_LINE = (
+    '<pc:TextLine id="line_{page}_{line}">'
+    '<pc:Coords points="{x0},{y0} {x1},{y0} {x1},{y1} {x0},{y1}"/>'
+    '<pc:TextEquiv><pc:Unicode>{text}</pc:Unicode></pc:TextEquiv></pc:TextLine>\n'
+)
+WORDS = (
+    "der die das und in zu den von mit sich des auf für ist im dem nicht ein eine als auch es an"
+).split()
+
+
+def scan_page(random: Random, width: int, height: int) -> Image.Image:
+    """
+    A grayscale "scan": paper with grain, lines of dark word blocks
+    """
+    page = Image.effect_noise((width, height), 24).point(lambda value: 128 + value // 2)
+    draw = ImageDraw.Draw(page)
+    for y in range(height // 10, height - height // 10, height // 40):
+        x = width // 10
+        while x < width - width // 10:
+            word = random.randint(width // 40, width // 10)
+            draw.rectangle([x, y, x + word, y + height // 80], fill=random.randint(20, 60))
+            x += word + width // 60
+    return page
+
+
+def page_xml(random: Random, page: int, lines: int = 40) -> str:
+    text_lines = "".join(
+        PAGE_XML_LINE.format(page=page, line=line, x0=100, y0=100 + line * 50, x1=1500,
+                             y1=140 + line * 50,
+                             text=" ".join(random.choice(WORDS) for _ in range(12)))
+        for line in range(lines)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<pc:PcGts xmlns:pc="http://schema.primaresearch.org/PAGE/gts/pagecontent/2019-07-15">\n'
+        f'<pc:Page imageFilename="OCR-D-IMG/IMG_{page:04}.jpg"><pc:TextRegion id="region_{page}">\n'
+        f'{text_lines}</pc:TextRegion></pc:Page></pc:PcGts>\n'
+    )
+
+
+def build_book(bench_dir: str, pages: int, width: int, height: int, tiff: bool = False) -> str:
+    random = Random(4711)
+    resolver = Resolver()
+    workspace_dir = join(bench_dir, "workspace")
+    workspace = resolver.workspace_from_nothing(directory=workspace_dir)
+    file_grps = {
+        "OCR-D-IMG": ("jpg", "image/jpeg"),
+        "OCR-D-BIN": ("png", "image/png"),
+        "OCR-D-OCR": ("xml", "application/vnd.prima.page+xml"),
+    }
+    if tiff:
+        file_grps["OCR-D-MASTER"] = ("tif", "image/tiff")
+    for file_grp in file_grps:
+        makedirs(join(workspace_dir, file_grp))
+    for page in range(1, pages + 1):
+        scan = scan_page(random, width, height)
+        for file_grp, (extension, mimetype) in file_grps.items():
+            local_filename = join(file_grp, f"{file_grp}_{page:04}.{extension}")
+            path = join(workspace_dir, local_filename)
+            if file_grp == "OCR-D-IMG":
+                scan.save(path, quality=85)
+            elif file_grp == "OCR-D-BIN":
+                scan.point(lambda value: 255 if value > 128 else 0).convert("1").save(path)
+            elif file_grp == "OCR-D-MASTER":
+                scan.save(path)
+            else:
+                with open(path, "w") as fout:
+                    fout.write(page_xml(random, page))
+            workspace.add_file(file_grp, file_id=f"{file_grp}_{page:04}", page_id=f"PHYS_{page:04}",
+                               mimetype=mimetype, local_filename=local_filename)
+    workspace.save_mets()
+    return workspace_dir
+
+
+def time_bagger(workspace_dir: str, bag_dest: str) -> float:
+    resolver = Resolver()
+    start = perf_counter()
+    WorkspaceBagger(resolver).bag(resolver.workspace_from_url(join(workspace_dir, "mets.xml")),
+                                  ocrd_identifier="bench", dest=bag_dest)
+    return perf_counter() - start
+
+
+def time_export(workspace_dir: str, bag_dest: str, compresslevel: int) -> float:
+    workspace_db = SimpleNamespace(ocrd_mets="mets.xml", ocrd_identifier="bench")
+    start = perf_counter()
+    extract_bag_dest(workspace_db, workspace_dir, bag_dest, compresslevel=compresslevel)
+    return perf_counter() - start
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--width", type=int, default=1600, help="width of the scans in pixels")
+    parser.add_argument("--height", type=int, default=2400, help="height of the scans in pixels")
+    parser.add_argument("--tiff", action="store_true", help="add uncompressed TIFF masters")
+    args = parser.parse_args()
+
+    bench_dir = mkdtemp(prefix="ocrd-webapi-bench-")
+    try:
+        workspace_dir = build_book(bench_dir, args.pages, args.width, args.height, tiff=args.tiff)
+        formats = "JPEG, PNG, PAGE-XML" + (", TIFF" if args.tiff else "")
+        print(f"Book: {args.pages} pages of {args.width}x{args.height} ({formats}), "
+              f"{dir_usage(workspace_dir)[0] / 1024 ** 2:.1f} MiB, {cpu_count()} cores available")
+        bag_dest = join(bench_dir, "bagger.ocrd.zip")
+        elapsed = time_bagger(workspace_dir, bag_dest)
+        print(f"bagger, all deflated     {elapsed:7.2f}s {getsize(bag_dest) / 1024 ** 2:9.1f} MiB")
+        for compresslevel in [1, 6, 9]:
+            bag_dest = join(bench_dir, f"export-{compresslevel}.ocrd.zip")
+            elapsed = time_export(workspace_dir, bag_dest, compresslevel)
+            print(f"per file, deflate level {compresslevel} {elapsed:7.2f}s "
+                  f"{getsize(bag_dest) / 1024 ** 2:9.1f} MiB")
+    finally:
+        rmtree(bench_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Throughput of the in-memory message broker in messages per second
+
+A producer publishes serialized processing messages while a consumer parses and acknowledges
+them, as the processing workers would do.
+
+    python -m tests.benchmarks.bench_broker --messages 100000
+"""
+from argparse import ArgumentParser
+from asyncio import gather, run
+from time import perf_counter, time
+
+from ocrd_webapi.message_broker import InMemoryBroker
+from ocrd_webapi.models.ocrd_messages import OcrdProcessingMessageModel
+
+
+async def produce(broker: InMemoryBroker, messages: int) -> None:
+    for i in range(messages):
+        message = OcrdProcessingMessageModel(
+            job_id=f"job-{i}",
+            processor_name="ocrd-dummy",
+            path_to_mets="/data/workspace/mets.xml",
+            input_file_grps=["OCR-D-IMG"],
+            output_file_grps=["OCR-D-DUMMY"],
+            page_id="PHYS_0001..PHYS_0005",
+            created_time=int(time())
+        )
+        await broker.publish("ocrd-dummy", message.json(exclude_none=True).encode("utf-8"))
+
+
+async def consume(broker: InMemoryBroker, messages: int) -> None:
+    received = 0
+    async for delivery in broker.consume("ocrd-dummy"):
+        OcrdProcessingMessageModel.parse_raw(delivery.body)
+        await delivery.ack()
+        received += 1
+        if received == messages:
+            return
+
+
+async def bench(messages: int) -> None:
+    broker = InMemoryBroker()
+    await broker.connect()
+
+    start = perf_counter()
+    await gather(produce(broker, messages), consume(broker, messages))
+    elapsed = perf_counter() - start
+    print(f"publish + consume with (de)serialization: {messages / elapsed:,.0f} msg/s")
+
+    raw = b"x" * 512
+    start = perf_counter()
+    for _ in range(messages):
+        await broker.publish("raw", raw)
+    received = 0
+    async for delivery in broker.consume("raw"):
+        await delivery.ack()
+        received += 1
+        if received == messages:
+            break
+    elapsed = perf_counter() - start
+    print(f"publish + consume of raw 512 byte bodies: {messages / elapsed:,.0f} msg/s")
+    await broker.close()
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000)
+    args = parser.parse_args()
+    run(bench(args.messages))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Per-item cost of the workspace list response
+
+Compares the former path (one validated WorkspaceRsrc per entry, validated again against the
+response model and encoded by FastAPI) with the trusted dicts encoded by the fast encoder, in one
+piece and streamed.
+
+    python -m tests.benchmarks.bench_responses --items 100000
+"""
+from argparse import ArgumentParser
+from asyncio import run
+from time import perf_counter
+from typing import List
+
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from ocrd_webapi.models.workspace import WorkspaceRsrc
+from ocrd_webapi.responses import iter_json_array, json_dumps, orjson
+
+
+def report(label: str, items: int, elapsed: float, size: int) -> None:
+    print(f"{label:<40} {elapsed * 1e6 / items:7.2f} us/item  {elapsed * 1000:8.1f} ms  "
+          f"{size:,} bytes")
+
+
+async def bench(items: int) -> None:
+    entries = [(f"ws-{i:08}", f"http://localhost:8000/workspace/ws-{i:08}") for i in range(items)]
+    response_field = create_response_field(name="response", type_=List[WorkspaceRsrc])
+
+    start = perf_counter()
+    response = [WorkspaceRsrc.create(workspace_id=ws_id, workspace_url=ws_url)
+                for ws_id, ws_url in entries]
+    content = await serialize_response(field=response_field, response_content=response)
+    body = json_dumps(content)
+    report("models + response validation", items, perf_counter() - start, len(body))
+
+    start = perf_counter()
+    body = json_dumps([WorkspaceRsrc.create_dict(workspace_id=ws_id, workspace_url=ws_url)
+                       for ws_id, ws_url in entries])
+    report("trusted dicts", items, perf_counter() - start, len(body))
+
+    start = perf_counter()
+    items_list = [WorkspaceRsrc.create_dict(workspace_id=ws_id, workspace_url=ws_url)
+                  for ws_id, ws_url in entries]
+    size = sum(len(chunk) for chunk in iter_json_array(items_list))
+    report("trusted dicts, streamed", items, perf_counter() - start, size)
+    print(f"encoder: {'orjson' if orjson else 'json'}")
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--items", type=int, default=100000)
+    args = parser.parse_args()
+    run(bench(args.items))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Cost of a dispatch decision of the fair-share scheduler with many queued jobs
+
+Queues the jobs of a skewed population (one user with half of the jobs, the rest spread over the
+other users), then times the decisions until the queue is empty. The cost per decision should
+grow with the logarithm of the active users only, not with the queued jobs.
+
+    python -m tests.benchmarks.bench_scheduler --jobs 10000 100000 --users 1000
+"""
+from argparse import ArgumentParser
+from random import Random
+from time import perf_counter
+
+from ocrd_webapi.scheduler import FairShareScheduler
+
+
+def bench(jobs: int, users: int, max_running_per_user: int) -> None:
+    random = Random(4711)
+    scheduler = FairShareScheduler(max_running_per_user=max_running_per_user)
+    for user in range(users):
+        scheduler.set_user(f"user{user}", share=random.choice([1, 1, 1, 2, 4]))
+    start = perf_counter()
+    for job in range(jobs):
+        user = "user0" if job % 2 else f"user{random.randrange(users)}"
+        scheduler.submit(f"job{job}", user, priority=random.choice([0, 0, 0, 1]))
+    submitted = perf_counter() - start
+
+    start = perf_counter()
+    decisions = 0
+    while True:
+        next_job = scheduler.next_job()
+        if not next_job:
+            break
+        decisions += 1
+        # Keeps the users below their maximum, the capped ones are parked and unparked
+        scheduler.release(next_job[0])
+    elapsed = perf_counter() - start
+    print(f"{jobs:>8} jobs {users:>6} users  submit {submitted * 1e6 / jobs:6.2f} us/job  "
+          f"decide {elapsed * 1e6 / decisions:6.2f} us/decision")
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--jobs", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--max-running-per-user", type=int, default=2)
+    args = parser.parse_args()
+    for jobs in args.jobs:
+        bench(jobs, args.users, args.max_running_per_user)
+
+
+if __name__ == "__main__":
+    main()
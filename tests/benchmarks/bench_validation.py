@@ -0,0 +1,73 @@
+"""
+Benchmark of the OCRD-ZIP ingest with different amounts of validation processes
+
+Builds a synthetic OCRD-ZIP of random "images" and measures `extract_bag_info` (validation +
+spilling) with 1, 4 and all cores, and the re-submission of an identical OCRD-ZIP.
+
+    python -m tests.benchmarks.bench_validation --files 200 --file-size 2
+"""
+from argparse import ArgumentParser
+from os import cpu_count, makedirs, urandom
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+
+from ocrd import Resolver
+from ocrd.workspace_bagger import WorkspaceBagger
+
+from ocrd_webapi import utils
+from ocrd_webapi.utils import extract_bag_info
+
+
+def build_bag(bench_dir: str, files: int, file_size_mb: int) -> str:
+    resolver = Resolver()
+    workspace_dir = join(bench_dir, "workspace")
+    workspace = resolver.workspace_from_nothing(directory=workspace_dir)
+    makedirs(join(workspace_dir, "OCR-D-IMG"))
+    for i in range(1, files + 1):
+        local_filename = join("OCR-D-IMG", f"IMG_{i:04}.tif")
+        with open(join(workspace_dir, local_filename), "wb") as fout:
+            fout.write(urandom(file_size_mb * 1024 * 1024))
+        workspace.add_file("OCR-D-IMG", file_id=f"IMG_{i:04}", page_id=f"PHYS_{i:04}",
+                           mimetype="image/tiff", local_filename=local_filename)
+    workspace.save_mets()
+    bag_dest = join(bench_dir, "bench.ocrd.zip")
+    WorkspaceBagger(resolver).bag(workspace, ocrd_identifier="bench", dest=bag_dest,
+                                  processes=cpu_count())
+    return bag_dest
+
+
+def time_ingest(bag_dest: str, bench_dir: str, processes: int, clear_cache: bool = True) -> float:
+    if clear_cache:
+        utils.validation_cache.clear()
+    spill_dir = join(bench_dir, f"spill-{processes}-{perf_counter()}")
+    start = perf_counter()
+    extract_bag_info(bag_dest, spill_dir, processes=processes)
+    elapsed = perf_counter() - start
+    rmtree(spill_dir)
+    return elapsed
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--file-size", type=int, default=2, help="size of a single file in MB")
+    args = parser.parse_args()
+
+    bench_dir = mkdtemp(prefix="ocrd-webapi-bench-")
+    try:
+        bag_dest = build_bag(bench_dir, args.files, args.file_size)
+        print(f"OCRD-ZIP: {args.files} files x {args.file_size} MB, {cpu_count()} cores available")
+        for processes in sorted({1, 4, cpu_count()}):
+            elapsed = time_ingest(bag_dest, bench_dir, processes)
+            print(f"processes={processes:<3} ingest: {elapsed:.2f}s")
+        time_ingest(bag_dest, bench_dir, 1)
+        elapsed = time_ingest(bag_dest, bench_dir, 1, clear_cache=False)
+        print(f"identical re-submission: {elapsed:.2f}s")
+    finally:
+        rmtree(bench_dir)
+
+
+if __name__ == "__main__":
+    main()
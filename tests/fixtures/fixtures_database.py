@@ -57,3 +57,10 @@ def fixture_workspace_mongo_coll(mongo_client):
     workspace_coll = mydb["workspace"]
     yield workspace_coll
     workspace_coll.drop()
+
+
+@fixture(scope="session", name='user_mongo_coll')
+def fixture_user_mongo_coll(mongo_client):
+    mydb = mongo_client[DB_NAME]
+    user_coll = mydb["user_accounts"]
+    yield user_coll
@@ -0,0 +1,69 @@
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from os import makedirs
+from os.path import join
+from threading import Thread
+
+from ocrd_models import OcrdMets
+from pytest import fixture
+
+
+class FlakyRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serves files of a directory. The first request to a path containing `flaky` fails with 503,
+    the first response to a path containing `truncated` breaks off in the middle of the body
+    """
+    failed_paths = set()
+
+    def do_GET(self):
+        if "flaky" in self.path and self.path not in self.failed_paths:
+            self.failed_paths.add(self.path)
+            self.send_error(503)
+            return
+        if "truncated" in self.path and self.path not in self.failed_paths:
+            self.failed_paths.add(self.path)
+            self.send_response(200)
+            self.send_header("Content-Length", "5000")
+            self.end_headers()
+            self.wfile.write(b"image" * 100)
+            self.close_connection = True
+            return
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Fixtures related to a local HTTP server
+@fixture(scope="session", name="http_server")
+def fixture_http_server(tmp_path_factory):
+    served_dir = str(tmp_path_factory.mktemp("http_server"))
+    handler = partial(FlakyRequestHandler, directory=served_dir)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", served_dir
+    server.shutdown()
+
+
+@fixture(scope="session", name="remote_mets_url")
+def fixture_remote_mets_url(http_server):
+    """
+    METS with 3 pages in the file groups OCR-D-IMG and OCR-D-GT-SEG-PAGE served by the
+    local HTTP server. The image of the second page fails once and the image of the third page
+    breaks off once, both must be retried
+    """
+    server_url, served_dir = http_server
+    mets = OcrdMets.empty_mets()
+    for page in range(1, 4):
+        img_name = {2: "flaky_2.tif", 3: "truncated_3.tif"}.get(page, f"img_{page}.tif")
+        makedirs(join(served_dir, "img"), exist_ok=True)
+        with open(join(served_dir, "img", img_name), "wb") as fout:
+            fout.write(b"image" * 1000)
+        mets.add_file("OCR-D-IMG", ID=f"IMG_{page}", pageId=f"PHYS_000{page}",
+                      mimetype="image/tiff", url=f"{server_url}/img/{img_name}")
+        mets.add_file("OCR-D-GT-SEG-PAGE", ID=f"PAGE_{page}", pageId=f"PHYS_000{page}",
+                      mimetype="application/vnd.prima.page+xml",
+                      url=f"{server_url}/page/page_{page}.xml")
+    with open(join(served_dir, "mets.xml"), "wb") as fout:
+        fout.write(mets.to_xml())
+    yield f"{server_url}/mets.xml"
@@ -0,0 +1,105 @@
+from datetime import datetime, timezone
+from io import BytesIO
+from threading import Lock
+from typing import Dict, List, Tuple
+from uuid import uuid4
+
+from pytest import fixture
+
+
+class FakeS3Client:
+    """
+    In-process stand-in for the boto3 S3 client, with the calls used by the S3Storage
+    """
+    def __init__(self, page_size: int = 1000):
+        self.page_size = page_size
+        self.objects: Dict[Tuple[str, str], Tuple[bytes, datetime]] = {}
+        self.uploads: Dict[str, Dict[int, bytes]] = {}
+        self.calls: List[str] = []
+        self._lock = Lock()
+
+    def _record(self, name: str) -> None:
+        with self._lock:
+            self.calls.append(name)
+
+    def put_object(self, Bucket, Key, Body):
+        self._record("put_object")
+        self.objects[(Bucket, Key)] = (bytes(Body), datetime.now(timezone.utc))
+        return {"ETag": uuid4().hex}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self._record("get_object")
+        body, _ = self.objects[(Bucket, Key)]
+        if Range:
+            start, end = Range[len("bytes="):].split("-")
+            body = body[int(start):int(end) + 1]
+        return {"Body": BytesIO(body), "ContentLength": len(body)}
+
+    def list_objects_v2(self, Bucket, Prefix="", Delimiter=None, MaxKeys=None,
+                        ContinuationToken=None):
+        self._record("list_objects_v2")
+        max_keys = min(MaxKeys or self.page_size, self.page_size)
+        entries = []
+        for bucket, key in sorted(self.objects):
+            if bucket != Bucket or not key.startswith(Prefix):
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                common_prefix = Prefix + rest[:rest.index(Delimiter) + 1]
+                if not entries or entries[-1] != ("prefix", common_prefix):
+                    entries.append(("prefix", common_prefix))
+            else:
+                entries.append(("key", key))
+        start = int(ContinuationToken or 0)
+        page = entries[start:start + max_keys]
+        response = {
+            "KeyCount": len(page),
+            "IsTruncated": start + max_keys < len(entries),
+            "Contents": [],
+            "CommonPrefixes": [],
+        }
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(start + max_keys)
+        for kind, value in page:
+            if kind == "prefix":
+                response["CommonPrefixes"].append({"Prefix": value})
+            else:
+                body, last_modified = self.objects[(Bucket, value)]
+                response["Contents"].append({"Key": value, "Size": len(body),
+                                             "LastModified": last_modified})
+        return response
+
+    def delete_objects(self, Bucket, Delete):
+        self._record("delete_objects")
+        for deleted in Delete["Objects"]:
+            self.objects.pop((Bucket, deleted["Key"]), None)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        self._record("create_multipart_upload")
+        upload_id = uuid4().hex
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._record("upload_part")
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": f"{UploadId}-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._record("complete_multipart_upload")
+        parts = self.uploads.pop(UploadId)
+        body = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+        self.objects[(Bucket, Key)] = (body, datetime.now(timezone.utc))
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._record("abort_multipart_upload")
+        self.uploads.pop(UploadId, None)
+        return {}
+
+
+@fixture(name='s3_client')
+def fixture_s3_client():
+    # Small pages, so the listings are paginated
+    return FakeS3Client(page_size=3)
@@ -0,0 +1,15 @@
+from .asserts_test import assert_status_code
+
+
+def test_storage_report_unauthorized(client):
+    response = client.get("/admin/storage", auth=("no_user", "no_pass"))
+    assert_status_code(response.status_code, expected_floor=4)
+
+
+def test_storage_report(client, auth):
+    response = client.get("/admin/storage", auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+    report = response.json()
+    assert report["dry_run"], "expecting the report to be a dry run"
+    assert report["disk_total"] > 0
+    assert all(artifact["reason"] in ["retention", "eviction"] for artifact in report["artifacts"])
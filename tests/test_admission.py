@@ -0,0 +1,109 @@
+from asyncio import Event, create_task, sleep
+from types import SimpleNamespace
+
+import httpx
+from pytest import fixture, raises
+
+from ocrd_webapi.admission import AdmissionController, classify_request
+from ocrd_webapi.exceptions import AdmissionRefusedError
+from ocrd_webapi.main import app
+from ocrd_webapi.routers import discovery
+
+GIB = 1024 ** 3
+
+
+@fixture(name="resources")
+def fixture_resources():
+    return SimpleNamespace(disk_free=10 * GIB, memory_available=8 * GIB, jobs=0, queued=0)
+
+
+@fixture(name="admission_controller")
+def fixture_admission_controller(resources):
+    async def count_jobs():
+        return resources.jobs
+
+    async def count_queued():
+        return resources.queued
+    return AdmissionController(
+        base_dir="/", min_free_disk=2 * GIB, max_ingests=2, min_free_memory=GIB, max_jobs=3,
+        max_queued=5, retry_after=7, refresh_interval=0,
+        get_disk_usage=lambda path: SimpleNamespace(free=resources.disk_free),
+        get_memory=lambda: SimpleNamespace(available=resources.memory_available),
+        count_jobs=count_jobs, count_queued=count_queued
+    )
+
+
+def test_classify_request():
+    assert classify_request("POST", "/workspace") == "ingest"
+    assert classify_request("PATCH", "/workspace/upload/u1") == "ingest"
+    assert classify_request("GET", "/workspace/ws1") is None
+    assert classify_request("POST", "/workflow/wf1") == "job"
+    assert classify_request("POST", "/workflow/wf1/job1/resume") == "job"
+    assert classify_request("POST", "/processor/ocrd-dummy") == "job"
+    # Uploading a workflow script is neither
+    assert classify_request("POST", "/workflow") is None
+
+
+async def test_admit_ingest(admission_controller, resources):
+    released = Event()
+
+    async def receive(content_length):
+        async with admission_controller.ingest(content_length):
+            await released.wait()
+
+    ingests = [create_task(receive(4 * GIB)), create_task(receive(GIB))]
+    await sleep(0)
+    assert admission_controller.ingests_in_flight == 2
+    with raises(AdmissionRefusedError) as refused:
+        await admission_controller.admit_ingest(0)
+    assert (refused.value.status_code, refused.value.retry_after) == (429, 7)
+    released.set()
+    for ingest in ingests:
+        await ingest
+    assert admission_controller.ingests_in_flight == 0
+
+    # The announced bytes of the ingests in flight are reserved
+    async with admission_controller.ingest(5 * GIB):
+        with raises(AdmissionRefusedError) as refused:
+            await admission_controller.admit_ingest(4 * GIB)
+        assert refused.value.status_code == 503
+    await admission_controller.admit_ingest(4 * GIB)
+    resources.disk_free = GIB
+    assert not (await admission_controller.get_state()).accepting_ingests
+
+
+async def test_admit_job(admission_controller, resources):
+    resources.jobs = 1
+    await admission_controller.admit_job()
+    await admission_controller.admit_job()
+    state = await admission_controller.get_state()
+    assert state.accepting_jobs and state.jobs_running == 1
+    resources.jobs = 3
+    with raises(AdmissionRefusedError) as refused:
+        await admission_controller.admit_job()
+    assert refused.value.status_code == 429
+    # Few jobs running, but a long backlog waiting for the dispatcher
+    resources.jobs, resources.queued = 0, 5
+    with raises(AdmissionRefusedError) as refused:
+        await admission_controller.admit_job()
+    assert refused.value.status_code == 429
+    assert not (await admission_controller.get_state()).accepting_jobs
+    resources.queued, resources.memory_available = 0, GIB // 2
+    with raises(AdmissionRefusedError) as refused:
+        await admission_controller.admit_job()
+    assert refused.value.status_code == 503
+    assert not (await admission_controller.get_state()).accepting_jobs
+
+
+async def test_admission_middleware(monkeypatch, admission_controller, resources):
+    monkeypatch.setattr(discovery, "admission_controller", admission_controller)
+    resources.disk_free = GIB
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.post("/workspace", content=b"x" * 1024)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "7"
+        response = await client.get("/discovery")
+        assert response.status_code == 200
+        assert response.json()["admission"]["accepting_ingests"] is False
+        assert response.json()["admission"]["accepting_jobs"] is True
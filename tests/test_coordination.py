@@ -0,0 +1,132 @@
+from asyncio import create_task, sleep
+from datetime import datetime, timedelta
+from time import monotonic
+from types import SimpleNamespace
+
+from pytest import fixture
+
+from ocrd_webapi import database as db
+from ocrd_webapi.coordination import LeaderElection
+
+TTL = 0.4
+
+
+@fixture(name="leases")
+def fixture_leases(monkeypatch):
+    """
+    The lease collection, with the semantics of the conditional upsert in the database
+    """
+    leases = {}
+    calls = []
+
+    async def acquire_lease(name, holder, ttl):
+        calls.append(holder)
+        now = datetime.utcnow()
+        lease = leases.get(name)
+        if not lease or lease.holder == holder or lease.expires < now:
+            lease = leases[name] = SimpleNamespace(holder=holder,
+                                                   expires=now + timedelta(seconds=ttl))
+        return lease
+
+    async def release_lease(name, holder):
+        if name in leases and leases[name].holder == holder:
+            leases[name].expires = datetime.utcfromtimestamp(0)
+            return True
+        return False
+
+    monkeypatch.setattr(db, "acquire_lease", acquire_lease)
+    monkeypatch.setattr(db, "release_lease", release_lease)
+    return SimpleNamespace(leases=leases, calls=calls)
+
+
+async def test_single_leader(leases):
+    elections = [LeaderElection("janitor", ttl=TTL, holder=f"worker{i}") for i in range(0, 4)]
+    for election in elections:
+        election.start()
+    await sleep(2 * TTL)
+    assert [election.is_leader() for election in elections] == [True, False, False, False]
+    # The leader renews three times per lease period, the followers query about once per period
+    follower_calls = [holder for holder in leases.calls if holder != "worker0"]
+    assert len(follower_calls) <= 3 * 3
+    for election in elections:
+        election._campaign_task.cancel()
+    await sleep(0)
+
+
+async def test_failover_on_leader_crash(leases):
+    leader = LeaderElection("janitor", ttl=TTL, holder="leader")
+    follower = LeaderElection("janitor", ttl=TTL, holder="follower")
+    runs = []
+
+    async def service():
+        runs.append(follower.holder)
+        await sleep(3600)
+
+    leader.start()
+    await sleep(0.01)
+    service_task = create_task(follower.run_as_leader(service, check_interval=0.01))
+    await sleep(0.05)
+    assert leader.is_leader() and not follower.is_leader()
+    assert not runs
+
+    # The leader dies without releasing its lease
+    async def crashed():
+        pass
+    leader.resign = crashed
+    leader._campaign_task.cancel()
+    crashed_at = monotonic()
+    while not follower.is_leader():
+        await sleep(0.01)
+    # Taken over within the lease period and the jitter
+    assert monotonic() - crashed_at <= TTL * 1.1 + 0.05
+    await sleep(0.05)
+    assert runs == ["follower"]
+
+    service_task.cancel()
+    follower._campaign_task.cancel()
+    await sleep(0.01)
+    # Released on cancellation
+    assert leases.leases["janitor"].expires < datetime.utcnow()
+
+
+async def test_step_down_without_renewal(leases, monkeypatch):
+    election = LeaderElection("janitor", ttl=TTL, holder="worker")
+    await election.try_acquire()
+    assert election.is_leader()
+
+    async def unavailable(name, holder, ttl):
+        raise ConnectionError("database unavailable")
+    monkeypatch.setattr(db, "acquire_lease", unavailable)
+    # Not renewed, the leader steps down before its lease expires in the database
+    assert await election.try_acquire() == TTL / 3
+    await sleep(TTL)
+    assert not election.is_leader()
+
+
+async def test_service_cancelled_on_step_down(leases, monkeypatch):
+    election = LeaderElection("janitor", ttl=TTL, holder="worker")
+    cancelled = []
+
+    async def service():
+        try:
+            await sleep(3600)
+        finally:
+            cancelled.append(monotonic())
+
+    await election.try_acquire()
+    runner = create_task(election.run_as_leader(service, check_interval=TTL))
+    await sleep(0.05)
+    assert election.is_leader() and not cancelled
+
+    async def unavailable(name, holder, ttl):
+        raise ConnectionError("database unavailable")
+    monkeypatch.setattr(db, "acquire_lease", unavailable)
+    # Not renewed, the service is stopped when the lease of the worker runs out, not a check later
+    while election.is_leader():
+        await sleep(0.01)
+    stepped_down = monotonic()
+    await sleep(0.05)
+    assert cancelled and cancelled[0] - stepped_down < TTL / 2
+    runner.cancel()
+    election._campaign_task.cancel()
+    await sleep(0.01)
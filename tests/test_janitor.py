@@ -0,0 +1,173 @@
+from os import utime, walk
+from os.path import exists
+from time import time
+from types import SimpleNamespace
+
+from pytest import fixture
+
+from ocrd_webapi import database as db
+from ocrd_webapi.janitor import StorageJanitor, TEMP_ARCHIVE_PREFIX, TrashReaper
+from ocrd_webapi.managers.resource_manager import ResourceManager
+
+DAY = 24 * 60 * 60
+
+
+def make_file(path, size: int = 100):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * size)
+
+
+def age_tree(root, age: float):
+    timestamp = time() - age
+    for path, _, files in walk(root, topdown=False):
+        for name in files:
+            utime(f"{path}/{name}", (timestamp, timestamp))
+        utime(path, (timestamp, timestamp))
+
+
+@fixture(name="storage")
+def fixture_storage(monkeypatch, tmp_path):
+    """
+    A BASE_DIR with a deleted and a live workspace, an aborted ingest, a finished and a running
+    workflow job and a left-over job archive, everything two days old
+    """
+    base_dir, temp_dir = tmp_path / "data", tmp_path / "tmp"
+    make_file(base_dir / "workspace" / "ws-deleted" / "mets.xml")
+    make_file(base_dir / "workspace" / "ws-live" / "mets.xml")
+    make_file(base_dir / "workspace" / "ws-aborted.zip")
+    make_file(base_dir / "workflow" / "wf" / "nextflow.nf")
+    make_file(base_dir / "workflow" / "wf" / "job-done" / "report.html")
+    make_file(base_dir / "workflow" / "wf" / "job-done" / "work" / "ab" / "out.xml", size=1000)
+    make_file(base_dir / "workflow" / "wf" / "job-running" / "work" / "cd" / "out.xml")
+    make_file(temp_dir / f"{TEMP_ARCHIVE_PREFIX}x1" / "job-done.zip")
+    make_file(temp_dir / "unrelated" / "file")
+    age_tree(tmp_path, 2 * DAY)
+
+    async def get_deleted_workspace_ids():
+        return ["ws-deleted"]
+
+    async def get_workflow_job_states(job_ids):
+        return {"job-done": "RUNNING", "job-running": "RUNNING"}
+
+    job_usages = {}
+
+    async def set_workflow_job_usage(job_id, size, files):
+        job_usages[job_id] = size, files
+        return True
+
+    monkeypatch.setattr(db, "get_deleted_workspace_ids", get_deleted_workspace_ids)
+    monkeypatch.setattr(db, "get_workflow_job_states", get_workflow_job_states)
+    monkeypatch.setattr(db, "set_workflow_job_usage", set_workflow_job_usage)
+    return SimpleNamespace(base_dir=base_dir, temp_dir=temp_dir, job_usages=job_usages)
+
+
+def disk(used: int, total: int = 100000):
+    return lambda path: SimpleNamespace(total=total, used=used, free=total - used)
+
+
+async def test_collect_artifacts(storage):
+    janitor = StorageJanitor(base_dir=str(storage.base_dir), temp_dir=str(storage.temp_dir))
+    artifacts = {artifact.path: artifact for artifact in await janitor.collect_artifacts()}
+    assert {artifact.artifact_class for artifact in artifacts.values()} == {
+        "temp_archive", "ingest_staging", "job_work_dir", "job_dir", "deleted_workspace"
+    }
+    # Running jobs, live workspaces and foreign temp dirs are never collected
+    assert not any("job-running" in path or "ws-live" in path or "unrelated" in path
+                   for path in artifacts)
+    job_dir = artifacts[str(storage.base_dir / "workflow" / "wf" / "job-done")]
+    assert job_dir.size >= 1100
+    assert job_dir.last_access.timestamp() < time() - DAY
+
+
+async def test_sweep_retention(storage):
+    janitor = StorageJanitor(
+        base_dir=str(storage.base_dir),
+        temp_dir=str(storage.temp_dir),
+        retentions={"temp_archive": 60, "ingest_staging": DAY, "job_work_dir": DAY, "job_dir": -1,
+                    "deleted_workspace": 0},
+        get_disk_usage=disk(used=10000)
+    )
+    report = await janitor.sweep(dry_run=True)
+    assert {artifact.artifact_class for artifact in report.artifacts} == {
+        "temp_archive", "ingest_staging", "job_work_dir", "deleted_workspace"
+    }
+    assert all(artifact.reason == "retention" for artifact in report.artifacts)
+    assert exists(storage.base_dir / "workflow" / "wf" / "job-done" / "work")
+
+    report = await janitor.sweep()
+    assert not report.dry_run
+    assert not exists(storage.base_dir / "workflow" / "wf" / "job-done" / "work")
+    assert not exists(storage.base_dir / "workspace" / "ws-deleted")
+    assert not exists(storage.base_dir / "workspace" / "ws-aborted.zip")
+    assert not exists(storage.temp_dir / f"{TEMP_ARCHIVE_PREFIX}x1")
+    assert exists(storage.base_dir / "workflow" / "wf" / "job-done" / "report.html")
+    assert exists(storage.base_dir / "workflow" / "wf" / "job-running" / "work")
+    assert exists(storage.base_dir / "workspace" / "ws-live")
+    assert exists(storage.temp_dir / "unrelated")
+    # Only the report of the job is left to be accounted to its owner
+    assert storage.job_usages == {"job-done": (100, 1)}
+
+
+async def test_sweep_eviction(storage):
+    # The finished job was used least recently, evicting its work dir gets below the low-water mark
+    age_tree(storage.base_dir / "workflow" / "wf" / "job-done", 3 * DAY)
+    janitor = StorageJanitor(
+        base_dir=str(storage.base_dir),
+        temp_dir=str(storage.temp_dir),
+        retentions={name: -1 for name in ["temp_archive", "ingest_staging", "job_work_dir",
+                                          "job_dir", "deleted_workspace"]},
+        high_water_mark=90,
+        low_water_mark=80,
+        get_disk_usage=disk(used=9100, total=10000)
+    )
+    report = await janitor.sweep(dry_run=True)
+    assert [artifact.artifact_class for artifact in report.artifacts] == ["job_work_dir"]
+    assert report.artifacts[0].reason == "eviction"
+    assert report.freed >= 1000
+
+    # Below the high-water mark nothing is evicted
+    janitor._get_disk_usage = disk(used=8900, total=10000)
+    assert not (await janitor.sweep(dry_run=True)).artifacts
+
+
+async def test_sweep_ingest_in_flight(storage):
+    # Still being received, it stays although its retention is over and the disk is full
+    make_file(storage.base_dir / "workspace" / "ws-new.ingest-x1.zip", size=5000)
+    janitor = StorageJanitor(
+        base_dir=str(storage.base_dir),
+        temp_dir=str(storage.temp_dir),
+        retentions={"ingest_staging": 0},
+        get_disk_usage=disk(used=9900, total=10000)
+    )
+    report = await janitor.sweep(dry_run=True)
+    assert str(storage.base_dir / "workspace" / "ws-aborted.zip") in \
+        [artifact.path for artifact in report.artifacts]
+    assert not any("ws-new" in artifact.path for artifact in report.artifacts)
+
+
+def test_single_janitor(tmp_path):
+    first, second = StorageJanitor(base_dir=str(tmp_path)), StorageJanitor(base_dir=str(tmp_path))
+    assert first.acquire_lock()
+    assert not second.acquire_lock()
+    first.release_lock()
+    assert second.acquire_lock()
+    second.release_lock()
+
+
+async def test_reap_trash(tmp_path):
+    workspace_manager = ResourceManager(__name__, "workspace", resources_base=str(tmp_path))
+    for index in range(0, 25):
+        make_file(tmp_path / "workspace" / "ws1" / "OCR-D-IMG" / f"page{index}.tif")
+    (tmp_path / "outside").mkdir()
+    (tmp_path / "workspace" / "ws1" / "linked").symlink_to(tmp_path / "outside")
+    await workspace_manager._delete_resource_dir("ws1")
+    # Moved into the trash at once, the reaper removes it later
+    assert not exists(tmp_path / "workspace" / "ws1")
+    assert len(list((tmp_path / ".trash").iterdir())) == 1
+
+    reaper = TrashReaper(base_dir=str(tmp_path), files_per_second=100)
+    # 25 files, 1 symlink and 2 dirs, removed in batches of 10
+    assert await reaper.reap() == 28
+    assert not list((tmp_path / ".trash").iterdir())
+    # Symlinked dirs are not followed
+    assert exists(tmp_path / "outside")
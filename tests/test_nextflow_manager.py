@@ -0,0 +1,438 @@
+from datetime import datetime
+from os import environ, killpg, pathsep
+from os.path import exists, join
+from signal import SIGKILL
+from socket import gethostname
+from time import sleep, time
+from types import SimpleNamespace
+from typing import Tuple
+
+from pytest import approx, fixture, raises
+
+from ocrd_webapi import database as db
+from ocrd_webapi.exceptions import WorkflowJobException, WorkflowJobStateException
+from ocrd_webapi.managers.nextflow_manager import NextflowManager
+from ocrd_webapi.managers.workflow_manager import WorkflowManager
+from .utils_test import to_asset_path
+
+
+def test_build_nf_command_resume():
+    nf_command = NextflowManager.build_nf_command(
+        nf_script_path="/workflow/nextflow.nf",
+        ws_mets_path="/workspace/mets.xml",
+        resume=True
+    )
+    assert nf_command.startswith("nextflow -bg run /workflow/nextflow.nf -resume ")
+    assert nf_command.endswith(" -with-report report.html -with-trace trace.txt")
+    nf_command = NextflowManager.build_nf_command("/workflow/nextflow.nf", "/workspace/mets.xml")
+    assert "-resume" not in nf_command
+
+
+def test_count_cached_tasks(tmp_path):
+    assert NextflowManager.count_cached_tasks(str(tmp_path)) == 0
+    (tmp_path / ".nextflow.log").write_text(
+        "INFO  nextflow.processor.TaskProcessor - "
+        "[3c/7b1a2f] Cached process > ocrd_cis_ocropy_binarize (1)\n"
+        "INFO  nextflow.processor.TaskProcessor - "
+        "[9e/04d2c1] Cached process > ocrd_anybaseocr_crop (1)\n"
+        "INFO  nextflow.Session - [a1/5f3e09] Submitted process > ocrd_tesserocr_recognize (1)\n"
+    )
+    assert NextflowManager.count_cached_tasks(str(tmp_path)) == 2
+
+
+def test_archive_attempt(tmp_path):
+    for file_name in ["report.html", "nextflow_out.txt", ".nextflow.log"]:
+        (tmp_path / file_name).write_text(file_name)
+    (tmp_path / "work").mkdir()
+    attempt_dir = NextflowManager.archive_attempt(str(tmp_path), attempt=1)
+    assert attempt_dir == join(str(tmp_path), "attempt_1")
+    # The outputs of the attempt are moved, the task cache stays for the resume
+    assert not NextflowManager.is_nf_report(str(tmp_path))
+    assert exists(join(attempt_dir, "report.html"))
+    assert exists(join(attempt_dir, ".nextflow.log"))
+    assert exists(tmp_path / "work")
+
+
+def test_parse_nf_script(tmp_path):
+    nf_params, nf_processes = NextflowManager.parse_nf_script(to_asset_path("nextflow-simple.nf"))
+    assert nf_params == {
+        "workspace": "$projectDir/ocrd-workspace/",
+        "mets": "$projectDir/ocrd-workspace/mets.xml",
+        "input_group": "OCR-D-IMG"
+    }
+    assert nf_processes == ["ocrd_dummy"]
+
+    nf_script = tmp_path / "params.nf"
+    nf_script.write_text(
+        'params.model_url = "https://example.org/models//latest" // remote model\n'
+        "params.threads = 4\n"
+        "params.output_group = ''\n"
+    )
+    nf_params, _ = NextflowManager.parse_nf_script(str(nf_script))
+    assert nf_params == {"model_url": "https://example.org/models//latest", "threads": "4",
+                         "output_group": None}
+
+
+def test_build_nf_command_params():
+    nf_command = NextflowManager.build_nf_command(
+        nf_script_path="/workflow/nextflow.nf",
+        ws_mets_path="/workspace/mets.xml",
+        nf_params={"input_group": "OCR-D-IMG", "model": "GT4Hist fraktur", "threads": 4,
+                   "dewarp": False}
+    )
+    assert "--input_group OCR-D-IMG --model 'GT4Hist fraktur' --threads 4 --dewarp false" \
+        in nf_command
+    # The parameters the launcher passes cannot be set twice
+    with raises(ValueError):
+        NextflowManager.build_nf_command(
+            nf_script_path="/workflow/nextflow.nf",
+            ws_mets_path="/workspace/mets.xml",
+            nf_params={"workspace_dir": "/elsewhere"}
+        )
+
+
+FAKE_NEXTFLOW = """#!/bin/bash
+# Stands in for `nextflow -bg run ...`: backgrounds a long-running "run" with child "processors"
+# and returns immediately
+if [ "$1" = "-v" ]; then
+    echo "nextflow version 23.04.0.5857"
+    exit 0
+fi
+nohup bash -c '{trap} sleep 300 & sleep 300 & wait' > /dev/null 2>&1 &
+"""
+
+
+@fixture(name="fake_nextflow")
+def fixture_fake_nextflow(monkeypatch, tmp_path):
+    started_groups = []
+
+    def start_fake_run(ignore_sigterm: bool = False) -> Tuple[int, str]:
+        bin_dir = tmp_path / "bin"
+        bin_dir.mkdir(exist_ok=True)
+        nextflow = bin_dir / "nextflow"
+        nextflow.write_text(FAKE_NEXTFLOW.format(trap='trap "" TERM;' if ignore_sigterm else ""))
+        nextflow.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{bin_dir}{pathsep}{environ['PATH']}")
+        job_dir = tmp_path / "job"
+        job_dir.mkdir(exist_ok=True)
+        process_group_id = NextflowManager.execute_workflow(
+            nf_script_path="nextflow.nf",
+            workspace_mets_path="mets.xml",
+            job_dir=str(job_dir)
+        )
+        started_groups.append(process_group_id)
+        for _ in range(0, 50):
+            if len(NextflowManager.get_process_group_members(process_group_id)) >= 3:
+                break
+            sleep(0.1)
+        return process_group_id, str(job_dir)
+
+    yield start_fake_run
+    # Do not leave processes behind if a test failed
+    for process_group_id in started_groups:
+        try:
+            killpg(process_group_id, SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def test_terminate_process_group(fake_nextflow):
+    process_group_id, _ = fake_nextflow()
+    assert len(NextflowManager.get_process_group_members(process_group_id)) >= 3
+    killed = NextflowManager.terminate_process_group(process_group_id, timeout=5)
+    assert not killed
+    # No orphans of the run are left
+    assert NextflowManager.get_process_group_members(process_group_id) == []
+
+
+def test_terminate_process_group_escalation(fake_nextflow):
+    process_group_id, _ = fake_nextflow(ignore_sigterm=True)
+    killed = NextflowManager.terminate_process_group(process_group_id, timeout=0.5)
+    assert killed
+    assert NextflowManager.get_process_group_members(process_group_id) == []
+
+
+async def test_cancel_workflow_job(monkeypatch, fake_nextflow):
+    started = datetime.utcnow()
+    process_group_id, job_dir = fake_nextflow()
+    job_states = {"job1": "RUNNING", "job2": "RUNNING", "job3": "RUNNING"}
+    wf_job_db = SimpleNamespace(workflow_job_id="job1", workflow_id="wf1", workspace_id="ws1",
+                                job_path=job_dir, job_state="RUNNING", attempts=1,
+                                process_group_id=process_group_id, trace_offset=0,
+                                host=gethostname(), started=started)
+    # Claims the same process group, but was started elsewhere
+    other_host_job_db = SimpleNamespace(**{**vars(wf_job_db), "workflow_job_id": "job2",
+                                           "host": "other-host"})
+    # Claims the same process group, but was started after it was created
+    reused_job_db = SimpleNamespace(**{**vars(wf_job_db), "workflow_job_id": "job3",
+                                       "started": datetime(2100, 1, 1)})
+    wf_jobs = {"job1": wf_job_db, "job2": other_host_job_db, "job3": reused_job_db}
+
+    async def get_workflow_job(job_id):
+        return wf_jobs[job_id]
+
+    async def set_workflow_job_state(job_id, job_state):
+        job_states[job_id] = job_state
+        return True
+
+    async def finish_workflow_job(job_id, attempts, job_state, failure_reason=None):
+        if job_states[job_id] not in ["QUEUED", "RUNNING"]:
+            return False
+        job_states[job_id] = job_state
+        return True
+
+    job_usages = {}
+
+    async def set_workflow_job_usage(job_id, size, files):
+        job_usages[job_id] = size, files
+        return True
+    monkeypatch.setattr(db, "get_workflow_job", get_workflow_job)
+    monkeypatch.setattr(db, "set_workflow_job_state", set_workflow_job_state)
+    monkeypatch.setattr(db, "finish_workflow_job", finish_workflow_job)
+    monkeypatch.setattr(db, "set_workflow_job_usage", set_workflow_job_usage)
+
+    released = []
+
+    async def release_slot(job):
+        released.append(job.workflow_job_id)
+
+    workflow_manager = WorkflowManager()
+    workflow_manager.add_release_hook(release_slot)
+    # Only the host which started the run signals its processes, and only its own ones
+    for job_id in ["job2", "job3"]:
+        await workflow_manager.cancel_workflow_job("wf1", job_id, timeout=5)
+        assert job_states[job_id] == "CANCELLED"
+        assert NextflowManager.get_process_group_members(process_group_id) != []
+    released.clear()
+    await workflow_manager.cancel_workflow_job("wf1", "job1", timeout=5)
+    assert job_states["job1"] == "CANCELLED"
+    assert released == ["job1"]
+    # The job dir is accounted to the owner of the job when it ends
+    assert "job1" in job_usages
+    assert NextflowManager.get_process_group_members(process_group_id) == []
+
+    # A finished job can not be cancelled again
+    with raises(WorkflowJobStateException):
+        await workflow_manager.cancel_workflow_job("wf1", "job1")
+
+
+async def test_resume_workflow_job_failed_launch(monkeypatch, tmp_path):
+    wf_job_db = SimpleNamespace(workflow_job_id="job1", workflow_id="wf1", workspace_id="ws1",
+                                job_path=str(tmp_path), job_state="FAILED", attempts=1,
+                                workflow_parameters={}, process_group_id=None, trace_offset=0,
+                                failure_reason=None, cached_tasks=0)
+
+    async def get_workflow_job(job_id):
+        return wf_job_db
+
+    async def get_workspace_mets_path(workspace_id):
+        return str(tmp_path / "mets.xml")
+
+    async def add_workflow_job_attempt(job_id, attempts, started):
+        if attempts != wf_job_db.attempts or wf_job_db.job_state in ["QUEUED", "RUNNING"]:
+            return False
+        wf_job_db.attempts, wf_job_db.job_state = attempts + 1, "RUNNING"
+        return True
+
+    async def finish_workflow_job(job_id, attempts, job_state, failure_reason=None):
+        wf_job_db.job_state, wf_job_db.failure_reason = job_state, failure_reason
+        return True
+
+    async def set_workflow_job_usage(job_id, size, files):
+        return True
+
+    async def stage(*args, **kwargs):
+        return str(tmp_path)
+
+    def execute_workflow(**kwargs):
+        raise OSError("nextflow not found")
+    monkeypatch.setattr(db, "get_workflow_job", get_workflow_job)
+    monkeypatch.setattr(db, "get_workspace_mets_path", get_workspace_mets_path)
+    monkeypatch.setattr(db, "add_workflow_job_attempt", add_workflow_job_attempt)
+    monkeypatch.setattr(db, "finish_workflow_job", finish_workflow_job)
+    monkeypatch.setattr(db, "set_workflow_job_usage", set_workflow_job_usage)
+    monkeypatch.setattr(NextflowManager, "execute_workflow", execute_workflow)
+
+    workflow_manager = WorkflowManager()
+    monkeypatch.setattr(workflow_manager, "stage_nf_script", stage)
+    monkeypatch.setattr(workflow_manager, "stage_resource", stage)
+    monkeypatch.setattr(workflow_manager._workspace_manager, "stage_resource", stage)
+    with raises(WorkflowJobException):
+        await workflow_manager.resume_nf_workflow("wf1", "job1")
+    # The attempt fails with the reason instead of looking like a stopped run
+    assert (wf_job_db.attempts, wf_job_db.job_state) == (2, "FAILED")
+    assert "nextflow not found" in wf_job_db.failure_reason
+
+    # A resume which read the job before another one resumed it does not get the job
+    stale_job_db = SimpleNamespace(**{**vars(wf_job_db), "attempts": 1})
+
+    async def get_stale_workflow_job(workflow_id, job_id):
+        return stale_job_db
+    monkeypatch.setattr(workflow_manager, "get_workflow_job", get_stale_workflow_job)
+    with raises(WorkflowJobStateException):
+        await workflow_manager.resume_nf_workflow("wf1", "job1")
+
+
+def test_get_run_state(tmp_path):
+    job_dir = str(tmp_path)
+    (tmp_path / ".nextflow.log").write_text(
+        "Jan-01 12:00:00.000 [main] DEBUG nextflow.Session - Session start\n"
+        "Jan-01 12:00:05.000 [Task monitor] ERROR nextflow.processor.TaskProcessor - "
+        "Error executing process > 'ocrd_dummy (1)'\n"
+        "Jan-01 12:00:06.000 [main] DEBUG nextflow.Session - Session aborted\n"
+    )
+    (tmp_path / "trace.txt").write_text(
+        "task_id\thash\tname\tstatus\texit\n"
+        "1\t3c/7b1a2f\tocrd_binarize (1)\tCOMPLETED\t0\n"
+        "2\t9e/04d2c1\tocrd_dummy (1)\tFAILED\t1\n"
+    )
+    now, live = datetime.utcnow(), {4242: time()}
+    assert NextflowManager.get_run_state(job_dir, 4242, now, live) == ("RUNNING", None)
+    # The process group id was reused after a reboot
+    assert NextflowManager.get_run_state(job_dir, 4242, datetime(2000, 1, 1), live)[0] == "FAILED"
+    # Or by the processes of another run, which are older than this one
+    reused = {4242: time() - 60}
+    assert NextflowManager.get_run_state(job_dir, 4242, datetime.utcnow(), reused)[0] == "FAILED"
+    job_state, reason = NextflowManager.get_run_state(job_dir, 4242, datetime.utcnow(), {})
+    assert job_state == "FAILED"
+    assert "Error executing process > 'ocrd_dummy (1)'" in reason
+    assert "1 COMPLETED, 1 FAILED" in reason
+    (tmp_path / "report.html").write_text("report")
+    assert NextflowManager.get_run_state(job_dir, 4242, datetime.utcnow(), {}) == ("STOPPED", None)
+
+
+async def test_reconcile_workflow_jobs(monkeypatch, fake_nextflow, tmp_path):
+    started = datetime.utcnow()
+    process_group_id, live_job_dir = fake_nextflow()
+    dead_job_dir = tmp_path / "dead-job"
+    dead_job_dir.mkdir()
+    (dead_job_dir / "nextflow_err.txt").write_text("Killed\n")
+    wf_jobs = [
+        SimpleNamespace(workflow_job_id="live", workflow_id="wf1", workspace_id="ws1",
+                        job_path=live_job_dir, job_state="RUNNING", attempts=1,
+                        process_group_id=process_group_id, started=started, trace_offset=0),
+        # Its process group is gone, e.g. the host was restarted
+        SimpleNamespace(workflow_job_id="dead", workflow_id="wf1", workspace_id="ws1",
+                        job_path=str(dead_job_dir), job_state="RUNNING", attempts=1,
+                        process_group_id=process_group_id + 100000, started=datetime.utcnow(),
+                        trace_offset=0),
+    ]
+    failures = {}
+
+    async def get_unfinished_workflow_jobs(host=None):
+        return [wf_job for wf_job in wf_jobs if wf_job.job_state in ["QUEUED", "RUNNING"]]
+
+    async def finish_workflow_job(job_id, attempts, job_state, failure_reason=None):
+        failures[job_id] = job_state, failure_reason
+        return True
+
+    async def set_workflow_job_usage(job_id, size, files):
+        return True
+
+    async def add_workflow_tasks(job_id, attempts, trace_offset, new_trace_offset, tasks):
+        return True
+    monkeypatch.setattr(db, "get_unfinished_workflow_jobs", get_unfinished_workflow_jobs)
+    monkeypatch.setattr(db, "add_workflow_tasks", add_workflow_tasks)
+    monkeypatch.setattr(db, "finish_workflow_job", finish_workflow_job)
+    monkeypatch.setattr(db, "set_workflow_job_usage", set_workflow_job_usage)
+
+    released = []
+
+    async def release_slot(job):
+        released.append(job.workflow_job_id)
+
+    workflow_manager = WorkflowManager()
+    workflow_manager.add_release_hook(release_slot)
+    assert await workflow_manager.reconcile_workflow_jobs() == {"dead": "FAILED"}
+    assert failures["dead"] == ("FAILED", "Nextflow run exited without a report: Killed")
+    assert released == ["dead"]
+
+    # The live run stays supervised and is finished by a later pass once it died
+    NextflowManager.terminate_process_group(process_group_id, timeout=5)
+    assert await workflow_manager.reconcile_workflow_jobs() == {"live": "FAILED"}
+    assert released == ["dead", "live"]
+
+
+TRACE_HEADER = (
+    "task_id\thash\tnative_id\tname\tstatus\texit\tsubmit\tduration\trealtime\t%cpu\tpeak_rss\n"
+)
+
+
+def test_read_trace(tmp_path):
+    assert NextflowManager.read_trace(str(tmp_path)) == ([], 0)
+    (tmp_path / "trace.txt").write_text(
+        TRACE_HEADER +
+        "1\t3c/7b1a2f\t4711\tocrd_cis_ocropy_binarize (1)\tCOMPLETED\t0\t2023-05-02 10:01:12.345\t"
+        "1m 2s\t59.5s\t98.5%\t1.5 GB\n"
+        "2\t9e/04d2c1\t4712\tocrd_dummy (1)\tFAILED\t1\t2023-05-02 10:02:14.000\t"
+        "345ms\t120ms\t-\t512 KB\n"
+        # Still being written
+        "3\ta1/5f3e09\t4713\tocrd_dummy (2)\tCOMPL"
+    )
+    tasks, offset = NextflowManager.read_trace(str(tmp_path))
+    assert [task["process"] for task in tasks] == ["ocrd_cis_ocropy_binarize", "ocrd_dummy"]
+    assert tasks[0]["status"] == "COMPLETED" and tasks[0]["exit"] == 0
+    assert tasks[0]["duration"] == 62 and tasks[0]["realtime"] == 59.5
+    assert tasks[0]["cpu"] == 98.5 and tasks[0]["peak_rss"] == 1.5 * 1024 ** 3
+    assert tasks[0]["submit"] is not None
+    assert tasks[1]["exit"] == 1 and tasks[1]["duration"] == approx(0.345)
+    assert tasks[1]["cpu"] is None
+    assert tasks[1]["peak_rss"] == 512 * 1024
+
+    with open(tmp_path / "trace.txt", "a") as trace_file:
+        trace_file.write("ETED\t0\t2023-05-02 10:02:15.000\t1h 1s\t1h\t100.0%\t100 B\n")
+    tasks, offset = NextflowManager.read_trace(str(tmp_path), offset)
+    assert [task["name"] for task in tasks] == ["ocrd_dummy (2)"]
+    assert tasks[0]["duration"] == 3601 and tasks[0]["peak_rss"] == 100
+    assert NextflowManager.read_trace(str(tmp_path), offset) == ([], offset)
+
+
+async def test_ingest_trace(monkeypatch, tmp_path):
+    (tmp_path / "trace.txt").write_text(
+        TRACE_HEADER +
+        "1\t3c/7b1a2f\t4711\tocrd_dummy (1)\tCACHED\t0\t2023-05-02 10:01:12.345\t"
+        "1s\t1s\t10%\t1 MB\n"
+        "2\t9e/04d2c1\t4712\tocrd_dummy (2)\tCOMPLETED\t0\t2023-05-02 10:02:14.000\t"
+        "2s\t1s\t50%\t2 MB\n"
+    )
+    wf_job_db = SimpleNamespace(workflow_job_id="job1", workflow_id="wf1", workspace_id="ws1",
+                                job_path=str(tmp_path), job_state="RUNNING", attempts=2,
+                                trace_offset=0)
+    stored = []
+    offsets = {"job1": 0}
+
+    async def add_workflow_tasks(job_id, attempts, trace_offset, new_trace_offset, tasks):
+        if offsets[job_id] != trace_offset:
+            return False
+        offsets[job_id] = new_trace_offset
+        stored.extend(tasks)
+        return True
+    monkeypatch.setattr(db, "add_workflow_tasks", add_workflow_tasks)
+
+    workflow_manager = WorkflowManager()
+    # The cached task was stored by a previous attempt
+    assert await workflow_manager.ingest_trace(wf_job_db) == 1
+    assert [(task["name"], task["attempt"], task["series"]["process"]) for task in stored] == \
+        [("ocrd_dummy (2)", 2, "ocrd_dummy")]
+    # Completed after its duration
+    submit = NextflowManager.read_trace(str(tmp_path))[0][1]["submit"]
+    assert (stored[0]["completed"] - submit).total_seconds() == 2
+    assert wf_job_db.trace_offset == offsets["job1"] > 0
+    assert await workflow_manager.ingest_trace(wf_job_db) == 0
+    # Another worker with an outdated offset does not store the tasks again
+    outdated_job_db = SimpleNamespace(**{**vars(wf_job_db), "trace_offset": 0})
+    assert await workflow_manager.ingest_trace(outdated_job_db) == 0
+    assert len(stored) == 1
+
+
+async def test_get_workflow_task_stats(monkeypatch):
+    async def get_workflow_task_values(workflow_id, since=None):
+        return [{"_id": "ocrd_dummy", "tasks": 4, "failed": 1, "duration": [3.0, 1.0, None, 2.0],
+                 "realtime": [2.0, 1.0, 1.5], "cpu": [], "peak_rss": [300, 100, 200]}]
+    monkeypatch.setattr(db, "get_workflow_task_values", get_workflow_task_values)
+    process_stats = await WorkflowManager().get_workflow_task_stats("wf1")
+    assert len(process_stats) == 1
+    assert process_stats[0].process == "ocrd_dummy" and process_stats[0].failed == 1
+    assert (process_stats[0].duration_p50, process_stats[0].duration_p95) == (2.0, 3.0)
+    assert (process_stats[0].peak_rss_p50, process_stats[0].peak_rss_p95) == (200, 300)
+    assert process_stats[0].cpu_p50 is None
@@ -1,2 +1,42 @@
-# We are going to use a different approach for the processing part
-# RabbitMQ will be used for better management
+from time import sleep
+
+from .asserts_test import assert_status_code
+from .utils_test import parse_job_state, parse_resource_id
+
+
+def test_run_processor_unauthorized(client, dummy_workspace_id):
+    params = {"workspace_id": dummy_workspace_id, "input_file_grps": "OCR-D-IMG"}
+    response = client.post("/processor/ocrd-dummy", json=params, auth=("no_user", "no_pass"))
+    assert_status_code(response.status_code, expected_floor=4)
+
+
+def test_run_processor_not_available(client, auth, dummy_workspace_id):
+    params = {"workspace_id": dummy_workspace_id, "input_file_grps": "OCR-D-IMG"}
+    response = client.post("/processor/ocrd-not-installed", json=params, auth=auth)
+    assert response.status_code == 404
+
+
+def test_run_processor(client, auth, dummy_workspace_id):
+    params = {
+        "workspace_id": dummy_workspace_id,
+        "input_file_grps": "OCR-D-IMG",
+        "output_file_grps": "OCR-D-DUMMY"
+    }
+    response = client.post("/processor/ocrd-dummy", json=params, auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+    job_id = parse_resource_id(response)
+    assert job_id, "expecting a processor job id"
+
+    job_state = None
+    for _ in range(0, 100):
+        response = client.get(f"/processor/ocrd-dummy/{job_id}")
+        assert_status_code(response.status_code, expected_floor=2)
+        job_state = parse_job_state(response)
+        if job_state in ["SUCCESS", "FAILED"]:
+            break
+        sleep(0.2)
+    assert job_state == "SUCCESS", f"expecting the processor job to succeed, but it is {job_state}"
+
+    # The job is only found with the processor it was submitted to
+    response = client.get(f"/processor/ocrd-other/{job_id}")
+    assert response.status_code == 404
@@ -0,0 +1,136 @@
+from asyncio import gather
+from zipfile import ZipFile
+
+from ocrd_models import OcrdMets
+
+from ocrd_webapi.managers.processor_manager import (
+    ProcessorManager,
+    ProcessorWorker,
+    resolve_processor_class,
+)
+from ocrd_webapi.message_broker import InMemoryBroker
+from ocrd_webapi.models.ocrd_messages import OcrdProcessingMessageModel, OcrdResultMessageModel
+from .utils_test import to_asset_path
+
+
+def extract_workspace(tmp_path) -> str:
+    with ZipFile(to_asset_path("example_ws.ocrd.zip")) as zip_file:
+        zip_file.extractall(tmp_path)
+    return str(tmp_path / "data" / "mets.xml")
+
+
+async def wait_for_result(consumer, status: str) -> OcrdResultMessageModel:
+    while True:
+        delivery = await consumer.__anext__()
+        await delivery.ack()
+        result = OcrdResultMessageModel.parse_raw(delivery.body)
+        if result.status == status or result.status == "FAILED":
+            return result
+
+
+def test_resolve_processor_class():
+    assert resolve_processor_class("ocrd-dummy").__name__ == "DummyProcessor"
+    assert not resolve_processor_class("ocrd-not-installed")
+
+
+async def test_processor_manager_warm_workers(tmp_path):
+    path_to_mets = extract_workspace(tmp_path)
+    broker = InMemoryBroker()
+    manager = ProcessorManager(broker, pool_size=1, max_jobs=2)
+    assert manager.is_processor_available("ocrd-dummy")
+    await manager.serve("ocrd-dummy")
+    worker = manager.get_workers("ocrd-dummy")[0]
+    first_pid = worker.pid
+    results = broker.consume("test-results")
+
+    worker_pids = []
+    jobs_done = []
+    for output_file_grp in ["OCR-D-DUMMY1", "OCR-D-DUMMY2", "OCR-D-DUMMY3"]:
+        message = OcrdProcessingMessageModel(
+            job_id=output_file_grp,
+            processor_name="ocrd-dummy",
+            path_to_mets=path_to_mets,
+            input_file_grps=["OCR-D-IMG"],
+            output_file_grps=[output_file_grp],
+            result_queue_name="test-results",
+        )
+        await broker.publish("ocrd-dummy", message.json().encode("utf-8"))
+        result = await wait_for_result(results, status="SUCCESS")
+        assert result.job_id == output_file_grp
+        assert result.status == "SUCCESS"
+        worker_pids.append(worker.pid)
+        jobs_done.append(worker.jobs_done)
+    await manager.stop()
+
+    mets = OcrdMets(filename=path_to_mets)
+    assert {"OCR-D-DUMMY1", "OCR-D-DUMMY2", "OCR-D-DUMMY3"} <= set(mets.file_groups)
+    # The warm worker runs two jobs, then it is recycled after max_jobs and a fresh one runs the
+    # third job
+    assert worker_pids[0] == first_pid
+    assert jobs_done[:2] == [1, 2]
+    assert worker_pids[2] != first_pid
+    assert jobs_done[2] == 1
+
+
+async def test_processor_manager_serve_concurrently(monkeypatch):
+    started = []
+    monkeypatch.setattr(ProcessorWorker, "start", lambda worker: started.append(worker))
+    monkeypatch.setattr(ProcessorWorker, "stop", lambda worker: None)
+    manager = ProcessorManager(InMemoryBroker(), pool_size=1)
+    await gather(*[manager.serve("ocrd-dummy") for _ in range(3)])
+    # Only one pool is started, no workers are left running outside of it
+    assert started == manager.get_workers("ocrd-dummy")
+    await manager.stop()
+
+
+async def test_processor_manager_failed_job(tmp_path):
+    broker = InMemoryBroker()
+    manager = ProcessorManager(broker, pool_size=1)
+    await manager.serve("ocrd-dummy")
+    message = OcrdProcessingMessageModel(
+        job_id="job1",
+        processor_name="ocrd-dummy",
+        path_to_mets=str(tmp_path / "mets.xml"),
+        input_file_grps=["OCR-D-IMG"],
+        output_file_grps=["OCR-D-DUMMY"],
+        result_queue_name="test-results",
+    )
+    await broker.publish("ocrd-dummy", message.json().encode("utf-8"))
+    result = await wait_for_result(broker.consume("test-results"), status="SUCCESS")
+    assert result.status == "FAILED"
+    await manager.stop()
+
+
+class FlakyBroker(InMemoryBroker):
+    """
+    Fails to publish the first result message
+    """
+    def __init__(self):
+        super().__init__()
+        self.failures = 1
+
+    async def publish(self, queue_name: str, body: bytes) -> None:
+        if queue_name == "test-results" and self.failures:
+            self.failures -= 1
+            raise ConnectionError("broker gone")
+        await super().publish(queue_name, body)
+
+
+async def test_processor_manager_unpublished_result(tmp_path):
+    broker = FlakyBroker()
+    manager = ProcessorManager(broker, pool_size=1)
+    await manager.serve("ocrd-dummy")
+    message = OcrdProcessingMessageModel(
+        job_id="job1",
+        processor_name="ocrd-dummy",
+        path_to_mets=str(tmp_path / "mets.xml"),
+        input_file_grps=["OCR-D-IMG"],
+        output_file_grps=["OCR-D-DUMMY"],
+        result_queue_name="test-results",
+    )
+    await broker.publish("ocrd-dummy", message.json().encode("utf-8"))
+    # The job is delivered again and its result published then
+    result = await wait_for_result(broker.consume("test-results"), status="SUCCESS")
+    assert result.job_id == "job1"
+    assert broker.queue_size("ocrd-dummy") == 0
+    await manager.stop()
@@ -0,0 +1,114 @@
+from asyncio import get_running_loop, sleep
+from time import perf_counter
+import os
+
+from fastapi import FastAPI
+import httpx
+
+from ocrd_webapi.profiling import (
+    PROFILE_HEADER,
+    PROFILE_ID_HEADER,
+    ProfilingMiddleware,
+    RequestProfiler,
+)
+from ocrd_webapi.tracing import in_context
+
+
+def busy_thread(seconds):
+    until = perf_counter() + seconds
+    while perf_counter() < until:
+        pass
+
+
+def busy_loop(seconds):
+    until = perf_counter() + seconds
+    while perf_counter() < until:
+        pass
+
+
+async def handler():
+    busy_loop(0.1)
+    await sleep(0.1)
+    await get_running_loop().run_in_executor(None, in_context(busy_thread, 0.1))
+
+
+def read_stacks(profiler, profile_id):
+    with open(profiler.get_profile_path(profile_id)) as fin:
+        return {line.rsplit(" ", 1)[0]: int(line.rsplit(" ", 1)[1]) for line in fin}
+
+
+async def test_profile(tmp_path):
+    profiler = RequestProfiler(profile_dir=str(tmp_path), interval=0.005)
+    async with profiler.profile("POST /workspace") as profile_id:
+        await handler()
+    stacks = read_stacks(profiler, profile_id)
+
+    def samples(predicate):
+        return sum(count for stack, count in stacks.items() if predicate(stack))
+    # The running task, from its coroutine to the leaf
+    assert samples(lambda stack: stack.startswith("[loop];") and ";handler" in stack
+                   and "busy_loop" in stack) > 2
+    # The awaits of the suspended task
+    assert samples(lambda stack: stack.startswith("[loop];") and ";handler" in stack
+                   and stack.endswith(";[await]")) > 2
+    # The offloaded work
+    assert samples(lambda stack: stack.startswith("[thread];") and "busy_thread" in stack) > 2
+    # Not the frames of the event loop itself
+    assert not samples(lambda stack: "run_until_complete" in stack)
+
+    [info] = profiler.get_profiles()
+    assert (info.profile_id, info.request) == (profile_id, "POST /workspace")
+    assert info.duration >= 0.3 and info.samples > 10
+
+
+async def test_max_profiles(tmp_path):
+    profiler = RequestProfiler(profile_dir=str(tmp_path), max_profiles=2)
+    profile_ids = []
+    for _ in range(3):
+        async with profiler.profile("GET /") as profile_id:
+            profile_ids.append(profile_id)
+    assert [info.profile_id for info in profiler.get_profiles()] == profile_ids[:0:-1]
+    assert len(os.listdir(tmp_path)) == 4
+    assert profiler.get_profile_path(profile_ids[0]) is None
+    assert profiler.get_profile_path("../../etc/passwd") is None
+
+
+def test_take_armed():
+    profiler = RequestProfiler()
+    assert not profiler.take_armed("/workspace")
+    profiler.arm(2, "/workspace")
+    assert not profiler.take_armed("/workflow")
+    assert profiler.take_armed("/workspace/ws1")
+    assert profiler.take_armed("/workspace")
+    assert not profiler.take_armed("/workspace")
+
+
+async def test_middleware(tmp_path):
+    profiler = RequestProfiler(profile_dir=str(tmp_path))
+    app = FastAPI()
+
+    async def is_admin(authorization):
+        return authorization == "Basic admin"
+    app.add_middleware(ProfilingMiddleware, profiler=profiler, is_admin=is_admin)
+
+    @app.get("/")
+    async def index():
+        await handler()
+        return {}
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/", headers={PROFILE_HEADER: "1",
+                                                  "Authorization": "Basic admin"})
+        profile_id = response.headers[PROFILE_ID_HEADER]
+        assert any("busy_loop" in stack for stack in read_stacks(profiler, profile_id))
+        # Only the admin decides what is profiled
+        response = await client.get("/", headers={PROFILE_HEADER: "1",
+                                                  "Authorization": "Basic user"})
+        assert PROFILE_ID_HEADER not in response.headers
+        profiler.arm(1)
+        response = await client.get("/", headers={"Authorization": "Basic user"})
+        assert PROFILE_ID_HEADER in response.headers
+        response = await client.get("/")
+        assert PROFILE_ID_HEADER not in response.headers
+    assert len(profiler.get_profiles()) == 2
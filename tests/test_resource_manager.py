@@ -0,0 +1,36 @@
+from ocrd_webapi.managers import resource_manager
+from ocrd_webapi.managers.resource_manager import ResourceManager
+
+
+def count_isdir(monkeypatch):
+    probes = []
+    isdir = resource_manager.isdir
+
+    def counting_isdir(path):
+        probes.append(path)
+        return isdir(path)
+    monkeypatch.setattr(resource_manager, "isdir", counting_isdir)
+    return probes
+
+
+async def test_resource_index(monkeypatch, tmp_path):
+    first = ResourceManager(__name__, "workspace", resources_base=str(tmp_path))
+    second = ResourceManager(__name__, "workspace", resources_base=str(tmp_path))
+    (tmp_path / "workspace" / "ws1").mkdir()
+    probes = count_isdir(monkeypatch)
+
+    assert (await first.get_resource("ws1", local=False)).endswith("/workspace/ws1")
+    assert len(probes) == 1
+    # Known to exist, no more file system probes by any manager of the process
+    for _ in range(0, 10):
+        assert await first.get_resource("ws1", local=True)
+        assert second.get_resource_job("ws1", "job1", local=False).endswith("/workspace/ws1/job1")
+    assert len(probes) == 1
+
+    # Not existing resources are not remembered, they may be created by another worker
+    assert await first.get_resource("ws2", local=True) is None
+    assert await first.get_resource("ws2", local=True) is None
+    assert len(probes) == 3
+
+    await second._delete_resource_dir("ws1")
+    assert await first.get_resource("ws1", local=True) is None
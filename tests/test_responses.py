@@ -0,0 +1,33 @@
+from json import loads
+
+from fastapi.responses import StreamingResponse
+
+from ocrd_webapi import responses
+from ocrd_webapi.models.workflow import WorkflowRsrc
+from ocrd_webapi.models.workspace import WorkspaceRsrc
+from ocrd_webapi.responses import FastJSONResponse, iter_json_array, json_list_response
+
+
+def test_trusted_dict():
+    # The same document as the validated models
+    assert WorkspaceRsrc.create_dict("ws1", "http://localhost/workspace/ws1") == \
+        WorkspaceRsrc.create("ws1", "http://localhost/workspace/ws1").dict()
+    assert WorkflowRsrc.create_dict("wf1", "http://localhost/workflow/wf1", description="OCR") == \
+        WorkflowRsrc.create("wf1", "http://localhost/workflow/wf1", description="OCR").dict()
+
+
+def test_iter_json_array():
+    items = [{"resource_id": f"ws{i}", "description": "Workspace ü"} for i in range(0, 7)]
+    for chunk_items in [1, 3, 7, 10]:
+        assert loads(b"".join(iter_json_array(items, chunk_items=chunk_items))) == items
+    assert b"".join(iter_json_array([])) == b"[]"
+
+
+def test_json_list_response(monkeypatch):
+    items = [WorkspaceRsrc.create_dict(f"ws{i}", f"http://localhost/workspace/ws{i}")
+             for i in range(0, 5)]
+    response = json_list_response(items)
+    assert isinstance(response, FastJSONResponse)
+    assert loads(response.body) == items
+    monkeypatch.setattr(responses, "JSON_STREAM_THRESHOLD", 3)
+    assert isinstance(json_list_response(items), StreamingResponse)
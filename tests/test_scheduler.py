@@ -0,0 +1,215 @@
+from collections import Counter, deque
+from random import Random
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Tuple
+
+from ocrd_webapi import database as db
+from ocrd_webapi.managers.nextflow_manager import NextflowManager
+from ocrd_webapi.managers.workflow_manager import WorkflowManager
+from ocrd_webapi.scheduler import FairShareScheduler
+
+
+def dispatch(scheduler: FairShareScheduler, amount: int) -> List[Tuple[str, str]]:
+    picked = []
+    for _ in range(amount):
+        next_job = scheduler.next_job()
+        if not next_job:
+            break
+        picked.append(next_job)
+    return picked
+
+
+def test_weighted_shares():
+    scheduler = FairShareScheduler()
+    scheduler.set_user("heavy", share=1)
+    scheduler.set_user("paying", share=2)
+    for i in range(300):
+        scheduler.submit(f"heavy-{i}", "heavy")
+        scheduler.submit(f"paying-{i}", "paying")
+    users = Counter(user for _, user in dispatch(scheduler, 90))
+    assert users == {"heavy": 30, "paying": 60}
+    # Each user's jobs in the order of their submission
+    assert [job_id for job_id, user in dispatch(scheduler, 6) if user == "heavy"] == \
+        ["heavy-30", "heavy-31"]
+
+
+def test_priority_classes():
+    scheduler = FairShareScheduler()
+    for i in range(5):
+        scheduler.submit(f"batch-{i}", "alice", priority=0)
+    scheduler.submit("urgent", "bob", priority=1)
+    assert scheduler.next_job() == ("urgent", "bob")
+    assert scheduler.next_job() == ("batch-0", "alice")
+
+
+def test_max_running_per_user():
+    scheduler = FairShareScheduler(max_running_per_user=2)
+    for i in range(5):
+        scheduler.submit(f"a-{i}", "alice")
+    scheduler.submit("b-0", "bob")
+    assert [job_id for job_id, _ in dispatch(scheduler, 5)] == ["a-0", "b-0", "a-1"]
+    # Alice runs her maximum, nobody else is waiting
+    assert scheduler.next_job() is None
+    scheduler.release("a-0")
+    assert scheduler.next_job() == ("a-2", "alice")
+    # The running jobs as found in the database replace the counted ones
+    scheduler.sync_running({"a-2": "alice"})
+    assert [job_id for job_id, _ in dispatch(scheduler, 5)] == ["a-3"]
+
+
+def test_remove():
+    scheduler = FairShareScheduler()
+    for i in range(3):
+        scheduler.submit(f"a-{i}", "alice")
+    assert scheduler.remove("a-0")
+    assert not scheduler.remove("a-0")
+    assert len(scheduler) == 2
+    assert [job_id for job_id, _ in dispatch(scheduler, 5)] == ["a-1", "a-2"]
+
+
+def test_virtual_time_and_idle_users():
+    scheduler = FairShareScheduler()
+    scheduler.submit("a-0", "alice", priority=0)
+    for i in range(3):
+        scheduler.submit(f"b-{i}", "bob", priority=1)
+    assert [job_id for job_id, _ in dispatch(scheduler, 4)] == ["b-0", "b-1", "b-2", "a-0"]
+    # Alice's flow was queued at the start, the virtual time does not go back for it
+    assert scheduler._virtual_time == 2
+    scheduler.submit("b-3", "bob", priority=1)
+    for job_id in ["b-0", "b-1", "b-2", "a-0"]:
+        scheduler.release(job_id)
+    # Idle users are forgotten, bob is kept while his job is queued
+    assert list(scheduler._users) == ["bob"]
+    scheduler.next_job()
+    scheduler.sync_running({})
+    assert not scheduler._users
+
+
+def simulate(trace: List[Tuple[int, str, int]], slots: int,
+             pick: Callable[[], Tuple[str, str]], submit: Callable[[str, str], None],
+             release: Callable[[str], None]) -> Dict[str, List[int]]:
+    """
+    Replay the submissions (time, user, duration) with `slots` running jobs at a time
+
+    Returns:
+        the waiting times of the jobs by user
+    """
+    pending = deque(sorted(trace))
+    submitted, durations, waits = {}, {}, {}
+    running: Dict[str, int] = {}
+    time = 0
+    while pending or submitted or running:
+        while pending and pending[0][0] <= time:
+            _, user, duration = pending.popleft()
+            job_id = f"{user}-{len(durations)}"
+            durations[job_id] = duration
+            submitted[job_id] = time, user
+            submit(job_id, user)
+        for job_id, ends in list(running.items()):
+            if ends <= time:
+                del running[job_id]
+                release(job_id)
+        while len(running) < slots:
+            next_job = pick()
+            if not next_job:
+                break
+            job_id, user = next_job
+            submit_time, _ = submitted.pop(job_id)
+            waits.setdefault(user, []).append(time - submit_time)
+            running[job_id] = time + durations[job_id]
+        time += 1
+    return waits
+
+
+def jain_index(values: List[float]) -> float:
+    return sum(values) ** 2 / (len(values) * sum(value ** 2 for value in values))
+
+
+def test_fair_share_simulation():
+    random = Random(4711)
+    # One user floods the queue at once, the others submit a few jobs over the day
+    trace = [(0, "flood", random.randint(5, 15)) for _ in range(5000)]
+    for user in [f"user{i}" for i in range(9)]:
+        trace += [(random.randint(0, 20000), user, random.randint(5, 15)) for _ in range(20)]
+    slots = 8
+
+    scheduler = FairShareScheduler()
+    fair_waits = simulate(trace, slots, scheduler.next_job,
+                          lambda job_id, user: scheduler.submit(job_id, user), scheduler.release)
+    fifo = deque()
+    fifo_waits = simulate(trace, slots, lambda: fifo.popleft() if fifo else None,
+                          lambda job_id, user: fifo.append((job_id, user)), lambda job_id: None)
+
+    light_users = [user for user in fair_waits if user != "flood"]
+    fair_light_wait = max(max(fair_waits[user]) for user in light_users)
+    fifo_light_wait = max(max(fifo_waits[user]) for user in light_users)
+    # Behind the flood with a FIFO, within one job duration (at most 15) with the fair share
+    assert fifo_light_wait > 5000
+    assert fair_light_wait <= 15
+    # The flood is not slowed down by more than the jobs of the others
+    assert max(fair_waits["flood"]) <= max(fifo_waits["flood"]) + 9 * 20 * 15 // slots
+
+
+def test_fair_share_simulation_weights():
+    # Backlogged users with different shares get turns in proportion to them
+    shares = {"a": 1, "b": 1, "c": 2, "d": 4}
+    scheduler = FairShareScheduler()
+    for user, share in shares.items():
+        scheduler.set_user(user, share=share)
+        for i in range(2000):
+            scheduler.submit(f"{user}-{i}", user)
+    started = Counter(user for _, user in dispatch(scheduler, 4000))
+    assert jain_index([started[user] / share for user, share in shares.items()]) > 0.999
+
+
+async def test_dispatch_workflow_jobs(monkeypatch, tmp_path):
+    wf_jobs = {}
+    for job_id, owner in [("a1", "alice"), ("a2", "alice"), ("a3", "alice"), ("b1", "bob"),
+                          ("c1", "carol")]:
+        wf_jobs[job_id] = SimpleNamespace(workflow_job_id=job_id, workflow_id="wf1",
+                                          workspace_id="ws1", job_path=str(tmp_path),
+                                          job_state="QUEUED", owner=owner, priority=0,
+                                          workflow_parameters=None, attempts=1, trace_offset=0)
+
+    async def get_queued_workflow_jobs(submitted_since=None):
+        return [wf_job for wf_job in wf_jobs.values() if wf_job.job_state == "QUEUED"]
+
+    async def get_users(emails):
+        if "bob" not in emails:
+            return []
+        return [SimpleNamespace(email="bob", share=1.0, max_running_jobs=0)]
+
+    async def get_running_workflow_job_owners():
+        return {wf_job.workflow_job_id: wf_job.owner for wf_job in wf_jobs.values()
+                if wf_job.job_state == "RUNNING"}
+
+    async def get_workflow_jobs(job_ids):
+        return [wf_jobs[job_id] for job_id in job_ids]
+
+    async def start_queued_workflow_job(job_id, process_group_id, host, started):
+        if wf_jobs[job_id].job_state != "QUEUED":
+            return False
+        wf_jobs[job_id].job_state = "RUNNING"
+        return True
+
+    async def get_workspace_mets_path(workspace_id):
+        return "/workspace/mets.xml"
+
+    async def stage(*args, **kwargs):
+        return "/workflow/nextflow.nf"
+    for function in [get_queued_workflow_jobs, get_users, get_running_workflow_job_owners,
+                     get_workflow_jobs, start_queued_workflow_job, get_workspace_mets_path]:
+        monkeypatch.setattr(db, function.__name__, function)
+    monkeypatch.setattr(NextflowManager, "execute_workflow", lambda **kwargs: 4242)
+
+    workflow_manager = WorkflowManager()
+    monkeypatch.setattr(workflow_manager, "stage_nf_script", stage)
+    monkeypatch.setattr(workflow_manager._workspace_manager, "stage_resource", stage)
+    workflow_manager.max_running = 3
+    # Every user gets a turn before alice gets a second one
+    assert sorted(await workflow_manager.dispatch_workflow_jobs()) == ["a1", "b1", "c1"]
+    assert await workflow_manager.dispatch_workflow_jobs() == []
+    wf_jobs["b1"].job_state = "SUCCESS"
+    # A cancelled job is not started, its slot goes to the next queued job
+    wf_jobs["a2"].job_state = "CANCELLED"
+    assert await workflow_manager.dispatch_workflow_jobs() == ["a3"]
@@ -0,0 +1,114 @@
+from os import urandom, utime
+from os.path import getmtime
+
+from pytest import raises
+
+from ocrd_webapi.managers.resource_manager import ResourceManager, _delete_tasks
+from ocrd_webapi.storage import LocalStorage, S3Storage, create_storage
+
+MIB = 1024 * 1024
+
+
+def make_tree(root):
+    (root / "OCR-D-IMG").mkdir(parents=True)
+    (root / "mets.xml").write_bytes(b"<mets/>")
+    (root / "OCR-D-IMG" / "page1.tif").write_bytes(urandom(12 * MIB))
+    (root / "OCR-D-IMG" / "page2.tif").write_bytes(urandom(1000))
+
+
+def test_s3_round_trip(s3_client, tmp_path):
+    storage = S3Storage(bucket="ocrd", prefix="/data/", client=s3_client, part_size=5 * MIB,
+                        transfers=4)
+    make_tree(tmp_path / "local")
+    assert storage.upload_dir(str(tmp_path / "local"), "workspace/ws1") == 3
+    # The 12 MiB page is uploaded in three parts
+    assert s3_client.calls.count("upload_part") == 3
+    assert ("ocrd", "data/workspace/ws1/OCR-D-IMG/page1.tif") in s3_client.objects
+    assert storage.has("workspace/ws1")
+    assert not storage.has("workspace/ws")
+    assert storage.list_children("workspace") == ["ws1"]
+
+    assert storage.download_dir("workspace/ws1", str(tmp_path / "staged")) == 3
+    for name in ["mets.xml", "OCR-D-IMG/page1.tif", "OCR-D-IMG/page2.tif"]:
+        assert (tmp_path / "staged" / name).read_bytes() == (tmp_path / "local" / name).read_bytes()
+    # The large page is downloaded with ranged requests
+    assert s3_client.calls.count("get_object") == 3 + 2
+
+
+def test_s3_upload_changes_only(s3_client, tmp_path):
+    storage = S3Storage(bucket="ocrd", client=s3_client)
+    local = tmp_path / "local"
+    make_tree(local)
+    storage.upload_dir(str(local), "workspace/ws1")
+    # Staged files are not newer than the stored ones, nothing is uploaded again
+    storage.download_dir("workspace/ws1", str(tmp_path / "staged"))
+    assert storage.upload_dir(str(tmp_path / "staged"), "workspace/ws1") == 0
+
+    (local / "mets.xml").write_bytes(b"<mets>changed</mets>")
+    utime(local / "mets.xml", (getmtime(local / "mets.xml") + 10,) * 2)
+    (local / "OCR-D-IMG" / "page2.tif").unlink()
+    assert storage.upload_dir(str(local), "workspace/ws1") == 1
+    assert ("ocrd", "workspace/ws1/OCR-D-IMG/page2.tif") not in s3_client.objects
+
+    storage.delete("workspace/ws1")
+    assert not s3_client.objects
+
+
+def test_s3_not_recursive(s3_client, tmp_path):
+    storage = S3Storage(bucket="ocrd", client=s3_client)
+    (tmp_path / "wf" / "job1").mkdir(parents=True)
+    (tmp_path / "wf" / "nextflow.nf").write_text("workflow {}")
+    (tmp_path / "wf" / "job1" / "report.html").write_text("report")
+    storage.upload_dir(str(tmp_path / "wf"), "workflow/wf", recursive=False)
+    assert list(s3_client.objects) == [("ocrd", "workflow/wf/nextflow.nf")]
+    storage.upload_dir(str(tmp_path / "wf" / "job1"), "workflow/wf/job1")
+    # The job dirs are kept when the files of the workflow are mirrored
+    (tmp_path / "wf" / "job1" / "report.html").unlink()
+    storage.upload_dir(str(tmp_path / "wf"), "workflow/wf", recursive=False)
+    assert ("ocrd", "workflow/wf/job1/report.html") in s3_client.objects
+    assert storage.download_dir("workflow/wf", str(tmp_path / "staged"), recursive=False) == 1
+
+
+def test_s3_upload_aborted(s3_client, tmp_path, monkeypatch):
+    storage = S3Storage(bucket="ocrd", client=s3_client)
+    make_tree(tmp_path / "local")
+
+    def failing_put_object(Bucket, Key, Body):
+        raise OSError("connection reset")
+    monkeypatch.setattr(s3_client, "put_object", failing_put_object)
+    with raises(OSError):
+        storage.upload_dir(str(tmp_path / "local"), "workspace/ws1")
+    # The multipart upload of the large page is not left open
+    assert "abort_multipart_upload" in s3_client.calls
+    assert not s3_client.uploads
+
+
+def test_create_storage(tmp_path):
+    assert isinstance(create_storage("", str(tmp_path)), LocalStorage)
+    assert create_storage("", str(tmp_path)) is create_storage("", str(tmp_path))
+
+
+async def test_resource_manager_stage_persist(s3_client, tmp_path):
+    storage = S3Storage(bucket="ocrd", client=s3_client)
+    first = ResourceManager(__name__, "workspace", resources_base=str(tmp_path / "node1"),
+                            storage=storage)
+    make_tree(tmp_path / "node1" / "workspace" / "ws1")
+    await first.persist_resource("ws1")
+
+    # Another node does not have the workspace cached, it is staged on demand
+    second = ResourceManager(__name__, "workspace", resources_base=str(tmp_path / "node2"),
+                             storage=storage)
+    assert await second.get_resource("ws1", local=True) is None
+    assert (await second.get_resource("ws1", local=False)).endswith("/workspace/ws1")
+    resources = await second.get_all_resources(local=False)
+    assert [resource_id for resource_id, _ in resources] == ["ws1"]
+    workspace_dir = await second.stage_resource("ws1")
+    assert workspace_dir == await second.get_resource("ws1", local=True)
+    assert (tmp_path / "node2" / "workspace" / "ws1" / "mets.xml").read_bytes() == b"<mets/>"
+    assert await second.stage_resource("ws2") is None
+
+    await second._delete_resource_dir("ws1")
+    # The stored tree is deleted in the background, the workspace is gone meanwhile
+    assert await second.get_resource("ws1", local=False) is None
+    await _delete_tasks["workspace/ws1"]
+    assert not storage.has("workspace/ws1")
@@ -0,0 +1,157 @@
+from asyncio import get_running_loop, sleep
+import json
+
+from fastapi import FastAPI, Request
+import httpx
+
+from ocrd_webapi.main import app as server
+from ocrd_webapi.tracing import (
+    REQUEST_ID_HEADER,
+    JsonlExporter,
+    OtlpExporter,
+    Tracer,
+    accept_request_id,
+    get_request_id,
+    in_context,
+    set_attributes,
+    span,
+    traced,
+)
+
+
+class ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+@traced
+def validate(path):
+    set_attributes(path=path)
+    return get_request_id()
+
+
+@traced(name="db.save")
+async def save():
+    await sleep(0)
+
+
+async def test_spans(tmp_path):
+    trace_file = str(tmp_path / "traces" / "spans.jsonl")
+    tracer = Tracer([JsonlExporter(trace_file)], sample_rate=1)
+    with tracer.trace("POST /workspace", "req-1") as root:
+        with span("manager.ingest", size=3):
+            # The context follows the call into the executor thread
+            request_id = await get_running_loop().run_in_executor(
+                None, in_context(validate, "ws.zip")
+            )
+            assert request_id == "req-1"
+            await save()
+        root.set_attribute("status_code", 201)
+    assert get_request_id() is None
+    tracer.close()
+
+    with open(trace_file) as fin:
+        spans = {span_dict["name"]: span_dict for span_dict in map(json.loads, fin)}
+    assert list(spans) == ["test_tracing.validate", "db.save", "manager.ingest", "POST /workspace"]
+    assert {span_dict["request_id"] for span_dict in spans.values()} == {"req-1"}
+    assert spans["POST /workspace"]["parent_id"] is None
+    assert spans["POST /workspace"]["attributes"] == {"status_code": 201}
+    assert spans["manager.ingest"]["parent_id"] == spans["POST /workspace"]["span_id"]
+    assert spans["db.save"]["parent_id"] == spans["manager.ingest"]["span_id"]
+    assert spans["test_tracing.validate"]["attributes"] == {"path": "ws.zip"}
+    assert spans["POST /workspace"]["duration"] >= spans["manager.ingest"]["duration"]
+
+
+async def test_span_error():
+    exporter = ListExporter()
+    tracer = Tracer([exporter], sample_rate=1)
+    try:
+        with tracer.trace("GET /"):
+            with span("stage"):
+                raise ValueError("broken")
+    except ValueError:
+        pass
+    tracer.close()
+    assert [span_dict["error"] for span_dict in exporter.spans] == ["ValueError: broken"] * 2
+
+
+async def test_sampling():
+    exporter = ListExporter()
+    tracer = Tracer([exporter], sample_rate=0, slow_threshold=0.05, max_spans=3)
+    with tracer.trace("fast"):
+        pass
+    # Slow requests are exported although they were not sampled
+    with tracer.trace("slow"):
+        for _ in range(5):
+            with span("stage"):
+                pass
+        await sleep(0.05)
+    tracer.close()
+    assert [span_dict["name"] for span_dict in exporter.spans] == ["stage", "stage", "slow"]
+    assert exporter.spans[-1]["attributes"] == {"dropped_spans": 3}
+
+
+async def test_disabled():
+    tracer = Tracer([])
+    with tracer.trace("GET /", "req-2") as root:
+        assert root is None
+        with span("stage") as current:
+            assert current is None
+        assert validate("ws.zip") == "req-2"
+    tracer.close()
+
+
+async def test_request_id_header():
+    exporter = ListExporter()
+    tracer = Tracer([exporter], sample_rate=1)
+    app = FastAPI()
+
+    @app.middleware("http")
+    async def trace_request(request: Request, call_next):
+        request_id = accept_request_id(request.headers.get(REQUEST_ID_HEADER))
+        with tracer.trace(request.url.path, request_id):
+            response = await call_next(request)
+        response.headers[REQUEST_ID_HEADER] = request_id
+        return response
+
+    @app.get("/")
+    async def index():
+        await save()
+        return {"request_id": get_request_id()}
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/", headers={REQUEST_ID_HEADER: "client-4711"})
+        assert response.headers[REQUEST_ID_HEADER] == "client-4711"
+        assert response.json() == {"request_id": "client-4711"}
+        # Not taken over
+        response = await client.get("/", headers={REQUEST_ID_HEADER: "bad id\twith spaces"})
+        assert len(response.headers[REQUEST_ID_HEADER]) == 32
+    tracer.close()
+    assert [span_dict["name"] for span_dict in exporter.spans] == ["db.save", "/"] * 2
+
+
+def test_otlp_payload():
+    spans = [{"request_id": "req-1", "trace_id": "a" * 32, "span_id": "b" * 16, "parent_id": None,
+              "name": "GET /", "start": 1.5, "duration": 0.25, "attributes": {"status_code": 200},
+              "error": None}]
+    payload = OtlpExporter("http://localhost:4318/").to_payload(spans)
+    otlp_span = payload["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+    assert otlp_span["startTimeUnixNano"] == "1500000000"
+    assert otlp_span["endTimeUnixNano"] == "1750000000"
+    assert "parentSpanId" not in otlp_span
+    assert otlp_span["attributes"] == [
+        {"key": "request_id", "value": {"stringValue": "req-1"}},
+        {"key": "status_code", "value": {"intValue": "200"}},
+    ]
+    assert OtlpExporter("http://localhost:4318/").url == "http://localhost:4318/v1/traces"
+
+
+async def test_server_request_id():
+    transport = httpx.ASGITransport(app=server)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/", headers={REQUEST_ID_HEADER: "client-4711"})
+    assert response.headers[REQUEST_ID_HEADER] == "client-4711"
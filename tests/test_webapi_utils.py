@@ -1,9 +1,27 @@
 import os
 import shutil
+from threading import Thread
+from types import SimpleNamespace
+import zipfile
 
+from ocrd_models import OcrdMets
+from pytest import raises
+
+from ocrd_webapi import utils
 from ocrd_webapi.utils import (
-    bagit_from_url
+    ProcessBudget,
+    bagit_from_url,
+    choose_compression,
+    digest_file,
+    download_workspace_from_url,
+    expand_page_ids,
+    extract_bag_dest,
+    extract_bag_info,
+    prune_mets,
+    split_page_ids,
+    validate_ocrd_zip,
 )
+from .utils_test import to_asset_path
 
 # Bigger mets file producing OCRD-ZIP that is bigger than 16MB (will be useful for DB tests)
 # has only the "DEFAULT" file group
@@ -50,3 +68,154 @@ def test_bagit_from_url_two_file_grps():
     assert os.path.exists(os.path.join(test_dest_ext, 'mets.xml'))
     assert os.path.exists(os.path.join(test_dest_ext, 'test789.zip'))
     shutil.rmtree(test_dest_ext)
+
+
+def test_expand_page_ids():
+    page_ids = expand_page_ids("PHYS_0001..PHYS_0003,PHYS_0007")
+    assert page_ids == ["PHYS_0001", "PHYS_0002", "PHYS_0003", "PHYS_0007"]
+    with raises(ValueError):
+        expand_page_ids("PHYS_1..PHYS_999999999")
+    with raises(ValueError):
+        expand_page_ids("PHYS_0001..PHYS_0003,PHYS_0007", max_pages=3)
+    with raises(ValueError):
+        expand_page_ids("PHYS_0001..OTHER_0003")
+
+
+def test_prune_mets():
+    mets = OcrdMets.empty_mets()
+    for file_grp in ["OCR-D-IMG", "OCR-D-OCR"]:
+        for page in range(1, 4):
+            mets.add_file(file_grp, ID=f"{file_grp}_{page}", pageId=f"PHYS_000{page}",
+                          mimetype="image/tiff", local_filename=f"{file_grp}/{page}.tif")
+    prune_mets(mets, file_grp=["OCR-D-OCR"], page_id=["PHYS_0001", "PHYS_0002"])
+    assert mets.file_groups == ["OCR-D-OCR"]
+    assert mets.physical_pages == ["PHYS_0001", "PHYS_0002"]
+    assert [f.ID for f in mets.find_files()] == ["OCR-D-OCR_1", "OCR-D-OCR_2"]
+
+
+def test_split_page_ids():
+    page_ids = [f"PHYS_000{page}" for page in range(1, 8)]
+    parts = split_page_ids(page_ids, 3)
+    assert [len(part) for part in parts] == [3, 2, 2]
+    assert sum(parts, []) == page_ids
+    # Never more shards than pages
+    assert len(split_page_ids(page_ids[:2], 4)) == 2
+
+
+def test_process_budget():
+    budget = ProcessBudget(4)
+    with budget.acquire(0) as granted1:
+        # A single validation leaves a share for the next one
+        assert granted1 == 2
+        with budget.acquire(0) as granted2:
+            assert granted2 == 1
+    with budget.acquire(3) as granted1:
+        with budget.acquire(0) as granted2:
+            assert (granted1, granted2) == (3, 1)
+            # Nothing left, a third validation has to wait for a release
+            results = []
+            waiting = Thread(target=lambda: results.append(budget.acquire(2).__enter__()))
+            waiting.start()
+            waiting.join(timeout=0.2)
+            assert waiting.is_alive()
+    waiting.join(timeout=1)
+    assert results == [2]
+
+
+def test_validate_ocrd_zip_memoized(monkeypatch):
+    zip_path = to_asset_path("example_ws.ocrd.zip")
+    utils.validation_cache.clear()
+    validate_ocrd_zip(zip_path, processes=1)
+    assert digest_file(zip_path) in utils.validation_cache
+
+    def fail_validation(*args, **kwargs):
+        raise AssertionError("an identical OCRD-ZIP should not be validated again")
+    monkeypatch.setattr(utils, "OcrdZipValidator", fail_validation)
+    validate_ocrd_zip(zip_path, processes=1)
+
+
+def test_download_workspace_from_url(remote_mets_url, tmp_path):
+    workspace_dir = str(tmp_path / "workspace")
+    bag_info = download_workspace_from_url(remote_mets_url, workspace_dir, file_grp=["OCR-D-IMG"],
+                                           ocrd_identifier="test-import", backoff=0)
+    assert bag_info["Ocrd-Identifier"] == "test-import"
+    mets = OcrdMets(filename=os.path.join(workspace_dir, "mets.xml"))
+    assert mets.file_groups == ["OCR-D-IMG"]
+    files = list(mets.find_files())
+    assert len(files) == 3
+    for ocrd_file in files:
+        # The failing image of the second page and the truncated one of the third are retried
+        assert os.path.getsize(os.path.join(workspace_dir, ocrd_file.local_filename)) == 5000
+
+
+def test_download_workspace_from_url_unsafe_names(http_server, tmp_path):
+    server_url, served_dir = http_server
+    mets = OcrdMets.empty_mets()
+    mets.add_file("OCR-D-IMG", ID="IMG_1", pageId="PHYS_0001", mimetype="image/tiff",
+                  url=f"{server_url}/img/img_1.tif")
+    # OcrdMets refuses to create such a file group, a forged METS is not that polite
+    with open(os.path.join(served_dir, "unsafe_mets.xml"), "wb") as fout:
+        fout.write(mets.to_xml().replace(b'USE="OCR-D-IMG"', b'USE="../OCR-D-IMG"'))
+    with raises(ValueError, match="file group or file id"):
+        download_workspace_from_url(f"{server_url}/unsafe_mets.xml", str(tmp_path / "workspace"),
+                                    backoff=0)
+
+
+def test_read_payload_oxum():
+    assert utils.read_payload_oxum({"Payload-Oxum": "12345.17"}) == (12345, 17)
+    assert utils.read_payload_oxum({"Payload-Oxum": "garbage"}) is None
+    assert utils.read_payload_oxum({}) is None
+
+
+def test_dir_usage(tmp_path):
+    (tmp_path / "OCR-D-IMG").mkdir()
+    (tmp_path / "OCR-D-IMG" / "page1.tif").write_bytes(b"x" * 1000)
+    (tmp_path / "mets.xml").write_bytes(b"x" * 234)
+    assert utils.dir_usage(str(tmp_path)) == (1234, 2)
+    assert utils.dir_usage(str(tmp_path / "not-existing")) == (0, 0)
+
+
+def test_percentile():
+    assert utils.percentile([], 50) is None
+    assert utils.percentile([3.0], 95) == 3.0
+    values = list(range(100, 0, -1))
+    assert utils.percentile(values, 50) == 50
+    assert utils.percentile(values, 95) == 95
+    assert utils.percentile(values, 100) == 100
+
+
+def test_choose_compression(tmp_path):
+    files = {
+        "page.jpg": b"x" * 1000,
+        "page.xml": os.urandom(1000),
+        "compressed.tif": os.urandom(100000),
+        "uncompressed.tif": bytes(range(256)) * 400,
+        "empty": b"",
+    }
+    for name, content in files.items():
+        (tmp_path / name).write_bytes(content)
+    compression = {name: choose_compression(str(tmp_path / name)) for name in files}
+    assert compression == {
+        "page.jpg": zipfile.ZIP_STORED,
+        "page.xml": zipfile.ZIP_DEFLATED,
+        "compressed.tif": zipfile.ZIP_STORED,
+        "uncompressed.tif": zipfile.ZIP_DEFLATED,
+        "empty": zipfile.ZIP_STORED,
+    }
+
+
+def test_extract_bag_dest(tmp_path):
+    workspace_dir = str(tmp_path / "workspace")
+    bag_info = extract_bag_info(to_asset_path("example_ws.ocrd.zip"), workspace_dir, processes=1)
+    workspace_db = SimpleNamespace(ocrd_mets=bag_info.get("Ocrd-Mets"),
+                                   ocrd_identifier=bag_info["Ocrd-Identifier"])
+    bag_dest = str(tmp_path / "export.ocrd.zip")
+    extract_bag_dest(workspace_db, workspace_dir, bag_dest)
+
+    utils.validation_cache.clear()
+    validate_ocrd_zip(bag_dest, processes=1)
+    with zipfile.ZipFile(bag_dest) as zip_file:
+        compression = {info.filename: info.compress_type for info in zip_file.infolist()}
+    assert compression["data/OCR-D-IMG/madeUpId-2.jpg"] == zipfile.ZIP_STORED
+    assert compression["data/mets.xml"] == zipfile.ZIP_DEFLATED
+    assert compression["bag-info.txt"] == zipfile.ZIP_DEFLATED
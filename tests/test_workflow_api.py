@@ -113,6 +113,39 @@ def test_run_workflow_different_mets(client, auth, dummy_workflow_id, asset_work
     #  the possibility to provide a different-mets-name to run the workflow has to be implemented
 
 
+def test_post_workflow_script_parameters(client, auth, workflow_mongo_coll, asset_workflow2):
+    response = client.post("/workflow", files=asset_workflow2, auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+    assert response.json()["workflow_parameters"]["input_group"] == "OCR-D-IMG"
+    assert response.json()["workflow_processes"] == ["ocrd_dummy"]
+    workflow_from_db = workflow_mongo_coll.find_one({"workflow_id": parse_resource_id(response)})
+    assert sorted(workflow_from_db["workflow_parameters"]) == ["input_group", "mets", "workspace"]
+
+
+def test_run_workflow_parameters(client, auth, dummy_workflow_id, dummy_workspace_id,
+                                 workflow_job_mongo_coll):
+    params = {"workspace_id": dummy_workspace_id,
+              "workflow_parameters": {"input_group": "OCR-D-IMG"}}
+    response = client.post(f"/workflow/{dummy_workflow_id}", json=params, auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+    workflow_job_from_db = workflow_job_mongo_coll.find_one(
+        {"workflow_job_id": parse_resource_id(response)}
+    )
+    assert workflow_job_from_db["workflow_parameters"] == {"input_group": "OCR-D-IMG"}
+
+
+def test_run_workflow_invalid_parameters(client, auth, dummy_workflow_id, dummy_workspace_id):
+    # Not declared by the script
+    params = {"workspace_id": dummy_workspace_id, "workflow_parameters": {"not_declared": "value"}}
+    response = client.post(f"/workflow/{dummy_workflow_id}", json=params, auth=auth)
+    assert response.status_code == 422
+    # Set by the server
+    params = {"workspace_id": dummy_workspace_id,
+              "workflow_parameters": {"mets": "/other/mets.xml"}}
+    response = client.post(f"/workflow/{dummy_workflow_id}", json=params, auth=auth)
+    assert response.status_code == 422
+
+
 # TODO: This should be better implemented...
 def test_workflow_job_status(client, auth, dummy_workflow_id, dummy_workspace_id):
     params = {"workspace_id": dummy_workspace_id}
@@ -136,6 +169,55 @@ def test_workflow_job_status(client, auth, dummy_workflow_id, dummy_workspace_id
     # TODO: Do database checks
 
 
+def test_resume_workflow_job(client, auth, dummy_workflow_id, dummy_workspace_id,
+                             workflow_job_mongo_coll):
+    params = {"workspace_id": dummy_workspace_id}
+    response = client.post(f"/workflow/{dummy_workflow_id}", json=params, auth=auth)
+    job_id = parse_resource_id(response)
+    for x in range(0, 100):
+        response = client.get(f"workflow/{dummy_workflow_id}/{job_id}")
+        if parse_job_state(response) in ['STOPPED', 'SUCCESS']:
+            break
+        sleep(3)
+
+    response = client.post(f"/workflow/{dummy_workflow_id}/{job_id}/resume", auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+    assert parse_resource_id(response) == job_id
+    assert response.json()["attempts"] == 2
+
+    # The attempt is recorded on the same job, all tasks of the first attempt are cached
+    for x in range(0, 100):
+        response = client.get(f"workflow/{dummy_workflow_id}/{job_id}")
+        if parse_job_state(response) in ['STOPPED', 'SUCCESS']:
+            break
+        sleep(3)
+    assert response.json()["cached_tasks"] > 0
+    workflow_job_from_db = workflow_job_mongo_coll.find_one({"workflow_job_id": job_id})
+    assert workflow_job_from_db["attempts"] == 2
+
+
+def test_cancel_workflow_job(client, auth, dummy_workflow_id, dummy_workspace_id,
+                             workflow_job_mongo_coll):
+    params = {"workspace_id": dummy_workspace_id}
+    response = client.post(f"/workflow/{dummy_workflow_id}", json=params, auth=auth)
+    job_id = parse_resource_id(response)
+
+    response = client.delete(f"/workflow/{dummy_workflow_id}/{job_id}", auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+    assert parse_job_state(response) == "CANCELLED"
+    workflow_job_from_db = workflow_job_mongo_coll.find_one({"workflow_job_id": job_id})
+    assert workflow_job_from_db["job_state"] == "CANCELLED"
+
+    # Only queued or running jobs can be cancelled
+    response = client.delete(f"/workflow/{dummy_workflow_id}/{job_id}", auth=auth)
+    assert response.status_code == 409
+
+
+def test_resume_workflow_job_non_existing(client, auth, dummy_workflow_id):
+    response = client.post(f"/workflow/{dummy_workflow_id}/non-existing-job/resume", auth=auth)
+    assert response.status_code == 404
+
+
 # TODO: Implement the test once there is an
 # delete workflow script source code implemented
 # delete workflow is not in the WebAPI specification
@@ -1,4 +1,7 @@
+from io import BytesIO
 from os.path import join
+from time import sleep
+from zipfile import ZipFile
 
 from .asserts_test import (
     assert_db_entry_created,
@@ -8,7 +11,7 @@ from .asserts_test import (
     assert_not_workspace_dir
 )
 from .constants import WORKSPACES_DIR
-from .utils_test import parse_resource_id
+from .utils_test import parse_job_state, parse_resource_id
 
 
 def test_post_workspace_unauthorized(client, asset_workspace1):
@@ -100,6 +103,51 @@ def test_delete_workspace(client, auth, workspace_mongo_coll, asset_workspace1):
     assert_db_entry_deleted(workspace_from_db)
 
 
+def test_workspace_usage(client, auth, workspace_mongo_coll, asset_workspace1):
+    used_before = client.get("/user/usage", auth=auth).json()
+    response = client.post("/workspace", files=asset_workspace1, auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+    workspace_id = parse_resource_id(response)
+
+    workspace_from_db = workspace_mongo_coll.find_one({"workspace_id": workspace_id})
+    assert workspace_from_db["owner"] == auth[0]
+    assert workspace_from_db["size"] > 0 and workspace_from_db["files"] > 0
+    used = client.get("/user/usage", auth=auth).json()
+    assert used["used_bytes"] == used_before["used_bytes"] + workspace_from_db["size"]
+    assert used["used_files"] == used_before["used_files"] + workspace_from_db["files"]
+
+    # Deleting gives the storage back
+    client.delete(f"/workspace/{workspace_id}", auth=auth)
+    used = client.get("/user/usage", auth=auth).json()
+    assert used["used_bytes"] == used_before["used_bytes"]
+    assert used["used_files"] == used_before["used_files"]
+
+
+def test_workspace_quota(client, auth, user_mongo_coll, asset_workspace1):
+    used_bytes = client.get("/user/usage", auth=auth).json()["used_bytes"]
+    user_mongo_coll.update_one({"email": auth[0]}, {"$set": {"quota_bytes": used_bytes + 10}})
+    try:
+        response = client.post("/workspace", files=asset_workspace1, auth=auth)
+        assert response.status_code == 413, "expecting the upload to be rejected"
+        assert client.get("/user/usage", auth=auth).json()["quota_bytes"] == used_bytes + 10
+        response = client.post("/workspace/upload", params={"upload_length": 1000}, auth=auth)
+        assert response.status_code == 413, "expecting the announced upload to be rejected"
+        response = client.post("/workspace/upload", auth=auth)
+        assert response.status_code == 422, "expecting an upload without length to be rejected"
+        # Chunks count together with the bytes staged already
+        response = client.post("/workspace/upload", params={"upload_length": 8}, auth=auth)
+        upload_id = parse_resource_id(response)
+        response = client.patch(f"/workspace/upload/{upload_id}", content=b"x" * 6,
+                                headers={"Upload-Offset": "0"}, auth=auth)
+        assert_status_code(response.status_code, expected_floor=2)
+        user_mongo_coll.update_one({"email": auth[0]}, {"$set": {"quota_bytes": used_bytes + 7}})
+        response = client.patch(f"/workspace/upload/{upload_id}", content=b"x" * 2,
+                                headers={"Upload-Offset": "6"}, auth=auth)
+        assert response.status_code == 413, "expecting the chunk over quota to be rejected"
+    finally:
+        user_mongo_coll.update_one({"email": auth[0]}, {"$unset": {"quota_bytes": ""}})
+
+
 def test_delete_workspace_non_existing(client, auth, workspace_mongo_coll, asset_workspace1):
     response = client.post("/workspace", files=asset_workspace1, auth=auth)
     workspace_id = parse_resource_id(response)
@@ -119,8 +167,135 @@ def test_get_workspace(client, auth, asset_workspace3):
         "content-type should be something with 'zip'"
 
 
+def test_get_workspace_filtered(client, auth, asset_workspace1):
+    response = client.post("/workspace", files=asset_workspace1, auth=auth)
+    workspace_id = parse_resource_id(response)
+    headers = {"accept": "application/vnd.ocrd+zip"}
+
+    params = {"file_grp": "OCR-D-IMG"}
+    response = client.get(f"/workspace/{workspace_id}", headers=headers, params=params)
+    assert_status_code(response.status_code, expected_floor=2)
+    names = ZipFile(BytesIO(response.content)).namelist()
+    assert any(name.startswith("data/OCR-D-IMG/") for name in names), \
+        "files of the requested file group should be in the bag"
+
+    params = {"file_grp": "OCR-D-NON-EXISTING"}
+    response = client.get(f"/workspace/{workspace_id}", headers=headers, params=params)
+    assert_status_code(response.status_code, expected_floor=2)
+    names = ZipFile(BytesIO(response.content)).namelist()
+    assert "data/mets.xml" in names, "the pruned mets should be in the bag"
+    assert not any(name.startswith("data/OCR-D-IMG/") for name in names), \
+        "files of not requested file groups should not be in the bag"
+
+    # The stored workspace must not be changed by a filtered export
+    with open(join(WORKSPACES_DIR, workspace_id, "mets.xml")) as fin:
+        assert "OCR-D-IMG" in fin.read(), "the stored mets should not be pruned"
+
+
+def test_get_workspace_filtered_invalid_page_range(client, auth, asset_workspace1):
+    response = client.post("/workspace", files=asset_workspace1, auth=auth)
+    workspace_id = parse_resource_id(response)
+    headers = {"accept": "application/vnd.ocrd+zip"}
+    params = {"page_id": "PHYS_0001..PAGE_0005"}
+    response = client.get(f"/workspace/{workspace_id}", headers=headers, params=params)
+    assert response.status_code == 422, "expect 422 error code for an invalid page range"
+
+
 def test_get_workspace_non_existing(client):
     headers = {"accept": "application/vnd.ocrd+zip"}
     response = client.get(f"/workspace/non-existing-workspace-id", headers=headers)
     assert response.status_code == 404, \
         "expect 404 error code for non existing workspace"
+
+
+def test_resumable_workspace_upload(client, auth, workspace_mongo_coll, asset_workspace1):
+    content = asset_workspace1["workspace"].read()
+    response = client.post("/workspace/upload", params={"upload_length": len(content)}, auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+    upload_id = parse_resource_id(response)
+    assert upload_id
+
+    half = len(content) // 2
+    response = client.patch(f"/workspace/upload/{upload_id}", content=content[:half],
+                            headers={"Upload-Offset": "0"}, auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+    assert response.headers["Upload-Offset"] == str(half)
+
+    # A chunk not starting at the current offset is refused
+    response = client.patch(f"/workspace/upload/{upload_id}", content=content[half:],
+                            headers={"Upload-Offset": "0"}, auth=auth)
+    assert response.status_code == 409, "expect 409 error code for a wrong upload offset"
+
+    # Resume from the offset reported by the server
+    response = client.get(f"/workspace/upload/{upload_id}", auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+    offset = response.json()["upload_offset"]
+    assert offset == half
+    response = client.patch(f"/workspace/upload/{upload_id}", content=content[offset:],
+                            headers={"Upload-Offset": str(offset)}, auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+
+    response = client.post(f"/workspace/upload/{upload_id}/finalize", auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+    workspace_id = parse_resource_id(response)
+    assert_workspace_dir(workspace_id)
+    resource_from_db = workspace_mongo_coll.find_one(
+        {"workspace_id": workspace_id}
+    )
+    assert_db_entry_created(resource_from_db, workspace_id, db_key="workspace_id")
+
+    # The session is gone after finalization
+    response = client.get(f"/workspace/upload/{upload_id}", auth=auth)
+    assert response.status_code == 404, "expect 404 error code for a finalized upload"
+    response = client.patch(f"/workspace/upload/{upload_id}", content=content,
+                            headers={"Upload-Offset": "0"}, auth=auth)
+    assert response.status_code == 404, "expect 404 error code for a late chunk"
+
+
+def test_failed_upload_keeps_workspace(client, auth, dummy_workspace_id):
+    content = b"not an ocrd-zip"
+    params = {"upload_length": len(content), "workspace_id": dummy_workspace_id}
+    response = client.post("/workspace/upload", params=params, auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+    upload_id = parse_resource_id(response)
+    response = client.patch(f"/workspace/upload/{upload_id}", content=content,
+                            headers={"Upload-Offset": "0"}, auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+
+    # The session is not disclosed to other users
+    response = client.get(f"/workspace/upload/{upload_id}", auth=("other@example.org", "password"))
+    assert_status_code(response.status_code, expected_floor=4)
+
+    response = client.post(f"/workspace/upload/{upload_id}/finalize", auth=auth)
+    assert_status_code(response.status_code, expected_floor=4)
+    # The workspace to replace is untouched and the session is kept
+    assert_workspace_dir(dummy_workspace_id)
+    response = client.get(f"/workspace/{dummy_workspace_id}",
+                          headers={"accept": "application/json"})
+    assert_status_code(response.status_code, expected_floor=2)
+    response = client.get(f"/workspace/upload/{upload_id}", auth=auth)
+    assert response.json()["upload_offset"] == len(content)
+
+
+def test_import_workspace(client, auth, workspace_mongo_coll, remote_mets_url):
+    params = {"mets_url": remote_mets_url, "file_grp": ["OCR-D-IMG"]}
+    response = client.post("/workspace/import", json=params, auth=auth)
+    assert_status_code(response.status_code, expected_floor=2)
+    import_id = parse_resource_id(response)
+
+    job_state = None
+    for _ in range(0, 50):
+        response = client.get(f"/workspace/import/{import_id}")
+        assert_status_code(response.status_code, expected_floor=2)
+        job_state = parse_job_state(response)
+        if job_state in ["SUCCESS", "FAILED"]:
+            break
+        sleep(0.2)
+    assert job_state == "SUCCESS", f"expecting the import to succeed, but it is {job_state}"
+
+    workspace_id = response.json()["workspace_rsrc"]["resource_id"]
+    assert_workspace_dir(workspace_id)
+    resource_from_db = workspace_mongo_coll.find_one(
+        {"workspace_id": workspace_id}
+    )
+    assert_db_entry_created(resource_from_db, workspace_id, db_key="workspace_id")